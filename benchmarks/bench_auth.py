@@ -0,0 +1,82 @@
+"""
+Benchmark authenticating requests by their JWT cookie.
+
+Seeds a temporary SQLite database with a user and a doc, then times
+JWTCookieAuthentication alone (a fresh request each time, so including
+the query for whether the user exists), and a title-only PUT
+/store/docs/:pk (as an autosave), with each token verified afresh (the
+cache cleared before every request) and with verified tokens kept in the
+cache.
+
+Usage: python benchmarks/bench_auth.py [requests]
+"""
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def main(requests=5000):
+    os.environ["DATABASE_URL"] = "sqlite:///" + os.path.join(tempfile.mkdtemp(), "bench_auth.sqlite3")
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'conduit_backend.settings')
+
+    import django
+    django.setup()
+
+    from django.conf import settings
+    from django.core.management import call_command
+    from django.http.cookie import SimpleCookie
+    from django.test import Client, RequestFactory
+    from django.urls import reverse
+    from rest_framework.request import Request
+
+    from user_accounts import authentication
+    from user_accounts.models import User, EditorFile
+
+    call_command("migrate", verbosity=0)
+    settings.ALLOWED_HOSTS.append("testserver")
+    settings.DEBUG = False
+
+    user = User.objects.create_user(username="bench", password="bench")
+    doc = EditorFile.objects.create(author=user, title="Doc", body=[{"text": "Body"}])
+    token = authentication.generate_jwt_token("bench")
+
+    factory = RequestFactory()
+    factory.cookies["jwt"] = token
+    backend = authentication.JWTCookieAuthentication()
+
+    client = Client()
+    client.cookies = SimpleCookie({"jwt": token})
+    url = reverse("edit-doc", kwargs={"pk": doc.pk})
+
+    def autosave():
+        response = client.put(url, {"doc": {"title": "Doc"}}, content_type="application/json")
+        assert response.status_code == 200, response.status_code
+
+    def run(call, count, cached):
+        authentication.tokens.clear()
+        call()
+        times = []
+
+        for _ in range(count):
+            if not cached:
+                authentication.tokens.clear()
+
+            start = time.perf_counter()
+            call()
+            times.append(time.perf_counter() - start)
+
+        return sum(times) / len(times) * 1e6
+
+    print("Mean µs per request\n")
+    print(f"  {'':20} {'verified':>10} {'cached':>10}")
+
+    for label, call, count in [("authenticate", lambda: backend.authenticate(Request(factory.get("/"))), requests), ("autosave PUT", autosave, requests // 5)]:
+        verified, cached = run(call, count, False), run(call, count, True)
+        print(f"  {label:20} {verified:10.1f} {cached:10.1f}")
+
+
+if __name__ == "__main__":
+    main(*(int(arg) for arg in sys.argv[1:2]))
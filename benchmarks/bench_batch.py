@@ -0,0 +1,89 @@
+"""
+Benchmark importing and updating docs one request at a time against
+POST /store/docs/batch.
+
+Seeds a temporary SQLite database with a user, then imports docs with
+one POST /store/docs each and with batches, and saves a paragraph of
+each with one PUT each and with batches, counting queries and timing
+each way.
+
+Usage: python benchmarks/bench_batch.py [docs] [blocks_per_doc] [batch_size]
+"""
+import json
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def main(docs=1000, blocks_per_doc=20, batch_size=1000):
+    os.environ["DATABASE_URL"] = "sqlite:///" + os.path.join(tempfile.mkdtemp(), "bench_batch.sqlite3")
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'conduit_backend.settings')
+
+    import django
+    django.setup()
+
+    from django.conf import settings
+    from django.core.management import call_command
+    from django.db import connection
+    from django.http.cookie import SimpleCookie
+    from django.test import Client
+    from django.urls import reverse
+
+    from user_accounts.models import User, EditorFile
+    from user_accounts.views import generate_jwt_token
+
+    call_command("migrate", verbosity=0)
+    settings.ALLOWED_HOSTS.append("testserver")
+
+    User.objects.create_user(username="bench", password="bench")
+
+    client = Client()
+    client.cookies = SimpleCookie({"jwt": generate_jwt_token("bench")})
+
+    def body(i, word="Paragraph"):
+        return [{"type": "paragraph", "text": f"{word} {j} of doc {i}."} for j in range(blocks_per_doc)]
+
+    def run(label, requests):
+        queries = []
+
+        def count(execute, sql, params, many, context):
+            queries.append(sql)
+            return execute(sql, params, many, context)
+
+        with connection.execute_wrapper(count):
+            start = time.perf_counter()
+
+            for path, data in requests:
+                response = client.generic(*path, data=json.dumps(data), content_type="application/json")
+                assert response.status_code in (200, 201), response.status_code
+
+            elapsed = time.perf_counter() - start
+
+        print(f"  {label:22} {len(queries):7} {elapsed:8.2f}s")
+
+    def batches(ops):
+        return [(("POST", reverse("batch-docs")), {"ops": ops[i:i + batch_size]}) for i in range(0, len(ops), batch_size)]
+
+    print(f"{docs} docs of {blocks_per_doc} blocks, batches of {batch_size}\n")
+    print(f"  {'':22} {'queries':>7} {'time':>9}")
+
+    run("create, one at a time", [(("POST", reverse("create-view-docs")), {"doc": {"title": f"Doc {i}", "body": body(i)}}) for i in range(docs)])
+    run("create, batched", batches([{"op": "create", "doc": {"title": f"Doc {i}", "body": body(i)}} for i in range(docs)]))
+
+    files = list(EditorFile.objects.order_by("created").values_list("pk", "version"))
+    singles, batched = files[:docs], files[docs:]
+
+    def edited(i):
+        edited_body = body(i)
+        edited_body[0] = {"type": "paragraph", "text": "Edited."}
+        return edited_body
+
+    run("update, one at a time", [(("PUT", reverse("edit-doc", kwargs={"pk": pk})), {"doc": {"body": edited(i), "version": version}}) for i, (pk, version) in enumerate(singles)])
+    run("update, batched", batches([{"op": "update", "uid": str(pk), "doc": {"body": edited(i), "version": version}} for i, (pk, version) in enumerate(batched)]))
+
+
+if __name__ == "__main__":
+    main(*(int(arg) for arg in sys.argv[1:4]))
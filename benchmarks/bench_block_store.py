@@ -0,0 +1,158 @@
+"""
+Benchmark the content-addressed block store on a duplicated corpus.
+
+Builds corpora the way users do: documents, then copies of them with a
+few paragraphs edited, and a few edits saved to each copy with PUT (the
+whole body). One corpus is of short documents (3-40 paragraphs, as
+notes and letters from a template), the other of long ones (300-1000
+paragraphs). Each is stored twice in temporary SQLite databases: with
+bodies stored whole (compressed where large), and with bodies stored in
+chunks of blocks, each distinct block stored once per user (by default,
+every body). Reports the size of the tables, and the time and bytes of
+SQL per save.
+
+Usage: python benchmarks/bench_block_store.py [docs] [copies] [edits]
+"""
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+TABLES = ('user_accounts_editorfile', 'user_accounts_editorfilechunk', 'user_accounts_editorblock')
+
+
+def sizes(cursor):
+    """
+    Bytes used by each table, with its indexes.
+    """
+    cursor.execute("VACUUM")
+    cursor.execute(f"""
+        SELECT tbl_name, SUM(pgsize) FROM dbstat JOIN sqlite_schema USING (name)
+        WHERE tbl_name IN ({', '.join('%s' for _ in TABLES)})
+        GROUP BY tbl_name
+    """, TABLES)
+    return dict(cursor.fetchall())
+
+
+def paragraph(rng, words):
+    return {"type": "paragraph", "text": " ".join(rng.choices(words, k=rng.randint(20, 60))).capitalize() + "."}
+
+
+def build_corpus(rng, words, docs, copies, lengths, changed):
+    """
+    docs originals of lengths paragraphs, each followed by copies of it
+    with changed paragraphs replaced.
+    """
+    corpus = []
+
+    for _ in range(docs):
+        body = [paragraph(rng, words) for _ in range(rng.randint(*lengths))]
+        corpus.append(body)
+
+        for _ in range(copies):
+            copy = list(body)
+            for _ in range(changed):
+                copy[rng.randrange(len(copy))] = paragraph(rng, words)
+            corpus.append(copy)
+
+    return corpus
+
+
+def main(docs=20, copies=5, edits=10):
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'conduit_backend.settings')
+
+    import django
+    from django.conf import settings as django_settings
+
+    rng = random.Random(0)
+    words = ["".join(rng.choices("etaoinshrdlcumwfgypbvk", k=rng.randint(2, 9))) for _ in range(3000)]
+
+    corpora = {
+        # Many more short docs, as users have.
+        "Short": build_corpus(rng, words, docs * 20, copies, (3, 40), 1),
+        "Long": build_corpus(rng, words, docs, copies, (300, 1000), 3),
+    }
+
+    database = os.path.join(tempfile.mkdtemp(), "bench_block_store.sqlite3")
+    os.environ["DATABASE_URL"] = "sqlite:///" + database
+    django.setup()
+
+    django_settings.ALLOWED_HOSTS.append("testserver")
+    threshold = django_settings.DOC_CHUNK_THRESHOLD
+
+    for name, corpus in corpora.items():
+        print(f"\n{name}: {len(corpus)} docs ({len(corpus) // (copies + 1)} originals, {copies} copies of each), {sum(map(len, corpus))} blocks, {edits} saves of each")
+        results = {}
+
+        for label, chunk_threshold in (("Whole", None), ("Block store", threshold)):
+            django_settings.DOC_CHUNK_THRESHOLD = chunk_threshold
+            results[label] = store(corpus, edits, words)
+
+        print(f"\n  {'':12} {'docs':>9} {'chunks':>9} {'blocks':>9} {'total':>9}   {'per save':>20}")
+
+        for label, (table_sizes, save_time, save_bytes) in results.items():
+            sizes_kib = [table_sizes.get(table, 0) / 1024 for table in TABLES]
+            print(
+                f"  {label:12} " + " ".join(f"{size:7.0f}Ki" for size in sizes_kib) + f" {sum(sizes_kib):7.0f}Ki"
+                f"   {save_time * 1000:6.1f} ms {save_bytes / 1024:7.1f} KiB"
+            )
+
+    django_settings.DOC_CHUNK_THRESHOLD = threshold
+
+
+def store(corpus, edits, words):
+    """
+    Store the corpus afresh, then save edits to each doc. Returns the
+    sizes of the tables, and the time and bytes of SQL per save.
+    """
+    from django.core.management import call_command
+    from django.db import connection
+    from django.http.cookie import SimpleCookie
+    from django.test import Client
+    from django.test.utils import CaptureQueriesContext
+    from django.urls import reverse
+
+    from user_accounts.models import User, EditorFile
+    from user_accounts.views import generate_jwt_token
+
+    call_command("flush", interactive=False, verbosity=0)
+    call_command("migrate", verbosity=0)
+
+    User.objects.create_user(username="bench", password="bench")
+    client = Client()
+    client.cookies = SimpleCookie({"jwt": generate_jwt_token("bench")})
+
+    for i, body in enumerate(corpus):
+        client.post(reverse("create-view-docs"), {"doc": {"title": f"Doc {i}", "body": body}}, content_type="application/json")
+
+    saves = 0
+    written = 0
+    start = time.perf_counter()
+
+    edit_rng = random.Random(1)
+
+    for doc, body in zip(EditorFile.objects.order_by("created"), corpus):
+        url = reverse("edit-doc", kwargs={"pk": doc.pk})
+        body = list(body)
+
+        for _ in range(edits):
+            body[edit_rng.randrange(len(body))] = paragraph(edit_rng, words)
+
+            with CaptureQueriesContext(connection) as queries:
+                response = client.put(url, {"doc": {"body": body}}, content_type="application/json")
+
+            assert response.status_code == 200, response.status_code
+            written += sum(len(query["sql"]) for query in queries if query["sql"].startswith(("UPDATE", "INSERT")))
+            saves += 1
+
+    elapsed = time.perf_counter() - start
+    call_command("collect_blocks", stdout=open(os.devnull, "w"))
+
+    return sizes(connection.cursor()), elapsed / saves, written / saves
+
+
+if __name__ == "__main__":
+    main(*(int(arg) for arg in sys.argv[1:4]))
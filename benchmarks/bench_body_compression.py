@@ -0,0 +1,157 @@
+"""
+Benchmark compressed storage of EditorFile bodies.
+
+1. Per body size: bytes of JSON and of compressed JSON, and the CPU time
+   to encode and decode each (json.dumps/loads alone as the baseline).
+2. A temporary SQLite database of docs of mixed sizes, stored
+   uncompressed and then after compress_doc_bodies: the size of the
+   table, and the time to load and save a doc through the ORM.
+
+Bodies are paragraphs of words drawn from a skewed vocabulary, which
+compresses roughly like prose (unlike repeated lorem ipsum, which
+compresses far better than anything real).
+
+Usage: python benchmarks/bench_body_compression.py [docs] [repeat]
+"""
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+SIZES = (1024, 4 * 1024, 8 * 1024, 32 * 1024, 128 * 1024)
+
+
+def make_body(size, rng, vocabulary):
+    """
+    A list of paragraph blocks of about `size` bytes of JSON.
+    """
+    body = []
+    length = 2
+
+    while length < size:
+        text = " ".join(rng.choices(vocabulary, cum_weights=WEIGHTS, k=rng.randint(20, 80))).capitalize() + "."
+        block = {"type": "paragraph", "text": text}
+        body.append(block)
+        length += len(json.dumps(block)) + 2
+
+    return body
+
+
+def make_vocabulary(rng, words=5000):
+    letters = "etaoinshrdlcumwfgypbvkjxqz"
+    return ["".join(rng.choices(letters, k=rng.randint(2, 10))) for _ in range(words)]
+
+
+# Zipf-like word frequencies.
+WEIGHTS = []
+for rank in range(1, 5001):
+    WEIGHTS.append((WEIGHTS[-1] if WEIGHTS else 0) + 1 / rank)
+
+
+def time_call(function, arg, repeat):
+    """
+    Mean microseconds per call.
+    """
+    start = time.perf_counter()
+    for _ in range(repeat):
+        function(arg)
+    return (time.perf_counter() - start) / repeat * 1e6
+
+
+def table_size(cursor):
+    cursor.execute("VACUUM")
+    cursor.execute("SELECT SUM(pgsize) FROM dbstat WHERE name = 'user_accounts_editorfile'")
+    return cursor.fetchone()[0]
+
+
+def main(docs=2000, repeat=200):
+    os.environ["DATABASE_URL"] = "sqlite:///" + os.path.join(tempfile.mkdtemp(), "bench_body_compression.sqlite3")
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'conduit_backend.settings')
+
+    import django
+    django.setup()
+
+    from django.conf import settings
+    from django.core.management import call_command
+    from django.db import connection
+
+    from user_accounts import documents
+    from user_accounts.models import User, EditorFile
+
+    rng = random.Random(0)
+    vocabulary = make_vocabulary(rng)
+
+    print(f"Per body (zlib level {documents.COMPRESSION_LEVEL}, {repeat} repeats):")
+    print(f"  {'JSON':>9} {'zlib':>9} {'ratio':>6}   {'dumps':>9} {'encode':>9}   {'loads':>9} {'decode':>9}")
+
+    for size in SIZES:
+        body = make_body(size, rng, vocabulary)
+        data = json.dumps(body)
+        _, compressed = documents.encode_body(body, threshold=0)
+
+        dumps = time_call(json.dumps, body, repeat)
+        encode = time_call(lambda body: documents.encode_body(body, threshold=0), body, repeat)
+        loads = time_call(json.loads, data, repeat)
+        decode = time_call(documents.decode_body, compressed, repeat)
+
+        print(
+            f"  {len(data):9} {len(compressed):9} {len(data) / len(compressed):6.1f}"
+            f"   {dumps:7.0f}us {encode:7.0f}us   {loads:7.0f}us {decode:7.0f}us"
+        )
+
+    call_command("migrate", verbosity=0)
+
+    threshold = settings.DOC_BODY_COMPRESSION_THRESHOLD
+    settings.DOC_BODY_COMPRESSION_THRESHOLD = None
+
+    user = User.objects.create_user(username="bench", password="bench")
+
+    # Mostly short docs, with a long tail.
+    EditorFile.objects.bulk_create(
+        EditorFile(author=user, title=f"Document {i}", body=body, **documents.summarize(body))
+        for i, body in enumerate(make_body(int(rng.lognormvariate(8.5, 1.2)), rng, vocabulary) for _ in range(docs))
+    )
+
+    uids = list(EditorFile.objects.values_list("uid", flat=True))
+    large = list(EditorFile.objects.filter(body_size__gt=threshold).values_list("uid", flat=True))
+
+    def measure(label):
+        cursor = connection.cursor()
+        size = table_size(cursor)
+
+        picks = [rng.choice(large) for _ in range(repeat)]
+
+        start = time.perf_counter()
+        loaded = [EditorFile.objects.get(pk=uid) for uid in picks]
+        read = (time.perf_counter() - start) / repeat * 1e6
+
+        start = time.perf_counter()
+        for doc in loaded:
+            doc.save()
+        write = (time.perf_counter() - start) / repeat * 1e6
+
+        print(f"  {label:14} {size / 1024:9.0f} KiB   {read:7.0f}us {write:7.0f}us")
+
+    print(f"\n{docs} docs, {len(large)} over the {threshold} byte threshold:")
+    print(f"  {'':14} {'table':>13}   {'load':>9} {'save':>9}  (docs over the threshold)")
+
+    measure("Uncompressed")
+
+    settings.DOC_BODY_COMPRESSION_THRESHOLD = threshold
+
+    start = time.perf_counter()
+    call_command("compress_doc_bodies", stdout=open(os.devnull, "w"))
+    print(f"  (compress_doc_bodies took {time.perf_counter() - start:.1f}s)")
+
+    measure("Compressed")
+
+    assert EditorFile.objects.filter(body__isnull=True).count() == len(large)
+    assert len(uids) == docs
+
+
+if __name__ == "__main__":
+    main(*(int(arg) for arg in sys.argv[1:3]))
@@ -0,0 +1,105 @@
+"""
+Benchmark chunked storage of large docs.
+
+For docs of increasing numbers of blocks, stored whole and stored in
+chunks, measures through the views:
+
+1. Saving an edit to one block with PATCH /store/docs/:pk: time, and
+   bytes of SQL sent to the database (which grows with the body when
+   it's rewritten whole).
+2. Reading 50 blocks with GET /store/docs/:pk?blocks=a-b, against
+   reading the whole doc.
+
+Uses a temporary SQLite database.
+
+Usage: python benchmarks/bench_doc_chunks.py [repeat]
+"""
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+BLOCKS = (500, 2000, 8000, 32000)
+
+
+def main(repeat=50):
+    os.environ["DATABASE_URL"] = "sqlite:///" + os.path.join(tempfile.mkdtemp(), "bench_doc_chunks.sqlite3")
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'conduit_backend.settings')
+
+    import django
+    django.setup()
+
+    from django.conf import settings
+    from django.core.management import call_command
+    from django.db import connection
+    from django.http.cookie import SimpleCookie
+    from django.test import Client
+    from django.test.utils import CaptureQueriesContext
+    from django.urls import reverse
+
+    from user_accounts.models import User, EditorFile
+    from user_accounts.views import generate_jwt_token
+
+    call_command("migrate", verbosity=0)
+    settings.ALLOWED_HOSTS.append("testserver")
+
+    User.objects.create_user(username="bench", password="bench")
+    user = User.objects.get(username="bench")
+
+    client = Client()
+    client.cookies = SimpleCookie({"jwt": generate_jwt_token("bench")})
+
+    def measure(doc, count):
+        url = reverse("edit-doc", kwargs={"pk": doc.pk})
+        written = 0
+
+        start = time.perf_counter()
+        for i in range(repeat):
+            ops = [{"op": "replace", "index": (i * 7919) % count, "block": {"type": "paragraph", "text": f"Edit {i}"}}]
+
+            with CaptureQueriesContext(connection) as queries:
+                response = client.patch(url, {"doc": {"ops": ops, "version": doc.version + i}}, content_type="application/json")
+
+            assert response.status_code == 200, response.status_code
+            written += sum(len(query["sql"]) for query in queries if query["sql"].startswith(("UPDATE", "INSERT")))
+        save = (time.perf_counter() - start) / repeat
+
+        start = time.perf_counter()
+        for i in range(repeat):
+            first = (i * 7919) % (count - 50)
+            client.get(url, {"blocks": f"{first}-{first + 49}"})
+        read_range = (time.perf_counter() - start) / repeat
+
+        start = time.perf_counter()
+        for i in range(repeat):
+            client.get(url)
+        read_all = (time.perf_counter() - start) / repeat
+
+        return save, written / repeat, read_range, read_all
+
+    threshold = settings.DOC_CHUNK_THRESHOLD
+
+    print(f"Per request, mean of {repeat}:")
+    print(f"  {'blocks':>7} {'storage':>8}   {'edit one block':>23}   {'read 50 blocks':>14} {'read all':>9}")
+
+    for count in BLOCKS:
+        body = [{"type": "paragraph", "text": f"Paragraph {i} of a long document, of about the usual length."} for i in range(count)]
+
+        for label, chunked in (("whole", None), ("chunked", threshold)):
+            settings.DOC_CHUNK_THRESHOLD = chunked
+            doc = EditorFile.objects.create(author=user, title="Bench", body=body)
+            assert doc.chunked == (chunked is not None)
+
+            save, written, read_range, read_all = measure(doc, count)
+            print(
+                f"  {count:7} {label:>8}   {save * 1000:7.2f} ms {written / 1024:9.1f} KiB"
+                f"   {read_range * 1000:11.2f} ms {read_all * 1000:6.2f} ms"
+            )
+
+    settings.DOC_CHUNK_THRESHOLD = threshold
+
+
+if __name__ == "__main__":
+    main(*(int(arg) for arg in sys.argv[1:2]))
@@ -0,0 +1,140 @@
+"""
+Benchmark saving a doc with PUT /store/docs/:pk.
+
+1. Queries and time per save: the view as it was (read the doc twice,
+   then save the instance) against the versioned single-UPDATE save.
+2. Concurrent saves: several "tabs" repeatedly read a doc, append a line
+   to its body and save it. With versions, conflicting saves are retried
+   and nothing is lost; without, tabs silently overwrite each other.
+
+Uses a temporary SQLite database.
+
+Usage: python benchmarks/bench_doc_saves.py [saves] [tabs] [edits_per_tab]
+"""
+import logging
+import os
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def main(saves=500, tabs=4, edits_per_tab=25):
+    os.environ["DATABASE_URL"] = "sqlite:///" + os.path.join(tempfile.mkdtemp(), "bench_doc_saves.sqlite3")
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'conduit_backend.settings')
+
+    import django
+    django.setup()
+
+    from django.conf import settings
+    from django.core.management import call_command
+    from django.db import connection
+    from django.http.cookie import SimpleCookie
+    from django.test import Client
+    from django.test.utils import CaptureQueriesContext
+    from django.urls import reverse
+
+    from user_accounts.models import User, EditorFile
+    from user_accounts.serializers import FilePatchSerializer
+    from user_accounts.views import generate_jwt_token, get_user_from_jwt
+
+    call_command("migrate", verbosity=0)
+    settings.ALLOWED_HOSTS.append("testserver")
+
+    # Conflicts are expected; don't log each one.
+    logging.getLogger("django.request").setLevel(logging.ERROR)
+
+    user = User.objects.create_user(username="bench", password="bench")
+    doc = EditorFile.objects.create(author=user, title="Bench", body=[])
+    url = reverse("edit-doc", kwargs={"pk": doc.pk})
+
+    client = Client()
+    client.cookies = SimpleCookie({"jwt": generate_jwt_token("bench")})
+
+    def old_save(request, data):
+        # DocRetrieveUpdateDestroyView.put before versioning.
+        get_user_from_jwt(request)
+        instance = EditorFile.objects.get(pk=doc.pk)
+        serializer = FilePatchSerializer(instance, data=data, partial=True)
+        serializer.is_valid(raise_exception=True)
+        EditorFile.objects.get(pk=doc.pk)
+        serializer.save()
+
+    def new_save(data):
+        version = EditorFile.objects.filter(pk=doc.pk).values_list("version", flat=True).get()
+        with CaptureQueriesContext(connection) as queries:
+            client.put(url, {"doc": {**data, "version": version}}, content_type="application/json")
+        return len(queries)
+
+    request = client.get(url).wsgi_request
+
+    with CaptureQueriesContext(connection) as queries:
+        old_save(request, {"title": "Old"})
+    old_queries = len(queries)
+
+    start = time.perf_counter()
+    for i in range(saves):
+        old_save(request, {"body": [i]})
+    old_time = (time.perf_counter() - start) / saves
+
+    new_queries = new_save({"title": "New"})
+
+    start = time.perf_counter()
+    for i in range(saves):
+        client.put(url, {"doc": {"body": [i]}}, content_type="application/json")
+    new_time = (time.perf_counter() - start) / saves
+
+    print(f"Per save ({saves} saves):")
+    print(f"  Before: {old_queries} queries, {old_time * 1000:.2f} ms (without request handling)")
+    print(f"  After:  {new_queries} queries, {new_time * 1000:.2f} ms (through the view)")
+
+    def run_tabs(versioned):
+        EditorFile.objects.filter(pk=doc.pk).update(body=[], version=1)
+        conflicts = []
+
+        def tab(name):
+            tab_client = Client()
+            tab_client.cookies = client.cookies
+
+            for edit in range(edits_per_tab):
+                while True:
+                    current = tab_client.get(url).json()["doc"]
+                    data = {"body": current["body"] + [f"{name}.{edit}"]}
+
+                    if versioned:
+                        data["version"] = current["version"]
+
+                    response = tab_client.put(url, {"doc": data}, content_type="application/json")
+
+                    if response.status_code != 409:
+                        assert response.status_code == 200, response.status_code
+                        break
+
+                    conflicts.append(name)
+
+            connection.close()
+
+        threads = [threading.Thread(target=tab, args=(f"tab{i}",)) for i in range(tabs)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        doc.refresh_from_db()
+        return len(doc.body), len(conflicts)
+
+    edits = tabs * edits_per_tab
+    print(f"\n{tabs} tabs making {edits_per_tab} edits each ({edits} edits):")
+
+    kept, conflicts = run_tabs(versioned=False)
+    print(f"  Unversioned: {kept} edits kept, {edits - kept} silently lost")
+
+    kept, conflicts = run_tabs(versioned=True)
+    print(f"  Versioned:   {kept} edits kept, {edits - kept} lost, {conflicts} conflicts retried")
+    assert kept == edits
+
+
+if __name__ == "__main__":
+    main(*(int(arg) for arg in sys.argv[1:4]))
@@ -0,0 +1,59 @@
+"""
+Benchmark the cost of getting a Tiktoken encoding on each /generate/text request.
+
+Compares the old per-request tiktoken.encoding_for_model() call in
+GenerateTextView.__init__ with the process-wide registry in
+user_accounts.encodings.
+
+Usage: python benchmarks/bench_encodings.py [requests]
+"""
+import os
+import sys
+import time
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import django
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'conduit_backend.settings')
+django.setup()
+
+import tiktoken
+from tiktoken import registry
+
+from user_accounts import encodings
+from user_accounts.views import GenerateTextView
+
+MODEL = "gpt-3.5-turbo"
+
+
+def cold_load():
+    """
+    Time a cold load, as paid by the first request on a fresh worker.
+    """
+    registry.ENCODINGS.clear()
+    encodings.clear_encodings()
+    encodings.use_vendored_encodings()
+
+    start = time.perf_counter()
+    tiktoken.encoding_for_model(MODEL)
+    return time.perf_counter() - start
+
+
+def main(requests=10000):
+    print(f"Cold encoding load: {cold_load() * 1000:.1f} ms")
+
+    encodings.warm_up([MODEL])
+
+    old = timeit.timeit(lambda: tiktoken.encoding_for_model(MODEL), number=requests)
+    new = timeit.timeit(lambda: encodings.get_encoding(MODEL), number=requests)
+    view = timeit.timeit(GenerateTextView, number=requests)
+
+    print(f"Per-request encoding_for_model(): {old / requests * 1e6:.2f} us")
+    print(f"Per-request registry lookup:      {new / requests * 1e6:.2f} us")
+    print(f"Per-request GenerateTextView():   {view / requests * 1e6:.2f} us")
+
+
+if __name__ == "__main__":
+    main(*(int(arg) for arg in sys.argv[1:]))
@@ -0,0 +1,118 @@
+"""
+Benchmark GET /store/docs/export and POST /store/docs/import for growing
+libraries.
+
+Seeds a temporary SQLite database with a user's docs, then measures the
+peak memory (with tracemalloc) and time of listing them all at once with
+GET /store/docs, of streaming the export, through the view and through
+Django's ASGI handler (as the server in the Procfile runs it), and of
+importing the export back. The import's body is built before measuring,
+so only the memory the view itself needs is counted.
+
+Usage: python benchmarks/bench_export.py [max_docs] [blocks_per_doc]
+"""
+import asyncio
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def main(max_docs=8000, blocks_per_doc=20):
+    os.environ["DATABASE_URL"] = "sqlite:///" + os.path.join(tempfile.mkdtemp(), "bench_export.sqlite3")
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'conduit_backend.settings')
+
+    import django
+    django.setup()
+
+    from django.conf import settings
+    from django.core.handlers.asgi import ASGIHandler
+    from django.core.management import call_command
+    from django.test import RequestFactory
+    from django.urls import reverse
+
+    from user_accounts.models import User, EditorFile
+    from user_accounts.views import generate_jwt_token, DocsCreateRetrieveView, DocsExportView, DocsImportView
+
+    call_command("migrate", verbosity=0)
+    settings.ALLOWED_HOSTS.append("testserver")
+
+    # Otherwise every query's SQL, bodies and all, is kept in connection.queries.
+    settings.DEBUG = False
+
+    user = User.objects.create_user(username="bench", password="bench")
+    token = generate_jwt_token("bench")
+    factory = RequestFactory()
+    factory.cookies["jwt"] = token
+    handler = ASGIHandler()
+
+    def measure(call):
+        tracemalloc.start()
+        start = time.perf_counter()
+        size = call()
+        elapsed = time.perf_counter() - start
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        return f"{peak / 2**20:7.1f} MB {elapsed:6.2f}s", size
+
+    def list_all():
+        response = DocsCreateRetrieveView.as_view()(factory.get(reverse("create-view-docs")))
+        response.render()
+        return len(response.content)
+
+    def export():
+        response = DocsExportView.as_view()(factory.get(reverse("export-docs")))
+        return sum(len(chunk) for chunk in response.streaming_content)
+
+    def export_asgi():
+        scope = {
+            "type": "http", "asgi": {"version": "3.0"}, "http_version": "1.1", "scheme": "http",
+            "method": "GET", "path": reverse("export-docs"), "root_path": "", "query_string": b"",
+            "headers": [(b"cookie", f"jwt={token}".encode())], "server": ("testserver", 80), "client": ("127.0.0.1", 50000),
+        }
+        messages = [{"type": "http.request", "body": b"", "more_body": False}]
+        sizes = []
+
+        async def receive():
+            if messages:
+                return messages.pop()
+
+            await asyncio.Event().wait()
+
+        async def send(message):
+            sizes.append(len(message.get("body", b"")))
+
+        asyncio.run(handler(scope, receive, send))
+        return sum(sizes)
+
+    print(f"Docs of {blocks_per_doc} blocks\n")
+    print(f"  {'docs':>6} {'GET /store/docs':>18} {'export':>18} {'export (ASGI)':>18} {'import':>18} {'export size':>12}")
+
+    docs = 0
+
+    for target in [max_docs // 8, max_docs // 4, max_docs // 2, max_docs]:
+        EditorFile.objects.create_many(user.pk, [
+            {"title": f"Doc {i}", "body": [{"type": "paragraph", "text": f"Paragraph {j} of doc {i}, " * 4} for j in range(blocks_per_doc)]}
+            for i in range(docs, target)
+        ])
+        docs = target
+
+        listed, _ = measure(list_all)
+        exported, size = measure(export)
+        exported_asgi, _ = measure(export_asgi)
+
+        payload = b"".join(DocsExportView.as_view()(factory.get(reverse("export-docs"))).streaming_content)
+        request = factory.post(reverse("import-docs"), payload, content_type="application/x-ndjson")
+        imported, _ = measure(lambda: DocsImportView.as_view()(request).data["created"])
+
+        # Back to the docs exported.
+        EditorFile.objects.filter(pk__in=list(EditorFile.objects.filter(author=user).order_by("-created").values_list("pk", flat=True)[:docs])).delete()
+
+        print(f"  {docs:6} {listed:>18} {exported:>18} {exported_asgi:>18} {imported:>18} {size / 2**20:9.1f} MB")
+
+
+if __name__ == "__main__":
+    main(*(int(arg) for arg in sys.argv[1:3]))
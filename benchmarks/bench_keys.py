@@ -0,0 +1,125 @@
+"""
+Benchmark EditorFile keys before and after the migration to an integer
+author foreign key and native UUID primary keys (migrations 0017-0019).
+
+Seeds a temporary SQLite database at migration 0016 (usernames as
+authors, stringified UUIDs as keys), measures the size of the table and
+its indexes and the latency of the hot lookups, runs the migrations
+(timing the batched backfill) and measures again.
+
+Usage: python benchmarks/bench_keys.py [users] [files_per_user] [lookups]
+"""
+import os
+import random
+import sys
+import tempfile
+import time
+import uuid
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+BEFORE = ('user_accounts', '0016_hot_lookup_indexes')
+AFTER = ('user_accounts', '0019_uuid_keys')
+
+
+def sizes(cursor):
+    """
+    Bytes used by the EditorFile table and each of its indexes.
+    """
+    cursor.execute("""
+        SELECT name, SUM(pgsize) FROM dbstat
+        WHERE name = 'user_accounts_editorfile'
+           OR name IN (SELECT name FROM sqlite_schema WHERE type = 'index' AND tbl_name = 'user_accounts_editorfile')
+        GROUP BY name ORDER BY name
+    """)
+    return cursor.fetchall()
+
+
+def time_queries(cursor, sql, params, repeat):
+    """
+    Mean seconds per query, over `repeat` random parameters.
+    """
+    choices = [random.choice(params) for _ in range(repeat)]
+
+    start = time.perf_counter()
+    for param in choices:
+        cursor.execute(sql, param)
+        cursor.fetchall()
+
+    return (time.perf_counter() - start) / repeat
+
+
+def report(label, cursor, by_uid, by_author, uids, authors, lookups):
+    print(f"\n{label}")
+
+    for name, size in sizes(cursor):
+        print(f"  {name:45} {size / 1024:10.0f} KiB")
+
+    print(f"  {'lookup by uid':45} {time_queries(cursor, by_uid, uids, lookups) * 1e6:10.1f} us")
+    print(f"  {'newest 20 files of an author':45} {time_queries(cursor, by_author, authors, lookups) * 1e6:10.1f} us")
+
+
+def main(users=1000, files_per_user=100, lookups=20000):
+    os.environ["DATABASE_URL"] = "sqlite:///" + os.path.join(tempfile.mkdtemp(), "bench_keys.sqlite3")
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'conduit_backend.settings')
+
+    import django
+    django.setup()
+
+    from django.core.management import call_command
+    from django.db import connection
+    from django.db.migrations.executor import MigrationExecutor
+
+    call_command("migrate", *BEFORE, verbosity=0)
+
+    # The models as they were at 0016.
+    state = MigrationExecutor(connection).loader.project_state(BEFORE)
+    User = state.apps.get_model('user_accounts', 'User')
+    EditorFile = state.apps.get_model('user_accounts', 'EditorFile')
+
+    User.objects.bulk_create(User(username=f'user_{i}', password='') for i in range(users))
+
+    for i in range(users):
+        EditorFile.objects.bulk_create(
+            EditorFile(uid=str(uuid.uuid4()), author=f'user_{i}', title=f'Document {j}', body=[{"text": "Lorem ipsum"}])
+            for j in range(files_per_user)
+        )
+
+    cursor = connection.cursor()
+    cursor.execute("VACUUM")
+    cursor.execute("ANALYZE")
+
+    uids = [(uid,) for uid in EditorFile.objects.values_list('uid', flat=True)]
+    authors = [(f'user_{i}',) for i in range(users)]
+
+    print(f"{users} users, {users * files_per_user} files, {lookups} lookups")
+
+    report(
+        "Before: username authors, string keys", cursor,
+        "SELECT uid, title, author FROM user_accounts_editorfile WHERE uid = %s",
+        "SELECT uid, title FROM user_accounts_editorfile WHERE author = %s ORDER BY created DESC, uid DESC LIMIT 20",
+        uids, authors, lookups,
+    )
+
+    start = time.perf_counter()
+    call_command("migrate", *AFTER, verbosity=0)
+    print(f"\nMigrated in {time.perf_counter() - start:.1f}s")
+
+    cursor = connection.cursor()
+    cursor.execute("VACUUM")
+    cursor.execute("ANALYZE")
+
+    # UUIDs are stored as 32 hex digits without a native UUID type.
+    uids = [(uuid.UUID(uid).hex,) for uid, in uids]
+    authors = list(connection.cursor().execute("SELECT id FROM user_accounts_user").fetchall())
+
+    report(
+        "After: integer author foreign key, UUID keys", cursor,
+        "SELECT uid, title, author_id FROM user_accounts_editorfile WHERE uid = %s",
+        "SELECT uid, title FROM user_accounts_editorfile WHERE author_id = %s ORDER BY created DESC, uid DESC LIMIT 20",
+        uids, authors, lookups,
+    )
+
+
+if __name__ == "__main__":
+    main(*(int(arg) for arg in sys.argv[1:4]))
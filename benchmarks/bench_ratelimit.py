@@ -0,0 +1,112 @@
+"""
+Benchmark rate and concurrency limit decisions.
+
+Times each backend's decisions alone: taking a token (allowed, from a
+bucket with plenty), being refused one (from an empty bucket), and taking
+and releasing a slot (two decisions), from one thread, from several at
+once sharing the backend (as a worker's request threads do), and, for
+SQLiteBackend, from as many processes sharing its file (as workers do).
+The file is in a temporary directory. Reports the mean and 99th
+percentile.
+
+Usage: python benchmarks/bench_ratelimit.py [decisions] [threads]
+"""
+import multiprocessing
+import os
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def main(decisions=20000, threads=8):
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'conduit_backend.settings')
+
+    import django
+    django.setup()
+
+    from user_accounts import ratelimit
+
+    path = os.path.join(tempfile.mkdtemp(), "bench_ratelimit.sqlite3")
+    backends = [("memory", ratelimit.MemoryBackend), ("sqlite", lambda: ratelimit.SQLiteBackend(path))]
+
+    def allowed(backend, key):
+        assert backend.take(key, 1e9, 1e9, time.time()) == 0
+
+    def refused(backend, key):
+        assert backend.take(key + ":empty", 1e-9, 1, time.time()) > 0
+
+    def slot(backend, key):
+        lease = backend.acquire(key, 1, 60, time.time())
+        assert lease is not None
+        backend.release(key, lease)
+
+    def run(backend, decide, count, key):
+        # Empties the bucket refused() uses, and opens the connection.
+        backend.take(key + ":empty", 1e-9, 1, time.time())
+        times = []
+
+        for _ in range(count):
+            start = time.perf_counter()
+            decide(backend, key)
+            times.append(time.perf_counter() - start)
+
+        return times
+
+    def run_threads(backend, decide):
+        results = [None] * threads
+        workers = [
+            threading.Thread(target=lambda i=i: results.__setitem__(i, run(backend, decide, decisions // threads, f"client{i}")))
+            for i in range(threads)
+        ]
+
+        for worker in workers:
+            worker.start()
+
+        for worker in workers:
+            worker.join()
+
+        return [t for times in results for t in times]
+
+    def run_processes(new_backend, decide):
+        context = multiprocessing.get_context("fork")
+        results = context.Queue()
+        workers = [
+            context.Process(target=lambda i=i: results.put(run(new_backend(), decide, decisions // threads, f"client{i}")))
+            for i in range(threads)
+        ]
+
+        for worker in workers:
+            worker.start()
+
+        times = [t for _ in workers for t in results.get()]
+
+        for worker in workers:
+            worker.join()
+
+        return times
+
+    def summary(times):
+        if times is None:
+            return f"{'-':>8} {'-':>9}"
+
+        times.sort()
+        return f"{sum(times) / len(times) * 1e6:8.1f} {times[int(len(times) * 0.99)] * 1e6:9.1f}"
+
+    print(f"µs per decision, {decisions} decisions\n")
+    print(f"  {'':26} {'1 thread':>18} {f'{threads} threads':>18} {f'{threads} processes':>18}")
+    print(f"  {'':26}" + f" {'mean':>8} {'p99':>9}" * 3)
+
+    for name, new_backend in backends:
+        backend = new_backend()
+
+        for label, decide in [("take, allowed", allowed), ("take, refused", refused), ("acquire + release", slot)]:
+            processes = run_processes(new_backend, decide) if name == "sqlite" else None
+            columns = [run(backend, decide, decisions, "client"), run_threads(backend, decide), processes]
+            print(f"  {f'{name}: {label}':26} {' '.join(summary(times) for times in columns)}")
+
+
+if __name__ == "__main__":
+    main(*(int(arg) for arg in sys.argv[1:3]))
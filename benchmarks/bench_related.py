@@ -0,0 +1,149 @@
+"""
+Benchmark GET /store/docs/:pk/related for a user with many docs.
+
+Seeds a temporary SQLite database with one user's docs, of words drawn
+from a Zipf-like vocabulary, as bench_search.py, with some from one of
+TOPICS smaller vocabularies, so docs on a topic are related. Embeds them with the
+embed_docs command, then times requests for related docs: with the
+user's index kept from the last request, built afresh (as after a
+restart), and a save of a doc with a paragraph rewritten (which embeds
+its one changed block) and a request after it. Last, compares brute-force search of
+the vectors with the LSH tables (see vectors.py), for time, recall of
+the exact top 10, and the share of results on the doc's topic.
+
+Usage: python benchmarks/bench_related.py [docs] [words_per_doc] [requests]
+"""
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+TOPICS = 300
+
+# Share of each doc's words from its topic's vocabulary.
+TOPIC_SHARE = 0.3
+
+
+def main(docs=20000, words_per_doc=300, requests=50):
+    os.environ["DATABASE_URL"] = "sqlite:///" + os.path.join(tempfile.mkdtemp(), "bench_related.sqlite3")
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'conduit_backend.settings')
+
+    import django
+    django.setup()
+
+    import numpy as np
+    from django.conf import settings
+    from django.core.management import call_command
+    from django.db import connection
+    from django.http.cookie import SimpleCookie
+    from django.test import Client
+    from django.urls import reverse
+
+    from user_accounts import documents, embeddings, vectors
+    from user_accounts.models import User, EditorFile, EditorFileVector
+    from user_accounts.views import generate_jwt_token
+
+    call_command("migrate", verbosity=0)
+    settings.ALLOWED_HOSTS.append("testserver")
+
+    rng = random.Random(0)
+    vocabulary = ["".join(rng.choices("etaoinshrdlcumwfgypbvk", k=rng.randint(3, 9))) for _ in range(20000)]
+    weights = [1 / (rank + 1) for rank in range(len(vocabulary))]
+
+    topic_words = [rng.sample(vocabulary[200:], 60) for _ in range(TOPICS)]
+
+    user = User.objects.create_user(username="bench", password="bench")
+
+    def body(topic):
+        words = [rng.choice(topic_words[topic]) if rng.random() < TOPIC_SHARE else word for word in rng.choices(vocabulary, weights, k=words_per_doc)]
+        return [{"type": "paragraph", "text": " ".join(words[i:i + 50])} for i in range(0, len(words), 50)]
+
+    topics = {}
+
+    for start in range(0, docs, 1000):
+        batch = []
+
+        for i in range(start, min(docs, start + 1000)):
+            topic = rng.randrange(TOPICS)
+            doc_body = body(topic)
+            batch.append(EditorFile(author=user, title=" ".join(rng.choices(vocabulary, weights, k=3)), body=doc_body, **documents.summarize(doc_body)))
+            topics[batch[-1].pk] = topic
+
+        EditorFile.objects.bulk_create(batch)
+
+    start = time.perf_counter()
+    call_command("embed_docs", stdout=open(os.devnull, "w"))
+    print(f"{docs} docs of {words_per_doc} words, embedded in {time.perf_counter() - start:.1f}s")
+
+    cursor = connection.cursor()
+    cursor.execute("VACUUM")
+    cursor.execute("ANALYZE")
+
+    client = Client()
+    client.cookies = SimpleCookie({"jwt": generate_jwt_token("bench")})
+    pks = list(EditorFile.objects.values_list("pk", flat=True))
+
+    def related(pk):
+        start = time.perf_counter()
+        response = client.get(reverse("related-docs", kwargs={"pk": pk}))
+        elapsed = time.perf_counter() - start
+
+        assert response.status_code == 200, response.status_code
+        return elapsed
+
+    def report(label, times):
+        print(f"  {label:16} {sum(times) / len(times) * 1000:6.1f} ms {max(times) * 1000:6.1f} ms")
+
+    print(f"\n  {'':16} {'mean':>9} {'worst':>9}")
+
+    related(pks[0])
+    report("kept index", [related(rng.choice(pks)) for _ in range(requests)])
+
+    def cold():
+        vectors.indexes.clear()
+        return related(rng.choice(pks))
+
+    report("new index", [cold() for _ in range(min(requests, 10))])
+
+    doc = EditorFile.objects.order_by("?").first()
+    doc_body = doc.body
+
+    def save_and_relate():
+        # An autosave: one paragraph rewritten.
+        doc_body[rng.randrange(len(doc_body))] = body(topics[doc.pk])[0]
+        start = time.perf_counter()
+        client.put(reverse("edit-doc", kwargs={"pk": doc.pk}), {"doc": {"body": doc_body}}, content_type="application/json")
+        return time.perf_counter() - start, related(doc.pk)
+
+    saves, after_save = zip(*(save_and_relate() for _ in range(requests)))
+    report("save", saves)
+    report("after a save", after_save)
+
+    rows = list(EditorFileVector.objects.values_list("pk", "vector"))
+    keys, matrix = [pk for pk, vector in rows], embeddings.unpack(b"".join(vector for pk, vector in rows))
+    brute = vectors.VectorIndex(keys, matrix)
+    brute.tables = None
+
+    threshold = vectors.LSH_THRESHOLD
+    vectors.LSH_THRESHOLD = 0
+    lsh = vectors.VectorIndex(keys, matrix)
+    vectors.LSH_THRESHOLD = threshold
+
+    sample = rng.sample(keys, requests)
+    exact = [{key for key, score in brute.nearest(brute.get(pk), 10, exclude=[pk])} for pk in sample]
+    print(f"\n  {len(keys)} vectors, top 10   {'mean':>9}  recall  on topic")
+
+    for label, index in [("brute force", brute), ("LSH", lsh)]:
+        start = time.perf_counter()
+        found = [{key for key, score in index.nearest(brute.get(pk), 10, exclude=[pk])} for pk in sample]
+        elapsed = (time.perf_counter() - start) / len(sample)
+        recall = np.mean([len(a & b) / len(b) for a, b in zip(found, exact)])
+        on_topic = np.mean([np.mean([topics[key] == topics[pk] for key in keys_found]) for pk, keys_found in zip(sample, found)])
+        print(f"  {label:16} {elapsed * 1000:6.2f} ms  {recall:6.2f}  {on_topic:8.2f}")
+
+
+if __name__ == "__main__":
+    main(*(int(arg) for arg in sys.argv[1:4]))
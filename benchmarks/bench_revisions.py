@@ -0,0 +1,145 @@
+"""
+Benchmark doc revision history: storage per revision and the time to
+read an old revision, for several snapshot intervals.
+
+Autosaves edits to a few docs the way the editor does: mostly PATCHes of
+a paragraph or two, and every few saves a PUT of the whole body. Each
+run records the same saves in a temporary SQLite database with a given
+snapshot interval (1 stores every revision whole, as a plain version
+table would). Reports the bytes of the revision table per revision, and
+the mean and worst time to read a revision with body_at. Then prunes the
+history as if it were old, with the prune_revisions command.
+
+Usage: python benchmarks/bench_revisions.py [docs] [saves] [paragraphs]
+"""
+import datetime
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+INTERVALS = (1, 5, 20, 50)
+
+
+def table_size(cursor, table):
+    """
+    Bytes used by a table, with its indexes.
+    """
+    cursor.execute("VACUUM")
+    cursor.execute("SELECT SUM(pgsize) FROM dbstat JOIN sqlite_schema USING (name) WHERE tbl_name = %s", [table])
+    return cursor.fetchone()[0] or 0
+
+
+def paragraph(rng, words):
+    return {"type": "paragraph", "text": " ".join(rng.choices(words, k=rng.randint(20, 60))).capitalize() + "."}
+
+
+def main(docs=5, saves=200, paragraphs=150):
+    os.environ["DATABASE_URL"] = "sqlite:///" + os.path.join(tempfile.mkdtemp(), "bench_revisions.sqlite3")
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'conduit_backend.settings')
+
+    import django
+    django.setup()
+
+    from django.conf import settings
+    from django.core.management import call_command
+    from django.db import connection
+    from django.http.cookie import SimpleCookie
+    from django.test import Client
+    from django.urls import reverse
+    from django.utils import timezone
+
+    from user_accounts import documents, revisions
+    from user_accounts.models import User, EditorFile, EditorFileRevision
+    from user_accounts.patching import apply_block_ops
+    from user_accounts.views import generate_jwt_token
+
+    settings.ALLOWED_HOSTS.append("testserver")
+
+    rng = random.Random(0)
+    words = ["".join(rng.choices("etaoinshrdlcumwfgypbvk", k=rng.randint(2, 9))) for _ in range(3000)]
+    originals = [[paragraph(rng, words) for _ in range(paragraphs)] for _ in range(docs)]
+
+    print(f"{docs} docs of {paragraphs} paragraphs, {saves} saves of each")
+    print(f"\n  {'interval':>8} {'per revision':>13} {'full copy':>10} {'read mean':>10} {'read worst':>11}")
+
+    for interval in INTERVALS:
+        revisions.SNAPSHOT_INTERVAL = interval
+
+        call_command("flush", interactive=False, verbosity=0)
+        call_command("migrate", verbosity=0)
+
+        user = User.objects.create_user(username="bench", password="bench")
+        client = Client()
+        client.cookies = SimpleCookie({"jwt": generate_jwt_token("bench")})
+
+        edit_rng = random.Random(1)
+        bodies = {}
+        full_copies = 0
+
+        for i, body in enumerate(originals):
+            doc = EditorFile.objects.create(author=user, title=f"Doc {i}", body=body)
+            url = reverse("edit-doc", kwargs={"pk": doc.pk})
+            bodies[doc.pk, 1] = body
+            full_copies += len(documents.compress_body(body))
+
+            for version in range(1, saves + 1):
+                if version % 5:
+                    ops = [{"op": "replace", "index": edit_rng.randrange(len(body)), "block": paragraph(edit_rng, words)}]
+                    if edit_rng.random() < 0.3:
+                        ops.append({"op": "insert", "index": edit_rng.randrange(len(body)), "block": paragraph(edit_rng, words)})
+
+                    response = client.patch(url, {"doc": {"ops": ops, "version": version}}, content_type="application/json")
+                    body = apply_block_ops(body, ops)
+                else:
+                    body = list(body)
+                    body[edit_rng.randrange(len(body))] = paragraph(edit_rng, words)
+                    del body[edit_rng.randrange(len(body))]
+                    response = client.put(url, {"doc": {"body": body, "version": version}}, content_type="application/json")
+
+                assert response.status_code == 200, response.status_code
+                bodies[doc.pk, version + 1] = body
+                full_copies += len(documents.compress_body(body))
+
+        count = EditorFileRevision.objects.count()
+        size = table_size(connection.cursor(), "user_accounts_editorfilerevision")
+
+        times = []
+
+        for (pk, version), body in rng.sample(sorted(bodies.items(), key=str), min(500, len(bodies))):
+            start = time.perf_counter()
+            read = EditorFileRevision.objects.body_at(pk, version)
+            times.append(time.perf_counter() - start)
+            assert read == body
+
+        print(
+            f"  {interval:8} {size / count / 1024:10.1f}KiB {full_copies / count / 1024:7.1f}KiB"
+            f" {sum(times) / len(times) * 1000:7.2f} ms {max(times) * 1000:8.2f} ms"
+        )
+
+    # As if all but the last 10 saves of each doc were made 60 days ago, 10 a day.
+    start_day = (timezone.now() - datetime.timedelta(days=60)).replace(hour=0)
+
+    for version in range(1, saves - 9):
+        created = start_day + datetime.timedelta(days=version // 10, minutes=version)
+        EditorFileRevision.objects.filter(version=version).update(created=created)
+
+    start = time.perf_counter()
+    call_command("prune_revisions", stdout=open(os.devnull, "w"))
+    elapsed = time.perf_counter() - start
+
+    pruned = EditorFileRevision.objects.count()
+    pruned_size = table_size(connection.cursor(), "user_accounts_editorfilerevision")
+    print(f"\nPruned to the last revision of each day older than 30 days, in {elapsed:.2f}s (interval {interval}):")
+    print(f"  {count} revisions, {size / 1024:.0f} KiB -> {pruned} revisions, {pruned_size / 1024:.0f} KiB")
+
+    for (pk, version), body in bodies.items():
+        if EditorFileRevision.objects.filter(file_id=pk, version=version).exists():
+            assert EditorFileRevision.objects.body_at(pk, version) == body
+
+
+if __name__ == "__main__":
+    main(*(int(arg) for arg in sys.argv[1:4]))
@@ -0,0 +1,121 @@
+"""
+Benchmark GET /store/docs/search for a user with many docs.
+
+Seeds a temporary SQLite database with one user's docs, of words drawn
+from a Zipf-like vocabulary so some terms are in nearly every doc and
+most in few. Indexes them with the index_docs command, then times
+searches for rare, middling and common terms, and a save of a doc with
+a paragraph rewritten (which indexes it) and a search after it. The
+search index used here is the portable one (EditorFileTerm); see
+search.py.
+
+Usage: python benchmarks/bench_search.py [docs] [words_per_doc] [searches]
+"""
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def main(docs=20000, words_per_doc=300, searches=50):
+    os.environ["DATABASE_URL"] = "sqlite:///" + os.path.join(tempfile.mkdtemp(), "bench_search.sqlite3")
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'conduit_backend.settings')
+
+    import django
+    django.setup()
+
+    from django.conf import settings
+    from django.core.management import call_command
+    from django.db import connection
+    from django.http.cookie import SimpleCookie
+    from django.test import Client
+    from django.urls import reverse
+
+    from user_accounts import documents
+    from user_accounts.models import User, EditorFile
+    from user_accounts.views import generate_jwt_token
+
+    call_command("migrate", verbosity=0)
+    settings.ALLOWED_HOSTS.append("testserver")
+
+    rng = random.Random(0)
+    vocabulary = ["".join(rng.choices("etaoinshrdlcumwfgypbvk", k=rng.randint(3, 9))) for _ in range(20000)]
+    weights = [1 / (rank + 1) for rank in range(len(vocabulary))]
+
+    user = User.objects.create_user(username="bench", password="bench")
+
+    def body():
+        words = rng.choices(vocabulary, weights, k=words_per_doc)
+        return [{"type": "paragraph", "text": " ".join(words[i:i + 50])} for i in range(0, len(words), 50)]
+
+    for start in range(0, docs, 1000):
+        batch = []
+
+        for i in range(start, min(docs, start + 1000)):
+            doc_body = body()
+            batch.append(EditorFile(author=user, title=" ".join(rng.choices(vocabulary, weights, k=3)), body=doc_body, **documents.summarize(doc_body)))
+
+        EditorFile.objects.bulk_create(batch)
+
+    start = time.perf_counter()
+    call_command("index_docs", stdout=open(os.devnull, "w"))
+    print(f"{docs} docs of {words_per_doc} words, indexed in {time.perf_counter() - start:.1f}s")
+
+    cursor = connection.cursor()
+    cursor.execute("VACUUM")
+    cursor.execute("ANALYZE")
+
+    client = Client()
+    client.cookies = SimpleCookie({"jwt": generate_jwt_token("bench")})
+    url = reverse("search-docs")
+
+    def time_search(queries):
+        times = []
+        matches = 0
+
+        for query in queries:
+            start = time.perf_counter()
+            response = client.get(url, {"q": query})
+            times.append(time.perf_counter() - start)
+
+            assert response.status_code == 200, response.status_code
+            matches += len(response.json()["docs"])
+
+        return sum(times) / len(times), max(times), matches / len(queries)
+
+    # Ranks in the vocabulary: the most common words are in nearly every doc.
+    cases = [
+        ("rare term", [vocabulary[rng.randrange(5000, 20000)] for _ in range(searches)]),
+        ("middling term", [vocabulary[rng.randrange(200, 1000)] for _ in range(searches)]),
+        ("common term", [vocabulary[rng.randrange(0, 20)] for _ in range(searches)]),
+        ("common + rare", [f"{vocabulary[rng.randrange(0, 20)]} {vocabulary[rng.randrange(5000, 20000)]}" for _ in range(searches)]),
+    ]
+
+    print(f"\n  {'':16} {'mean':>9} {'worst':>9} {'results':>8}")
+
+    for label, queries in cases:
+        mean, worst, results = time_search(queries)
+        print(f"  {label:16} {mean * 1000:6.1f} ms {worst * 1000:6.1f} ms {results:8.1f}")
+
+    doc = EditorFile.objects.order_by("?").first()
+    doc_body = doc.body
+
+    def save_and_search():
+        # An autosave: one paragraph rewritten.
+        doc_body[rng.randrange(len(doc_body))] = body()[0]
+        start = time.perf_counter()
+        client.put(reverse("edit-doc", kwargs={"pk": doc.pk}), {"doc": {"body": doc_body}}, content_type="application/json")
+        saved = time.perf_counter()
+        client.get(url, {"q": vocabulary[rng.randrange(5000, 20000)]})
+        return saved - start, time.perf_counter() - saved
+
+    saves, after_save = zip(*(save_and_search() for _ in range(searches)))
+    print(f"  {'save':16} {sum(saves) / len(saves) * 1000:6.1f} ms {max(saves) * 1000:6.1f} ms")
+    print(f"  {'after a save':16} {sum(after_save) / len(after_save) * 1000:6.1f} ms {max(after_save) * 1000:6.1f} ms")
+
+
+if __name__ == "__main__":
+    main(*(int(arg) for arg in sys.argv[1:4]))
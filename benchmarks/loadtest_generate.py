@@ -0,0 +1,135 @@
+"""
+Load test /generate/text against a local fake OpenAI server.
+
+Compares the sync view, served by a fixed number of sync workers (as with
+`gunicorn conduit_backend.wsgi`), with the async view handling every request
+concurrently on a single event loop (as with one ASGI worker).
+
+The fake server answers every chat completion after a fixed delay, standing
+in for generation time. Nothing leaves the machine.
+
+Usage: python benchmarks/loadtest_generate.py [requests] [sync_workers] [latency_seconds]
+"""
+import asyncio
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+LATENCY = 0.5
+
+COMPLETION = {
+    "id": "chatcmpl-loadtest",
+    "object": "chat.completion",
+    "created": 0,
+    "model": "gpt-3.5-turbo",
+    "choices": [{"index": 0, "message": {"role": "assistant", "content": "The sky is blue."}, "finish_reason": "stop"}],
+    "usage": {"prompt_tokens": 50, "completion_tokens": 5, "total_tokens": 55},
+}
+
+
+async def handle_connection(reader, writer):
+    """
+    Minimal HTTP/1.1 keep-alive server for POST /v1/chat/completions.
+    """
+    try:
+        while True:
+            headers = await reader.readuntil(b"\r\n\r\n")
+            length = 0
+            for line in headers.decode().split("\r\n"):
+                if line.lower().startswith("content-length:"):
+                    length = int(line.split(":")[1])
+            await reader.readexactly(length)
+
+            await asyncio.sleep(LATENCY)
+
+            body = json.dumps(COMPLETION).encode()
+            writer.write(b"HTTP/1.1 200 OK\r\nContent-Type: application/json\r\nContent-Length: "
+                         + str(len(body)).encode() + b"\r\n\r\n" + body)
+            await writer.drain()
+    except (asyncio.IncompleteReadError, ConnectionError):
+        writer.close()
+
+
+def start_fake_openai():
+    """
+    Run the fake server on a background thread, returning its port.
+    """
+    loop = asyncio.new_event_loop()
+    server = loop.run_until_complete(asyncio.start_server(handle_connection, "127.0.0.1", 0))
+    threading.Thread(target=loop.run_forever, daemon=True).start()
+    return server.sockets[0].getsockname()[1]
+
+
+def main(requests=200, sync_workers=4, latency=0.5):
+    global LATENCY
+    LATENCY = latency
+
+    port = start_fake_openai()
+    os.environ["OPENAI_BASE_URL"] = f"http://127.0.0.1:{port}/v1"
+    os.environ["OPENAI_API_KEY"] = "loadtest"
+    os.environ["DATABASE_URL"] = "sqlite:///" + os.path.join(tempfile.mkdtemp(), "loadtest.sqlite3")
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'conduit_backend.settings')
+
+    import django
+    django.setup()
+
+    import tiktoken
+    from django.conf import settings
+    from django.core.management import call_command
+    from django.http.cookie import SimpleCookie
+    from django.test import Client, AsyncClient
+    from django.urls import reverse
+
+    from user_accounts import encodings
+    from user_accounts.models import User
+    from user_accounts.views import generate_jwt_token
+
+    call_command("migrate", verbosity=0)
+    settings.ALLOWED_HOSTS.append("testserver")
+
+    # A local encoding, so the test doesn't need to download one.
+    encodings.register_encoding("gpt-3.5-turbo", tiktoken.Encoding(
+        name="loadtest", pat_str=r"\S+|\s+", mergeable_ranks={bytes([i]): i for i in range(256)}, special_tokens={}))
+
+    User.objects.create_user(username="loadtest", password="loadtest", credits=1000000)
+    cookies = SimpleCookie({"jwt": generate_jwt_token("loadtest")})
+    body = json.dumps({"prompt": {"name": "Load test", "messages": [{"role": "user", "content": "Why is the sky blue?"}]}})
+
+    def sync_request(_):
+        client = Client()
+        client.cookies = cookies
+        return client.post(reverse("generate-text"), body, content_type="application/json").status_code
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(sync_workers) as workers:
+        statuses = list(workers.map(sync_request, range(requests)))
+    sync_time = time.perf_counter() - start
+    assert set(statuses) == {200}, statuses
+
+    async def async_requests():
+        client = AsyncClient()
+        client.cookies = cookies
+        return await asyncio.gather(*(
+            client.post(reverse("generate-text-async"), body, content_type="application/json")
+            for _ in range(requests)
+        ))
+
+    start = time.perf_counter()
+    responses = asyncio.run(async_requests())
+    async_time = time.perf_counter() - start
+    assert {response.status_code for response in responses} == {200}
+
+    print(f"{requests} requests, {latency}s upstream latency")
+    print(f"Sync view, {sync_workers} workers:   {requests / sync_time:8.1f} req/s ({sync_time:.2f}s)")
+    print(f"Async view, 1 event loop: {requests / async_time:8.1f} req/s ({async_time:.2f}s)")
+
+
+if __name__ == "__main__":
+    args = sys.argv[1:]
+    main(*(int(arg) for arg in args[:2]), *(float(arg) for arg in args[2:3]))
@@ -0,0 +1,96 @@
+"""
+Load test a burst of logins alongside doc reads.
+
+Seeds a temporary SQLite database with users, then serves a burst of
+POST /auth/login requests mixed with GET /store/docs from a fixed number
+of request threads, standing in for a worker's. Runs it with a hasher
+pool so large nothing is refused (as hashing inline on the request
+threads), and with the bounded pool from settings, which refuses logins
+past PASSWORD_HASHER_QUEUE with a 503. Reports the latency of the reads,
+and how many logins were refused.
+
+Usage: python benchmarks/loadtest_logins.py [logins] [reads] [threads]
+"""
+import os
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def main(logins=200, reads=400, threads=32):
+    os.environ["DATABASE_URL"] = "sqlite:///" + os.path.join(tempfile.mkdtemp(), "loadtest_logins.sqlite3")
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'conduit_backend.settings')
+
+    import django
+    django.setup()
+
+    from django.conf import settings
+    from django.core.management import call_command
+    from django.db import connection
+    from django.test import Client
+    from django.urls import reverse
+
+    from user_accounts import authentication, hashing
+    from user_accounts.models import User, EditorFile
+
+    call_command("migrate", verbosity=0)
+    settings.ALLOWED_HOSTS.append("testserver")
+    settings.DEBUG = False
+
+    user = User.objects.create_user(username="reader", password="reader")
+    EditorFile.objects.create(author=user, title="Doc", body=[{"text": "Body"}])
+    token = authentication.generate_jwt_token("reader")
+    connection.close()
+
+    def login(i):
+        client = Client()
+        response = client.post(reverse("login"), {"username": "reader", "password": "reader"}, content_type="application/json")
+        connection.close()
+        return response.status_code
+
+    def read(i):
+        client = Client()
+        client.cookies["jwt"] = token
+        start = time.perf_counter()
+        response = client.get(reverse("create-view-docs"))
+        assert response.status_code == 200, response.status_code
+        connection.close()
+        return time.perf_counter() - start
+
+    def burst(executor):
+        hashing._executor = executor
+        latencies, statuses = [], []
+
+        with ThreadPoolExecutor(max_workers=threads) as pool:
+            futures = []
+
+            # Logins first, as when every client reconnects at once.
+            for i in range(max(logins, reads)):
+                if i < logins:
+                    futures.append(("login", pool.submit(login, i)))
+                if i < reads:
+                    futures.append(("read", pool.submit(read, i)))
+
+            for kind, future in futures:
+                (statuses if kind == "login" else latencies).append(future.result())
+
+        latencies.sort()
+        return latencies[len(latencies) // 2], latencies[int(len(latencies) * 0.95)], statuses.count(503)
+
+    print(f"{logins} logins and {reads} reads, {threads} request threads\n")
+    print(f"  {'hasher pool':28} {'read p50 ms':>12} {'read p95 ms':>12} {'refused':>8}")
+
+    unbounded = hashing.BoundedExecutor(threads, logins + reads)
+    bounded = hashing.BoundedExecutor(settings.PASSWORD_HASHER_WORKERS, settings.PASSWORD_HASHER_QUEUE)
+    label = f"bounded ({settings.PASSWORD_HASHER_WORKERS} + {settings.PASSWORD_HASHER_QUEUE})"
+
+    for label, executor in [("unbounded", unbounded), (label, bounded)]:
+        p50, p95, refused = burst(executor)
+        print(f"  {label:28} {p50 * 1e3:12.1f} {p95 * 1e3:12.1f} {refused:8}")
+
+
+if __name__ == "__main__":
+    main(*(int(arg) for arg in sys.argv[1:4]))
@@ -0,0 +1,86 @@
+"""
+Load test keeping users logged in, by logging in again each hour or by
+renewing their sessions without the password (TokenRefreshMiddleware).
+
+Seeds a temporary SQLite database with users, then simulates each using
+the app for a working day: a number of doc reads an hour. When their
+access token runs out, each either logs in again with POST /auth/login
+(running the password hasher), or carries on: the first request of the
+hour is sent with an access token about to expire, or already expired,
+and the middleware renews it. Reports CPU time (time.process_time) per
+active user per day for each.
+
+Usage: python benchmarks/loadtest_sessions.py [users] [hours] [requests_per_hour]
+"""
+import datetime
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def main(users=10, hours=8, requests_per_hour=20):
+    os.environ["DATABASE_URL"] = "sqlite:///" + os.path.join(tempfile.mkdtemp(), "loadtest_sessions.sqlite3")
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'conduit_backend.settings')
+
+    import django
+    django.setup()
+
+    from django.conf import settings
+    from django.core.management import call_command
+    from django.test import Client
+    from django.urls import reverse
+
+    from user_accounts import authentication
+    from user_accounts.models import User, EditorFile
+
+    call_command("migrate", verbosity=0)
+    settings.ALLOWED_HOSTS.append("testserver")
+    settings.DEBUG = False
+
+    clients = []
+
+    for i in range(users):
+        user = User.objects.create_user(username=f"user{i}", password=f"password{i}")
+        EditorFile.objects.create(author=user, title="Doc", body=[{"text": "Body"}])
+        clients.append((f"user{i}", f"password{i}", Client()))
+
+    def login(username, password, client):
+        response = client.post(reverse("login"), {"username": username, "password": password}, content_type="application/json")
+        assert response.status_code == 200, response.status_code
+
+    def read(client):
+        response = client.get(reverse("create-view-docs"))
+        assert response.status_code == 200, response.status_code
+
+    def day(renew):
+        authentication.tokens.clear()
+        start = time.process_time()
+
+        for hour in range(hours):
+            for username, password, client in clients:
+                if hour == 0:
+                    login(username, password, client)
+                elif renew == "login":
+                    login(username, password, client)
+                elif renew == "near expiry":
+                    client.cookies["jwt"] = authentication.generate_jwt_token(username, datetime.timedelta(seconds=60))
+                else:
+                    client.cookies["jwt"] = authentication.generate_jwt_token(username, datetime.timedelta(seconds=-1))
+
+                for _ in range(requests_per_hour):
+                    read(client)
+
+        return (time.process_time() - start) / users
+
+    print(f"{users} users, {hours} hours, {requests_per_hour} requests an hour\n")
+    print(f"  {'renewed by':26} {'CPU s/user/day':>15}")
+
+    for label, renew in [("logging in each hour", "login"), ("middleware, near expiry", "near expiry"), ("middleware, refresh token", "expired")]:
+        print(f"  {label:26} {day(renew):15.3f}")
+
+
+if __name__ == "__main__":
+    main(*(int(arg) for arg in sys.argv[1:4]))
@@ -63,6 +63,9 @@ MIDDLEWARE = [
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
 
+    # Renews the JWT cookie before it expires.
+    'user_accounts.middleware.TokenRefreshMiddleware',
+
 ]
 
 ROOT_URLCONF = 'conduit_backend.urls'
@@ -121,8 +124,105 @@ if 'test' in sys.argv:
         'NAME': ':memory:',
     }
 
+# Tiktoken encodings. BPE files are loaded from TIKTOKEN_ENCODINGS_DIR when it
+# has been populated with `python manage.py vendor_encodings`, or downloaded
+# (and cached) on first use otherwise.
+TIKTOKEN_ENCODINGS_DIR = os.getenv("TIKTOKEN_ENCODINGS_DIR", os.path.join(BASE_DIR, 'tiktoken_encodings'))
+
+# Encodings loaded when each server worker starts (see asgi.py and wsgi.py).
+TIKTOKEN_WARMUP_MODELS = ["gpt-3.5-turbo"]
+
+if 'test' in sys.argv:
+    # Tests register their own local encodings.
+    TIKTOKEN_WARMUP_MODELS = []
+
+# OpenAI client connection pool, shared by all requests in a worker.
+# The API key (and OPENAI_BASE_URL, if set) are read from the environment.
+OPENAI_MAX_CONNECTIONS = int(os.getenv("OPENAI_MAX_CONNECTIONS", 500))
+OPENAI_MAX_KEEPALIVE_CONNECTIONS = int(os.getenv("OPENAI_MAX_KEEPALIVE_CONNECTIONS", 100))
+OPENAI_KEEPALIVE_EXPIRY = 30
+
+# Seconds. Generations can be slow, but shouldn't hold a connection forever.
+OPENAI_TIMEOUT = 120
+OPENAI_CONNECT_TIMEOUT = 5
+OPENAI_MAX_RETRIES = 2
+
+# Seconds before credits reserved for a generation are released if it never
+# finishes, e.g. because its worker died. Longer than any generation can take.
+CREDIT_HOLD_TTL = 600
+
+# Seconds. Access tokens (the "jwt" cookie) are short-lived; the "refresh"
+# cookie renews them without logging in again, so the password hasher
+# only runs on real logins. See user_accounts/authentication.py.
+ACCESS_TOKEN_LIFETIME = 3600
+REFRESH_TOKEN_LIFETIME = 14 * 24 * 3600
+
+# Access tokens with less than this left are renewed, with the refresh
+# cookie, on the next request.
+ACCESS_TOKEN_REFRESH_WINDOW = 15 * 60
+
+# A refresh token used again this soon after it was replaced (as by
+# parallel requests with the same cookie) isn't taken as stolen.
+REFRESH_TOKEN_REUSE_GRACE = 30
+
+# Doc bodies stored whole (see DOC_CHUNK_THRESHOLD) larger than this, in
+# bytes of JSON, are stored compressed. None stores every body
+# uncompressed. See the compress_doc_bodies command.
+DOC_BODY_COMPRESSION_THRESHOLD = 8 * 1024
+
+# Doc bodies of more blocks than this are stored in chunks, so ranges of
+# blocks can be read and edited alone, and their blocks are stored once
+# per user however many docs use them (see user_accounts/blockstore.py).
+# 0 stores every body of blocks so, however short, as short docs are
+# copied as often as long ones. None stores every body whole.
+DOC_CHUNK_THRESHOLD = 0
+
 AUTH_USER_MODEL = 'user_accounts.User'
 
+# Hashes passwords in a bounded pool of threads; see user_accounts/hashing.py.
+AUTHENTICATION_BACKENDS = ['user_accounts.hashing.PooledModelBackend']
+
+# Passwords hashed at once by each worker, and how many more may wait.
+# Logins past that are refused with a 503, and asked to retry after
+# PASSWORD_HASHER_RETRY_AFTER seconds.
+PASSWORD_HASHER_WORKERS = int(os.getenv("PASSWORD_HASHER_WORKERS", 2))
+PASSWORD_HASHER_QUEUE = int(os.getenv("PASSWORD_HASHER_QUEUE", 8))
+PASSWORD_HASHER_RETRY_AFTER = 1
+
+# Rate and concurrency limits for expensive endpoints; see
+# user_accounts/ratelimit.py. Counted in each worker, or, if
+# RATE_LIMIT_PATH is set, in a SQLite file shared by the machine's workers.
+if os.getenv("RATE_LIMIT_PATH"):
+    RATE_LIMIT_BACKEND = {
+        'BACKEND': 'user_accounts.ratelimit.SQLiteBackend',
+        'OPTIONS': {'path': os.getenv("RATE_LIMIT_PATH")},
+    }
+else:
+    RATE_LIMIT_BACKEND = {'BACKEND': 'user_accounts.ratelimit.MemoryBackend'}
+
+# (requests, seconds) allowed by each client (user, or IP address), per scope.
+RATE_LIMITS = {
+    'generate': (20, 60),
+    'login': (10, 60),
+    'forgot': (5, 300),
+    'register': (5, 300),
+}
+
+# Requests each user may have in flight at once, per scope. A slot is
+# freed after CONCURRENCY_LEASE seconds even if its request never
+# finishes (longer than any generation can take). Refused requests are
+# asked to retry after CONCURRENCY_RETRY_AFTER seconds.
+CONCURRENCY_LIMITS = {
+    'generate': 2,
+}
+CONCURRENCY_LEASE = 600
+CONCURRENCY_RETRY_AFTER = 5
+
+if 'test' in sys.argv:
+    # Tests set their own.
+    RATE_LIMITS = {}
+    CONCURRENCY_LIMITS = {}
+
 # Password validation
 # https://docs.djangoproject.com/en/4.2/ref/settings/#auth-password-validators
 
@@ -175,11 +275,20 @@ EMAIL_BACKEND = 'django.core.mail.backends.console.EmailBackend'
 
 # Django Rest Framework settings
 REST_FRAMEWORK = {
+    # The JWT cookie set on login; see user_accounts/authentication.py.
+    'DEFAULT_AUTHENTICATION_CLASSES': [
+        'user_accounts.authentication.JWTCookieAuthentication'
+    ],
     # Use Django's standard `django.contrib.auth` permissions,
     # or allow read-only access for unauthenticated users.
     'DEFAULT_PERMISSION_CLASSES': [
         'rest_framework.permissions.AllowAny'
-    ]
+    ],
+    # Proxies in front of the app, which each append to X-Forwarded-For
+    # (one: Heroku's router). Rate limits key on the address the nearest
+    # added, not on what the client sent, which it could change at will.
+    # 0 if clients connect directly.
+    'NUM_PROXIES': int(os.getenv("NUM_PROXIES", 1)),
 }
 
 # CORS Headers settings
@@ -207,8 +316,14 @@ CORS_ALLOW_HEADERS = [
     "x-csrftoken",
     "x-requested-with",
     "access-control-allow-credentials",
+    # Conditional requests for docs.
+    "if-none-match",
+    "if-modified-since",
 ]
 
+# Let the frontend read ETags, to send back in If-None-Match.
+CORS_EXPOSE_HEADERS = ["etag"]
+
 # Allow credentials (cookies, authorization headers, etc.) to be included in cross-origin requests
 CORS_ALLOW_CREDENTIALS = True
 
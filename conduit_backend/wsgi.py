@@ -13,3 +13,10 @@ from django.core.wsgi import get_wsgi_application
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'conduit_backend.settings')
 
 application = get_wsgi_application()
+
+# Load Tiktoken encodings once per worker, as it starts, rather than on the
+# first /generate/text request. Here, rather than in the app's ready(), so
+# management commands don't.
+from user_accounts.encodings import warm_up
+
+warm_up()
@@ -1,7 +1,12 @@
 from django.contrib import admin
 from django.contrib.auth.admin import UserAdmin
-from .models import User, EditorFile
+from .models import User, EditorFile, CreditAccount, CreditEntry, CreditHold
 
 # Ensure users and files can be accessed from Django admin site.
 admin.site.register(User, UserAdmin)
-admin.site.register(EditorFile)
\ No newline at end of file
+admin.site.register(EditorFile)
+
+# Credit balances and the ledger behind them.
+admin.site.register(CreditAccount)
+admin.site.register(CreditEntry)
+admin.site.register(CreditHold)
@@ -0,0 +1,336 @@
+"""
+JWT cookie authentication.
+
+Logging in sets a "jwt" cookie holding a signed token with the user's pk
+(and username). JWTCookieAuthentication decodes it once per request and
+sets request.user to a LazyUser, which knows its pk without a query, so
+views which only filter by the user, as most do, never load it. The
+user's row is read the first time anything else about them is needed.
+Whether the user still exists, and when their tokens were last ended,
+is checked for every request, with a query on their pk alone, so tokens
+of deleted users, and ended tokens, are refused whatever the view reads.
+
+Views ask for a user with permission_classes = [IsAuthenticated] (or
+IsAuthenticatedWithError), rather than checking the token themselves.
+
+Access tokens last ACCESS_TOKEN_LIFETIME. Logging in also sets a
+"refresh" cookie (see RefreshToken), and TokenRefreshMiddleware renews
+the access token with it, near the access token's expiry or after it,
+so the password hasher only runs on real logins.
+
+Each worker keeps the tokens it has verified, by digest, in an LRU cache
+until they expire, so a client's many requests with the same cookie (as
+autosaves make) verify its signature once.
+
+Logging out and resetting a password end the user's access tokens: each
+token carries when it was issued ("iat"), and those issued before the
+user's tokens_valid_after are refused, by every worker. Logging out ends
+the user's other sessions' access tokens too, but not their refresh
+tokens, so TokenRefreshMiddleware renews those on their next request.
+"""
+
+import datetime
+import hashlib
+import time
+from collections import namedtuple
+
+import jwt
+from django.conf import settings
+from django.utils import timezone
+from django.utils.functional import SimpleLazyObject
+from jwt.exceptions import InvalidTokenError
+from rest_framework import exceptions, permissions
+from rest_framework.authentication import BaseAuthentication
+
+from .cache import LRUCache
+from .models import RefreshToken, User
+
+# TODO: Set key securely.
+key = "TODO_CHANGEME_KEY"
+
+COOKIE_NAME = 'jwt'
+REFRESH_COOKIE_NAME = 'refresh'
+
+# Verified tokens kept by each worker.
+TOKEN_CACHE_SIZE = 10000
+
+# A verified token's claims, and the pk and username of its user.
+VerifiedToken = namedtuple('VerifiedToken', ['claims', 'user_id', 'username'])
+
+tokens = LRUCache(maxsize=TOKEN_CACHE_SIZE)
+
+
+def generate_jwt_token(username, expiry_length=None, user_id=None):
+    """
+    An access token for the user, valid for expiry_length (by default,
+    ACCESS_TOKEN_LIFETIME). The user's pk is looked up if not given.
+    """
+    if expiry_length is None:
+        expiry_length = datetime.timedelta(seconds=settings.ACCESS_TOKEN_LIFETIME)
+
+    if user_id is None:
+        user_id = User.objects.filter(username=username).values_list('pk', flat=True).first()
+
+    # iat to the microsecond, so a token issued just after the user's
+    # tokens were ended (see end_tokens) is still valid.
+    payload = {"username": username, "iat": time.time(), "exp": datetime.datetime.now(tz=datetime.timezone.utc) + expiry_length}
+
+    if user_id is not None:
+        payload["user_id"] = user_id
+
+    return jwt.encode(payload, key, algorithm="HS256")
+
+
+def set_cookie(response, name, value, max_age=None):
+    response.set_cookie(
+        key=name,
+        value=value,
+        max_age=max_age,
+        httponly=True,
+        samesite='None',
+        domain='.conduits.link',
+        secure=True,
+        path="/"
+    )
+
+
+def encode_jwt_token(response, username, expiry_length=None, user_id=None):
+    """
+    Set an access token for the user as the response's JWT cookie.
+    """
+    set_cookie(response, COOKIE_NAME, str(generate_jwt_token(username, expiry_length, user_id)))
+    return response
+
+
+def set_session_cookies(response, access, refresh=None):
+    """
+    Set the response's JWT cookie to the access token, and its refresh
+    cookie to the refresh token, if given, unless the view has set them.
+    """
+    if COOKIE_NAME not in response.cookies:
+        set_cookie(response, COOKIE_NAME, access)
+
+    if refresh is not None and REFRESH_COOKIE_NAME not in response.cookies:
+        set_cookie(response, REFRESH_COOKIE_NAME, refresh, max_age=settings.REFRESH_TOKEN_LIFETIME)
+
+    return response
+
+
+def start_session(response, username, user_id):
+    """
+    Log the user in: set an access token and a new refresh token as the
+    response's cookies.
+    """
+    return set_session_cookies(response, generate_jwt_token(username, user_id=user_id), RefreshToken.objects.issue(user_id))
+
+
+def refresh_session(secret):
+    """
+    Exchange a refresh token for a new access token, and the refresh
+    token replacing it (None if another request just replaced it; see
+    RefreshTokenQuerySet.rotate). Returns (access, refresh), or None if
+    the refresh token isn't valid.
+    """
+    rotated = RefreshToken.objects.rotate(secret)
+
+    if rotated is None:
+        return None
+
+    user_id, username, refresh = rotated
+    return generate_jwt_token(username, user_id=user_id), refresh
+
+
+def end_session(request, response):
+    """
+    Log out: revoke the request's refresh token (and those before and
+    after it), end the user's access tokens, and clear both cookies.
+    """
+    refresh = request.COOKIES.get(REFRESH_COOKIE_NAME)
+
+    if refresh:
+        RefreshToken.objects.revoke(refresh)
+
+    end_tokens(request.user.pk)
+
+    set_cookie(response, COOKIE_NAME, '')
+    set_cookie(response, REFRESH_COOKIE_NAME, '', max_age=0)
+    return response
+
+
+def end_all_sessions(user_id):
+    """
+    Log the user out everywhere, as on resetting their password: revoke
+    all of their refresh tokens, and end their access tokens.
+    """
+    RefreshToken.objects.filter(user_id=user_id).delete()
+    end_tokens(user_id)
+
+
+def end_tokens(user_id):
+    """
+    Make the user's access tokens issued until now invalid.
+    """
+    User.objects.filter(pk=user_id).update(tokens_valid_after=timezone.now())
+
+
+def token_digest(token):
+    """
+    The key of a token in the cache.
+    """
+    return hashlib.blake2b(token.encode(), digest_size=16).digest()
+
+
+def verify_token(token):
+    """
+    The token's VerifiedToken, or None if it isn't valid, has expired, has
+    been ended (see end_tokens), or its user doesn't exist.
+    """
+    verified = verify_signature(token)
+
+    if verified is None:
+        return None
+
+    user = User.objects.filter(pk=verified.user_id).values_list('tokens_valid_after').first()
+
+    if user is None:
+        return None
+
+    valid_after = user[0]
+
+    if valid_after is not None and verified.claims.get('iat', 0) <= valid_after.timestamp():
+        return None
+
+    return verified
+
+
+def verify_signature(token):
+    """
+    The token's VerifiedToken, or None if it isn't valid or has expired.
+    Kept in the cache until the token expires; everything in it comes from
+    the token's own claims.
+    """
+    digest = token_digest(token)
+    verified = tokens.get(digest)
+
+    if verified is not None:
+        if verified.claims['exp'] > time.time():
+            return verified
+
+        tokens.pop(digest)
+        return None
+
+    try:
+        claims = jwt.decode(token, key, algorithms=["HS256"])
+    except InvalidTokenError:
+        return None
+
+    username = claims.get('username')
+    user_id = claims.get('user_id')
+
+    if user_id is None:
+        # Tokens issued before they carried the pk. Not cached, as the
+        # user they name could be replaced by another of the same name.
+        user_id = User.objects.filter(username=username).values_list('pk', flat=True).first()
+        return None if user_id is None else VerifiedToken(claims, user_id, username)
+
+    verified = VerifiedToken(claims, user_id, username)
+
+    if 'exp' in claims:
+        tokens.set(digest, verified)
+
+    return verified
+
+
+def decode_jwt_token(request):
+    """
+    The VerifiedToken of the request's JWT cookie, or None if it has none,
+    or it isn't valid (see verify_token). Kept on the request, so
+    TokenRefreshMiddleware and the view verify it once.
+    """
+    token = request.COOKIES.get(COOKIE_NAME)
+
+    if token is None:
+        return None
+
+    if getattr(request, '_verified_token', (None, None))[0] != token:
+        request._verified_token = (token, verify_token(token))
+
+    return request._verified_token[1]
+
+
+class LazyUser(SimpleLazyObject):
+    """
+    The user with the given pk, read from the database only when more
+    than its pk and username are needed. Raises AuthenticationFailed then
+    if the user has been deleted since the request was authenticated.
+    """
+
+    def __init__(self, user_id, username):
+        def load():
+            user = User.objects.filter(pk=user_id).first()
+
+            if user is None:
+                raise exceptions.AuthenticationFailed("The user no longer exists.")
+
+            return user
+
+        super().__init__(load)
+
+        # Found without loading the user.
+        self.__dict__.update(pk=user_id, id=user_id, username=username, is_authenticated=True, is_anonymous=False)
+
+
+def get_user(request):
+    """
+    The user the request's JWT cookie was issued to, as a LazyUser, or
+    None if it has no valid token.
+    """
+    verified = decode_jwt_token(request)
+
+    if verified is None:
+        return None
+
+    return LazyUser(verified.user_id, verified.username)
+
+
+class JWTCookieAuthentication(BaseAuthentication):
+    """
+    Authenticates requests by their JWT cookie. Requests without a valid
+    one are anonymous, rather than refused, so views which allow anyone
+    (such as logging in) still work with an expired cookie.
+    """
+
+    def authenticate(self, request):
+        user = get_user(request._request)
+
+        if user is None:
+            return None
+
+        return (user, None)
+
+    def authenticate_header(self, request):
+        # Makes refusals 401s rather than 403s.
+        return 'Cookie realm="api"'
+
+
+class IsAuthenticated(permissions.BasePermission):
+    """
+    Allows only requests with a valid JWT cookie. The rest are refused
+    with a 401, and the body `detail` (DRF's own, if None).
+    """
+
+    detail = None
+
+    def has_permission(self, request, view):
+        if request.user is not None and request.user.is_authenticated:
+            return True
+
+        raise exceptions.NotAuthenticated(self.detail)
+
+
+class IsAuthenticatedWithError(IsAuthenticated):
+    """
+    IsAuthenticated, for views whose clients expect {"error": "Unauthorized"}.
+    """
+
+    detail = {"error": "Unauthorized"}
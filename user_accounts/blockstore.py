@@ -0,0 +1,57 @@
+"""
+Content-addressed storage of the blocks of document bodies.
+
+Chunks (see chunks.py) hold the digests of their blocks rather than the
+blocks themselves, and each distinct block is stored once per user, as
+an EditorBlock, however many documents (or places in one document) use
+it. A copy of a document costs only its digests, and saving an edited
+document only stores the blocks which changed.
+
+Chunked bodies, of more than settings.DOC_CHUNK_THRESHOLD blocks, are
+stored this way; by default, every body of blocks is, so copies of short
+documents are deduplicated as well as long ones.
+
+Each EditorBlock counts the references to it from chunks. Blocks which
+are no longer referenced are deleted by the collect_blocks command.
+"""
+
+import hashlib
+import json
+from collections import Counter
+
+# Bytes of each digest.
+DIGEST_SIZE = 16
+
+
+def digest(block):
+    """
+    Digest of a block's JSON. Blocks are only the same if their JSON is,
+    key order included, so they read back exactly as they were saved.
+    """
+    data = json.dumps(block, ensure_ascii=False, separators=(",", ":")).encode()
+    return hashlib.blake2b(data, digest_size=DIGEST_SIZE).digest()
+
+
+def pack(digests):
+    """
+    Digests, in order, as stored in a chunk.
+    """
+    return b"".join(digests)
+
+
+def unpack(data):
+    """
+    The digests stored in a chunk, in order.
+    """
+    data = bytes(data)
+    return [data[i:i + DIGEST_SIZE] for i in range(0, len(data), DIGEST_SIZE)]
+
+
+def ref_changes(old, new):
+    """
+    Changes to the reference counts of blocks when digests old are replaced
+    by new, as {digest: change}, leaving out those which don't change.
+    """
+    changes = Counter(new)
+    changes.subtract(old)
+    return {key: change for key, change in changes.items() if change}
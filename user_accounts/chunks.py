@@ -0,0 +1,114 @@
+"""
+Chunked storage of document bodies.
+
+A body of more than settings.DOC_CHUNK_THRESHOLD blocks (by default, any
+body of blocks but an empty one) is stored as EditorFileChunk rows of
+consecutive blocks, ordered by position, rather than in the EditorFile's
+body column. A range of blocks can then be read, and block operations
+(see patching.py) written, by loading and rewriting only the chunks they
+touch, so the I/O of an edit doesn't grow with the size of the document.
+
+Each chunk stores its number of blocks and their size, so the file's
+block_count and body_size can be kept up to date without its body. The
+blocks themselves are stored by content; see blockstore.py.
+"""
+
+import json
+
+from django.conf import settings
+
+from .patching import PatchError, validate_op
+
+# Blocks per chunk when a body is split.
+CHUNK_BLOCKS = 64
+
+# Chunks grown past this by inserts are split again.
+MAX_CHUNK_BLOCKS = 2 * CHUNK_BLOCKS
+
+
+def threshold():
+    """
+    Bodies of more blocks than this are stored chunked; None stores none chunked.
+    """
+    return settings.DOC_CHUNK_THRESHOLD
+
+
+def is_chunked(body):
+    """
+    Whether a body is to be stored chunked.
+    """
+    return threshold() is not None and isinstance(body, list) and len(body) > threshold()
+
+
+def is_unchunked(block_count):
+    """
+    Whether a chunked body edited down to this many blocks is to be stored
+    in one piece again. Only once well under the threshold, so a body
+    doesn't move back and forth as blocks are added and removed.
+    """
+    return threshold() is None or block_count <= threshold() // 2
+
+
+def split(blocks, size=CHUNK_BLOCKS):
+    """
+    Blocks in consecutive runs of the given size.
+    """
+    return [blocks[i:i + size] for i in range(0, len(blocks), size)]
+
+
+def blocks_size(blocks):
+    """
+    The bytes the blocks add to the JSON of a body (as documents.body_size),
+    including the separator after each. A body's size is the sum of its
+    chunks' sizes (or 2, for "[]").
+    """
+    return sum(len(json.dumps(block, ensure_ascii=False).encode()) + 2 for block in blocks)
+
+
+def parse_range(value):
+    """
+    Returns (start, stop) for a range of blocks, "first-last" inclusive,
+    e.g. "100-150". Raises ValueError if it is invalid.
+    """
+    first, sep, last = value.partition("-")
+
+    if not sep or not first.isdigit() or not last.isdigit() or int(first) > int(last):
+        raise ValueError("blocks must be a range of block indexes, e.g. 100-150.")
+
+    return int(first), int(last) + 1
+
+
+def locate_ops(sizes, ops):
+    """
+    Which chunk each operation applies to, given the number of blocks in each
+    chunk, in order. Returns a list of (chunk, op), with each op's index
+    relative to its chunk, to be applied in order.
+
+    Raises PatchError if any of the operations are invalid, as apply_block_ops.
+    """
+    if not isinstance(ops, list):
+        raise PatchError("Operations must be a list.")
+
+    sizes = list(sizes)
+    located = []
+
+    for op in ops:
+        validate_op(op, sum(sizes))
+
+        offset = 0
+
+        for chunk, size in enumerate(sizes):
+            # An insert at the very end goes on the end of the last chunk.
+            if op["index"] < offset + size or chunk == len(sizes) - 1:
+                break
+
+            offset += size
+
+        if op["op"] == "insert":
+            sizes[chunk] += 1
+        elif op["op"] == "delete":
+            sizes[chunk] -= 1
+
+        located.append((chunk, {**op, "index": op["index"] - offset}))
+
+    return located
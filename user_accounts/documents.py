@@ -0,0 +1,219 @@
+"""
+Documents (EditorFiles): summaries of their bodies, and keyset
+pagination for listing them.
+"""
+
+import base64
+import datetime
+import hashlib
+import json
+import uuid
+import zlib
+
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db.models import Q
+
+# Most documents returned in one page of a listing.
+MAX_PAGE_SIZE = 100
+
+# Most operations in one batch (see DocsBatchView).
+MAX_BATCH_SIZE = 1000
+
+# Documents read, or created, at a time by exports and imports.
+TRANSFER_BATCH_SIZE = 100
+
+# Most invalid lines of an import reported; the rest are only counted.
+MAX_IMPORT_ERRORS = 100
+
+# zlib level for compressed bodies: most of the saving of level 9, at a fraction of the CPU.
+COMPRESSION_LEVEL = 6
+
+# Length of the text preview stored with each document.
+PREVIEW_LENGTH = 200
+
+# Keys of a block holding its text, rather than e.g. its type or styling.
+TEXT_KEYS = ("text", "content", "children")
+
+
+def body_text(body):
+    """
+    The plain text in a document body, a JSON structure of blocks.
+    """
+    if isinstance(body, str):
+        return body
+
+    if isinstance(body, list):
+        return " ".join(text for text in map(body_text, body) if text)
+
+    if isinstance(body, dict):
+        values = [body[key] for key in TEXT_KEYS if key in body] or list(body.values())
+        return " ".join(text for text in map(body_text, values) if text)
+
+    return ""
+
+
+def preview(body, length=PREVIEW_LENGTH):
+    """
+    The start of a document's text, with whitespace collapsed.
+    """
+    text = " ".join(body_text(body).split())
+
+    if len(text) > length:
+        return text[:length - 1].rstrip() + "…"
+
+    return text
+
+
+def body_size(body):
+    """
+    Size of a document body, in bytes of JSON.
+    """
+    return len(json.dumps(body, ensure_ascii=False).encode())
+
+
+def block_count(body):
+    """
+    Number of top-level blocks in a document body.
+    """
+    if isinstance(body, list):
+        return len(body)
+
+    return 1 if body else 0
+
+
+def encode_body(body, threshold=None):
+    """
+    How to store a document body: returns (body, body_zlib) column values.
+
+    Bodies larger than the threshold, in bytes of JSON, are stored
+    zlib-compressed in body_zlib, leaving body empty. The threshold
+    defaults to settings.DOC_BODY_COMPRESSION_THRESHOLD; None disables
+    compression.
+    """
+    if threshold is None:
+        threshold = settings.DOC_BODY_COMPRESSION_THRESHOLD
+
+    if threshold is None:
+        return body, None
+
+    # As body_size, so the threshold can be compared with stored sizes.
+    data = json.dumps(body, ensure_ascii=False).encode()
+
+    if len(data) <= threshold:
+        return body, None
+
+    return None, zlib.compress(data, COMPRESSION_LEVEL)
+
+
+def compress_body(body):
+    """
+    A document body as zlib-compressed JSON, whatever its size.
+    """
+    return zlib.compress(json.dumps(body, ensure_ascii=False).encode(), COMPRESSION_LEVEL)
+
+
+def decode_body(body_zlib):
+    """
+    The document body stored compressed by encode_body or compress_body.
+    """
+    return json.loads(zlib.decompress(body_zlib))
+
+
+def summarize(body):
+    """
+    The summary fields stored with a document, for its body.
+    """
+    return {
+        "preview": preview(body),
+        "body_size": body_size(body),
+        "block_count": block_count(body),
+    }
+
+
+def export_line(doc):
+    """
+    A document as a line of NDJSON, for exports.
+    """
+    data = {
+        "uid": doc.uid,
+        "title": doc.title,
+        "body": doc.body,
+        "created": doc.created,
+        "modified": doc.modified,
+        "version": doc.version,
+    }
+
+    return json.dumps(data, cls=DjangoJSONEncoder, ensure_ascii=False).encode() + b"\n"
+
+
+def parse_line(line):
+    """
+    The title and body of a document from a line of an export, as
+    {"title": ..., "body": ...}. Raises ValueError if it isn't a document.
+    """
+    doc = json.loads(line)
+
+    if not isinstance(doc, dict):
+        raise ValueError("Each line must be a JSON object.")
+
+    return {"title": doc.get("title"), "body": doc.get("body")}
+
+
+def doc_etag(uid, version):
+    """
+    Strong ETag for a version of a document.
+    """
+    return f'"{uid}-{version}"'
+
+
+def listing_etag(user_id, latest, count, query):
+    """
+    Strong ETag for a listing of a user's documents, from the time the most
+    recent of them was modified and how many there are (which changes when
+    one is deleted), and the query parameters which shaped the response.
+    """
+    key = f"{user_id}|{latest.isoformat() if latest else ''}|{count}|{query}"
+    return '"' + hashlib.blake2b(key.encode(), digest_size=16).hexdigest() + '"'
+
+
+def encode_cursor(doc):
+    """
+    Opaque cursor for the position after a document in a listing.
+    """
+    position = json.dumps([doc.created.isoformat(), str(doc.uid)])
+    return base64.urlsafe_b64encode(position.encode()).decode()
+
+
+def decode_cursor(cursor):
+    """
+    Returns (created, uid) from a cursor. Raises ValueError if it is invalid.
+    """
+    try:
+        created, uid = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        return datetime.datetime.fromisoformat(created), uuid.UUID(uid)
+    except (AttributeError, TypeError, ValueError) as e:
+        raise ValueError("Invalid cursor.") from e
+
+
+def page(queryset, limit, cursor=None):
+    """
+    A page of documents, newest first, after the cursor's position.
+
+    Seeks to the position with WHERE (created, uid) < (cursor), rather than
+    an OFFSET, so every page costs the same however deep it is.
+    Returns (documents, cursor for the next page or None).
+    """
+    queryset = queryset.order_by('-created', '-uid')
+
+    if cursor is not None:
+        created, uid = decode_cursor(cursor)
+        queryset = queryset.filter(Q(created__lt=created) | Q(created=created, uid__lt=uid))
+
+    docs = list(queryset[:limit + 1])
+
+    if len(docs) > limit:
+        docs = docs[:limit]
+        return docs, encode_cursor(docs[-1])
+
+    return docs, None
@@ -0,0 +1,111 @@
+"""
+Embeddings of document blocks, for finding related documents.
+
+Blocks are embedded locally, on the CPU, with no model to download: each
+block's words and their character trigrams are hashed into DIMENSIONS
+signed buckets (feature hashing), with sublinear counts, and the vector
+normalized. Documents sharing words, or forms of them, point the same
+way. A document's vector is the normalized sum of its blocks'.
+
+Block vectors are stored by the block's digest (see blockstore.py), so
+re-embedding a saved document only embeds the blocks which changed.
+Vectors are stored as float16; see vectors.py for searching them.
+
+Documents are embedded as they're written, with their search indexing
+(see search.py), so requests for related docs only read. One behind its
+version is embedded by the embed_docs command.
+"""
+
+import functools
+import hashlib
+import math
+
+import numpy as np
+
+from . import blockstore, documents, search
+
+DIMENSIONS = 256
+
+# Weight of a word's character trigrams, against the word itself.
+TRIGRAM_WEIGHT = 0.5
+
+DTYPE = np.float16
+
+
+@functools.lru_cache(maxsize=1 << 16)
+def bucket(feature):
+    """
+    The (index, sign) a feature is hashed to.
+    """
+    value = int.from_bytes(hashlib.blake2b(feature.encode(), digest_size=8).digest(), "little")
+    return value % DIMENSIONS, 1.0 if value >> 63 else -1.0
+
+
+def features(text):
+    """
+    {feature: weight} for some text: its words, and their character trigrams.
+    """
+    counts = {}
+
+    for word in search.terms(text):
+        counts[word] = counts.get(word, 0) + 1
+
+    weights = {}
+
+    for word, count in counts.items():
+        weight = 1 + math.log(count)
+        weights[word] = weights.get(word, 0) + weight
+
+        padded = f" {word} "
+
+        for i in range(len(padded) - 2):
+            trigram = "#" + padded[i:i + 3]
+            weights[trigram] = weights.get(trigram, 0) + weight * TRIGRAM_WEIGHT
+
+    return weights
+
+
+def embed(text):
+    """
+    The unit vector for some text, as float32; zeros if it has no words.
+    """
+    vector = np.zeros(DIMENSIONS, dtype=np.float32)
+
+    for feature, weight in features(text).items():
+        index, sign = bucket(feature)
+        vector[index] += sign * weight
+
+    return normalize(vector)
+
+
+def parts(title, body):
+    """
+    [(digest, text)] of the parts of a document embedded: its title, and
+    each top-level block of its body, less those without text.
+    """
+    blocks = [title, *(body if isinstance(body, list) else [body])]
+    texts = [(block, documents.body_text(block)) for block in blocks]
+    return [(blockstore.digest(block), text) for block, text in texts if text.strip()]
+
+
+def combine(vectors):
+    """
+    A document's unit vector, from its blocks'.
+    """
+    if not len(vectors):
+        return np.zeros(DIMENSIONS, dtype=np.float32)
+
+    return normalize(np.sum(np.asarray(vectors, dtype=np.float32), axis=0))
+
+
+def normalize(vector):
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm else vector
+
+
+def pack(vector):
+    return np.asarray(vector, dtype=DTYPE).tobytes()
+
+
+def unpack(data):
+    return np.frombuffer(data, dtype=DTYPE)
@@ -0,0 +1,90 @@
+"""
+Process-wide registry of Tiktoken encodings.
+
+Loading an encoding parses a ~100k entry BPE file (and downloads it on a
+cold cache), so each encoding is loaded once per worker and shared by every
+request. Set TIKTOKEN_ENCODINGS_DIR to a directory populated with
+`python manage.py vendor_encodings` to load the BPE files from disk instead
+of the network.
+"""
+
+import logging
+import os
+import threading
+
+import tiktoken
+from django.conf import settings
+
+logger = logging.getLogger('defaultlogger')
+
+# Model name -> tiktoken.Encoding, shared by all requests in this process.
+_encodings = {}
+_lock = threading.Lock()
+
+
+def use_vendored_encodings():
+    """
+    Point Tiktoken's file cache at the vendored encodings directory, if one
+    exists. An explicit TIKTOKEN_CACHE_DIR environment variable wins.
+    """
+    directory = getattr(settings, 'TIKTOKEN_ENCODINGS_DIR', None)
+
+    if directory and os.path.isdir(directory):
+        os.environ.setdefault('TIKTOKEN_CACHE_DIR', str(directory))
+
+
+def get_encoding(model):
+    """
+    Return the Tiktoken encoding for the given model name, loading it
+    on first use.
+    """
+    encoding = _encodings.get(model)
+
+    if encoding is not None:
+        return encoding
+
+    # Only one thread loads a given encoding; the rest wait for it.
+    with _lock:
+        encoding = _encodings.get(model)
+
+        if encoding is None:
+            use_vendored_encodings()
+            encoding = tiktoken.encoding_for_model(model)
+            _encodings[model] = encoding
+
+    return encoding
+
+
+def register_encoding(model, encoding):
+    """
+    Use a specific encoding for a model name (e.g. a fine-tuned model
+    Tiktoken doesn't recognise, or a local encoding in tests).
+    """
+    with _lock:
+        _encodings[model] = encoding
+
+
+def clear_encodings():
+    """
+    Forget all loaded encodings. Mostly useful in tests.
+    """
+    with _lock:
+        _encodings.clear()
+
+
+def warm_up(models=None):
+    """
+    Load the encodings for the given models (TIKTOKEN_WARMUP_MODELS by
+    default), so the first request on a new worker doesn't pay for it.
+
+    Failures are logged rather than raised: a worker that can't reach the
+    network should still start, and will retry on first use.
+    """
+    if models is None:
+        models = getattr(settings, 'TIKTOKEN_WARMUP_MODELS', [])
+
+    for model in models:
+        try:
+            get_encoding(model)
+        except Exception as e:
+            logger.warning('Could not load Tiktoken encoding for %s: %s', model, e)
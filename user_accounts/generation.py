@@ -0,0 +1,248 @@
+"""
+Text generation with the OpenAI API, shared by the sync and async
+/generate/text views.
+"""
+
+import asyncio
+import json
+import threading
+import weakref
+
+from django.conf import settings
+from openai import OpenAI, AsyncOpenAI, DefaultHttpxClient, DefaultAsyncHttpxClient, DEFAULT_CONNECTION_LIMITS, Timeout
+from rest_framework import status
+
+from . import ledger
+from .encodings import get_encoding
+from .pricing import CostQuote, MILLION, micro_cost
+
+# Model used for generation; see pricing.PRICING.
+MODEL = "gpt-3.5-turbo"
+
+# One client per process (and, for the async client, per event loop), so
+# requests share pooled keep-alive connections instead of each paying
+# for a new TLS handshake.
+_client = None
+_async_clients = weakref.WeakKeyDictionary()
+_lock = threading.Lock()
+
+
+def client_options():
+    """
+    Connection pool limits and timeouts for the OpenAI clients.
+    """
+    # The SDK exports its default limits but not the class, which belongs
+    # to whichever HTTP library it is built on; build ours from the same type.
+    limits = type(DEFAULT_CONNECTION_LIMITS)(
+        max_connections=settings.OPENAI_MAX_CONNECTIONS,
+        max_keepalive_connections=settings.OPENAI_MAX_KEEPALIVE_CONNECTIONS,
+        keepalive_expiry=settings.OPENAI_KEEPALIVE_EXPIRY,
+    )
+    timeout = Timeout(settings.OPENAI_TIMEOUT, connect=settings.OPENAI_CONNECT_TIMEOUT)
+
+    return {"limits": limits, "timeout": timeout}
+
+
+def get_client():
+    """
+    The process-wide OpenAI client.
+    """
+    global _client
+
+    if _client is None:
+        with _lock:
+            if _client is None:
+                _client = OpenAI(http_client=DefaultHttpxClient(**client_options()), max_retries=settings.OPENAI_MAX_RETRIES)
+
+    return _client
+
+
+def get_async_client():
+    """
+    The AsyncOpenAI client for the running event loop.
+
+    Under an ASGI server there is one loop per worker, so this is one
+    client per process. Pooled connections can't be shared between loops,
+    so sync code calling async_to_sync (which starts a new loop) gets its own.
+    """
+    loop = asyncio.get_running_loop()
+    client = _async_clients.get(loop)
+
+    if client is None:
+        client = AsyncOpenAI(http_client=DefaultAsyncHttpxClient(**client_options()), max_retries=settings.OPENAI_MAX_RETRIES)
+        _async_clients[loop] = client
+
+    return client
+
+
+def sse_event(event, data):
+    """
+    Format a Server-Sent Event with a JSON payload.
+    """
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+class GenerationError(Exception):
+    """
+    A /generate/text request which can't be sent to the model.
+    """
+
+    def __init__(self, error, status):
+        super().__init__(error)
+        self.error = error
+        self.status = status
+
+
+class Generation:
+    """
+    A validated /generate/text request, priced against the user's credits.
+
+    Raises GenerationError if the request is malformed or unaffordable.
+    """
+
+    def __init__(self, data, credits, model=MODEL):
+        self.model = model
+
+        if credits <= 0:
+            raise GenerationError("You have no remaining credits. Please add some to your account.", status.HTTP_402_PAYMENT_REQUIRED)
+
+        if not isinstance(data, dict) or not isinstance(data.get('prompt', {}), dict):
+            raise GenerationError("Messages in wrong format.", status.HTTP_400_BAD_REQUEST)
+
+        # Extract data from the request
+        self.prompt_name = data.get('prompt', {}).get('name', '')
+        self.messages = data.get('prompt', {}).get('messages', [])
+        self.is_scaling_output = True if 'scale' in data else False
+        self.is_streaming = data.get('stream') is True
+
+        # Validate input.
+        if not self.messages:
+            raise GenerationError("Messages cannot be empty.", status.HTTP_400_BAD_REQUEST)
+
+        for message in self.messages:
+            if not isinstance(message, dict) or "role" not in message or "content" not in message:
+                raise GenerationError("Messages in wrong format.", status.HTTP_400_BAD_REQUEST)
+
+        # Tokenize the prompt once, and price everything from that.
+        self.quote = CostQuote(self.messages, credits, model)
+
+        if not self.quote.can_afford_prompt:
+            raise GenerationError("The cost of your prompt exceeds your remaining credits.", status.HTTP_402_PAYMENT_REQUIRED)
+
+        # If the maximum cost of the LLM is too high, and the user has
+        # not opted to scale down the response output, end the payment.
+        if not self.quote.can_afford_max and not self.is_scaling_output:
+            raise GenerationError("Insufficient credits for the response. Please add credits or select 'Scale Down Output'.", status.HTTP_402_PAYMENT_REQUIRED)
+
+        # If scaling down output is selected and necessary, do so.
+        self.max_tokens = self.quote.max_tokens(self.is_scaling_output)
+
+        # Most the call can cost, reserved until it's done.
+        self.max_micro_cost = micro_cost(model, self.quote.prompt_tokens, self.max_tokens)
+        self.hold = None
+
+    def reserve(self, user):
+        """
+        Hold the maximum cost of the call against the user's credits.
+
+        Raises GenerationError if other generations in progress have
+        reserved the credits in the meantime.
+        """
+        try:
+            self.hold = ledger.reserve(user, self.max_micro_cost)
+        except ledger.InsufficientCredits:
+            raise GenerationError("Your remaining credits are reserved by generations in progress. Please wait for them to finish or add credits.", status.HTTP_402_PAYMENT_REQUIRED)
+
+    def settle(self, cost):
+        """
+        Charge the user the actual cost of the call, in micro-credits, and release the hold.
+        """
+        ledger.settle(self.hold, cost)
+
+    def release(self):
+        """
+        Release the hold without charging, when the call failed.
+        """
+        ledger.release(self.hold)
+
+    def completion_options(self):
+        """
+        Arguments for chat.completions.create().
+        """
+        options = {
+            "model": self.model,
+            "messages": self.messages,
+            "temperature": 0.7,
+            "top_p": 1,
+            "frequency_penalty": 0,
+            "presence_penalty": 0,
+            "max_tokens": self.max_tokens,
+            "stream": self.is_streaming,
+            "n": 1,
+        }
+
+        if self.is_streaming:
+            # The final chunk reports the usage we bill for.
+            options["stream_options"] = {"include_usage": True}
+
+        return options
+
+    def result(self, answer, cost):
+        """
+        Response body for generated text. The cost is in micro-credits.
+        """
+        return {
+            "detail": "Text generated successfully",
+            "prompt": {
+                "name": self.prompt_name,
+                "messages": [
+                    {
+                        "role": "user",
+                        "content": answer
+                    }
+                ]
+            },
+            "cost": cost / MILLION
+        }
+
+
+class StreamTally:
+    """
+    Collects a streamed completion chunk by chunk, keeping a running token
+    count so it can be billed even if the stream ends before the usage arrives.
+    """
+
+    def __init__(self, generation):
+        self.generation = generation
+        self.encoding = get_encoding(generation.model)
+        self.answer = []
+        self.completion_tokens = 0
+        self.usage = None
+
+    def add(self, chunk):
+        """
+        Record a chunk, returning its text (or None if it has none).
+        """
+        if chunk.usage is not None:
+            self.usage = chunk.usage
+
+        if not chunk.choices or not chunk.choices[0].delta.content:
+            return None
+
+        text = chunk.choices[0].delta.content
+        self.answer.append(text)
+        self.completion_tokens += len(self.encoding.encode(text, disallowed_special=()))
+
+        return text
+
+    def cost(self):
+        """
+        Cost of the stream so far, in micro-credits.
+        """
+        if self.usage is not None:
+            return self.generation.quote.final_micro_cost(self.usage)
+
+        return micro_cost(self.generation.model, self.generation.quote.prompt_tokens, self.completion_tokens)
+
+    def result(self, cost):
+        return self.generation.result("".join(self.answer), cost)
@@ -0,0 +1,188 @@
+"""
+Password hashing off the request threads.
+
+The password hasher is deliberately slow: PBKDF2 takes hundreds of
+milliseconds of CPU. Run inline, a burst of logins, whether a brute-force
+attempt or every client reconnecting at once, holds every request thread
+and starves the rest of the API.
+
+Here hashing runs in a pool of PASSWORD_HASHER_WORKERS threads of its
+own, with at most PASSWORD_HASHER_QUEUE more hashes waiting. Past that,
+HasherBusy is raised at once, and the login is refused with a 503 rather
+than queued. hashlib releases the GIL while hashing, so the pool runs
+alongside the request threads, and async views can await it without
+holding one at all.
+
+PooledModelBackend, Django's ModelBackend hashing in the pool, is the
+authentication backend (see AUTHENTICATION_BACKENDS), so authenticate()
+and aauthenticate() use it.
+"""
+
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.contrib.auth import get_user_model, hashers
+from django.contrib.auth.backends import ModelBackend
+
+
+class HasherBusy(Exception):
+    """
+    Too many passwords are being hashed, or waiting to be, to take another.
+    """
+
+
+class BoundedExecutor:
+    """
+    A thread pool which refuses work, rather than queueing it without
+    limit, once `workers` jobs are running and `queue_size` more waiting.
+    """
+
+    def __init__(self, workers, queue_size):
+        self._pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='hasher')
+        self._slots = threading.BoundedSemaphore(workers + queue_size)
+
+    def submit(self, fn, *args):
+        """
+        Run fn(*args) in the pool, returning its Future. Raises HasherBusy
+        if the pool and its queue are full.
+        """
+        if not self._slots.acquire(blocking=False):
+            raise HasherBusy()
+
+        def job():
+            try:
+                return fn(*args)
+            finally:
+                # Before the result is seen.
+                self._slots.release()
+
+        try:
+            return self._pool.submit(job)
+        except BaseException:
+            self._slots.release()
+            raise
+
+    def run(self, fn, *args):
+        return self.submit(fn, *args).result()
+
+    async def arun(self, fn, *args):
+        # Awaited, so no thread waits for it.
+        return await asyncio.wrap_future(self.submit(fn, *args))
+
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def get_executor():
+    """
+    The worker's pool, started on first use (so after the server forks).
+    """
+    global _executor
+
+    with _executor_lock:
+        if _executor is None:
+            _executor = BoundedExecutor(settings.PASSWORD_HASHER_WORKERS, settings.PASSWORD_HASHER_QUEUE)
+
+        return _executor
+
+
+def verify(password, encoded):
+    """
+    Whether the password matches the encoded hash, and its new hash if the
+    hash should be upgraded (as when the hasher's iterations are raised),
+    or None. Only hashes: safe to run in the pool.
+    """
+    upgraded = []
+    valid = hashers.check_password(password, encoded, setter=lambda raw: upgraded.append(hashers.make_password(raw)))
+    return valid, upgraded[0] if upgraded else None
+
+
+def make_password(password):
+    """
+    hashers.make_password, in the pool.
+    """
+    return get_executor().run(hashers.make_password, password)
+
+
+def check_password(user, password):
+    """
+    user.check_password, hashing in the pool.
+    """
+    valid, upgraded = get_executor().run(verify, password, user.password)
+
+    if upgraded is not None:
+        user.password = upgraded
+        user.save(update_fields=['password'])
+
+    return valid
+
+
+async def acheck_password(user, password):
+    """
+    user.acheck_password, hashing in the pool.
+    """
+    valid, upgraded = await get_executor().arun(verify, password, user.password)
+
+    if upgraded is not None:
+        user.password = upgraded
+        await user.asave(update_fields=['password'])
+
+    return valid
+
+
+def set_password(user, password):
+    """
+    user.set_password, hashing in the pool. The user isn't saved.
+    """
+    user.password = make_password(password)
+
+
+class PooledModelBackend(ModelBackend):
+    """
+    ModelBackend, hashing passwords in the pool. Raises HasherBusy if it's
+    full, from authenticate() and aauthenticate().
+    """
+
+    def authenticate(self, request, username=None, password=None, **kwargs):
+        UserModel = get_user_model()
+
+        if username is None:
+            username = kwargs.get(UserModel.USERNAME_FIELD)
+
+        if username is None or password is None:
+            return None
+
+        try:
+            user = UserModel._default_manager.get_by_natural_key(username)
+        except UserModel.DoesNotExist:
+            # Hash anyway, so unknown usernames take as long as wrong passwords.
+            make_password(password)
+            return None
+
+        if check_password(user, password) and self.user_can_authenticate(user):
+            return user
+
+        return None
+
+    async def aauthenticate(self, request, username=None, password=None, **kwargs):
+        UserModel = get_user_model()
+
+        if username is None:
+            username = kwargs.get(UserModel.USERNAME_FIELD)
+
+        if username is None or password is None:
+            return None
+
+        try:
+            user = await UserModel._default_manager.aget_by_natural_key(username)
+        except UserModel.DoesNotExist:
+            await get_executor().arun(hashers.make_password, password)
+            return None
+
+        if await acheck_password(user, password) and self.user_can_authenticate(user):
+            return user
+
+        return None
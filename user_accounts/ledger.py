@@ -0,0 +1,223 @@
+"""
+Credit ledger.
+
+Every change to a user's credits is an append-only CreditEntry, applied to
+the user's CreditAccount balance with a single atomic UPDATE ... SET
+balance = balance + amount. Nothing reads the balance before writing it,
+so concurrent requests can't lose each other's updates, and the hot write
+touches one small row rather than the whole User.
+
+Generations reserve their worst-case cost up front as a CreditHold, with a
+conditional UPDATE ... SET held = held + amount WHERE balance - held >=
+amount, and settle it to the actual cost when they finish. Parallel
+generations can't overdraw the account between them, and no row lock is
+held while waiting on the model. Holds expire, so credits reserved by a
+worker that died are freed the next time the user's balance is read.
+
+Amounts are integer micro-credits (millionths of a credit), so costs
+computed by pricing.micro_cost are stored exactly.
+"""
+
+import datetime
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F, Sum
+from django.utils import timezone
+
+from .models import CreditAccount, CreditEntry, CreditHold
+from .pricing import MILLION
+
+
+class InsufficientCredits(Exception):
+    """
+    The user's available credits don't cover a hold.
+    """
+
+
+def to_micro(credits):
+    """
+    Convert credits to micro-credits.
+    """
+    return round(credits * MILLION)
+
+
+def from_micro(micro_credits):
+    """
+    Convert micro-credits to credits.
+    """
+    return micro_credits / MILLION
+
+
+def get_balance(user):
+    """
+    The user's balance, in micro-credits.
+    """
+    balance = CreditAccount.objects.filter(user_id=user.pk).values_list('balance', flat=True).first()
+    return balance or 0
+
+
+def get_available(user):
+    """
+    The user's balance less their holds, in micro-credits.
+    Releases any of their holds which have expired first.
+    """
+    release_expired(user)
+
+    account = CreditAccount.objects.filter(user_id=user.pk).values_list('balance', 'held').first()
+
+    if account is None:
+        return 0
+
+    balance, held = account
+    return balance - held
+
+
+def post_entry(user, amount, kind, reference=''):
+    """
+    Append an entry to the ledger and apply it to the user's balance.
+    Returns the new CreditEntry.
+    """
+    with transaction.atomic():
+        entry = CreditEntry.objects.create(user_id=user.pk, amount=amount, kind=kind, reference=reference)
+
+        updated = CreditAccount.objects.filter(user_id=user.pk).update(balance=F('balance') + amount)
+
+        if not updated:
+            # First entry for this user.
+            CreditAccount.objects.get_or_create(user_id=user.pk)
+            CreditAccount.objects.filter(user_id=user.pk).update(balance=F('balance') + amount)
+
+    return entry
+
+
+def credit(user, amount, kind=CreditEntry.PURCHASE, reference=''):
+    """
+    Add micro-credits to the user's balance.
+    """
+    return post_entry(user, amount, kind, reference)
+
+
+def debit(user, amount, kind=CreditEntry.GENERATION, reference=''):
+    """
+    Take micro-credits from the user's balance. The balance may go negative.
+    """
+    return post_entry(user, -amount, kind, reference)
+
+
+def set_balance(user, balance):
+    """
+    Set the user's balance, in micro-credits, with an adjustment entry for
+    the difference. For admin use and tests; this reads the balance before
+    writing it, so the account row is locked while it does.
+    """
+    with transaction.atomic():
+        account, _ = CreditAccount.objects.get_or_create(user_id=user.pk)
+        account = CreditAccount.objects.select_for_update().get(pk=account.pk)
+
+        if balance != account.balance:
+            post_entry(user, balance - account.balance, CreditEntry.ADJUSTMENT)
+
+
+def reserve(user, amount, ttl=None):
+    """
+    Hold micro-credits for a generation, returning the new CreditHold.
+
+    Raises InsufficientCredits if the user's available credits don't cover it.
+    """
+    if ttl is None:
+        ttl = settings.CREDIT_HOLD_TTL
+
+    now = timezone.now()
+
+    with transaction.atomic():
+        # Only succeeds if the credits are available when the row is written,
+        # however many other holds are being placed at the same time.
+        updated = CreditAccount.objects.filter(
+            user_id=user.pk, balance__gte=F('held') + amount,
+        ).update(held=F('held') + amount)
+
+        if not updated:
+            raise InsufficientCredits()
+
+        return CreditHold.objects.create(
+            user=user, amount=amount, created=now, expires=now + datetime.timedelta(seconds=ttl))
+
+
+def release(hold):
+    """
+    Free the credits held by a hold. Returns False if it was already
+    released (or settled), e.g. because it expired.
+    """
+    with transaction.atomic():
+        deleted, _ = CreditHold.objects.filter(pk=hold.pk).delete()
+
+        if deleted:
+            CreditAccount.objects.filter(user_id=hold.user_id).update(held=F('held') - hold.amount)
+
+    return bool(deleted)
+
+
+def settle(hold, amount, kind=CreditEntry.GENERATION, reference=''):
+    """
+    Release a hold and debit the actual cost of the generation, in
+    micro-credits. The cost is debited even if the hold has expired.
+    """
+    with transaction.atomic():
+        release(hold)
+        return debit(hold.user, amount, kind, reference)
+
+
+def release_expired(user=None):
+    """
+    Release expired holds, for one user or everyone.
+    Returns the number released.
+    """
+    holds = CreditHold.objects.filter(expires__lte=timezone.now())
+
+    if user is not None:
+        holds = holds.filter(user_id=user.pk)
+
+    return sum(release(hold) for hold in holds.only('pk', 'user_id', 'amount'))
+
+
+def compact(before):
+    """
+    Fold each user's entries created before the given time into a single
+    compaction entry with the same total, so the ledger doesn't grow without
+    bound. Balances are unchanged. Returns the number of entries removed.
+    """
+    removed = 0
+
+    user_ids = CreditEntry.objects.filter(created__lt=before).values_list('user_id', flat=True).distinct()
+
+    for user_id in user_ids.iterator():
+        with transaction.atomic():
+            entries = CreditEntry.objects.select_for_update().filter(user_id=user_id, created__lt=before)
+            ids = list(entries.values_list('id', flat=True))
+
+            if len(ids) < 2:
+                continue
+
+            total = CreditEntry.objects.filter(id__in=ids).aggregate(total=Sum('amount'))['total']
+            CreditEntry.objects.filter(id__in=ids).delete()
+            CreditEntry.objects.create(user_id=user_id, amount=total, kind=CreditEntry.COMPACTION, created=before)
+
+            removed += len(ids) - 1
+
+    return removed
+
+
+def unreconciled_accounts():
+    """
+    Accounts whose balance doesn't match the sum of their ledger entries,
+    or whose held credits don't match the sum of their holds.
+    Should always be empty.
+    """
+    totals = dict(CreditEntry.objects.values_list('user_id').annotate(total=Sum('amount')))
+    held = dict(CreditHold.objects.values_list('user_id').annotate(total=Sum('amount')))
+
+    return [
+        account for account in CreditAccount.objects.all()
+        if account.balance != totals.get(account.user_id, 0) or account.held != held.get(account.user_id, 0)
+    ]
@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from user_accounts.models import RefreshToken
+
+
+class Command(BaseCommand):
+    help = 'Delete expired refresh tokens. Run periodically.'
+
+    def handle(self, *args, **options):
+        # Replaced tokens are kept until then, to catch their reuse.
+        removed, _ = RefreshToken.objects.filter(expires__lte=timezone.now()).delete()
+
+        self.stdout.write(f'Removed {removed} expired refresh tokens.')
@@ -0,0 +1,20 @@
+from django.core.management.base import BaseCommand
+
+from user_accounts.models import EditorBlock, EditorBlockVector
+
+
+class Command(BaseCommand):
+    help = 'Delete stored doc blocks, and block vectors, which no doc refers to any more. Run periodically.'
+
+    def handle(self, *args, **options):
+        user_ids = EditorBlock.objects.filter(refs=0).values_list('user_id', flat=True).distinct()
+
+        # One user at a time, so saves are only held up for their own user's.
+        deleted = sum(EditorBlock.objects.collect(user_id) for user_id in list(user_ids))
+
+        self.stdout.write(f'Deleted {deleted} unreferenced blocks.')
+
+        user_ids = EditorBlockVector.objects.values_list('user_id', flat=True).distinct()
+        deleted = sum(EditorBlockVector.objects.collect(user_id) for user_id in list(user_ids))
+
+        self.stdout.write(f'Deleted {deleted} unused block vectors.')
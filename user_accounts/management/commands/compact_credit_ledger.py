@@ -0,0 +1,24 @@
+import datetime
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+
+from user_accounts.ledger import compact, unreconciled_accounts
+
+
+class Command(BaseCommand):
+    help = 'Fold old credit ledger entries into one entry per user, and check balances match the ledger. Run periodically.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int, default=90, help='Compact entries older than this many days.')
+
+    def handle(self, *args, **options):
+        before = timezone.now() - datetime.timedelta(days=options['days'])
+
+        removed = compact(before)
+        self.stdout.write(f'Removed {removed} ledger entries older than {before:%Y-%m-%d}.')
+
+        unreconciled = unreconciled_accounts()
+
+        if unreconciled:
+            raise CommandError(f'{len(unreconciled)} credit balances do not match the ledger: {", ".join(str(account) for account in unreconciled)}')
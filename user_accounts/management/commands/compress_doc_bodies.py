@@ -0,0 +1,59 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from user_accounts import documents
+from user_accounts.models import EditorFile
+
+
+class Command(BaseCommand):
+    help = 'Compress stored doc bodies larger than the threshold, or decompress them all. Can be run repeatedly, so the change can be made gradually.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--threshold', type=int, default=settings.DOC_BODY_COMPRESSION_THRESHOLD, help='Compress bodies larger than this many bytes of JSON.')
+        parser.add_argument('--decompress', action='store_true', help='Store compressed bodies uncompressed again.')
+        parser.add_argument('--batch-size', type=int, default=500, help='Docs rewritten per transaction.')
+        parser.add_argument('--limit', type=int, default=None, help='Stop after this many docs.')
+
+    def handle(self, *args, **options):
+        if options['decompress']:
+            docs = EditorFile.objects.filter(body_zlib__isnull=False)
+        elif options['threshold'] is None:
+            raise CommandError('No threshold: set DOC_BODY_COMPRESSION_THRESHOLD or pass --threshold.')
+        else:
+            docs = EditorFile.objects.filter(body_zlib__isnull=True, chunked=False, body_size__gt=options['threshold'])
+
+        docs = docs.only('uid', 'version', 'body', 'body_zlib').order_by('uid')
+
+        rewritten = skipped = 0
+        last = None
+
+        while options['limit'] is None or rewritten + skipped < options['limit']:
+            batch_size = options['batch_size']
+
+            if options['limit'] is not None:
+                batch_size = min(batch_size, options['limit'] - rewritten - skipped)
+
+            batch = list((docs if last is None else docs.filter(uid__gt=last))[:batch_size])
+
+            if not batch:
+                break
+
+            with transaction.atomic():
+                for doc in batch:
+                    if options['decompress']:
+                        body, body_zlib = doc.body, None
+                    else:
+                        body, body_zlib = documents.encode_body(doc.body, options['threshold'])
+
+                    # The body is unchanged, so the version (and ETag) is kept.
+                    # Docs saved since they were read are skipped.
+                    if EditorFile.objects.filter(pk=doc.pk, version=doc.version).update(body=body, body_zlib=body_zlib):
+                        rewritten += 1
+                    else:
+                        skipped += 1
+
+            last = batch[-1].pk
+
+        action = 'Decompressed' if options['decompress'] else 'Compressed'
+        self.stdout.write(f'{action} {rewritten} doc bodies; skipped {skipped} saved meanwhile.')
@@ -0,0 +1,15 @@
+from django.core.management.base import BaseCommand
+
+from user_accounts.models import EditorFile
+
+
+class Command(BaseCommand):
+    help = 'Embed docs saved since they were last embedded, for related docs. Docs are embedded as they\'re written; run after deploying related docs, for docs saved before.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=100, help='Docs read at a time.')
+
+    def handle(self, *args, **options):
+        embedded = EditorFile.objects.embed(batch_size=options['batch_size'])
+
+        self.stdout.write(f'Embedded {embedded} docs.')
@@ -0,0 +1,15 @@
+from django.core.management.base import BaseCommand
+
+from user_accounts.models import EditorFile
+
+
+class Command(BaseCommand):
+    help = 'Index docs saved since they were last indexed for search. Docs are indexed as they\'re written; run after deploying search, for docs saved before.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=100, help='Docs read at a time.')
+
+    def handle(self, *args, **options):
+        indexed = EditorFile.objects.index(batch_size=options['batch_size'])
+
+        self.stdout.write(f'Indexed {indexed} docs.')
@@ -0,0 +1,22 @@
+import datetime
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from user_accounts.models import EditorFileRevision
+
+
+class Command(BaseCommand):
+    help = 'Thin out old doc revisions to the last of each day, and compact those left. Run periodically.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int, default=30, help='Keep every revision from the last this many days.')
+
+    def handle(self, *args, **options):
+        before = timezone.now() - datetime.timedelta(days=options['days'])
+        file_ids = EditorFileRevision.objects.filter(created__lt=before).values_list('file_id', flat=True).distinct()
+
+        # One doc at a time, so saves are only held up for the doc being pruned.
+        removed = sum(EditorFileRevision.objects.prune(file_id, before) for file_id in list(file_ids))
+
+        self.stdout.write(f'Removed {removed} doc revisions older than {before:%Y-%m-%d}.')
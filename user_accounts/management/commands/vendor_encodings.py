@@ -0,0 +1,31 @@
+import os
+
+import tiktoken
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+
+class Command(BaseCommand):
+    help = 'Download Tiktoken BPE files into TIKTOKEN_ENCODINGS_DIR, so workers can start without network access.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('models', nargs='*', help='Model names to vendor encodings for (default: TIKTOKEN_WARMUP_MODELS).')
+
+    def handle(self, *args, **options):
+        directory = getattr(settings, 'TIKTOKEN_ENCODINGS_DIR', None)
+
+        if not directory:
+            raise CommandError('TIKTOKEN_ENCODINGS_DIR is not set.')
+
+        os.makedirs(directory, exist_ok=True)
+
+        # Tiktoken stores downloaded files in its cache directory, under
+        # the names it looks them up by, so fill the vendored directory
+        # by loading each encoding with the cache pointed at it.
+        os.environ['TIKTOKEN_CACHE_DIR'] = str(directory)
+
+        models = options['models'] or settings.TIKTOKEN_WARMUP_MODELS
+
+        for model in models:
+            encoding = tiktoken.encoding_for_model(model)
+            self.stdout.write(f'Vendored {encoding.name} for {model} into {directory}')
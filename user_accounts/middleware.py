@@ -0,0 +1,74 @@
+import time
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction, sync_to_async
+from django.conf import settings
+
+from .authentication import COOKIE_NAME, REFRESH_COOKIE_NAME, decode_jwt_token, refresh_session, set_session_cookies
+
+
+class TokenRefreshMiddleware:
+    """
+    Keeps active users logged in without their passwords.
+
+    An access token with less than ACCESS_TOKEN_REFRESH_WINDOW left, or
+    which has expired, been ended (see end_tokens), or is missing, is
+    replaced using the refresh cookie (rotating it), so a session ended by
+    logging out or resetting the password can't be renewed with a copy of
+    its access token, while the user's other sessions, whose access tokens
+    logging out ends too, carry on. Tokens which aren't valid are replaced
+    before the view runs, so the request itself is authenticated.
+
+    Async under ASGI, so async views (as /generate/text/async) don't hold
+    a thread for the whole request.
+    """
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+        if iscoroutinefunction(self.get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+
+        session = self.renew(request)
+        return self.respond(self.get_response(request), session)
+
+    async def __acall__(self, request):
+        # decode_jwt_token and refresh_session may query.
+        session = await sync_to_async(self.renew)(request)
+        return self.respond(await self.get_response(request), session)
+
+    def renew(self, request):
+        """
+        The new (access, refresh) tokens for the request's session, if it
+        needs them. Refresh is None unless it was rotated.
+        """
+        verified = decode_jwt_token(request)
+
+        if verified is not None and verified.claims['exp'] - time.time() >= settings.ACCESS_TOKEN_REFRESH_WINDOW:
+            return None
+
+        if not request.COOKIES.get(REFRESH_COOKIE_NAME):
+            return None
+
+        # None if the session has ended. A token near its expiry is still
+        # good until then.
+        session = refresh_session(request.COOKIES[REFRESH_COOKIE_NAME])
+
+        if session is not None:
+            # For JWTCookieAuthentication, in this request.
+            request.COOKIES[COOKIE_NAME] = session[0]
+
+        return session
+
+    def respond(self, response, session):
+        if session is not None:
+            # Unless the view set its own, as on logging in or out.
+            set_session_cookies(response, *session)
+
+        return response
@@ -0,0 +1,37 @@
+"""
+Migration operations for changing large tables on PostgreSQL without
+holding locks which block reads or writes for the length of a scan or
+rewrite of the table.
+"""
+
+from django.db import migrations
+
+
+class OnPostgreSQL(migrations.SeparateDatabaseAndState):
+    """
+    The given operations, but on PostgreSQL, the postgresql operations
+    instead: the same change to the schema, made online. The operations
+    alone change the state, so the two must end with the same schema.
+    """
+
+    def __init__(self, operations, postgresql):
+        super().__init__(database_operations=postgresql, state_operations=operations)
+
+    def database_operations_for(self, schema_editor):
+        if schema_editor.connection.vendor == 'postgresql':
+            return self.database_operations
+
+        return self.state_operations
+
+    def database_forwards(self, app_label, schema_editor, from_state, to_state):
+        migrations.SeparateDatabaseAndState(self.database_operations_for(schema_editor)).database_forwards(
+            app_label, schema_editor, from_state, to_state,
+        )
+
+    def database_backwards(self, app_label, schema_editor, from_state, to_state):
+        migrations.SeparateDatabaseAndState(self.database_operations_for(schema_editor)).database_backwards(
+            app_label, schema_editor, from_state, to_state,
+        )
+
+    def describe(self):
+        return "Schema change, made online on PostgreSQL"
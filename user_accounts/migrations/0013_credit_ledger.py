@@ -0,0 +1,65 @@
+# Generated by Django 5.2.18 on 2026-10-18 18:57
+
+import django.db.models.deletion
+import django.utils.timezone
+from django.conf import settings
+from django.db import migrations, models
+
+
+def open_credit_accounts(apps, schema_editor):
+    """
+    Move each user's credits into the ledger, as an opening adjustment.
+    """
+    User = apps.get_model('user_accounts', 'User')
+    CreditAccount = apps.get_model('user_accounts', 'CreditAccount')
+    CreditEntry = apps.get_model('user_accounts', 'CreditEntry')
+
+    for user_id, credits in User.objects.exclude(credits=0).values_list('id', 'credits').iterator():
+        balance = round(credits * 1000000)
+        CreditAccount.objects.create(user_id=user_id, balance=balance)
+        CreditEntry.objects.create(user_id=user_id, amount=balance, kind='adjustment', reference='Opening balance')
+
+
+def close_credit_accounts(apps, schema_editor):
+    User = apps.get_model('user_accounts', 'User')
+    CreditAccount = apps.get_model('user_accounts', 'CreditAccount')
+
+    for user_id, balance in CreditAccount.objects.values_list('user_id', 'balance').iterator():
+        User.objects.filter(id=user_id).update(credits=balance / 1000000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('user_accounts', '0012_alter_prompt_uid'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CreditAccount',
+            fields=[
+                ('user', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='credit_account', serialize=False, to=settings.AUTH_USER_MODEL)),
+                ('balance', models.BigIntegerField(default=0)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='CreditEntry',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('amount', models.BigIntegerField()),
+                ('kind', models.CharField(choices=[('purchase', 'Purchase'), ('generation', 'Generation'), ('adjustment', 'Adjustment'), ('compaction', 'Compaction')], max_length=20)),
+                ('reference', models.CharField(blank=True, default='', max_length=255)),
+                ('created', models.DateTimeField(default=django.utils.timezone.now)),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='credit_entries', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'verbose_name_plural': 'credit entries',
+                'indexes': [models.Index(fields=['user', 'created'], name='user_accoun_user_id_bf2cea_idx')],
+            },
+        ),
+        migrations.RunPython(open_credit_accounts, close_credit_accounts),
+        migrations.RemoveField(
+            model_name='user',
+            name='credits',
+        ),
+    ]
@@ -0,0 +1,88 @@
+# Generated by Django 5.2.18 on 2026-10-18 19:04
+
+import json
+
+from django.db import migrations, models
+
+# Copied from user_accounts/documents.py, as it was when this migration
+# was written, so later changes there don't change what it does.
+
+PREVIEW_LENGTH = 200
+
+TEXT_KEYS = ("text", "content", "children")
+
+def body_text(body):
+    if isinstance(body, str):
+        return body
+
+    if isinstance(body, list):
+        return " ".join(text for text in map(body_text, body) if text)
+
+    if isinstance(body, dict):
+        values = [body[key] for key in TEXT_KEYS if key in body] or list(body.values())
+        return " ".join(text for text in map(body_text, values) if text)
+
+    return ""
+
+def preview(body, length=PREVIEW_LENGTH):
+    text = " ".join(body_text(body).split())
+
+    if len(text) > length:
+        return text[:length - 1].rstrip() + "…"
+
+    return text
+
+def body_size(body):
+    return len(json.dumps(body, ensure_ascii=False).encode())
+
+def block_count(body):
+    if isinstance(body, list):
+        return len(body)
+
+    return 1 if body else 0
+
+def summarize_files(apps, schema_editor):
+    """
+    Compute the summary of every existing file.
+    """
+    EditorFile = apps.get_model('user_accounts', 'EditorFile')
+
+    batch = []
+
+    for file in EditorFile.objects.only('uid', 'body').iterator(chunk_size=500):
+        file.preview = preview(file.body)
+        file.body_size = body_size(file.body)
+        file.block_count = block_count(file.body)
+        batch.append(file)
+
+        if len(batch) == 500:
+            EditorFile.objects.bulk_update(batch, ['preview', 'body_size', 'block_count'])
+            batch = []
+
+    EditorFile.objects.bulk_update(batch, ['preview', 'body_size', 'block_count'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('user_accounts', '0014_credit_holds'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='editorfile',
+            name='block_count',
+            field=models.PositiveIntegerField(default=0, help_text='Number of blocks in body'),
+        ),
+        migrations.AddField(
+            model_name='editorfile',
+            name='body_size',
+            field=models.PositiveIntegerField(default=0, help_text='Size of body, in bytes of JSON'),
+        ),
+        migrations.AddField(
+            model_name='editorfile',
+            name='preview',
+            field=models.CharField(blank=True, default='', help_text='Start of the text in file', max_length=200),
+        ),
+        migrations.RunPython(summarize_files, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,100 @@
+# Generated by Django 5.2.18 on 2026-10-18 19:20
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models, transaction
+
+from user_accounts.migration_operations import OnPostgreSQL
+
+# Files updated per transaction.
+BATCH_SIZE = 1000
+
+def check_authors(apps, schema_editor):
+    """
+    Stop, before changing anything, if any file's author has no User, so
+    no one's files are lost: reassign them to the right username, or
+    delete them, and migrate again.
+    """
+    EditorFile = apps.get_model('user_accounts', 'EditorFile')
+    User = apps.get_model('user_accounts', 'User')
+
+    # Files whose author has no User (deleted, or renamed).
+    orphaned = {}
+    for author, uid in EditorFile.objects.exclude(author__in=User.objects.values('username')).values_list('author', 'uid'):
+        orphaned.setdefault(author, []).append(str(uid))
+
+    if orphaned:
+        report = "\n".join(f"  {author!r}: {', '.join(uids)}" for author, uids in sorted(orphaned.items()))
+        raise RuntimeError(
+            f"Files whose author has no user, by author:\n{report}\n"
+            "Set their author to an existing username, or delete them, then migrate again."
+        )
+
+def backfill_authors(apps, schema_editor):
+    """
+    Point each file at its author's User, a batch at a time, so the table
+    isn't locked for the length of the whole backfill. Files whose author
+    was deleted since check_authors are left without one, and 0018 stops
+    until they're dealt with.
+    """
+    EditorFile = apps.get_model('user_accounts', 'EditorFile')
+    User = apps.get_model('user_accounts', 'User')
+
+    files_left = EditorFile.objects.filter(author_user__isnull=True).order_by('uid')
+    last = None
+
+    while True:
+        batch = list((files_left if last is None else files_left.filter(uid__gt=last)).values_list('uid', 'author')[:BATCH_SIZE])
+
+        if not batch:
+            break
+
+        last = batch[-1][0]
+
+        files = {}
+        for uid, author in batch:
+            files.setdefault(author, []).append(uid)
+
+        user_ids = dict(User.objects.filter(username__in=files).values_list('username', 'id'))
+
+        with transaction.atomic():
+            for author, uids in files.items():
+                if author in user_ids:
+                    EditorFile.objects.filter(uid__in=uids).update(author_user_id=user_ids[author])
+
+class Migration(migrations.Migration):
+
+    # Each batch of the backfill commits on its own.
+    atomic = False
+
+    dependencies = [
+        ('user_accounts', '0016_hot_lookup_indexes'),
+    ]
+
+    operations = [
+        # First, so nothing has changed if it stops the migration.
+        migrations.RunPython(check_authors, migrations.RunPython.noop),
+        OnPostgreSQL(
+            [
+                migrations.AddField(
+                    model_name='editorfile',
+                    name='author_user',
+                    field=models.ForeignKey(null=True, on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL),
+                ),
+            ],
+            # Without scanning the table: the foreign key is only checked
+            # for rows written from now on (0018 checks the rest), and the
+            # column isn't indexed, as 0018 would only drop the index.
+            postgresql=[
+                migrations.RunSQL(
+                    [
+                        'ALTER TABLE user_accounts_editorfile ADD COLUMN author_user_id bigint NULL',
+                        'ALTER TABLE user_accounts_editorfile ADD CONSTRAINT editorfile_author_fk FOREIGN KEY (author_user_id)'
+                        ' REFERENCES user_accounts_user (id) DEFERRABLE INITIALLY DEFERRED NOT VALID',
+                    ],
+                    'ALTER TABLE user_accounts_editorfile DROP COLUMN author_user_id',
+                ),
+            ],
+        ),
+        migrations.RunPython(backfill_authors, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,116 @@
+# Generated by Django 5.2.18 on 2026-10-18 19:20
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import OuterRef, Subquery
+
+from user_accounts.migration_operations import OnPostgreSQL
+
+def backfill_new_files(apps, schema_editor):
+    """
+    Point files created since 0017's backfill, by code which only set the
+    username, at their author's User. Usually few, so in one UPDATE.
+    """
+    EditorFile = apps.get_model('user_accounts', 'EditorFile')
+    User = apps.get_model('user_accounts', 'User')
+
+    EditorFile.objects.filter(author_user__isnull=True).update(
+        author_user=Subquery(User.objects.filter(username=OuterRef('author')).values('pk')[:1]),
+    )
+
+def restore_usernames(apps, schema_editor):
+    """
+    Reverse: copy each file's author's username back into the author column.
+    """
+    EditorFile = apps.get_model('user_accounts', 'EditorFile')
+    User = apps.get_model('user_accounts', 'User')
+
+    EditorFile.objects.update(author=Subquery(User.objects.filter(pk=OuterRef('author_user_id')).values('username')[:1]))
+
+class Migration(migrations.Migration):
+
+    # On PostgreSQL, indexes are built concurrently, and constraints
+    # validated, outside a transaction.
+    atomic = False
+
+    dependencies = [
+        ('user_accounts', '0017_editorfile_author_user'),
+    ]
+
+    operations = [
+        migrations.RunPython(backfill_new_files, migrations.RunPython.noop),
+        OnPostgreSQL(
+            [
+                migrations.RemoveIndex(
+                    model_name='editorfile',
+                    name='editorfile_author_created_idx',
+                ),
+                # The default lets the column be added back, and refilled, when reversing.
+                migrations.AlterField(
+                    model_name='editorfile',
+                    name='author',
+                    field=models.CharField(default='', help_text='Username of file creator', max_length=20),
+                ),
+                migrations.RunPython(migrations.RunPython.noop, restore_usernames),
+                migrations.RemoveField(
+                    model_name='editorfile',
+                    name='author',
+                ),
+                migrations.RenameField(
+                    model_name='editorfile',
+                    old_name='author_user',
+                    new_name='author',
+                ),
+                migrations.AlterField(
+                    model_name='editorfile',
+                    name='author',
+                    field=models.ForeignKey(db_index=False, help_text='File creator', on_delete=django.db.models.deletion.CASCADE, related_name='files', to=settings.AUTH_USER_MODEL),
+                ),
+                migrations.AddIndex(
+                    model_name='editorfile',
+                    index=models.Index(fields=['author', '-created', '-uid'], name='editorfile_author_created_idx'),
+                ),
+            ],
+            # Only scans of the table that don't block reads or writes, and
+            # changes to its definition, each locking it only for a moment.
+            postgresql=[
+                # Built before the index it replaces is dropped, so listings keep an index.
+                migrations.RunSQL(
+                    'CREATE INDEX CONCURRENTLY editorfile_author_created_new ON user_accounts_editorfile (author_user_id, created DESC, uid DESC)',
+                    'DROP INDEX CONCURRENTLY editorfile_author_created_new',
+                ),
+                migrations.RunSQL(
+                    'DROP INDEX CONCURRENTLY editorfile_author_created_idx',
+                    'CREATE INDEX CONCURRENTLY editorfile_author_created_idx ON user_accounts_editorfile (author, created DESC, uid DESC)',
+                ),
+                migrations.RunSQL(
+                    'ALTER INDEX editorfile_author_created_new RENAME TO editorfile_author_created_idx',
+                    'ALTER INDEX editorfile_author_created_idx RENAME TO editorfile_author_created_new',
+                ),
+                migrations.RunPython(migrations.RunPython.noop, restore_usernames),
+                migrations.RunSQL(
+                    'ALTER TABLE user_accounts_editorfile DROP COLUMN author',
+                    "ALTER TABLE user_accounts_editorfile ADD COLUMN author varchar(20) NOT NULL DEFAULT ''",
+                ),
+                migrations.RunSQL(
+                    'ALTER TABLE user_accounts_editorfile RENAME COLUMN author_user_id TO author_id',
+                    'ALTER TABLE user_accounts_editorfile RENAME COLUMN author_id TO author_user_id',
+                ),
+                # The foreign key added NOT VALID by 0017, checked for the
+                # rows before it, and the column made NOT NULL by way of a
+                # CHECK constraint checked the same way, so SET NOT NULL
+                # needn't scan the table holding its lock.
+                migrations.RunSQL(
+                    [
+                        'ALTER TABLE user_accounts_editorfile VALIDATE CONSTRAINT editorfile_author_fk',
+                        'ALTER TABLE user_accounts_editorfile ADD CONSTRAINT editorfile_author_not_null CHECK (author_id IS NOT NULL) NOT VALID',
+                        'ALTER TABLE user_accounts_editorfile VALIDATE CONSTRAINT editorfile_author_not_null',
+                        'ALTER TABLE user_accounts_editorfile ALTER COLUMN author_id SET NOT NULL',
+                        'ALTER TABLE user_accounts_editorfile DROP CONSTRAINT editorfile_author_not_null',
+                    ],
+                    'ALTER TABLE user_accounts_editorfile ALTER COLUMN author_id DROP NOT NULL',
+                ),
+            ],
+        ),
+    ]
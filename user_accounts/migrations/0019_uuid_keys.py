@@ -0,0 +1,143 @@
+# Generated by Django 5.2.18 on 2026-10-18 19:20
+
+import uuid
+from django.db import migrations, models, transaction
+
+from user_accounts.migration_operations import OnPostgreSQL
+
+# Rows converted per transaction, on PostgreSQL.
+BATCH_SIZE = 1000
+
+# The tables whose uid column becomes a uuid, with the length it had as
+# a varchar, and the indexes on it other than the key, as (name, columns
+# with {} for the uid column).
+TABLES = {
+    'user_accounts_editorfile': (50, [('editorfile_author_created_idx', 'author_id, created DESC, {} DESC')]),
+    'user_accounts_prompt': (100, []),
+}
+
+def strip_uuid_hyphens(apps, schema_editor):
+    """
+    Without a native UUID type, UUIDFields are stored as 32 hex digits, but
+    the CharFields held them with hyphens. PostgreSQL converts the column
+    itself, in convert_keys below.
+    """
+    if schema_editor.connection.features.has_native_uuid_field:
+        return
+
+    for model_name in ('EditorFile', 'Prompt'):
+        table = schema_editor.quote_name(apps.get_model('user_accounts', model_name)._meta.db_table)
+        schema_editor.execute(f"UPDATE {table} SET uid = REPLACE(uid, '-', '')")
+
+def add_uuid_hyphens(apps, schema_editor):
+    if schema_editor.connection.features.has_native_uuid_field:
+        return
+
+    for model_name in ('EditorFile', 'Prompt'):
+        Model = apps.get_model('user_accounts', model_name)
+
+        for uid in Model.objects.values_list('uid', flat=True).iterator():
+            Model.objects.filter(uid=uid).update(uid=str(uuid.UUID(uid)))
+
+def convert_keys(apps, schema_editor):
+    """
+    On PostgreSQL, rather than ALTER COLUMN ... TYPE uuid, which rewrites
+    the table, and its indexes, holding a lock which blocks even reads: a
+    uuid column is added beside each uid, kept in step by a trigger,
+    filled a batch at a time, and indexed concurrently, then swapped for
+    it in one brief transaction.
+    """
+    cursor = schema_editor.connection.cursor()
+
+    cursor.execute("""
+        CREATE FUNCTION user_accounts_uid_to_uuid() RETURNS trigger AS $$
+        BEGIN
+            NEW.uid_new := NEW.uid::uuid;
+            RETURN NEW;
+        END
+        $$ LANGUAGE plpgsql
+    """)
+
+    for table, (length, indexes) in TABLES.items():
+        cursor.execute(f'ALTER TABLE {table} ADD COLUMN uid_new uuid NULL')
+        cursor.execute(f'CREATE TRIGGER {table}_uid_new BEFORE INSERT OR UPDATE ON {table} FOR EACH ROW EXECUTE FUNCTION user_accounts_uid_to_uuid()')
+
+        # Rows written from here on are filled by the trigger.
+        last = ''
+
+        while True:
+            cursor.execute(f'SELECT uid FROM {table} WHERE uid > %s ORDER BY uid LIMIT %s', [last, BATCH_SIZE])
+            batch = [row[0] for row in cursor.fetchall()]
+
+            if not batch:
+                break
+
+            with transaction.atomic(using=schema_editor.connection.alias):
+                cursor.execute(f'UPDATE {table} SET uid_new = uid::uuid WHERE uid > %s AND uid <= %s', [last, batch[-1]])
+
+            last = batch[-1]
+
+        cursor.execute(f'CREATE UNIQUE INDEX CONCURRENTLY {table}_uid_new_key ON {table} (uid_new)')
+
+        for name, columns in indexes:
+            cursor.execute(f"CREATE INDEX CONCURRENTLY {name}_new ON {table} ({columns.format('uid_new')})")
+
+        # So SET NOT NULL, below, needn't scan the table.
+        cursor.execute(f'ALTER TABLE {table} ADD CONSTRAINT {table}_uid_new_not_null CHECK (uid_new IS NOT NULL) NOT VALID')
+        cursor.execute(f'ALTER TABLE {table} VALIDATE CONSTRAINT {table}_uid_new_not_null')
+
+        # The swap. Dropping uid drops the key, and the indexes on it.
+        with transaction.atomic(using=schema_editor.connection.alias):
+            cursor.execute(f'ALTER TABLE {table} ALTER COLUMN uid_new SET NOT NULL')
+            cursor.execute(f'ALTER TABLE {table} DROP CONSTRAINT {table}_uid_new_not_null')
+            cursor.execute(f'DROP TRIGGER {table}_uid_new ON {table}')
+            cursor.execute(f'ALTER TABLE {table} DROP COLUMN uid')
+            cursor.execute(f'ALTER TABLE {table} RENAME COLUMN uid_new TO uid')
+            cursor.execute(f'ALTER TABLE {table} ADD CONSTRAINT {table}_pkey PRIMARY KEY USING INDEX {table}_uid_new_key')
+
+            for name, columns in indexes:
+                cursor.execute(f'ALTER INDEX {name}_new RENAME TO {name}')
+
+    cursor.execute('DROP FUNCTION user_accounts_uid_to_uuid()')
+
+def restore_keys(apps, schema_editor):
+    """
+    Reverse, on PostgreSQL: as AlterField would, rewriting the tables.
+    Not online; only for rolling back.
+    """
+    cursor = schema_editor.connection.cursor()
+
+    for table, (length, indexes) in TABLES.items():
+        cursor.execute(f'ALTER TABLE {table} ALTER COLUMN uid TYPE varchar({length}) USING uid::varchar({length})')
+        cursor.execute(f'CREATE INDEX {table}_uid_like ON {table} (uid varchar_pattern_ops)')
+
+class Migration(migrations.Migration):
+
+    # On PostgreSQL, each batch commits on its own, and indexes are built
+    # concurrently, outside a transaction.
+    atomic = False
+
+    dependencies = [
+        ('user_accounts', '0018_editorfile_author_fk'),
+    ]
+
+    operations = [
+        migrations.RunPython(strip_uuid_hyphens, add_uuid_hyphens),
+        OnPostgreSQL(
+            [
+                migrations.AlterField(
+                    model_name='editorfile',
+                    name='uid',
+                    field=models.UUIDField(default=uuid.uuid4, editable=False, help_text='ID of file', primary_key=True, serialize=False),
+                ),
+                migrations.AlterField(
+                    model_name='prompt',
+                    name='uid',
+                    field=models.UUIDField(default=uuid.uuid4, primary_key=True, serialize=False),
+                ),
+            ],
+            postgresql=[
+                migrations.RunPython(convert_keys, restore_keys),
+            ],
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-18 19:16
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('user_accounts', '0019_uuid_keys'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='editorfile',
+            name='version',
+            field=models.PositiveBigIntegerField(default=1, help_text='Number of times file has been saved'),
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 5.2.18 on 2026-10-18 21:02
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('user_accounts', '0020_editorfile_version'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='editorfile',
+            name='body',
+            field=models.JSONField(default=list, help_text='Text stored in file', null=True),
+        ),
+        migrations.AddField(
+            model_name='editorfile',
+            name='body_zlib',
+            field=models.BinaryField(editable=False, help_text='Compressed text stored in file', null=True),
+        ),
+    ]
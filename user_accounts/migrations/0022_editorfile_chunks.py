@@ -0,0 +1,34 @@
+# Generated by Django 5.2.18 on 2026-10-18 19:29
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('user_accounts', '0021_editorfile_body_zlib'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='editorfile',
+            name='chunked',
+            field=models.BooleanField(default=False, help_text='Whether body is stored in chunks'),
+        ),
+        migrations.CreateModel(
+            name='EditorFileChunk',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('position', models.PositiveIntegerField()),
+                ('blocks', models.JSONField(default=list)),
+                ('block_count', models.PositiveIntegerField(default=0, help_text='Number of blocks in chunk')),
+                ('body_size', models.PositiveIntegerField(default=0, help_text='Bytes the blocks add to the JSON of the body')),
+                ('file', models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='chunks', to='user_accounts.editorfile')),
+            ],
+            options={
+                'ordering': ['position'],
+                'indexes': [models.Index(fields=['file', 'position'], name='editorfilechunk_file_pos_idx')],
+            },
+        ),
+    ]
@@ -0,0 +1,98 @@
+# Generated by Django 5.2.18 on 2026-10-18 19:39
+
+import hashlib
+import json
+from collections import Counter
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import F
+
+# Copied from user_accounts/blockstore.py, as it was when this migration
+# was written, so later changes there don't change what it does.
+
+DIGEST_SIZE = 16
+
+def digest(block):
+    data = json.dumps(block, ensure_ascii=False, separators=(",", ":")).encode()
+    return hashlib.blake2b(data, digest_size=DIGEST_SIZE).digest()
+
+def pack(digests):
+    return b"".join(digests)
+
+def unpack(data):
+    data = bytes(data)
+    return [data[i:i + DIGEST_SIZE] for i in range(0, len(data), DIGEST_SIZE)]
+
+def store_blocks(apps, schema_editor):
+    """
+    Move the blocks of existing chunks into the block store, one file at a time.
+    """
+    EditorFile = apps.get_model('user_accounts', 'EditorFile')
+    EditorFileChunk = apps.get_model('user_accounts', 'EditorFileChunk')
+    EditorBlock = apps.get_model('user_accounts', 'EditorBlock')
+
+    for pk, author_id in EditorFile.objects.filter(chunked=True).values_list('pk', 'author_id').iterator(chunk_size=500):
+        file_chunks = list(EditorFileChunk.objects.filter(file_id=pk))
+        refs = Counter()
+        contents = {}
+
+        for chunk in file_chunks:
+            digests = [digest(block) for block in chunk.blocks]
+            chunk.digests = pack(digests)
+            refs.update(digests)
+            contents.update(zip(digests, chunk.blocks))
+
+        EditorFileChunk.objects.bulk_update(file_chunks, ['digests'])
+        EditorBlock.objects.bulk_create((EditorBlock(user_id=author_id, digest=key, content=block) for key, block in contents.items()), ignore_conflicts=True)
+
+        for key, count in refs.items():
+            EditorBlock.objects.filter(user_id=author_id, digest=key).update(refs=F('refs') + count)
+
+def restore_blocks(apps, schema_editor):
+    """
+    Put the blocks back in the chunks.
+    """
+    EditorFileChunk = apps.get_model('user_accounts', 'EditorFileChunk')
+    EditorBlock = apps.get_model('user_accounts', 'EditorBlock')
+
+    for chunk in EditorFileChunk.objects.select_related('file').iterator(chunk_size=500):
+        digests = unpack(chunk.digests)
+        contents = {bytes(key): block for key, block in EditorBlock.objects.filter(user_id=chunk.file.author_id, digest__in=digests).values_list('digest', 'content')}
+        chunk.blocks = [contents[key] for key in digests]
+        chunk.save(update_fields=['blocks'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('user_accounts', '0022_editorfile_chunks'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='EditorBlock',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('digest', models.BinaryField(max_length=16)),
+                ('content', models.JSONField()),
+                ('refs', models.PositiveIntegerField(default=0)),
+                ('user', models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='blocks', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'indexes': [models.Index(condition=models.Q(('refs', 0)), fields=['user'], name='editorblock_unreferenced_idx')],
+                'constraints': [models.UniqueConstraint(fields=('user', 'digest'), name='editorblock_user_digest_key')],
+            },
+        ),
+        migrations.AddField(
+            model_name='editorfilechunk',
+            name='digests',
+            field=models.BinaryField(default=b''),
+        ),
+        migrations.RunPython(store_blocks, restore_blocks),
+        migrations.RemoveField(
+            model_name='editorfilechunk',
+            name='blocks',
+        ),
+    ]
@@ -0,0 +1,37 @@
+# Generated by Django 5.2.18 on 2026-10-18 19:49
+
+import django.db.models.deletion
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('user_accounts', '0023_block_store'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='editorfile',
+            name='revisions_since_snapshot',
+            field=models.PositiveSmallIntegerField(editable=False, null=True),
+        ),
+        migrations.CreateModel(
+            name='EditorFileRevision',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('version', models.PositiveBigIntegerField()),
+                ('created', models.DateTimeField(default=django.utils.timezone.now)),
+                ('title', models.CharField(max_length=50)),
+                ('snapshot', models.BinaryField(null=True)),
+                ('delta', models.JSONField(null=True)),
+                ('depth', models.PositiveSmallIntegerField(default=0)),
+                ('file', models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='revisions', to='user_accounts.editorfile')),
+            ],
+            options={
+                'ordering': ['version'],
+                'constraints': [models.UniqueConstraint(fields=('file', 'version'), name='editorfilerevision_file_version_key')],
+            },
+        ),
+    ]
@@ -0,0 +1,68 @@
+# Generated by Django 5.2.18 on 2026-10-18 20:15
+
+import django.contrib.postgres.search
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+def create_search_index(apps, schema_editor):
+    # GIN indexes are PostgreSQL's; elsewhere search uses EditorFileTerm.
+    if schema_editor.connection.vendor == 'postgresql':
+        schema_editor.execute('CREATE INDEX editorfile_search_idx ON user_accounts_editorfile USING gin (search_vector)')
+
+
+def drop_search_index(apps, schema_editor):
+    if schema_editor.connection.vendor == 'postgresql':
+        schema_editor.execute('DROP INDEX editorfile_search_idx')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('user_accounts', '0024_editorfile_revisions'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='EditorFileTerm',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('term', models.CharField(max_length=64)),
+                ('weight', models.PositiveIntegerField(help_text='Times term appears in file, more for the title')),
+            ],
+        ),
+        migrations.AddField(
+            model_name='editorfile',
+            name='indexed_version',
+            field=models.PositiveBigIntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='editorfile',
+            name='search_vector',
+            field=django.contrib.postgres.search.SearchVectorField(editable=False, null=True),
+        ),
+        migrations.AddIndex(
+            model_name='editorfile',
+            index=models.Index(condition=models.Q(('indexed_version__lt', models.F('version'))), fields=['author'], name='editorfile_unindexed_idx'),
+        ),
+        migrations.AddField(
+            model_name='editorfileterm',
+            name='author',
+            field=models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='+', to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.AddField(
+            model_name='editorfileterm',
+            name='file',
+            field=models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='terms', to='user_accounts.editorfile'),
+        ),
+        migrations.AddIndex(
+            model_name='editorfileterm',
+            index=models.Index(fields=['author', 'term', 'weight', 'file'], name='editorfileterm_author_term_idx'),
+        ),
+        migrations.AddConstraint(
+            model_name='editorfileterm',
+            constraint=models.UniqueConstraint(fields=('file', 'term'), name='editorfileterm_file_term_key'),
+        ),
+        migrations.RunPython(create_search_index, drop_search_index),
+    ]
@@ -0,0 +1,59 @@
+# Generated by Django 5.2.18 on 2026-10-18 20:39
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('user_accounts', '0025_search_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='EditorBlockVector',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('digest', models.BinaryField(max_length=16)),
+                ('vector', models.BinaryField()),
+            ],
+        ),
+        migrations.CreateModel(
+            name='EditorFileVector',
+            fields=[
+                ('file', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='vector', serialize=False, to='user_accounts.editorfile')),
+                ('vector', models.BinaryField()),
+                ('digests', models.BinaryField()),
+                ('updated', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='editorfile',
+            name='embedded_version',
+            field=models.PositiveBigIntegerField(default=0, editable=False),
+        ),
+        migrations.AddIndex(
+            model_name='editorfile',
+            index=models.Index(condition=models.Q(('embedded_version__lt', models.F('version'))), fields=['author'], name='editorfile_unembedded_idx'),
+        ),
+        migrations.AddField(
+            model_name='editorblockvector',
+            name='user',
+            field=models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='+', to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.AddField(
+            model_name='editorfilevector',
+            name='author',
+            field=models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='+', to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.AddConstraint(
+            model_name='editorblockvector',
+            constraint=models.UniqueConstraint(fields=('user', 'digest'), name='editorblockvector_user_digest_key'),
+        ),
+        migrations.AddIndex(
+            model_name='editorfilevector',
+            index=models.Index(fields=['author', 'updated'], name='editorfilevector_author_idx'),
+        ),
+    ]
@@ -0,0 +1,35 @@
+# Generated by Django 5.2.18 on 2026-10-18 22:16
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('user_accounts', '0027_refresh_tokens'),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name='editorfilevector',
+            name='editorfilevector_author_idx',
+        ),
+        migrations.RemoveField(
+            model_name='editorfilevector',
+            name='updated',
+        ),
+        migrations.AddField(
+            model_name='editorfilevector',
+            name='sequence',
+            field=models.PositiveBigIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='user',
+            name='vector_sequence',
+            field=models.PositiveBigIntegerField(default=0, editable=False),
+        ),
+        migrations.AddIndex(
+            model_name='editorfilevector',
+            index=models.Index(fields=['author', 'sequence'], name='editorfilevector_author_idx'),
+        ),
+    ]
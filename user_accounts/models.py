@@ -1,20 +1,366 @@
-from django.db import models
+from django.conf import settings
+from django.contrib.postgres.search import SearchQuery, SearchRank, SearchVector, SearchVectorField
+from django.db import connection, models, transaction
 from django.urls import reverse
 from django.contrib.auth.models import AbstractUser 
 from django.core.validators import MinValueValidator
+from django.db.models import Case, Count, F, FloatField, Max, Q, Sum, Value, When, Window
+from django.db.models.functions import Cast, Lower
+from django.utils import timezone
+import datetime
+import hashlib
+import secrets
 import uuid
 
+from collections import defaultdict
+
+from . import blockstore, chunks, documents, embeddings, revisions, search, vectors
+from .patching import apply_block_ops
+
+class EditorFileQuerySet(models.QuerySet):
+
+    def only(self, *fields):
+        # The body may be stored in any of these; see EditorFile.from_db.
+        # Chunked bodies' blocks are stored by author (see blockstore.py).
+        if 'body' in fields:
+            fields = (*fields, 'body_zlib', 'chunked', 'author')
+
+        return super().only(*fields)
+
+    def write(self, version=None, ops=None, **changes):
+        """
+        Save changes to the matching file, bumping its version. If a
+        version is given, the file is only written if still at that
+        version. Returns the number of files updated.
+
+        Changes without a body are saved in a single UPDATE, and the file
+        indexed for search, and embedded for related docs, again only if
+        its title changed. A body is
+        also recorded as a revision (see revisions.py), and rewrites the
+        file's chunks if either it or the file's current body is stored
+        chunked (see chunks.py). ops, if given, are the block operations
+        which made the body from the current one, and saves working out
+        the revision's delta.
+        """
+        queryset = self if version is None else self.filter(version=version)
+
+        if 'body' not in changes:
+            # Still indexed and embedded as at its version, unless the title changes.
+            unchanged = Q(title=changes['title']) if 'title' in changes else Q()
+
+            def kept(field):
+                return Case(
+                    When(Q(**{field: F('version')}) & unchanged, then=F('version') + 1),
+                    default=F(field), output_field=models.PositiveBigIntegerField(),
+                )
+
+            updated = queryset.update(
+                version=F('version') + 1, indexed_version=kept('indexed_version'), embedded_version=kept('embedded_version'), **changes,
+            )
+
+            # Left stale, for index_docs, if this fails.
+            if updated and 'title' in changes:
+                self.index()
+
+            return updated
+
+        body = changes.pop('body')
+
+        with transaction.atomic(using=self.db):
+            # The body is only read if a revision's delta needs working out.
+            files = queryset.select_for_update().only('pk', 'author', 'title', 'version', 'chunked', 'revisions_since_snapshot')
+            return sum(file.write_body(body, ops, **changes) for file in files)
+
+    def create_many(self, author_id, docs):
+        """
+        Create files for the author from [{field: value}], each with a
+        body, as save() would one at a time, in a few queries for all of
+        them. Returns the files.
+        """
+        files, bodies, revisions = [], [], []
+
+        for fields in docs:
+            body = fields['body']
+            file = EditorFile(author_id=author_id, **fields, **documents.summarize(body), revisions_since_snapshot=0)
+            file.chunked = chunks.is_chunked(body)
+
+            if file.chunked:
+                file.body = None
+            else:
+                file.body, file.body_zlib = documents.encode_body(body)
+
+            revision = EditorFileRevision(file_id=file.pk, version=file.version, title=file.title)
+            revision.set_snapshot(body)
+
+            files.append(file)
+            bodies.append(body)
+            revisions.append(revision)
+
+        with transaction.atomic(using=self.db):
+            self.bulk_create(files)
+            EditorFileRevision.objects.bulk_create(revisions)
+            EditorFile.replace_many_chunks(author_id, {file.pk: body for file, body in zip(files, bodies) if file.chunked})
+
+            for file, body in zip(files, bodies):
+                file.body, file.body_zlib = body, None
+
+            EditorFile.index_files(files)
+
+        return files
+
+    def write_many(self, updates):
+        """
+        Save changes to many of the matching files, as write() would to
+        each, in a few queries for all of them. updates is {pk: (version,
+        changes)}, with a version of None to save unconditionally. Returns
+        {pk: new version} for the files saved; the rest are missing or
+        at another version.
+        """
+        with_body = [pk for pk, (version, changes) in updates.items() if 'body' in changes]
+        fields = ('pk', 'author', 'title', 'version', 'chunked', 'revisions_since_snapshot', 'indexed_version', 'embedded_version')
+        written = {}
+
+        with transaction.atomic(using=self.db):
+            # Locked, so their versions can be checked here. Current bodies
+            # are read to work out the revisions' deltas.
+            bodied = list(self.filter(pk__in=with_body).select_for_update().only(*fields, 'body'))
+            EditorFile.read_bodies(bodied)
+            files = [*bodied, *self.filter(pk__in=updates.keys() - set(with_body)).select_for_update().only(*fields)]
+
+            by_fields = defaultdict(list)
+            revisions = []
+            replaced = defaultdict(dict)
+            indexed, retitled = [], []
+
+            for file in files:
+                version, changes = updates[file.pk]
+
+                if version is not None and version != file.version:
+                    continue
+
+                changes = dict(changes)
+
+                if 'body' in changes:
+                    body = changes['body']
+                    revision = EditorFileRevision.after(file, body, title=changes.get('title', file.title))
+                    revisions.append(revision)
+
+                    changes.update(documents.summarize(body), revisions_since_snapshot=revision.depth, chunked=chunks.is_chunked(body))
+
+                    if changes['chunked']:
+                        changes['body'], changes['body_zlib'] = None, None
+                    else:
+                        changes['body'], changes['body_zlib'] = documents.encode_body(body)
+
+                    if changes['chunked'] or file.chunked:
+                        replaced[file.author_id][file.pk] = body if changes['chunked'] else []
+
+                    indexed.append((file, body))
+                elif changes.get('title', file.title) == file.title:
+                    # Still indexed and embedded as at its version, if it was.
+                    for field in ('indexed_version', 'embedded_version'):
+                        if getattr(file, field) == file.version:
+                            changes[field] = file.version + 1
+                else:
+                    retitled.append(file.pk)
+
+                changes['version'] = written[file.pk] = file.version + 1
+
+                for field, value in changes.items():
+                    setattr(file, field, value)
+
+                by_fields[tuple(sorted(changes))].append(file)
+
+            for changed, group in by_fields.items():
+                self.bulk_update(group, changed)
+
+            for author_id in sorted(replaced):
+                EditorFile.replace_many_chunks(author_id, replaced[author_id])
+
+            EditorFileRevision.objects.bulk_create(revisions)
+
+            for file, body in indexed:
+                file.body = body
+
+            EditorFile.index_files([file for file, body in indexed])
+            self.filter(pk__in=retitled).index()
+
+        return written
+
+    def delete_many(self, deletes):
+        """
+        Delete many of the matching files: deletes is {pk: version}, with
+        a version of None to delete unconditionally. Returns the pks of
+        the files deleted; the rest are missing or at another version.
+        """
+        with transaction.atomic(using=self.db):
+            current = self.filter(pk__in=deletes).select_for_update().values_list('pk', 'version')
+            deleted = [pk for pk, version in current if deletes[pk] in (None, version)]
+            self.filter(pk__in=deleted).delete()
+
+        return deleted
+
+    def delete(self):
+        # Release the blocks of chunked files' chunks, as EditorFile.delete.
+        with transaction.atomic(using=self.db):
+            released = defaultdict(dict)
+
+            for pk, author_id in self.filter(chunked=True).values_list('pk', 'author_id'):
+                released[author_id][pk] = []
+
+            for author_id in sorted(released):
+                EditorFile.replace_many_chunks(author_id, released[author_id])
+
+            return super().delete()
+
+    def index(self, batch_size=100):
+        """
+        Bring the search index (see search.py) up to date for those of the
+        matching files saved since they were last indexed, a batch at a
+        time. Returns the number of files indexed.
+        """
+        stale = self.filter(indexed_version__lt=F('version')).order_by('pk').only('pk', 'author', 'title', 'version', 'body')
+        indexed = 0
+        last = None
+
+        while True:
+            # Found first, as usually there are none (see write).
+            pks = list((stale if last is None else stale.filter(pk__gt=last)).values_list('pk', flat=True)[:batch_size])
+
+            if not pks:
+                return indexed
+
+            # A batch a transaction, locked so none is saved meanwhile.
+            with transaction.atomic(using=self.db):
+                files = list(stale.filter(pk__in=pks).select_for_update())
+                EditorFile.read_bodies(files)
+                EditorFile.index_files(files)
+
+            indexed += len(files)
+
+            if len(pks) < batch_size:
+                return indexed
+
+            last = pks[-1]
+
+    def search(self, author_id, query, limit=search.MAX_RESULTS):
+        """
+        The author's files matching all the terms of a query, best first,
+        each with its rank. Only reads: files are indexed as they're
+        written. Only the fields needed for results (see SearchDocsView)
+        are loaded, with bodies.
+        """
+        if connection.vendor == 'postgresql':
+            search_query = SearchQuery(query, config=search.CONFIG, search_type='websearch')
+            ranked = (
+                self.filter(author_id=author_id, search_vector=search_query)
+                .annotate(rank=SearchRank(F('search_vector'), search_query))
+                .order_by('-rank', '-created')
+                .values_list('pk', 'rank')[:limit]
+            )
+        else:
+            ranked = EditorFileTerm.objects.rank(author_id, search.query_terms(query), limit)
+
+        ranks = dict(ranked)
+        files = {file.pk: file for file in self.filter(pk__in=ranks).only('uid', 'title', 'created', 'modified', 'version', 'body')}
+        EditorFile.read_bodies(files.values())
+
+        for pk, file in files.items():
+            file.rank = ranks[pk]
+
+        # In rank order, less any deleted since they were ranked.
+        return [files[pk] for pk in ranks if pk in files]
+
+    def embed(self, batch_size=100):
+        """
+        Bring the vectors for related docs (see embeddings.py) up to date
+        for those of the matching files saved since they were last
+        embedded, a batch at a time. Returns the number of files embedded.
+        """
+        stale = self.filter(embedded_version__lt=F('version')).order_by('pk').only('pk', 'author', 'title', 'version', 'body')
+        embedded = 0
+        last = None
+
+        while True:
+            # Found first, as usually there are none (see index_files).
+            pks = list((stale if last is None else stale.filter(pk__gt=last)).values_list('pk', flat=True)[:batch_size])
+
+            if not pks:
+                return embedded
+
+            # A batch a transaction, locked so none is saved meanwhile.
+            with transaction.atomic(using=self.db):
+                files = list(stale.filter(pk__in=pks).select_for_update())
+                EditorFile.read_bodies(files)
+                EditorFileVector.objects.replace(files)
+
+                for file in files:
+                    file.embedded_version = file.version
+
+                EditorFile.objects.bulk_update(files, ['embedded_version'])
+
+            embedded += len(files)
+
+            if len(pks) < batch_size:
+                return embedded
+
+            last = pks[-1]
+
+    def related(self, author_id, file_id, limit=10):
+        """
+        The author's files most like the given one, best first, each with
+        its score, the cosine similarity of their vectors. Only reads:
+        files are embedded as they're written. Only the fields needed for
+        results (see RelatedDocsView) are loaded.
+        """
+        index = EditorFileVector.objects.index(author_id)
+        vector = index.get(file_id)
+
+        if vector is None or not vector.any():
+            return []
+
+        scores = {pk: score for pk, score in index.nearest(vector, limit, exclude=[file_id]) if score > 0}
+        files = self.filter(pk__in=scores).only('uid', 'title', 'created', 'modified', 'version').in_bulk()
+
+        for pk, file in files.items():
+            file.score = scores[pk]
+
+        # Deleted files are only noticed here, so as not to count the author's files each time.
+        for pk in scores.keys() - files.keys():
+            index.remove(pk)
+
+        # Best first, less any deleted.
+        return [files[pk] for pk in scores if pk in files]
+
+class EditorFileManager(models.Manager.from_queryset(EditorFileQuerySet)):
+
+    def get_queryset(self):
+        # The PostgreSQL search index (see search.py) is only read by searches.
+        return super().get_queryset().defer('search_vector')
+
 class EditorFile(models.Model):
     """Class to represent a basic text file in our database."""
 
-    uid = models.CharField(max_length=50, primary_key=True, default=uuid.uuid4, editable=False, help_text='ID of file')
+    objects = EditorFileManager()
+
+    uid = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False, help_text='ID of file')
 
     title = models.CharField(max_length=50, help_text='Title of file')
 
     # 25000 chars ≈ 5000 words.
-    body = models.JSONField(default=list, help_text='Text stored in file')
+    # Null when the body is stored compressed, in body_zlib.
+    body = models.JSONField(default=list, null=True, help_text='Text stored in file')
+
+    # Large bodies, as zlib-compressed JSON; see documents.encode_body.
+    # Decoded into body when the file is loaded, so only save() and
+    # write() need to know about it.
+    body_zlib = models.BinaryField(null=True, editable=False, help_text='Compressed text stored in file')
+
+    # Whether the body is stored in EditorFileChunks (see chunks.py),
+    # rather than in body or body_zlib.
+    chunked = models.BooleanField(default=False, help_text='Whether body is stored in chunks')
 
-    author = models.CharField(max_length = 20, help_text='Username of file creator')
+    author = models.ForeignKey(settings.AUTH_USER_MODEL, related_name='files', on_delete=models.CASCADE, db_index=False, help_text='File creator')
 
     # Automatically set when file is made
     created = models.DateTimeField(auto_now_add=True) 
@@ -22,10 +368,439 @@ class EditorFile(models.Model):
     # Automatically set when file is modified
     modified = models.DateTimeField(auto_now=True)
 
+    # Summary of the body, kept up to date on save() so
+    # documents can be listed without loading their bodies.
+    preview = models.CharField(max_length=200, blank=True, default='', help_text='Start of the text in file')
+
+    body_size = models.PositiveIntegerField(default=0, help_text='Size of body, in bytes of JSON')
+
+    block_count = models.PositiveIntegerField(default=0, help_text='Number of blocks in body')
+
+    # Incremented on every save, so clients can save
+    # conditionally on the version they last saw.
+    version = models.PositiveBigIntegerField(default=1, help_text='Number of times file has been saved')
+
+    # Deltas since the latest snapshot in the file's revisions (see
+    # revisions.py), so saves know when to take the next. None if the
+    # file has no revisions.
+    revisions_since_snapshot = models.PositiveSmallIntegerField(null=True, editable=False)
+
+    # The version last indexed for search (see search.py). Files are indexed
+    # as they're written; any left behind version are indexed by index_docs.
+    indexed_version = models.PositiveBigIntegerField(default=0, editable=False)
+
+    # Title and body text, on PostgreSQL, with a GIN index created by
+    # migration 0025 (there is none on other databases). Null elsewhere.
+    search_vector = SearchVectorField(null=True, editable=False)
+
+    # The version last embedded for related docs (see embeddings.py), as
+    # indexed_version; any left behind version are embedded by embed_docs.
+    embedded_version = models.PositiveBigIntegerField(default=0, editable=False)
+
     class Meta:
         # Order files from most recent to oldest.
         ordering = ['-created']
 
+        indexes = [
+            # A user's files, newest first, in listing (and cursor) order.
+            models.Index(fields=['author', '-created', '-uid'], name='editorfile_author_created_idx'),
+
+            # A user's files to be indexed for search: few, as searches index them.
+            models.Index(fields=['author'], condition=Q(indexed_version__lt=F('version')), name='editorfile_unindexed_idx'),
+
+            # A user's files to be embedded for related docs.
+            models.Index(fields=['author'], condition=Q(embedded_version__lt=F('version')), name='editorfile_unembedded_idx'),
+        ]
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+
+        # Compressed bodies are decoded once, here, and not kept twice.
+        if instance.__dict__.get('body_zlib') is not None:
+            instance.body = documents.decode_body(instance.body_zlib)
+            instance.body_zlib = None
+
+        # Chunked bodies are left deferred, and only read if used.
+        if instance.__dict__.get('chunked'):
+            instance.__dict__.pop('body', None)
+
+        return instance
+
+    def refresh_from_db(self, using=None, fields=None, from_queryset=None):
+        if fields is not None and 'body' in fields:
+            if self.__dict__.get('chunked'):
+                self.body = self.read_blocks()
+                fields = [field for field in fields if field != 'body']
+
+                if not fields:
+                    return
+            else:
+                # A deferred body may be stored in any of these.
+                fields = [*fields, 'body_zlib', 'chunked']
+
+        super().refresh_from_db(using=using, fields=fields, from_queryset=from_queryset)
+
+        if fields is None and self.chunked:
+            self.__dict__.pop('body', None)
+
+    def save(self, *args, **kwargs):
+        update_fields = kwargs.get('update_fields')
+
+        if not self._state.adding:
+            self.version += 1
+
+        # A chunked body is only saved if it was read (or set).
+        if 'body' not in self.__dict__ or (update_fields is not None and 'body' not in update_fields):
+            if update_fields is not None:
+                kwargs['update_fields'] = {*update_fields, 'version'}
+
+            with transaction.atomic():
+                super().save(*args, **kwargs)
+
+                # Indexed again, in case the title changed.
+                if update_fields is None or 'title' in update_fields:
+                    EditorFile.objects.filter(pk=self.pk).index()
+
+            return
+
+        body = self.body
+        summary = documents.summarize(body)
+
+        for field, value in summary.items():
+            setattr(self, field, value)
+
+        previous = None if self._state.adding else (
+            EditorFile.objects.filter(pk=self.pk).only('pk', 'author', 'title', 'version', 'chunked', 'revisions_since_snapshot').first()
+        )
+
+        if previous is None:
+            revision = EditorFileRevision(file_id=self.pk, title=self.title)
+            revision.set_snapshot(body)
+        else:
+            revision = EditorFileRevision.after(previous, body, title=self.title)
+
+        revision.version = self.version
+        self.revisions_since_snapshot = revision.depth
+
+        if update_fields is not None:
+            kwargs['update_fields'] = {*update_fields, 'version', 'body_zlib', 'chunked', 'revisions_since_snapshot', *summary}
+
+        # If it's unknown whether the file was chunked, its chunks are cleared anyway.
+        was_chunked = self.__dict__.get('chunked', True)
+        self.chunked = chunks.is_chunked(body)
+
+        if self.chunked:
+            self.body, self.body_zlib = None, None
+        else:
+            self.body, self.body_zlib = documents.encode_body(body)
+
+        try:
+            with transaction.atomic():
+                super().save(*args, **kwargs)
+
+                if was_chunked or self.chunked:
+                    EditorFile.replace_chunks(self.pk, self.author_id, body if self.chunked else [])
+
+                revision.save()
+
+                self.body, self.body_zlib = body, None
+                EditorFile.index_files([self])
+        finally:
+            self.body, self.body_zlib = body, None
+
+    def delete(self, *args, **kwargs):
+        with transaction.atomic():
+            if self.chunked:
+                # Release the blocks the chunks refer to.
+                EditorFile.replace_chunks(self.pk, self.author_id, [])
+
+            return super().delete(*args, **kwargs)
+
+    def write_body(self, body, ops=None, **changes):
+        """
+        Save a new body, and other changes, if the file is still at
+        self.version, and record it as a revision. ops are as for
+        EditorFileQuerySet.write. Returns whether it was saved.
+        """
+        revision = EditorFileRevision.after(self, body, ops, title=changes.get('title', self.title))
+        changes.update(documents.summarize(body))
+        chunked = chunks.is_chunked(body)
+
+        if chunked:
+            changes.update(body=None, body_zlib=None)
+        else:
+            changes['body'], changes['body_zlib'] = documents.encode_body(body)
+
+        with transaction.atomic():
+            updated = EditorFile.objects.filter(pk=self.pk, version=self.version).update(
+                version=F('version') + 1, chunked=chunked, revisions_since_snapshot=revision.depth, **changes,
+            )
+
+            if not updated:
+                return False
+
+            if chunked or self.chunked:
+                EditorFile.replace_chunks(self.pk, self.author_id, body if chunked else [])
+
+            revision.save()
+
+            EditorFile.index_files([EditorFile(pk=self.pk, author_id=self.author_id, title=changes.get('title', self.title), version=self.version + 1, body=body)])
+
+        return True
+
+    @staticmethod
+    def index_files(files):
+        """
+        Index files' titles and bodies for search, and store their vectors
+        for related docs, as at their versions, in a few queries for all of
+        them. Only for files just written, or locked, so none has been saved
+        since, within a transaction.
+        """
+        if not files:
+            return
+
+        EditorFileVector.objects.replace(files)
+
+        texts = {file.pk: documents.body_text(file.body)[:search.MAX_TEXT_LENGTH] for file in files}
+        indexed = [EditorFile(pk=file.pk, indexed_version=file.version, embedded_version=file.version) for file in files]
+
+        if connection.vendor == 'postgresql':
+            for file, row in zip(files, indexed):
+                row.search_vector = (
+                    SearchVector(Value(file.title), weight='A', config=search.CONFIG) + SearchVector(Value(texts[file.pk]), weight='B', config=search.CONFIG)
+                )
+
+            EditorFile.objects.bulk_update(indexed, ['search_vector', 'indexed_version', 'embedded_version'])
+            return
+
+        EditorFileTerm.objects.replace_many({file.pk: (file.author_id, search.term_weights(file.title, texts[file.pk])) for file in files})
+        EditorFile.objects.bulk_update(indexed, ['indexed_version', 'embedded_version'])
+
+    @staticmethod
+    def replace_chunks(pk, author_id, body):
+        """
+        Store a file's body in chunks ([] for none), only rewriting the
+        chunks, and storing the blocks, which change.
+        """
+        EditorFile.replace_many_chunks(author_id, {pk: body})
+
+    @staticmethod
+    def replace_many_chunks(author_id, bodies):
+        """
+        replace_chunks for many of the author's files, from {pk: body}, in
+        a few queries for all of them.
+        """
+        if not bodies:
+            return
+
+        old = defaultdict(list)
+
+        for chunk in EditorFileChunk.objects.filter(file_id__in=list(bodies)).only('pk', 'file', 'position', 'digests'):
+            old[chunk.file_id].append(chunk)
+
+        digests = {pk: [blockstore.digest(block) for block in body] for pk, body in bodies.items()}
+
+        EditorBlock.objects.adjust(
+            author_id,
+            blockstore.ref_changes(
+                [key for runs in old.values() for chunk in runs for key in blockstore.unpack(chunk.digests)],
+                [key for keys in digests.values() for key in keys],
+            ),
+            {key: block for pk, body in bodies.items() for key, block in zip(digests[pk], body)},
+        )
+
+        changed, added, removed = [], [], []
+
+        for pk, body in bodies.items():
+            new = [
+                EditorFileChunk.for_blocks(pk, position, run, run_digests)
+                for position, (run, run_digests) in enumerate(zip(chunks.split(body), chunks.split(digests[pk])))
+            ]
+
+            for chunk, previous in zip(new, old[pk]):
+                if chunk.position != previous.position or chunk.digests != bytes(previous.digests):
+                    chunk.pk = previous.pk
+                    changed.append(chunk)
+
+            added.extend(new[len(old[pk]):])
+            removed.extend(chunk.pk for chunk in old[pk][len(new):])
+
+        EditorFileChunk.objects.bulk_update(changed, ['position', 'digests', 'block_count', 'body_size'])
+        EditorFileChunk.objects.bulk_create(added)
+        EditorFileChunk.objects.filter(pk__in=removed).delete()
+
+    @staticmethod
+    def read_bodies(files):
+        """
+        Read the bodies of the chunked files among files, in two queries
+        rather than two for each.
+        """
+        chunked = {file.pk: file for file in files if file.chunked}
+
+        if not chunked:
+            return
+
+        digests = defaultdict(list)
+
+        for file_id, run in EditorFileChunk.objects.filter(file__in=chunked).values_list('file_id', 'digests'):
+            digests[file_id].extend(blockstore.unpack(run))
+
+        contents = {}
+
+        for author_id in {file.author_id for file in chunked.values()}:
+            contents.update(EditorBlock.objects.contents(author_id, [key for pk, file in chunked.items() if file.author_id == author_id for key in digests[pk]]))
+
+        for pk, file in chunked.items():
+            file.body = [contents[key] for key in digests[pk]]
+
+    def resolve_blocks(self, digests):
+        """
+        The file's blocks with the given digests, in order.
+        """
+        contents = EditorBlock.objects.contents(self.author_id, digests)
+        return [contents[key] for key in digests]
+
+    def read_blocks(self, start=0, stop=None):
+        """
+        Blocks start to stop of the body (all of them by default). Of a
+        chunked file, reads only the chunks holding them.
+        """
+        if not self.chunked:
+            return self.body[start:stop]
+
+        if start == 0 and stop is None:
+            runs = self.chunks.values_list('digests', flat=True)
+            return self.resolve_blocks([key for run in runs for key in blockstore.unpack(run)])
+
+        # The chunks overlapping the range, from the running total of their lengths.
+        rows = self.chunks.annotate(end=Window(Sum('block_count'), order_by='position')).filter(end__gt=start)
+
+        if stop is not None:
+            rows = rows.filter(end__lt=stop + F('block_count'))
+
+        rows = list(rows.values_list('end', 'block_count', 'digests'))
+
+        if not rows:
+            return []
+
+        first = rows[0][0] - rows[0][1]
+        digests = [key for end, block_count, run in rows for key in blockstore.unpack(run)]
+
+        return self.resolve_blocks(digests[start - first:None if stop is None else stop - first])
+
+    def write_block_ops(self, ops, **changes):
+        """
+        Apply block operations (see patching.py) to a chunked file, reading
+        and rewriting only the chunks they touch, if it's still at
+        self.version. Returns whether it was.
+
+        Raises PatchError if any of the operations are invalid.
+        """
+        file_chunks = list(self.chunks.only('pk', 'file', 'position', 'block_count', 'body_size'))
+        located = chunks.locate_ops([chunk.block_count for chunk in file_chunks], ops)
+        touched = sorted({index for index, op in located})
+
+        runs = dict(EditorFileChunk.objects.filter(pk__in=[file_chunks[index].pk for index in touched]).values_list('pk', 'digests'))
+        old = {index: blockstore.unpack(runs[file_chunks[index].pk]) for index in touched}
+        contents = EditorBlock.objects.contents(self.author_id, [key for digests in old.values() for key in digests])
+
+        for index in touched:
+            file_chunks[index].blocks = [contents[key] for key in old[index]]
+
+        for index, op in located:
+            file_chunks[index].blocks = apply_block_ops(file_chunks[index].blocks, [op])
+
+        for index in touched:
+            chunk = file_chunks[index]
+            chunk.block_count, chunk.body_size = len(chunk.blocks), chunks.blocks_size(chunk.blocks)
+
+        block_count = sum(chunk.block_count for chunk in file_chunks)
+
+        if chunks.is_unchunked(block_count):
+            # Small enough to store in one piece again.
+            for chunk in file_chunks:
+                if not hasattr(chunk, 'blocks'):
+                    chunk.blocks = self.read_chunk(chunk)
+
+            body = [block for chunk in file_chunks for block in chunk.blocks]
+            return bool(EditorFile.objects.filter(pk=self.pk).write(self.version, ops, body=body, **changes))
+
+        # A snapshot, if one is due, is taken once the chunks are written.
+        revision = EditorFileRevision.after(self, None, ops, title=changes.get('title', self.title))
+
+        changes.update(
+            block_count=block_count,
+            body_size=max(sum(chunk.body_size for chunk in file_chunks), 2),
+            revisions_since_snapshot=revision.depth,
+        )
+
+        if 0 in touched:
+            changes['preview'] = self.chunked_preview(file_chunks)
+
+        with transaction.atomic():
+            if not EditorFile.objects.filter(pk=self.pk, version=self.version).update(version=F('version') + 1, **changes):
+                return False
+
+            digests = {index: [blockstore.digest(block) for block in file_chunks[index].blocks] for index in touched}
+
+            EditorBlock.objects.adjust(
+                self.author_id,
+                blockstore.ref_changes([key for index in touched for key in old[index]], [key for index in touched for key in digests[index]]),
+                {key: block for index in touched for key, block in zip(digests[index], file_chunks[index].blocks)},
+            )
+
+            # From the end, so moving the chunks after a split doesn't move those still to be written.
+            for index in reversed(touched):
+                chunk = file_chunks[index]
+
+                if not chunk.blocks:
+                    chunk.delete()
+                    continue
+
+                size = chunks.MAX_CHUNK_BLOCKS if chunk.block_count <= chunks.MAX_CHUNK_BLOCKS else chunks.CHUNK_BLOCKS
+                first, *rest = [
+                    EditorFileChunk.for_blocks(self.pk, chunk.position + offset, run, run_digests)
+                    for offset, (run, run_digests) in enumerate(zip(chunks.split(chunk.blocks, size), chunks.split(digests[index], size)))
+                ]
+
+                if rest:
+                    self.chunks.filter(position__gt=chunk.position).update(position=F('position') + len(rest))
+                    EditorFileChunk.objects.bulk_create(rest)
+
+                EditorFileChunk.objects.filter(pk=chunk.pk).update(digests=first.digests, block_count=first.block_count, body_size=first.body_size)
+
+            if revision.delta is None:
+                revision.set_snapshot(self.read_blocks())
+
+            revision.save()
+
+            # From the whole body, read back.
+            EditorFile.objects.filter(pk=self.pk).index()
+
+        return True
+
+    def chunked_preview(self, file_chunks):
+        """
+        The preview of a chunked body, from as many of its first chunks as it takes.
+        """
+        blocks = []
+
+        for chunk in file_chunks:
+            # Chunks which weren't edited are read here, if needed.
+            blocks.extend(chunk.blocks if hasattr(chunk, 'blocks') else self.read_chunk(chunk))
+
+            if len(' '.join(documents.body_text(blocks).split())) > documents.PREVIEW_LENGTH:
+                break
+
+        return documents.preview(blocks)
+
+    def read_chunk(self, chunk):
+        """
+        The blocks of one of the file's chunks.
+        """
+        return self.resolve_blocks(blockstore.unpack(EditorFileChunk.objects.filter(pk=chunk.pk).values_list('digests', flat=True).get()))
+
     def get_absolute_url(self):
         """Returns the URL to access a particular instance of EditorFile."""
         return reverse('file-detail', args=[str(self.id)])
@@ -34,19 +809,775 @@ class EditorFile(models.Model):
         """String for representing the EditorFile object (in Admin site etc.)."""
         return self.title
 
+class EditorFileChunk(models.Model):
+    """A run of consecutive blocks of a large EditorFile's body; see chunks.py."""
+
+    file = models.ForeignKey(EditorFile, related_name='chunks', on_delete=models.CASCADE, db_index=False)
+
+    # Order of the chunk in the body. Not necessarily consecutive.
+    position = models.PositiveIntegerField()
+
+    # Digests of its blocks, in order (see blockstore.py). The blocks
+    # themselves are EditorBlocks.
+    digests = models.BinaryField(default=b'')
+
+    block_count = models.PositiveIntegerField(default=0, help_text='Number of blocks in chunk')
+
+    body_size = models.PositiveIntegerField(default=0, help_text='Bytes the blocks add to the JSON of the body')
+
+    class Meta:
+        ordering = ['position']
+
+        indexes = [
+            models.Index(fields=['file', 'position'], name='editorfilechunk_file_pos_idx'),
+        ]
+
+    @classmethod
+    def for_blocks(cls, file_id, position, blocks, digests=None):
+        if digests is None:
+            digests = [blockstore.digest(block) for block in blocks]
+
+        return cls(file_id=file_id, position=position, digests=blockstore.pack(digests), block_count=len(blocks), body_size=chunks.blocks_size(blocks))
+
+    def __str__(self):
+        return f'{self.file_id} #{self.position}'
+
+class EditorFileRevisionQuerySet(models.QuerySet):
+
+    def body_at(self, file_id, version):
+        """
+        The body of a file at one of its revisions, read from the snapshot
+        at or before it and the deltas since. None if there's no such revision.
+        """
+        base = self.filter(file_id=file_id, version__lte=version, snapshot__isnull=False).order_by('-version').values_list('version', flat=True).first()
+
+        if base is None:
+            return None
+
+        chain = list(self.filter(file_id=file_id, version__gte=base, version__lte=version).order_by('version').values_list('version', 'snapshot', 'delta'))
+
+        if chain[-1][0] != version:
+            return None
+
+        body = documents.decode_body(chain[0][1])
+
+        for _, snapshot, delta in chain[1:]:
+            body = apply_block_ops(body, delta)
+
+        return body
+
+    def prune(self, file_id, keep_after):
+        """
+        Thin out a file's revisions from before keep_after to the last of
+        each day (see revisions.thin), and compact the rest: those after
+        the first removed are stored again as deltas between the revisions
+        kept, with snapshots every SNAPSHOT_INTERVAL. Returns the number
+        of revisions removed.
+        """
+        with transaction.atomic(using=self.db):
+            # Saves wait, so no revision is added meanwhile.
+            if not EditorFile.objects.select_for_update().filter(pk=file_id).exists():
+                return 0
+
+            rows = list(self.filter(file_id=file_id).order_by('version').only('pk', 'version', 'created', 'depth'))
+            keep = revisions.thin([(row.version, row.created) for row in rows], keep_after)
+
+            if len(keep) == len(rows):
+                return 0
+
+            stored = self.filter(file_id=file_id).order_by('version').values_list('snapshot', 'delta').iterator()
+            removed, compacted = [], []
+            body = kept_body = depth = None
+
+            for row, (snapshot, delta) in zip(rows, stored):
+                body = documents.decode_body(snapshot) if snapshot is not None else apply_block_ops(body, delta)
+
+                if row.version not in keep:
+                    removed.append(row.pk)
+                    continue
+
+                if removed:
+                    delta = None if depth is None or depth + 1 >= revisions.SNAPSHOT_INTERVAL else revisions.diff(kept_body, body)
+
+                    if delta is None:
+                        row.set_snapshot(body)
+                    else:
+                        row.snapshot, row.delta, row.depth = None, delta, depth + 1
+
+                    compacted.append(row)
+
+                kept_body, depth = body, row.depth
+
+            self.filter(pk__in=removed).delete()
+            self.bulk_update(compacted, ['snapshot', 'delta', 'depth'], batch_size=100)
+            EditorFile.objects.filter(pk=file_id).update(revisions_since_snapshot=depth)
+
+            return len(removed)
+
+class EditorFileRevision(models.Model):
+    """A saved body of an EditorFile; see revisions.py."""
+
+    objects = EditorFileRevisionQuerySet.as_manager()
+
+    file = models.ForeignKey(EditorFile, related_name='revisions', on_delete=models.CASCADE, db_index=False)
+
+    # The file's version once saved.
+    version = models.PositiveBigIntegerField()
+
+    created = models.DateTimeField(default=timezone.now)
+
+    title = models.CharField(max_length=50)
+
+    # The body as zlib-compressed JSON (see documents.compress_body),
+    # for snapshots; null for deltas.
+    snapshot = models.BinaryField(null=True)
+
+    # Block operations (see patching.py) turning the previous revision's
+    # body into this one's, for deltas; null for snapshots.
+    delta = models.JSONField(null=True)
+
+    # Deltas since the latest snapshot, including this one; 0 for snapshots.
+    depth = models.PositiveSmallIntegerField(default=0)
+
+    class Meta:
+        ordering = ['version']
+
+        constraints = [
+            models.UniqueConstraint(fields=['file', 'version'], name='editorfilerevision_file_version_key'),
+        ]
+
+    @classmethod
+    def after(cls, file, body, ops=None, title=None):
+        """
+        The revision recording a save of a new body to the file, as it is
+        before the save: a delta from its body, or a snapshot when one is
+        due (see revisions.py). The delta is ops if given, or worked out
+        otherwise. A snapshot without a body given is left to be set.
+        """
+        revision = cls(file_id=file.pk, version=file.version + 1, title=file.title if title is None else title)
+        depth = file.revisions_since_snapshot
+
+        if depth is not None and depth + 1 < revisions.SNAPSHOT_INTERVAL:
+            if ops is not None:
+                delta = ops
+            else:
+                # Bodies other than lists of blocks are always snapshots, so aren't read to diff.
+                delta = revisions.diff(file.body, body) if isinstance(body, list) else None
+
+            if delta is not None:
+                revision.delta, revision.depth = delta, depth + 1
+                return revision
+
+        if body is not None:
+            revision.set_snapshot(body)
+
+        return revision
+
+    def set_snapshot(self, body):
+        self.snapshot, self.delta, self.depth = documents.compress_body(body), None, 0
+
+    def __str__(self):
+        return f"{self.file_id} v{self.version}"
+
+class EditorFileTermQuerySet(models.QuerySet):
+
+    BATCH_SIZE = 1000
+
+    # Rough cost of looking up a file's term, against reading one in a run of a term's files.
+    LOOKUP_COST = 10
+
+    def replace_many(self, files):
+        """
+        Index files' terms, from {file_id: (author_id, {term: weight})}
+        (see search.term_weights), only writing those which changed since
+        they were last indexed.
+        """
+        file_ids = list(files)
+        old = defaultdict(dict)
+
+        for i in range(0, len(file_ids), self.BATCH_SIZE):
+            for pk, file_id, term, weight in self.filter(file_id__in=file_ids[i:i + self.BATCH_SIZE]).values_list('pk', 'file_id', 'term', 'weight'):
+                old[file_id][term] = (pk, weight)
+
+        removed, changed, added = [], [], []
+
+        for file_id, (author_id, weights) in files.items():
+            terms = old[file_id]
+            removed.extend(pk for term, (pk, weight) in terms.items() if term not in weights)
+            changed.extend(EditorFileTerm(pk=terms[term][0], weight=weight) for term, weight in weights.items() if term in terms and terms[term][1] != weight)
+            added.extend(EditorFileTerm(file_id=file_id, author_id=author_id, term=term, weight=weight) for term, weight in weights.items() if term not in terms)
+
+        for i in range(0, len(removed), self.BATCH_SIZE):
+            self.filter(pk__in=removed[i:i + self.BATCH_SIZE]).delete()
+
+        self.bulk_update(changed, ['weight'], batch_size=self.BATCH_SIZE)
+        self.bulk_create(added, batch_size=self.BATCH_SIZE)
+
+    def rank(self, author_id, terms, limit):
+        """
+        [(file, score)] for the author's files containing all the terms,
+        best first, by BM25 (see search.py).
+        """
+        if not terms:
+            return []
+
+        postings = self.filter(author_id=author_id, term__in=terms).order_by()
+        matching = dict(postings.values_list('term').annotate(Count('file')))
+
+        if len(matching) < len(terms):
+            return []
+
+        doc_count = EditorFile.objects.filter(author_id=author_id).count()
+        idfs = {term: search.idf(doc_count, count) for term, count in matching.items()}
+
+        if len(terms) == 1:
+            # The score only grows with the weight, so the best are read off the index in order.
+            ranked = postings.order_by('-weight', 'file').values_list('file_id', 'weight')[:limit]
+            return [(file_id, search.score(idfs[terms[0]], weight)) for file_id, weight in ranked]
+
+        rarest = min(matching, key=matching.get)
+
+        # Only files with the rarest term can have them all. If there are
+        # few, their terms are looked up by file, rather than read by term.
+        if matching[rarest] * self.LOOKUP_COST < sum(matching.values()):
+            postings = self.filter(file__in=self.filter(author_id=author_id, term=rarest).values('file'), term__in=terms).order_by()
+
+        idf = Case(*[When(term=term, then=Value(value)) for term, value in idfs.items()], output_field=FloatField())
+        weight = Cast('weight', FloatField())
+
+        return list(
+            postings.values('file_id')
+            .annotate(matched=Count('file'), score=Sum(idf * weight * (search.K1 + 1) / (weight + search.K1)))
+            .filter(matched=len(terms))
+            .order_by('-score', 'file_id')
+            .values_list('file_id', 'score')[:limit]
+        )
+
+class EditorFileTerm(models.Model):
+    """A term in an EditorFile, in the search index used without PostgreSQL; see search.py."""
+
+    objects = EditorFileTermQuerySet.as_manager()
+
+    file = models.ForeignKey(EditorFile, related_name='terms', on_delete=models.CASCADE, db_index=False)
+
+    # The file's author, so a user's files can be searched from the index alone.
+    author = models.ForeignKey(settings.AUTH_USER_MODEL, related_name='+', on_delete=models.CASCADE, db_index=False)
+
+    term = models.CharField(max_length=search.MAX_TERM_LENGTH)
+
+    # See search.term_weights.
+    weight = models.PositiveIntegerField(help_text='Times term appears in file, more for the title')
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['file', 'term'], name='editorfileterm_file_term_key'),
+        ]
+
+        indexes = [
+            # Files containing a term, by author, covering searches (see rank).
+            models.Index(fields=['author', 'term', 'weight', 'file'], name='editorfileterm_author_term_idx'),
+        ]
+
+    def __str__(self):
+        return self.term
+
+class EditorFileVectorQuerySet(models.QuerySet):
+
+    def replace(self, files):
+        """
+        Store the vectors of files, with their bodies read, as at their
+        versions. Only the parts (see embeddings.parts) their authors have
+        no vectors stored for are embedded. Only for files just written, or
+        locked, so none has been saved since, within a transaction.
+        """
+        parts = {file.pk: embeddings.parts(file.title, file.body) for file in files}
+        known = {}
+
+        for author_id in {file.author_id for file in files}:
+            digests = {key: text for file in files if file.author_id == author_id for key, text in parts[file.pk]}
+            stored = EditorBlockVector.objects.vectors(author_id, digests)
+            new = {key: embeddings.embed(text) for key, text in digests.items() if key not in stored}
+
+            # Another request may have just stored some of the same blocks.
+            EditorBlockVector.objects.bulk_create(
+                [EditorBlockVector(user_id=author_id, digest=key, vector=embeddings.pack(vector)) for key, vector in new.items()],
+                batch_size=EditorBlockVectorQuerySet.BATCH_SIZE, ignore_conflicts=True,
+            )
+
+            known[author_id] = {**stored, **new}
+
+        # Locks the authors' rows until commit, so each store's sequence
+        # is after those of the stores committed before it.
+        sequences = {}
+
+        for author_id in sorted(known):
+            User.objects.filter(pk=author_id).update(vector_sequence=F('vector_sequence') + 1)
+            sequences[author_id] = User.objects.filter(pk=author_id).values_list('vector_sequence', flat=True).get()
+
+        self.bulk_create(
+            [
+                EditorFileVector(
+                    file_id=file.pk,
+                    author_id=file.author_id,
+                    vector=embeddings.pack(embeddings.combine([known[file.author_id][key] for key, text in parts[file.pk]])),
+                    digests=blockstore.pack([key for key, text in parts[file.pk]]),
+                    sequence=sequences[file.author_id],
+                )
+                for file in files
+            ],
+            update_conflicts=True, unique_fields=['file'], update_fields=['vector', 'digests', 'sequence'],
+        )
+
+    def index(self, author_id):
+        """
+        The author's vectors, as a VectorIndex (see vectors.py) of file pks.
+        Kept between calls, and only brought up to date with the vectors
+        stored since. Deleted files are left in it; see related.
+        """
+        index = vectors.indexes.get(author_id)
+
+        if index is not None:
+            # Read before catching up, so the index isn't locked for the query.
+            index.catch_up([
+                (pk, embeddings.unpack(vector), sequence)
+                for pk, vector, sequence in self.filter(author_id=author_id, sequence__gt=index.sequence).values_list('pk', 'vector', 'sequence')
+            ])
+            return index
+
+        rows = list(self.filter(author_id=author_id).values_list('pk', 'vector', 'sequence'))
+        index = vectors.VectorIndex(
+            [pk for pk, vector, sequence in rows],
+            embeddings.unpack(b"".join(vector for pk, vector, sequence in rows)),
+            max((sequence for pk, vector, sequence in rows), default=0),
+        )
+        vectors.indexes.set(author_id, index)
+
+        return index
+
+class EditorFileVector(models.Model):
+    """The vector of an EditorFile, for finding related docs; see embeddings.py."""
+
+    objects = EditorFileVectorQuerySet.as_manager()
+
+    file = models.OneToOneField(EditorFile, primary_key=True, related_name='vector', on_delete=models.CASCADE)
+
+    author = models.ForeignKey(settings.AUTH_USER_MODEL, related_name='+', on_delete=models.CASCADE, db_index=False)
+
+    # See embeddings.pack.
+    vector = models.BinaryField()
+
+    # Digests of the parts of the file embedded, so their vectors aren't collected.
+    digests = models.BinaryField()
+
+    # The author's vector_sequence when the vector was stored, so indexes
+    # (see vectors.py) can catch up. Unlike a time, in the order stores commit.
+    sequence = models.PositiveBigIntegerField(default=0)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['author', 'sequence'], name='editorfilevector_author_idx'),
+        ]
+
+    def __str__(self):
+        return str(self.file_id)
+
+class EditorBlockVectorQuerySet(models.QuerySet):
+
+    # Most digests in one query.
+    BATCH_SIZE = 1000
+
+    def vectors(self, user_id, digests):
+        """
+        The user's vectors for the given digests, as {digest: vector}.
+        """
+        digests = list(set(digests))
+        vectors = {}
+
+        for i in range(0, len(digests), self.BATCH_SIZE):
+            rows = self.filter(user_id=user_id, digest__in=digests[i:i + self.BATCH_SIZE]).values_list('digest', 'vector')
+            vectors.update((bytes(key), embeddings.unpack(vector)) for key, vector in rows)
+
+        return vectors
+
+    def collect(self, user_id):
+        """
+        Delete the user's block vectors which none of their files' vectors
+        were made from. Returns how many.
+
+        Not locked against saves: a vector deleted just as a file comes to
+        use it is only embedded again.
+        """
+        live = set()
+
+        for run in EditorFileVector.objects.filter(author_id=user_id).values_list('digests', flat=True).iterator():
+            live.update(blockstore.unpack(run))
+
+        dead = [pk for pk, key in self.filter(user_id=user_id).values_list('pk', 'digest').iterator() if bytes(key) not in live]
+
+        for i in range(0, len(dead), self.BATCH_SIZE):
+            self.filter(pk__in=dead[i:i + self.BATCH_SIZE]).delete()
+
+        return len(dead)
+
+class EditorBlockVector(models.Model):
+    """The vector of a block of EditorFiles, stored once per user; see embeddings.py."""
+
+    objects = EditorBlockVectorQuerySet.as_manager()
+
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, related_name='+', on_delete=models.CASCADE, db_index=False)
+
+    digest = models.BinaryField(max_length=blockstore.DIGEST_SIZE)
+
+    # See embeddings.pack.
+    vector = models.BinaryField()
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['user', 'digest'], name='editorblockvector_user_digest_key'),
+        ]
+
+    def __str__(self):
+        return f'{self.user_id} {bytes(self.digest).hex()}'
+
+class EditorBlockQuerySet(models.QuerySet):
+
+    # Most digests in one query.
+    BATCH_SIZE = 1000
+
+    def contents(self, user_id, digests):
+        """
+        The user's blocks with the given digests, as {digest: block}.
+        """
+        digests = list(set(digests))
+        contents = {}
+
+        for i in range(0, len(digests), self.BATCH_SIZE):
+            rows = self.filter(user_id=user_id, digest__in=digests[i:i + self.BATCH_SIZE]).values_list('digest', 'content')
+            contents.update((bytes(key), content) for key, content in rows)
+
+        return contents
+
+    def stored(self, user_id, digests):
+        """
+        Which of the digests the user has blocks stored for.
+        """
+        digests = list(set(digests))
+        stored = set()
+
+        for i in range(0, len(digests), self.BATCH_SIZE):
+            stored.update(bytes(key) for key in self.filter(user_id=user_id, digest__in=digests[i:i + self.BATCH_SIZE]).values_list('digest', flat=True))
+
+        return stored
+
+    def adjust(self, user_id, changes, blocks):
+        """
+        Change the reference counts of the user's blocks by changes
+        ({digest: change}), first storing those of blocks ({digest: block})
+        which are newly referenced and not stored already.
+        """
+        if not changes:
+            return
+
+        with transaction.atomic(using=self.db):
+            # A user's saves (and collections) take turns, so a block can't be
+            # collected between being found already stored and referenced.
+            lock_user(user_id)
+
+            # Blocks already stored (e.g. in a copy of the doc) aren't sent again.
+            added = [key for key, change in changes.items() if change > 0]
+            stored = self.stored(user_id, added)
+
+            self.bulk_create(
+                (EditorBlock(user_id=user_id, digest=key, content=blocks[key]) for key in added if key not in stored),
+                batch_size=self.BATCH_SIZE,
+            )
+
+            by_change = defaultdict(list)
+
+            for key, change in changes.items():
+                by_change[change].append(key)
+
+            for change, keys in by_change.items():
+                for i in range(0, len(keys), self.BATCH_SIZE):
+                    self.filter(user_id=user_id, digest__in=keys[i:i + self.BATCH_SIZE]).update(refs=F('refs') + change)
+
+    def collect(self, user_id):
+        """
+        Delete the user's blocks which nothing refers to. Returns how many.
+        """
+        with transaction.atomic(using=self.db):
+            lock_user(user_id)
+            deleted, _ = self.filter(user_id=user_id, refs=0).delete()
+
+        return deleted
+
+class EditorBlock(models.Model):
+    """A block of chunked EditorFile bodies, stored once per user; see blockstore.py."""
+
+    objects = EditorBlockQuerySet.as_manager()
+
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, related_name='blocks', on_delete=models.CASCADE, db_index=False)
+
+    digest = models.BinaryField(max_length=blockstore.DIGEST_SIZE)
+
+    content = models.JSONField()
+
+    # Number of places in chunks which refer to the block.
+    # Blocks nothing refers to are deleted by collect_blocks.
+    refs = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['user', 'digest'], name='editorblock_user_digest_key'),
+        ]
+
+        indexes = [
+            # Blocks to collect.
+            models.Index(fields=['user'], condition=Q(refs=0), name='editorblock_unreferenced_idx'),
+        ]
+
+    def __str__(self):
+        return f'{self.user_id} {bytes(self.digest).hex()}'
+
+def lock_user(user_id):
+    """
+    Lock the user's row until the end of the transaction.
+    """
+    list(User.objects.select_for_update().filter(pk=user_id).values_list('pk', flat=True))
+
 class User(AbstractUser):
     """Class to store user information in our database."""
 
-    # Store LLM API credits.
-    # Float field to we can subtract fractions of a credit for small prompts.
-    # Negative credits are permitted to allow for Tiktoken price estimation errors.
-    credits = models.FloatField(default=0.0)
+    # Access tokens issued until then are refused; see authentication.end_tokens.
+    tokens_valid_after = models.DateTimeField(null=True, blank=True, editable=False)
+
+    # Stores of the user's doc vectors so far; see EditorFileVector.sequence.
+    vector_sequence = models.PositiveBigIntegerField(default=0, editable=False)
+
+    class Meta(AbstractUser.Meta):
+        indexes = [
+            # Case-insensitive email lookups; see views.get_user_by_email.
+            models.Index(Lower('email'), name='user_email_lower_idx'),
+        ]
+
+    def __init__(self, *args, **kwargs):
+        # Credits set before the user is saved, e.g. create_user(credits=...).
+        self._credits = None
+        super().__init__(*args, **kwargs)
+
+    @property
+    def credits(self):
+        """
+        LLM API credits, read from the user's CreditAccount.
+
+        Each read is a query, and may differ from the last if a generation
+        has been charged meanwhile, so read it once. ledger.get_balance (or
+        get_available, less holds) gives it in micro-credits.
+
+        Negative credits are permitted to allow for Tiktoken price estimation errors.
+        """
+        if self.pk is None:
+            return self._credits or 0.0
+
+        from .ledger import get_balance, from_micro
+        return from_micro(get_balance(self))
+
+    @credits.setter
+    def credits(self, value):
+        # Applied as an adjustment entry in the ledger on save().
+        # Spending and purchases should go through ledger.debit() and
+        # ledger.credit() instead, which don't read the balance first.
+        self._credits = value
+
+    def save(self, *args, **kwargs):
+        super().save(*args, **kwargs)
+
+        if self._credits is not None:
+            from .ledger import set_balance, to_micro
+            set_balance(self, to_micro(self._credits))
+            self._credits = None
     
     def __str__(self):
         return self.username
 
+class CreditAccount(models.Model):
+    """
+    A user's credit balance, in micro-credits (millionths of a credit).
+
+    Materialized from the CreditEntry ledger and updated atomically with
+    each entry, so reading a balance is a single small-row lookup.
+    """
+    user = models.OneToOneField(User, primary_key=True, related_name='credit_account', on_delete=models.CASCADE)
+
+    balance = models.BigIntegerField(default=0)
+
+    # Sum of the user's CreditHolds. Credits available
+    # to new generations are balance - held.
+    held = models.BigIntegerField(default=0)
+
+    def __str__(self):
+        return f'{self.user}: {self.balance}'
+
+class CreditEntry(models.Model):
+    """
+    Append-only ledger of changes to users' credits, in micro-credits.
+    Credits are positive, debits negative.
+    """
+    PURCHASE = 'purchase'
+    GENERATION = 'generation'
+    ADJUSTMENT = 'adjustment'
+    COMPACTION = 'compaction'
+
+    KIND_CHOICES = [
+        (PURCHASE, 'Purchase'),
+        (GENERATION, 'Generation'),
+        (ADJUSTMENT, 'Adjustment'),
+        # Sum of older entries, folded together by compact_credit_ledger.
+        (COMPACTION, 'Compaction'),
+    ]
+
+    user = models.ForeignKey(User, related_name='credit_entries', on_delete=models.CASCADE)
+
+    amount = models.BigIntegerField()
+
+    kind = models.CharField(max_length=20, choices=KIND_CHOICES)
+
+    # e.g. the Stripe checkout session ID for purchases.
+    reference = models.CharField(max_length=255, blank=True, default='')
+
+    created = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['user', 'created']),
+        ]
+        verbose_name_plural = 'credit entries'
+
+    def __str__(self):
+        return f'{self.user}: {self.amount} ({self.kind})'
+
+class CreditHold(models.Model):
+    """
+    Micro-credits reserved for a generation in progress, so parallel
+    generations can't spend the same credits. Settled to the actual cost
+    when the generation ends, or released once expired if it never does.
+    """
+    user = models.ForeignKey(User, related_name='credit_holds', on_delete=models.CASCADE)
+
+    amount = models.BigIntegerField()
+
+    created = models.DateTimeField(default=timezone.now)
+
+    expires = models.DateTimeField()
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['user', 'expires']),
+        ]
+
+    def __str__(self):
+        return f'{self.user}: {self.amount} until {self.expires}'
+
+class RefreshTokenQuerySet(models.QuerySet):
+
+    def issue(self, user_id, family=None):
+        """
+        A new refresh token for the user, in the given family (a new one
+        if None), valid for REFRESH_TOKEN_LIFETIME. Returns the secret to
+        give the client; only its digest is stored.
+        """
+        secret = secrets.token_urlsafe(32)
+        now = timezone.now()
+
+        self.create(
+            user_id=user_id,
+            digest=RefreshToken.digest_of(secret),
+            family=family or uuid.uuid4(),
+            created=now,
+            expires=now + datetime.timedelta(seconds=settings.REFRESH_TOKEN_LIFETIME),
+        )
+
+        return secret
+
+    def rotate(self, secret):
+        """
+        Use a refresh token: mark it replaced, and issue the next in its
+        family. Returns (user_id, username, the new secret), or None if the
+        token isn't valid.
+
+        A token used again after it was replaced means it has been copied,
+        so its whole family is revoked, unless that happens within
+        REFRESH_TOKEN_REUSE_GRACE of the rotation (as when parallel
+        requests carry the same cookie); then the new secret is None.
+        """
+        digest = RefreshToken.digest_of(secret)
+        now = timezone.now()
+
+        token = self.filter(digest=digest, expires__gt=now).values('pk', 'user_id', 'user__username', 'family', 'replaced').first()
+
+        if token is None:
+            return None
+
+        if token['replaced'] is None:
+            # Only one request can replace it.
+            with transaction.atomic(using=self.db):
+                if self.filter(pk=token['pk'], replaced__isnull=True).update(replaced=now):
+                    return token['user_id'], token['user__username'], self.issue(token['user_id'], token['family'])
+
+            token['replaced'] = now
+
+        if now - token['replaced'] <= datetime.timedelta(seconds=settings.REFRESH_TOKEN_REUSE_GRACE):
+            return token['user_id'], token['user__username'], None
+
+        self.filter(family=token['family']).delete()
+        return None
+
+    def revoke(self, secret):
+        """
+        Revoke a refresh token's family, as on logging out.
+        """
+        family = self.filter(digest=RefreshToken.digest_of(secret)).values('family')
+        return self.filter(family__in=family).delete()[0]
+
+class RefreshToken(models.Model):
+    """
+    A token the client exchanges for a new access token (see
+    authentication.py) when its own expires, without logging in again.
+
+    Each use replaces it with the next in its family, so a copied token
+    is found out when either copy is used a second time.
+    """
+    user = models.ForeignKey(User, related_name='refresh_tokens', on_delete=models.CASCADE)
+
+    # SHA-256 of the secret, so a database leak doesn't leak sessions.
+    digest = models.BinaryField(max_length=32, unique=True)
+
+    # The token first issued on logging in, and those which replaced it.
+    family = models.UUIDField(db_index=True)
+
+    created = models.DateTimeField(default=timezone.now)
+
+    expires = models.DateTimeField()
+
+    # When it was used, and replaced by the next in its family.
+    replaced = models.DateTimeField(null=True, blank=True)
+
+    objects = RefreshTokenQuerySet.as_manager()
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['expires'], name='refreshtoken_expires_idx'),
+        ]
+
+    def __str__(self):
+        return f'{self.user}: until {self.expires}'
+
+    @staticmethod
+    def digest_of(secret):
+        return hashlib.sha256(secret.encode()).digest()
+
 class Prompt(models.Model):
-    uid = models.CharField(primary_key=True, default=uuid.uuid4, max_length=100)
+    uid = models.UUIDField(primary_key=True, default=uuid.uuid4)
     user = models.ForeignKey(User, related_name='prompts', on_delete=models.CASCADE)
     name = models.CharField(max_length=100, unique=True)
     prompt = models.CharField(max_length=255)
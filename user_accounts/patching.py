@@ -0,0 +1,69 @@
+"""
+Block-level edits to document bodies.
+
+A document body is a list of blocks. Rather than re-uploading the whole
+body, the editor can send the operations which turn one version into the
+next:
+
+    {"op": "insert", "index": 2, "block": {...}}
+    {"op": "replace", "index": 0, "block": {...}}
+    {"op": "delete", "index": 3}
+
+Operations are applied in order, and each index refers to the body as
+left by the operations before it.
+"""
+
+OPS = ("insert", "replace", "delete")
+
+
+class PatchError(Exception):
+    """
+    Operations which can't be applied to a body.
+    """
+
+
+def validate_op(op, length):
+    """
+    Raises PatchError if the operation can't be applied to a body of the given length.
+    """
+    if not isinstance(op, dict) or op.get("op") not in OPS:
+        raise PatchError(f"Each operation must be an object with an op of {', '.join(OPS)}.")
+
+    index = op.get("index")
+
+    # Blocks can be inserted at the end, but only existing ones replaced or deleted.
+    end = length if op["op"] == "insert" else length - 1
+
+    if not isinstance(index, int) or isinstance(index, bool) or not 0 <= index <= end:
+        raise PatchError(f"Index out of range for {op['op']}: {index!r}.")
+
+    if op["op"] != "delete" and "block" not in op:
+        raise PatchError(f"No block given to {op['op']}.")
+
+
+def apply_block_ops(body, ops):
+    """
+    Return a copy of the body with the operations applied.
+
+    Raises PatchError if the body isn't a list of blocks, or any of the
+    operations are invalid, in which case none of them are applied.
+    """
+    if not isinstance(body, list):
+        raise PatchError("The doc's body isn't a list of blocks.")
+
+    if not isinstance(ops, list):
+        raise PatchError("Operations must be a list.")
+
+    body = list(body)
+
+    for op in ops:
+        validate_op(op, len(body))
+
+        if op["op"] == "insert":
+            body.insert(op["index"], op["block"])
+        elif op["op"] == "replace":
+            body[op["index"]] = op["block"]
+        else:
+            del body[op["index"]]
+
+    return body
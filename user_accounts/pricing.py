@@ -0,0 +1,179 @@
+"""
+Pricing and cost quotes for LLM calls.
+
+Credits are US cents. Prices are given in cents per million tokens, so a
+cost in micro-credits (millionths of a credit) is always a whole number:
+tokens * price.
+"""
+
+import hashlib
+from math import floor
+
+from .cache import LRUCache
+from .encodings import get_encoding
+
+# Convenience variable for a million.
+MILLION = 1000000
+
+PRICING = {
+    "gpt-3.5-turbo": {
+        # This number of tokens are permitted
+        # in the combined prompt and response.
+        "total_tokens": 4096,
+
+        # Cents per million tokens.
+        "input": 50,
+        "output": 150,
+    },
+}
+
+# Token overhead of the chat format, from:
+# https://cookbook.openai.com/examples/how_to_count_tokens_with_tiktoken
+TOKENS_PER_MESSAGE = 3
+TOKENS_PER_NAME = 1
+TOKENS_PER_REPLY = 3
+
+# Token counts of message contents, keyed by (encoding, content hash),
+# so repeated prompts (e.g. a saved prompt run over several documents)
+# are only tokenized once. Hashing the content keeps large prompts
+# from being held in memory by the cache.
+_token_counts = LRUCache(maxsize=4096)
+
+
+def get_pricing(model):
+    """
+    Return the pricing table entry for a model.
+
+    Raises KeyError if the model has no pricing.
+    """
+    return PRICING[model]
+
+
+def count_text_tokens(encoding, text):
+    """
+    Number of tokens in a piece of text, cached by its hash.
+    """
+    key = (encoding.name, hashlib.blake2b(text.encode(), digest_size=16).digest())
+
+    tokens = _token_counts.get(key)
+
+    if tokens is None:
+        tokens = len(encoding.encode(text, disallowed_special=()))
+        _token_counts.set(key, tokens)
+
+    return tokens
+
+
+def count_message_tokens(messages, model):
+    """
+    Number of prompt tokens the chat API will bill for the given messages,
+    including the boilerplate it adds around each message and the reply.
+    """
+    encoding = get_encoding(model)
+
+    tokens = TOKENS_PER_REPLY
+
+    for message in messages:
+        tokens += TOKENS_PER_MESSAGE
+
+        for field, value in message.items():
+            tokens += count_text_tokens(encoding, str(value))
+
+            if field == "name":
+                tokens += TOKENS_PER_NAME
+
+    return tokens
+
+
+def micro_cost(model, prompt_tokens, completion_tokens):
+    """
+    Cost of a call in micro-credits.
+    """
+    pricing = get_pricing(model)
+    return prompt_tokens * pricing["input"] + completion_tokens * pricing["output"]
+
+
+def usage_cost(model, usage):
+    """
+    Given the usage field of the ChatGPT Completions
+    response JSON, calculates the cost of the API call, in credits.
+
+    Format:
+
+    "usage": {
+        "completion_tokens": 17,
+        "prompt_tokens": 57,
+        "total_tokens": 74
+    }
+    """
+    return micro_cost(model, usage.prompt_tokens, usage.completion_tokens) / MILLION
+
+
+class CostQuote:
+    """
+    The price of sending some messages to a model, given the user's credits.
+
+    Tokenizes the prompt once; every figure below is derived from that count.
+    """
+
+    def __init__(self, messages, credits, model="gpt-3.5-turbo"):
+        pricing = get_pricing(model)
+
+        self.model = model
+        self.credits = credits
+
+        self.prompt_tokens = count_message_tokens(messages, model)
+
+        # The response may use whatever the prompt leaves of the context.
+        self.max_response_tokens = max(pricing["total_tokens"] - self.prompt_tokens, 0)
+
+        self.prompt_micro_cost = micro_cost(model, self.prompt_tokens, 0)
+        self.max_micro_cost = micro_cost(model, self.prompt_tokens, self.max_response_tokens)
+
+        # Longest response the user's credits cover.
+        remaining = credits * MILLION - self.prompt_micro_cost
+        self.affordable_tokens = max(min(floor(remaining / pricing["output"]), self.max_response_tokens), 0)
+
+    @property
+    def prompt_cost(self):
+        """
+        Cost of the prompt alone, in credits.
+        """
+        return self.prompt_micro_cost / MILLION
+
+    @property
+    def max_cost(self):
+        """
+        Cost if the response is of maximum length, in credits.
+        """
+        return self.max_micro_cost / MILLION
+
+    @property
+    def can_afford_prompt(self):
+        return self.prompt_micro_cost <= self.credits * MILLION
+
+    @property
+    def can_afford_max(self):
+        return self.max_micro_cost <= self.credits * MILLION
+
+    def max_tokens(self, is_scaling_output):
+        """
+        The max_tokens to request: the full response length if the user can
+        afford it, or what they can afford if they've opted to scale down.
+        """
+        if is_scaling_output and not self.can_afford_max:
+            return self.affordable_tokens
+
+        return self.max_response_tokens
+
+    def final_micro_cost(self, usage):
+        """
+        The actual cost of the call, in micro-credits, from the API's usage field.
+        """
+        return micro_cost(self.model, usage.prompt_tokens, usage.completion_tokens)
+
+    def final_cost(self, usage):
+        """
+        The actual cost of the call, in credits, from the API's usage field.
+        """
+        return usage_cost(self.model, usage)
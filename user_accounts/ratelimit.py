@@ -0,0 +1,342 @@
+"""
+Rate and concurrency limits for expensive endpoints.
+
+Each limited endpoint has a scope: RATE_LIMITS gives its rate, as
+(requests, seconds), enforced by a token bucket per client, which holds
+`requests` tokens and refills at requests/seconds. A request takes a
+token, or is refused with a 429 and Retry-After for when one will be
+back. CONCURRENCY_LIMITS gives how many requests a client may have in
+flight at once; each holds a slot, released when it finishes, or after
+CONCURRENCY_LEASE seconds if its worker dies first. Clients are users if
+they're logged in, or IP addresses if not. Scopes not listed aren't limited.
+
+The counts are kept by RATE_LIMIT_BACKEND:
+
+- MemoryBackend, in the worker: each worker of the server limits alone.
+- SQLiteBackend, in a SQLite file shared by the workers on a machine.
+
+Each decision is a dict lookup, or a single SQLite statement (the file
+in WAL mode, and never synced to disk), so a few microseconds, or tens;
+see benchmarks/bench_ratelimit.py. Either may wait, for a lock or for
+another process, so async code uses atake, aacquire and Slot.arelease,
+which run them in a thread.
+"""
+
+import itertools
+import sqlite3
+import threading
+import time
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+from django.utils.module_loading import import_string
+from rest_framework.throttling import BaseThrottle
+
+from .cache import LRUCache
+
+# Token buckets kept by MemoryBackend. A bucket evicted is refilled.
+MEMORY_BUCKETS = 100000
+
+# SQLiteBackend prunes full buckets and expired slots once in this many decisions.
+SQLITE_PRUNE_EVERY = 10000
+
+# Seconds SQLiteBackend waits between tries while another process is
+# writing, and in all before giving up. SQLite's own wait is at least 1ms.
+SQLITE_BUSY_WAIT = 0.00002
+SQLITE_BUSY_TIMEOUT = 5
+
+
+class MemoryBackend:
+    """
+    Counts kept in this process.
+    """
+
+    def __init__(self, maxsize=MEMORY_BUCKETS):
+        # key -> (tokens, time they were counted)
+        self._buckets = LRUCache(maxsize=maxsize)
+        # key -> {lease: expiry}
+        self._leases = {}
+        self._lease_ids = itertools.count()
+        self._lock = threading.Lock()
+
+    def take(self, key, rate, burst, now):
+        """
+        Take a token from the key's bucket. Returns 0 if there was one, or
+        else the seconds until there will be.
+        """
+        with self._lock:
+            tokens, counted = self._buckets.get(key) or (burst, now)
+            tokens = min(burst, tokens + (now - counted) * rate)
+
+            if tokens < 1:
+                return (1 - tokens) / rate
+
+            self._buckets.set(key, (tokens - 1, now))
+            return 0
+
+    def acquire(self, key, limit, ttl, now):
+        """
+        Take one of the key's `limit` slots for `ttl` seconds. Returns its
+        lease, to release it by, or None if they're all taken.
+        """
+        with self._lock:
+            leases = {lease: expiry for lease, expiry in self._leases.get(key, {}).items() if expiry > now}
+
+            if len(leases) >= limit:
+                return None
+
+            lease = next(self._lease_ids)
+            leases[lease] = now + ttl
+            self._leases[key] = leases
+            return lease
+
+    def release(self, key, lease):
+        with self._lock:
+            leases = self._leases.get(key)
+
+            if leases is not None:
+                leases.pop(lease, None)
+
+                if not leases:
+                    del self._leases[key]
+
+    def clear(self):
+        with self._lock:
+            self._buckets.clear()
+            self._leases.clear()
+
+
+class SQLiteBackend:
+    """
+    Counts kept in a SQLite file, shared by every process using it. The
+    threads of a process share one connection, taking turns.
+
+    Blocks while waiting for its turn, or for another process (see
+    execute), so must never be called on an event loop.
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS buckets (
+            key TEXT PRIMARY KEY,
+            tokens REAL NOT NULL,
+            counted REAL NOT NULL,
+            full REAL NOT NULL,
+            allowed INTEGER NOT NULL
+        ) WITHOUT ROWID;
+        CREATE TABLE IF NOT EXISTS leases (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            key TEXT NOT NULL,
+            expiry REAL NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS leases_key ON leases (key);
+    """
+
+    # Refills the bucket, and takes a token if it then has one. Returns
+    # the tokens left, and whether one was taken.
+    TAKE = """
+        INSERT INTO buckets (key, tokens, counted, full, allowed) VALUES (:key, :burst - 1, :now, :now + 1 / :rate, 1)
+        ON CONFLICT (key) DO UPDATE SET
+            tokens = min(:burst, tokens + (:now - counted) * :rate) - (min(:burst, tokens + (:now - counted) * :rate) >= 1),
+            counted = :now,
+            full = :now + (:burst - min(:burst, tokens + (:now - counted) * :rate) + (min(:burst, tokens + (:now - counted) * :rate) >= 1)) / :rate,
+            allowed = min(:burst, tokens + (:now - counted) * :rate) >= 1
+        RETURNING tokens, allowed
+    """
+
+    # Adds a lease if fewer than the limit haven't expired.
+    ACQUIRE = """
+        INSERT INTO leases (key, expiry)
+        SELECT :key, :now + :ttl
+        WHERE (SELECT count(*) FROM leases WHERE key = :key AND expiry > :now) < :limit
+        RETURNING id
+    """
+
+    def __init__(self, path):
+        # Autocommit: each statement is its own transaction. No timeout, as
+        # execute() waits for other processes itself.
+        self.connection = sqlite3.connect(path, timeout=0, isolation_level=None, check_same_thread=False)
+        self._lock = threading.Lock()
+        self._decisions = itertools.count(1)
+
+        self.execute("PRAGMA journal_mode=WAL")
+        # Counts lost in a crash of the machine don't matter.
+        self.execute("PRAGMA synchronous=OFF")
+
+        for statement in self.SCHEMA.split(';'):
+            if statement.strip():
+                self.execute(statement)
+
+    def execute(self, sql, parameters=()):
+        """
+        Run a statement, returning its first row. While another process is
+        writing, tries again every SQLITE_BUSY_WAIT seconds.
+        """
+        deadline = None
+
+        with self._lock:
+            while True:
+                try:
+                    return self.connection.execute(sql, parameters).fetchone()
+                except sqlite3.OperationalError as e:
+                    if e.sqlite_errorcode != sqlite3.SQLITE_BUSY:
+                        raise
+
+                    now = time.monotonic()
+                    deadline = deadline or now + SQLITE_BUSY_TIMEOUT
+
+                    if now > deadline:
+                        raise
+
+                time.sleep(SQLITE_BUSY_WAIT)
+
+    def take(self, key, rate, burst, now):
+        """
+        As MemoryBackend.take.
+        """
+        if next(self._decisions) % SQLITE_PRUNE_EVERY == 0:
+            self.prune(now)
+
+        tokens, allowed = self.execute(self.TAKE, {'key': key, 'rate': rate, 'burst': burst, 'now': now})
+        return 0 if allowed else (1 - tokens) / rate
+
+    def acquire(self, key, limit, ttl, now):
+        """
+        As MemoryBackend.acquire.
+        """
+        row = self.execute(self.ACQUIRE, {'key': key, 'limit': limit, 'ttl': ttl, 'now': now})
+        return None if row is None else row[0]
+
+    def release(self, key, lease):
+        self.execute("DELETE FROM leases WHERE id = ?", (lease,))
+
+    def prune(self, now):
+        """
+        Delete full buckets (the same as none) and expired leases.
+        """
+        self.execute("DELETE FROM buckets WHERE full <= ?", (now,))
+        self.execute("DELETE FROM leases WHERE expiry <= ?", (now,))
+
+    def clear(self):
+        self.execute("DELETE FROM buckets")
+        self.execute("DELETE FROM leases")
+
+
+_backend = None
+_backend_lock = threading.Lock()
+
+
+def get_backend():
+    """
+    The backend given by RATE_LIMIT_BACKEND, created on first use.
+    """
+    global _backend
+
+    if _backend is None:
+        with _backend_lock:
+            if _backend is None:
+                config = settings.RATE_LIMIT_BACKEND
+                _backend = import_string(config['BACKEND'])(**config.get('OPTIONS', {}))
+
+    return _backend
+
+
+@receiver(setting_changed)
+def reset_backend(setting, **kwargs):
+    global _backend
+
+    if setting == 'RATE_LIMIT_BACKEND':
+        _backend = None
+
+
+def take(scope, client):
+    """
+    Count a request by the client against the scope's rate. Returns 0 if
+    it's allowed, or else the seconds until it would be.
+    """
+    limit = settings.RATE_LIMITS.get(scope)
+
+    if limit is None:
+        return 0
+
+    requests, seconds = limit
+    return get_backend().take(f'{scope}:{client}', requests / seconds, requests, time.time())
+
+
+async def atake(scope, client):
+    """
+    take, for async code: the backend is called in a thread.
+    """
+    return await sync_to_async(take, thread_sensitive=False)(scope, client)
+
+
+class Slot:
+    """
+    One of a client's slots in a scope, held until release() (or the end
+    of a with block). Releasing again does nothing.
+    """
+
+    def __init__(self, key=None, lease=None):
+        self.key = key
+        self.lease = lease
+
+    def release(self):
+        if self.lease is not None:
+            get_backend().release(self.key, self.lease)
+            self.lease = None
+
+    async def arelease(self):
+        """
+        release, for async code.
+        """
+        await sync_to_async(self.release, thread_sensitive=False)()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.release()
+
+
+def acquire(scope, client):
+    """
+    A Slot for a request by the client, or None if the client already has
+    as many in flight as the scope allows.
+    """
+    limit = settings.CONCURRENCY_LIMITS.get(scope)
+
+    if limit is None:
+        return Slot()
+
+    key = f'{scope}:{client}'
+    lease = get_backend().acquire(key, limit, settings.CONCURRENCY_LEASE, time.time())
+    return None if lease is None else Slot(key, lease)
+
+
+async def aacquire(scope, client):
+    """
+    acquire, for async code: the backend is called in a thread.
+    """
+    return await sync_to_async(acquire, thread_sensitive=False)(scope, client)
+
+
+class TokenBucketThrottle(BaseThrottle):
+    """
+    Limits requests to the rate in RATE_LIMITS for the view's
+    throttle_scope, per user, or per IP address for anonymous requests
+    (as the proxy in front of the app saw it; see NUM_PROXIES). Refused
+    requests get a 429, with Retry-After.
+    """
+
+    def allow_request(self, request, view):
+        if request.user is not None and request.user.is_authenticated:
+            client = f'user:{request.user.pk}'
+        else:
+            client = f'ip:{self.get_ident(request)}'
+
+        self.delay = take(view.throttle_scope, client)
+        return self.delay == 0
+
+    def wait(self):
+        return self.delay
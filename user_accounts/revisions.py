@@ -0,0 +1,77 @@
+"""
+Revision history of document bodies.
+
+Each save which changes a document's body is recorded as an
+EditorFileRevision. Most revisions are deltas: the block operations
+(see patching.py) which turn the body of the revision before into
+theirs. Every SNAPSHOT_INTERVAL revisions, and whenever a delta would be
+no smaller, the whole body is stored instead, so reading any revision
+means applying at most SNAPSHOT_INTERVAL - 1 deltas to a snapshot.
+
+Old revisions are thinned out by the prune_revisions command.
+"""
+
+import difflib
+import json
+
+# Most revisions between snapshots, counting the snapshot.
+SNAPSHOT_INTERVAL = 20
+
+
+def diff(old, new):
+    """
+    Block operations which turn body old into new, or None if bodies
+    aren't lists of blocks or a snapshot of new would be as small.
+    """
+    if not isinstance(old, list) or not isinstance(new, list):
+        return None
+
+    # Blocks compared by their JSON, key order included, as blockstore.digest.
+    matcher = difflib.SequenceMatcher(
+        a=[json.dumps(block, separators=(",", ":")) for block in old],
+        b=[json.dumps(block, separators=(",", ":")) for block in new],
+        autojunk=False,
+    )
+
+    ops = []
+
+    # Indexes are into the body as left by the operations before, which
+    # is new up to j1 and old after i1.
+    for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+        if tag == "equal":
+            continue
+
+        replaced = min(i2 - i1, j2 - j1) if tag == "replace" else 0
+
+        for k in range(replaced):
+            ops.append({"op": "replace", "index": j1 + k, "block": new[j1 + k]})
+
+        for k in range(i2 - i1 - replaced):
+            ops.append({"op": "delete", "index": j1 + replaced})
+
+        for k in range(replaced, j2 - j1):
+            ops.append({"op": "insert", "index": j1 + k, "block": new[j1 + k]})
+
+        if len(ops) >= len(new):
+            return None
+
+    return ops
+
+
+def thin(revisions, keep_after):
+    """
+    Which revisions to keep, given (version, created) of all of a
+    document's revisions in order: the latest, those created after
+    keep_after, and of the rest, the last of each day.
+    """
+    keep = {version for version, created in revisions if created > keep_after}
+
+    if revisions:
+        keep.add(revisions[-1][0])
+
+    last_of_day = {}
+
+    for version, created in revisions:
+        last_of_day[created.date()] = version
+
+    return keep | set(last_of_day.values())
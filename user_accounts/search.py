@@ -0,0 +1,124 @@
+"""
+Full-text search of a user's documents.
+
+Documents are indexed by title and body text. On PostgreSQL, the index
+is a tsvector column on EditorFile with a GIN index, and searches use
+its native full-text search. Other databases (SQLite, in tests) use
+EditorFileTerm rows: an inverted index from each term to the documents
+containing it, ranked here with BM25.
+
+Documents are indexed as they're written, in the same transaction
+(batches of them at once), so searches only read. A document is indexed
+as at its indexed_version; one behind its version (as one saved before
+indexing on write, or whose indexing failed) is stale, and indexed by
+the index_docs command. Saving only the title, unchanged, leaves the
+index alone. Deleting a document deletes its index entries with it.
+"""
+
+import math
+import re
+
+# Weight of a term in the title, against one in the body.
+TITLE_WEIGHT = 3
+
+# BM25 term frequency saturation.
+K1 = 1.2
+
+# Text search configuration, on PostgreSQL.
+CONFIG = 'english'
+
+# Longest indexed term, in characters; longer ones are left out.
+MAX_TERM_LENGTH = 64
+
+# Characters of a body indexed, within PostgreSQL's limits on tsvectors.
+MAX_TEXT_LENGTH = 500_000
+
+# Most results returned for a search.
+MAX_RESULTS = 50
+
+# Length of the snippet of text returned with each result.
+SNIPPET_LENGTH = 160
+
+WORD = re.compile(r"\w+")
+
+# Too common to be worth indexing, as PostgreSQL's english configuration.
+STOP_WORDS = frozenset("""
+    a an and are as at be but by for if in into is it no not of on or such
+    that the their then there these they this to was will with
+""".split())
+
+
+def terms(text):
+    """
+    The indexed terms in some text, in order, repeated as often as they appear.
+    """
+    return [
+        term for term in (match.group().casefold() for match in WORD.finditer(text))
+        if term not in STOP_WORDS and len(term) <= MAX_TERM_LENGTH
+    ]
+
+
+def query_terms(query):
+    """
+    The distinct terms of a search query, in order.
+    """
+    return list(dict.fromkeys(terms(query)))
+
+
+def term_weights(title, text):
+    """
+    {term: weight} for a document: the times each term is in its body,
+    plus TITLE_WEIGHT for each time in its title.
+    """
+    weights = {}
+
+    for term in terms(title):
+        weights[term] = weights.get(term, 0) + TITLE_WEIGHT
+
+    for term in terms(text):
+        weights[term] = weights.get(term, 0) + 1
+
+    return weights
+
+
+def idf(doc_count, matching):
+    """
+    BM25 inverse document frequency of a term in matching of doc_count documents.
+    """
+    return math.log(1 + (doc_count - matching + 0.5) / (matching + 0.5))
+
+
+def score(idf, weight):
+    """
+    BM25 score of a term of a document, without length normalization.
+    """
+    return idf * weight * (K1 + 1) / (weight + K1)
+
+
+def snippet(text, query, length=SNIPPET_LENGTH):
+    """
+    The part of a document's text around the first match of the query's
+    terms, with whitespace collapsed. Returns {"text": ..., "highlights":
+    [[start, end], ...]}, the spans of matched words in the snippet.
+    """
+    text = " ".join(text.split())
+    wanted = set(query_terms(query))
+    words = list(WORD.finditer(text))
+    first = next((word for word in words if word.group().casefold() in wanted), None)
+
+    # Some context before the match (more, near the end), starting at a word.
+    start = 0 if first is None else max(0, min(first.start() - length // 4, len(text) - length))
+
+    if start:
+        start = next(word.start() for word in words if word.start() >= start)
+
+    end = min(len(text), start + length)
+    prefix = "…" if start else ""
+
+    highlights = [
+        [len(prefix) + word.start() - start, len(prefix) + word.end() - start]
+        for word in words
+        if start <= word.start() and word.end() <= end and word.group().casefold() in wanted
+    ]
+
+    return {"text": prefix + text[start:end] + ("…" if end < len(text) else ""), "highlights": highlights}
@@ -13,17 +13,34 @@ class FileDetailSerializer(serializers.ModelSerializer):
 class FileCreateSerializer(serializers.ModelSerializer):
     class Meta:
         model = EditorFile
-        fields = ('title', 'body', 'author', 'created', 'modified')    
+        fields = ('title', 'body', 'created', 'modified')    
 
 class FilePatchSerializer(serializers.ModelSerializer):
     class Meta:
         model = EditorFile
-        fields = ('title', 'body', 'modified')   
+        fields = ('title', 'body', 'modified', 'version')
+        read_only_fields = ('version',)
+
+class SparseFieldsMixin:
+    """
+    Takes a `fields` argument to serialize only some of the Meta fields.
+    """
+    def __init__(self, *args, fields=None, **kwargs):
+        super().__init__(*args, **kwargs)
+
+        if fields is not None:
+            for name in set(self.fields) - set(fields):
+                self.fields.pop(name)
+
+class FileListSerializer(SparseFieldsMixin, serializers.ModelSerializer):
+    class Meta:
+        model = EditorFile
+        fields = ('uid', 'title', 'body', 'created', 'modified', 'version')
 
-class FileListSerializer(serializers.ModelSerializer):
+class FileSummarySerializer(SparseFieldsMixin, serializers.ModelSerializer):
     class Meta:
         model = EditorFile
-        fields = ('uid', 'title', 'body', 'created', 'modified') 
+        fields = ('uid', 'title', 'created', 'modified', 'version', 'preview', 'body_size', 'block_count')
 
 class PromptSerializer(serializers.ModelSerializer):
     class Meta:
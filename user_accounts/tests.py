@@ -1,17 +1,46 @@
-from django.test import TestCase
+from django.test import TestCase, TransactionTestCase
 from django.urls import reverse
 from django.utils.http import urlsafe_base64_encode
 from django.utils.encoding import force_bytes
 from rest_framework import status
 from rest_framework.test import APIClient, APITestCase
 from django.http.cookie import SimpleCookie
+from django.test.utils import CaptureQueriesContext
+from django.test import override_settings
+from django.core.management import call_command
+from django.core.handlers.asgi import ASGIHandler
+from django.apps import apps
 
 from .views import generate_jwt_token, encode_password_reset_uid, OrderFulfillmentWebhookView
 import jwt, json
-
-from .models import User, EditorFile, Prompt
+import hashlib, re, tempfile, threading, time
+import django.contrib.auth.hashers
+from django.conf import settings
+
+from .models import User, EditorFile, EditorBlock, EditorBlockVector, EditorFileRevision, EditorFileTerm, EditorFileVector, Prompt, CreditAccount, CreditEntry, CreditHold, RefreshToken
+from . import authentication, hashing, ledger, ratelimit
+from . import encodings
+from .pricing import CostQuote, count_message_tokens
+from .patching import apply_block_ops
+from . import documents
+from . import revisions
+from . import search
+from . import blockstore, embeddings, vectors
+import numpy
+import random
+from . import generation
+import asyncio
+from asgiref.sync import sync_to_async
 import os , unittest.mock
-from openai import AuthenticationError 
+import importlib, sys
+import datetime
+import uuid
+from django.db import connection
+from django.db.models import F
+from django.utils import timezone
+from types import SimpleNamespace
+import tiktoken
+from openai import APIError, AuthenticationError 
 
 
 def validate_jwt(self, response, username):
@@ -29,6 +58,106 @@ def validate_jwt(self, response, username):
     self.assertEqual(jwt_cookie["secure"], True)
     self.assertEqual(jwt_cookie["domain"], ".conduits.link")
 
+def fake_completion(content, prompt_tokens, completion_tokens):
+    """
+    The fields we use from a ChatGPT Completions response.
+    """
+    return SimpleNamespace(
+        choices=[SimpleNamespace(message=SimpleNamespace(content=content))],
+        usage=SimpleNamespace(
+            prompt_tokens=prompt_tokens,
+            completion_tokens=completion_tokens,
+            total_tokens=prompt_tokens + completion_tokens
+        )
+    )
+
+def fake_chunk(content=None, usage=None):
+    """
+    A chunk of a streamed ChatGPT Completions response.
+    """
+    choices = [] if content is None else [SimpleNamespace(delta=SimpleNamespace(content=content))]
+    return SimpleNamespace(choices=choices, usage=usage)
+
+class FakeStream:
+    """
+    Stands in for the openai Stream returned when stream=True.
+    """
+    def __init__(self, chunks):
+        self.chunks = chunks
+        self.closed = False
+
+    def __iter__(self):
+        return iter(self.chunks)
+
+    def close(self):
+        self.closed = True
+
+def upstream_error(message):
+    """
+    An APIError, as the openai client raises when a stream fails partway.
+    """
+    return APIError(message, None, body=None)
+
+def parse_sse(content):
+    """
+    Return a list of (event, data) from a Server-Sent Events body.
+    """
+    events = []
+    for block in content.decode().strip().split("\n\n"):
+        event, data = block.split("\n")
+        events.append((event[len("event: "):], json.loads(data[len("data: "):])))
+    return events
+
+async def asgi_request(method, path, body=b'', cookies=None, on_body=None):
+    """
+    Send a request straight to Django's ASGI handler, as the server in the
+    Procfile does, and return (status, body chunks). on_body(chunk) is
+    called as each chunk is sent, while the response is still streaming.
+    """
+    headers = [(b'content-type', b'application/json'), (b'content-length', str(len(body)).encode())]
+
+    if cookies:
+        headers.append((b'cookie', '; '.join(f'{name}={value}' for name, value in cookies.items()).encode()))
+
+    scope = {
+        'type': 'http', 'asgi': {'version': '3.0'}, 'http_version': '1.1', 'scheme': 'http',
+        'method': method, 'path': path, 'root_path': '', 'query_string': b'', 'headers': headers,
+        'server': ('testserver', 80), 'client': ('127.0.0.1', 50000),
+    }
+    messages = [{'type': 'http.request', 'body': body, 'more_body': False}]
+    started, chunks = {}, []
+
+    async def receive():
+        if messages:
+            return messages.pop(0)
+
+        # The client never hangs up.
+        await asyncio.Event().wait()
+
+    async def send(message):
+        if message['type'] == 'http.response.start':
+            started.update(message)
+        elif message.get('body'):
+            chunks.append(message['body'])
+
+            if on_body is not None:
+                on_body(message['body'])
+
+    await ASGIHandler()(scope, receive, send)
+    return started['status'], chunks
+
+def byte_encoding():
+    """
+    A Tiktoken encoding with one token per byte, which
+    can be built without downloading any BPE files.
+    """
+    return tiktoken.Encoding(
+        name="test_bytes",
+        pat_str=r"""\S+|\s+""",
+        mergeable_ranks={bytes([i]): i for i in range(256)},
+        special_tokens={}
+    )
+
 
 # Tests the registration email view executes correctly.
 # Doesn't test if the email sends correctly.
@@ -269,6 +398,356 @@ class UserLogoutViewTest(APITestCase):
         self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
 
 
+class JWTCookieAuthenticationTest(APITestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='test_user', password='test_password')
+        self.token = generate_jwt_token('test_user')
+        self.client.cookies = SimpleCookie({'jwt': self.token})
+        self.doc = EditorFile.objects.create(author=self.user, title='Doc', body=['Body'])
+        authentication.tokens.clear()
+
+    def test_login_token_carries_pk(self):
+        response = self.client.post(reverse('login'), {'username': 'test_user', 'password': 'test_password'}, format='json')
+        claims = jwt.decode(response.cookies['jwt'].value, authentication.key, algorithms=["HS256"])
+
+        self.assertEqual((claims['username'], claims['user_id']), ('test_user', self.user.pk))
+
+    def test_reads_dont_load_user(self):
+        # That the user exists, the ETag, the docs, then their chunks and blocks.
+        with self.assertNumQueries(5):
+            response = self.client.get(reverse('create-view-docs'))
+
+        self.assertEqual([doc['uid'] for doc in response.data['docs']], [str(self.doc.uid)])
+
+        # That the user exists, the doc, then its chunks and blocks.
+        with self.assertNumQueries(4):
+            response = self.client.get(reverse('edit-doc', kwargs={'pk': self.doc.pk}))
+
+        self.assertEqual(response.data['doc']['title'], 'Doc')
+
+        with self.assertNumQueries(2):
+            self.assertEqual(self.client.get(reverse('prompts')).status_code, status.HTTP_200_OK)
+
+    def test_user_loaded_when_needed(self):
+        self.user.credits = 7
+        self.user.save()
+
+        # That the user exists, then their balance.
+        with self.assertNumQueries(2):
+            response = self.client.get(reverse('credits'))
+
+        self.assertEqual(response.data['credits'], 7)
+
+        # The user's row, only once something needs it.
+        request = unittest.mock.Mock(_request=SimpleNamespace(COOKIES={'jwt': self.token}))
+        user = authentication.JWTCookieAuthentication().authenticate(request)[0]
+
+        with self.assertNumQueries(1):
+            self.assertEqual(user.email, self.user.email)
+
+    def test_username_only_token(self):
+        # Issued before tokens carried the pk.
+        token = jwt.encode({"username": "test_user", "exp": datetime.datetime.now(tz=datetime.timezone.utc) + datetime.timedelta(hours=1)}, authentication.key, algorithm="HS256")
+        self.client.cookies = SimpleCookie({'jwt': token})
+
+        response = self.client.get(reverse('edit-doc', kwargs={'pk': self.doc.pk}))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+    def test_expired_token(self):
+        self.client.cookies = SimpleCookie({'jwt': generate_jwt_token('test_user', datetime.timedelta(seconds=-1))})
+
+        self.assertEqual(self.client.get(reverse('create-view-docs')).status_code, status.HTTP_401_UNAUTHORIZED)
+
+        # Views open to anyone ignore it.
+        response = self.client.post(reverse('login'), {'username': 'test_user', 'password': 'test_password'}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+    def test_deleted_user(self):
+        # Verified, and cached, while the user existed.
+        self.client.get(reverse('create-view-docs'))
+        self.user.delete()
+
+        # Refused whether or not the view reads the user.
+        for name in ['create-view-docs', 'prompts', 'credits', 'search-docs']:
+            response = self.client.get(reverse(name), {'q': 'x'})
+            self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED, name)
+
+        response = self.client.post(reverse('create-view-docs'), {'doc': {'title': 'New', 'body': []}}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+
+    def test_tokens_verified_once(self):
+        with unittest.mock.patch.object(authentication.jwt, 'decode', wraps=jwt.decode) as decode:
+            for _ in range(3):
+                self.assertEqual(self.client.get(reverse('edit-doc', kwargs={'pk': self.doc.pk})).status_code, status.HTTP_200_OK)
+
+        self.assertEqual(decode.call_count, 1)
+        self.assertEqual(authentication.tokens.get(authentication.token_digest(self.token)).user_id, self.user.pk)
+
+    def test_cached_token_expires(self):
+        self.client.get(reverse('create-view-docs'))
+        exp = authentication.tokens.get(authentication.token_digest(self.token)).claims['exp']
+
+        with unittest.mock.patch.object(authentication.time, 'time', return_value=exp):
+            self.assertIsNone(authentication.verify_token(self.token))
+
+        self.assertNotIn(authentication.token_digest(self.token), authentication.tokens)
+
+    def test_logout_ends_access_tokens(self):
+        other = generate_jwt_token('test_user', datetime.timedelta(seconds=60))
+        self.assertEqual(self.client.get(reverse('create-view-docs')).status_code, status.HTTP_200_OK)
+
+        self.client.get(reverse('logout'))
+
+        # Still cached as verified, but refused.
+        self.assertIn(authentication.token_digest(self.token), authentication.tokens)
+        self.client.cookies = SimpleCookie({'jwt': self.token})
+        self.assertEqual(self.client.get(reverse('create-view-docs')).status_code, status.HTTP_401_UNAUTHORIZED)
+        self.assertIsNone(authentication.verify_token(other))
+
+        # Logging in again starts afresh.
+        response = self.client.post(reverse('login'), {'username': 'test_user', 'password': 'test_password'}, format='json')
+        self.client.cookies = SimpleCookie({'jwt': response.cookies['jwt'].value})
+        self.assertEqual(self.client.get(reverse('create-view-docs')).status_code, status.HTTP_200_OK)
+
+    def test_password_reset_ends_access_tokens(self):
+        self.user.email = 'test@example.com'
+        self.user.save()
+        self.assertEqual(self.client.get(reverse('create-view-docs')).status_code, status.HTTP_200_OK)
+
+        response = self.client.post(reverse('reset', kwargs={'pk': encode_password_reset_uid('test@example.com')}), {'password': 'new_password'})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+        self.client.cookies = SimpleCookie({'jwt': self.token})
+        self.assertEqual(self.client.get(reverse('create-view-docs')).status_code, status.HTTP_401_UNAUTHORIZED)
+
+    def test_unauthorized_bodies(self):
+        self.client.cookies = SimpleCookie()
+
+        response = self.client.get(reverse('credits'))
+        self.assertEqual((response.status_code, response.data), (status.HTTP_401_UNAUTHORIZED, {"error": "Unauthorized"}))
+
+        response = self.client.get(reverse('search-docs'), {'q': 'x'})
+        self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+        self.assertIn('detail', response.data)
+
+
+class TokenRefreshTest(APITestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='test_user', email='test@example.com', password='test_password')
+        self.doc = EditorFile.objects.create(author=self.user, title='Doc', body=['Body'])
+        authentication.tokens.clear()
+
+        response = self.client.post(reverse('login'), {'username': 'test_user', 'password': 'test_password'}, format='json')
+        self.refresh = response.cookies['refresh'].value
+
+    def expire_access(self):
+        self.client.cookies['jwt'] = generate_jwt_token('test_user', datetime.timedelta(seconds=-1))
+
+    def test_login_issues_refresh_token(self):
+        token = RefreshToken.objects.get()
+
+        self.assertEqual(token.user, self.user)
+        self.assertEqual(bytes(token.digest), hashlib.sha256(self.refresh.encode()).digest())
+        self.assertIsNone(token.replaced)
+
+    def test_expired_access_renewed(self):
+        self.expire_access()
+
+        # No password hashing.
+        with unittest.mock.patch.object(User, 'check_password') as check_password:
+            response = self.client.get(reverse('create-view-docs'))
+
+        check_password.assert_not_called()
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(response.data['docs']), 1)
+
+        # Both renewed, the old refresh token replaced by the new.
+        self.assertIsNotNone(authentication.verify_token(response.cookies['jwt'].value))
+        self.assertNotEqual(response.cookies['refresh'].value, self.refresh)
+        self.assertEqual(RefreshToken.objects.filter(replaced__isnull=True).get().digest, RefreshToken.digest_of(response.cookies['refresh'].value))
+        self.assertEqual(RefreshToken.objects.values('family').distinct().count(), 1)
+
+    async def test_expired_access_renewed_async(self):
+        # Through the middleware's async path, as under ASGI.
+        self.async_client.cookies = SimpleCookie({'refresh': self.refresh, 'jwt': await sync_to_async(generate_jwt_token)('test_user', datetime.timedelta(seconds=-1))})
+
+        response = await self.async_client.get(reverse('create-view-docs'))
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertNotEqual(response.cookies['refresh'].value, self.refresh)
+        self.assertIsNotNone(await sync_to_async(authentication.verify_token)(response.cookies['jwt'].value))
+
+    def test_access_renewed_near_expiry(self):
+        self.client.cookies['jwt'] = generate_jwt_token('test_user', datetime.timedelta(seconds=60))
+
+        response = self.client.get(reverse('create-view-docs'))
+
+        claims = authentication.verify_token(response.cookies['jwt'].value).claims
+        self.assertGreater(claims['exp'], time.time() + settings.ACCESS_TOKEN_LIFETIME - 60)
+        self.assertNotEqual(response.cookies['refresh'].value, self.refresh)
+
+        # Not while there's long enough left.
+        self.assertNotIn('jwt', self.client.get(reverse('create-view-docs')).cookies)
+
+    def test_ended_session_not_renewed(self):
+        for end in ['logout', 'reset']:
+            with self.subTest(end=end):
+                self.refresh = self.client.post(reverse('login'), {'username': 'test_user', 'password': 'test_password'}, format='json').cookies['refresh'].value
+                copy = generate_jwt_token('test_user', datetime.timedelta(seconds=300))
+
+                if end == 'logout':
+                    self.client.get(reverse('logout'))
+                else:
+                    self.client.post(reverse('reset', kwargs={'pk': encode_password_reset_uid('test@example.com')}), {'password': 'test_password'})
+
+                # Refused, and not renewed, with or without the refresh cookie.
+                for cookies in [{'jwt': copy}, {'jwt': copy, 'refresh': self.refresh}]:
+                    self.client.cookies = SimpleCookie(cookies)
+                    response = self.client.get(reverse('create-view-docs'))
+
+                    self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+                    self.assertNotIn('jwt', response.cookies)
+
+    def test_other_session_renewed_after_logout(self):
+        other = self.client_class()
+        response = other.post(reverse('login'), {'username': 'test_user', 'password': 'test_password'}, format='json')
+        other.cookies = SimpleCookie({'jwt': response.cookies['jwt'].value, 'refresh': response.cookies['refresh'].value})
+
+        self.client.get(reverse('logout'))
+
+        # Its access token ended, but renewed with its own refresh token.
+        response = other.get(reverse('create-view-docs'))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertIsNotNone(authentication.verify_token(response.cookies['jwt'].value))
+
+    def test_expired_without_refresh_token(self):
+        self.expire_access()
+        del self.client.cookies['refresh']
+
+        self.assertEqual(self.client.get(reverse('create-view-docs')).status_code, status.HTTP_401_UNAUTHORIZED)
+
+    def test_parallel_reuse_allowed(self):
+        access, refresh = authentication.refresh_session(self.refresh)
+
+        # As by a request sent before the first's response came back.
+        access_again, refresh_again = authentication.refresh_session(self.refresh)
+        self.assertIsNotNone(access_again)
+        self.assertIsNone(refresh_again)
+
+        self.assertIsNotNone(authentication.refresh_session(refresh))
+
+    def test_reuse_revokes_family(self):
+        access, refresh = authentication.refresh_session(self.refresh)
+        RefreshToken.objects.update(replaced=timezone.now() - datetime.timedelta(seconds=settings.REFRESH_TOKEN_REUSE_GRACE + 1))
+
+        self.assertIsNone(authentication.refresh_session(self.refresh))
+
+        # The copy issued from it is no good either.
+        self.assertIsNone(authentication.refresh_session(refresh))
+        self.assertFalse(RefreshToken.objects.exists())
+
+    def test_expired_refresh_token(self):
+        RefreshToken.objects.update(expires=timezone.now())
+
+        self.assertIsNone(authentication.refresh_session(self.refresh))
+
+    def test_refresh_view(self):
+        response = self.client.post(reverse('refresh'))
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertIsNotNone(authentication.verify_token(response.cookies['jwt'].value))
+        self.assertNotEqual(response.cookies['refresh'].value, self.refresh)
+
+        self.client.cookies = SimpleCookie({'refresh': 'not-a-token'})
+        self.assertEqual(self.client.post(reverse('refresh')).status_code, status.HTTP_401_UNAUTHORIZED)
+
+    def test_logout_revokes_refresh_token(self):
+        response = self.client.get(reverse('logout'))
+
+        self.assertEqual((response.cookies['jwt'].value, response.cookies['refresh'].value), ('', ''))
+        self.assertFalse(RefreshToken.objects.exists())
+        self.assertIsNone(authentication.refresh_session(self.refresh))
+
+    def test_password_reset_revokes_refresh_tokens(self):
+        other = RefreshToken.objects.issue(self.user.pk)
+
+        self.client.post(reverse('reset', kwargs={'pk': encode_password_reset_uid('test@example.com')}), {'password': 'new_password'})
+
+        self.assertIsNone(authentication.refresh_session(self.refresh))
+        self.assertIsNone(authentication.refresh_session(other))
+
+
+class PasswordHashingTest(APITestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='test_user', email='test@example.com', password='test_password')
+
+    def login(self, password='test_password', username='test_user'):
+        return self.client.post(reverse('login'), {'username': username, 'password': password}, format='json')
+
+    def test_executor_refuses_when_full(self):
+        executor = hashing.BoundedExecutor(1, 1)
+        release = threading.Event()
+        running = [executor.submit(release.wait), executor.submit(release.wait)]
+
+        # One running and one waiting.
+        with self.assertRaises(hashing.HasherBusy):
+            executor.submit(release.wait)
+
+        release.set()
+        self.assertEqual([future.result() for future in running], [True, True])
+
+        # Taken again once they're done.
+        self.assertEqual(executor.run(sum, [1, 2]), 3)
+
+    def test_hashed_in_pool(self):
+        threads = []
+        check_password = django.contrib.auth.hashers.check_password
+
+        def record(*args, **kwargs):
+            threads.append(threading.current_thread().name)
+            return check_password(*args, **kwargs)
+
+        with unittest.mock.patch.object(hashing.hashers, 'check_password', side_effect=record):
+            self.assertEqual(self.login().status_code, status.HTTP_200_OK)
+            self.assertEqual(self.login('wrong_password').status_code, status.HTTP_401_UNAUTHORIZED)
+
+        self.assertEqual(len(threads), 2)
+        self.assertTrue(all(name.startswith('hasher') for name in threads))
+
+    def test_unknown_username_hashed(self):
+        with unittest.mock.patch.object(hashing.hashers, 'make_password', wraps=django.contrib.auth.hashers.make_password) as make_password:
+            self.assertEqual(self.login(username='nobody').status_code, status.HTTP_401_UNAUTHORIZED)
+
+        make_password.assert_called_once()
+
+    @override_settings(PASSWORD_HASHERS=['django.contrib.auth.hashers.PBKDF2PasswordHasher', 'django.contrib.auth.hashers.MD5PasswordHasher'])
+    def test_outdated_hash_upgraded(self):
+        self.user.password = django.contrib.auth.hashers.make_password('test_password', hasher='md5')
+        self.user.save()
+
+        self.assertEqual(self.login().status_code, status.HTTP_200_OK)
+
+        self.user.refresh_from_db()
+        self.assertTrue(self.user.password.startswith('pbkdf2_sha256$'))
+        self.assertTrue(self.user.check_password('test_password'))
+
+    def test_refused_when_busy(self):
+        with unittest.mock.patch.object(hashing.BoundedExecutor, 'submit', side_effect=hashing.HasherBusy):
+            response = self.login()
+            reset = self.client.post(reverse('reset', kwargs={'pk': encode_password_reset_uid('test@example.com')}), {'password': 'new_password'})
+            register = self.client.post(reverse('register-account', kwargs={'pk': urlsafe_base64_encode(force_bytes('new@example.com'))}), {'username': 'new_user', 'password': 'new_password'})
+
+        self.assertEqual(response.status_code, status.HTTP_503_SERVICE_UNAVAILABLE)
+        self.assertEqual(response['Retry-After'], str(settings.PASSWORD_HASHER_RETRY_AFTER))
+        self.assertNotIn('jwt', response.cookies)
+
+        # Nothing changed.
+        self.assertEqual((reset.status_code, register.status_code), (status.HTTP_503_SERVICE_UNAVAILABLE, status.HTTP_503_SERVICE_UNAVAILABLE))
+        self.user.refresh_from_db()
+        self.assertTrue(self.user.check_password('test_password'))
+        self.assertFalse(User.objects.filter(username='new_user').exists())
+
+
 class DocsCreateRetrieveViewTest(APITestCase):
     def setUp(self):
         self.client = APIClient()
@@ -281,8 +760,8 @@ class DocsCreateRetrieveViewTest(APITestCase):
 
     def test_get_docs_list(self):
         # Create a document associated with the authenticated user
-        EditorFile.objects.create(author=self.username, title='Test Document', body='Lorem Ipsum')
-        EditorFile.objects.create(author=self.username, title='Test Document 2', body='Lorem Ipsum')
+        EditorFile.objects.create(author=self.user, title='Test Document', body='Lorem Ipsum')
+        EditorFile.objects.create(author=self.user, title='Test Document 2', body='Lorem Ipsum')
 
         # Send a GET request to retrieve the list of documents
         response = self.client.get(reverse('create-view-docs'))
@@ -357,6 +836,108 @@ class DocsCreateRetrieveViewTest(APITestCase):
         # Check if the response contains an empty list of docs
         self.assertEqual(response.data['docs'], [])
 
+    def test_get_docs_summary(self):
+        body = [{"type": "paragraph", "children": [{"text": "The sky "}, {"text": "is blue."}]}, {"type": "paragraph", "children": [{"text": "x" * 500}]}]
+        EditorFile.objects.create(author=self.user, title='Test Document', body=body)
+
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse('create-view-docs'), {'view': 'summary'})
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+        doc = response.data['docs'][0]
+        self.assertNotIn('body', doc)
+        self.assertEqual(doc['title'], 'Test Document')
+        self.assertTrue(doc['preview'].startswith('The sky is blue. xxx'))
+        self.assertEqual(len(doc['preview']), 200)
+        self.assertEqual(doc['block_count'], 2)
+        self.assertEqual(doc['body_size'], len(json.dumps(body)))
+
+        # The bodies aren't even loaded.
+        self.assertFalse(any('"body"' in query['sql'] for query in queries))
+
+    def test_get_docs_fields(self):
+        EditorFile.objects.create(author=self.user, title='Test Document', body='Lorem Ipsum')
+
+        response = self.client.get(reverse('create-view-docs'), {'fields': 'uid,title'})
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(set(response.data['docs'][0]), {'uid', 'title'})
+
+        response = self.client.get(reverse('create-view-docs'), {'fields': 'title,author'})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+        # Bodies aren't part of summaries.
+        response = self.client.get(reverse('create-view-docs'), {'view': 'summary', 'fields': 'body'})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_get_docs_paginated(self):
+        for i in range(5):
+            EditorFile.objects.create(author=self.user, title=f'Document {i}', body='Lorem Ipsum')
+
+        # Documents created at the same time are ordered by uid.
+        EditorFile.objects.filter(title__in=['Document 1', 'Document 2', 'Document 3']).update(created=timezone.now())
+
+        expected = [doc.title for doc in EditorFile.objects.filter(author=self.user).order_by('-created', '-uid')]
+
+        titles = []
+        params = {'limit': 2, 'view': 'summary'}
+
+        while True:
+            response = self.client.get(reverse('create-view-docs'), params)
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            self.assertLessEqual(len(response.data['docs']), 2)
+
+            titles += [doc['title'] for doc in response.data['docs']]
+
+            if response.data['next'] is None:
+                break
+
+            params['cursor'] = response.data['next']
+
+        self.assertEqual(titles, expected)
+
+    def test_get_docs_paginated_invalid(self):
+        response = self.client.get(reverse('create-view-docs'), {'limit': 0})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+        response = self.client.get(reverse('create-view-docs'), {'limit': 'ten'})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+        response = self.client.get(reverse('create-view-docs'), {'limit': 10, 'cursor': 'not a cursor'})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_get_docs_not_modified(self):
+        doc = EditorFile.objects.create(author=self.user, title='Test Document', body='Lorem Ipsum')
+        url = reverse('create-view-docs')
+
+        etag = self.client.get(url)['ETag']
+
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+        self.assertFalse(any('"body"' in query['sql'] for query in queries))
+
+        # Listings with other parameters have their own ETags.
+        self.assertNotEqual(self.client.get(url, {'view': 'summary'})['ETag'], etag)
+
+        # Edits, additions and deletions all change the listing.
+        doc.title = 'Renamed'
+        doc.save()
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        etag = response['ETag']
+
+        other = EditorFile.objects.create(author=self.user, title='Another Document', body='Lorem Ipsum')
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        etag = response['ETag']
+
+        other.delete()
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
 class DocRetrieveUpdateDestroyViewTest(APITestCase):
     def setUp(self):
         self.client = APIClient()
@@ -481,83 +1062,1402 @@ class DocRetrieveUpdateDestroyViewTest(APITestCase):
         # Check if the document still exists
         self.assertTrue(EditorFile.objects.filter(pk=self.doc.pk).exists())
 
-class PromptViewTests(APITestCase):
-    def setUp(self):
-        self.client = APIClient()
-        self.username = 'test_user'
-        self.user = User.objects.create_user(username=self.username, password='test_password')
-        self.url = reverse('prompts')
-
-        # Include the token in the client's request headers
-        self.client.cookies = SimpleCookie({'jwt': generate_jwt_token(self.username)})        
+    def test_update_selected_doc_version(self):
+        url = reverse('edit-doc', kwargs={'pk': self.doc.pk})
 
-    def test_get_prompts_empty(self):
-        response = self.client.get(self.url)
+        response = self.client.put(url, {'doc': {'body': 'First tab', 'version': 1}}, format='json')
         self.assertEqual(response.status_code, status.HTTP_200_OK)
-        self.assertEqual(response.data, [])
+        self.assertEqual(response.data['doc']['version'], 2)
 
-    def test_get_prompts_nonempty(self):
-        prompt1 = Prompt.objects.create(user=self.user, name="Test", prompt="Test prompt")
-        prompt2 = Prompt.objects.create(user=self.user, name="Test2", prompt="Test prompt 2")
+        # A second tab, still on version 1, can't overwrite the first.
+        response = self.client.put(url, {'doc': {'body': 'Second tab', 'version': 1}}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_409_CONFLICT)
+        self.assertEqual(response.data['doc']['version'], 2)
 
-        response = self.client.get(self.url)
-        self.assertEqual(response.status_code, status.HTTP_200_OK)
-        expected_data = [
-            {"uid": str(prompt1.uid), "name": "Test", "prompt": "Test prompt"},
-            {"uid": str(prompt2.uid), "name": "Test2", "prompt": "Test prompt 2"}
-        ]
-        self.assertEqual(response.data, expected_data)
+        doc = EditorFile.objects.get(pk=self.doc.pk)
+        self.assertEqual(doc.body, 'First tab')
+        self.assertEqual(doc.version, 2)
 
-    def test_post_single_prompt(self):
-        data = {"name": "Test", "prompt": "Test prompt"}
-        response = self.client.post(self.url, data, format='json')
-        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
-        self.assertEqual(self.user.prompts.count(), 1)
-        self.assertEqual(self.user.prompts.first().name, "Test")
-        self.assertEqual(self.user.prompts.first().prompt, "Test prompt")
+        # Without a version, saves are unconditional.
+        response = self.client.put(url, {'doc': {'title': 'Renamed'}}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['doc']['version'], 3)
 
+        response = self.client.put(url, {'doc': {'title': 'Renamed', 'version': '3'}}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
 
-    def test_post_prompts_duplicate_name(self):
-        Prompt.objects.create(user=self.user, name="Test", prompt="Test prompt")
+    def test_update_selected_doc_queries(self):
+        url = reverse('edit-doc', kwargs={'pk': self.doc.pk})
 
-        # Try and create a prompt with a duplicate name
-        data = {"name": "Test", "prompt": "Test prompt 2"}
-        response = self.client.post(self.url, data, format='json')
+        # That the user exists, one UPDATE, and that the doc needn't be
+        # indexed again, as its title is the same: the user isn't loaded
+        # (see authentication.py).
+        with self.assertNumQueries(3):
+            response = self.client.put(url, {'doc': {'title': 'Test Document', 'version': 1}}, format='json')
 
-        # Response should fail.
-        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
 
-    def test_get_prompts_unauthenticated(self):
-        # Log out.
-        self.client.cookies = SimpleCookie({})
-        response = self.client.get(reverse('prompts'))
-        self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+        # A body is also recorded as a revision, indexed and embedded:
+        # locking the doc, the UPDATE, the revision, its block vectors (read,
+        # and those new added), the user's vector_sequence (bumped and read),
+        # its vector, then its terms (read, with those changed deleted and
+        # added) and indexed_version, in a transaction (four savepoint queries).
+        with self.assertNumQueries(17):
+            response = self.client.put(url, {'doc': {'body': 'Updated', 'version': 2}}, format='json')
 
-    def test_post_prompts_unauthenticated(self):
-        # Log out.
-        self.client.cookies = SimpleCookie({})
-        response = self.client.post(reverse('prompts'), {})
-        self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
 
-class PromptDetailViewTests(APITestCase):
-    def setUp(self):
-        self.client = APIClient()
-        self.username = 'test_user'
-        self.user = User.objects.create_user(username=self.username, password='test_password')
-        self.prompt = Prompt.objects.create(user=self.user, name="Test", prompt="Test prompt")
-        self.url_name = 'prompts-detail'
-        self.url = reverse(self.url_name, kwargs={'pk': self.prompt.uid})
+    def test_update_missing_doc(self):
+        response = self.client.put(reverse('edit-doc', kwargs={'pk': uuid.uuid4()}), {'doc': {'title': 'Updated'}}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
 
-        # Include the token in the client's request headers
-        self.client.cookies = SimpleCookie({'jwt': generate_jwt_token(self.username)})
+    def test_patch_doc_version(self):
+        self.doc.body = [{"text": "One"}]
+        self.doc.save()
+        version = EditorFile.objects.get(pk=self.doc.pk).version
 
-    def test_get_prompt(self):
-        response = self.client.get(self.url)
+        response = self.client.patch(reverse('edit-doc', kwargs={'pk': self.doc.pk}), {'doc': {'version': version, 'ops': [{"op": "delete", "index": 0}]}}, format='json')
         self.assertEqual(response.status_code, status.HTTP_200_OK)
-        expected_data = {"uid": str(self.prompt.uid), "name": "Test", "prompt": "Test prompt"}
-        self.assertEqual(response.data, expected_data)
+        self.assertEqual(response.data['doc']['version'], version + 1)
 
-    def test_get_nonexistent_prompt(self):
+        response = self.client.patch(reverse('edit-doc', kwargs={'pk': self.doc.pk}), {'doc': {'version': version, 'ops': []}}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_409_CONFLICT)
+
+    def test_get_selected_doc_not_modified(self):
+        url = reverse('edit-doc', kwargs={'pk': self.doc.pk})
+
+        response = self.client.get(url)
+        etag = response['ETag']
+        self.assertEqual(etag, f'"{self.doc.pk}-1"')
+
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+        self.assertEqual(response['ETag'], etag)
+        self.assertFalse(any('"body"' in query['sql'] for query in queries))
+
+        response = self.client.get(url, HTTP_IF_MODIFIED_SINCE=self.client.get(url)['Last-Modified'])
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+
+        # Saving makes a new version.
+        response = self.client.put(url, {'doc': {'title': 'Updated Document'}}, format='json')
+        self.assertEqual(response['ETag'], f'"{self.doc.pk}-2"')
+
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['doc']['title'], 'Updated Document')
+
+    def test_get_selected_doc_not_modified_wrong_user(self):
+        etag = self.client.get(reverse('edit-doc', kwargs={'pk': self.doc.pk}))['ETag']
+
+        self.client.cookies = self.another_jwt
+        response = self.client.get(reverse('edit-doc', kwargs={'pk': self.doc.pk}), HTTP_IF_NONE_MATCH=etag)
+
+        self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+
+    def patch_doc(self, ops, base=None, **doc):
+        if base is None:
+            base = EditorFile.objects.get(pk=self.doc.pk).modified
+
+        return self.client.patch(reverse('edit-doc', kwargs={'pk': self.doc.pk}), {'doc': {'base': base.isoformat(), 'ops': ops, **doc}}, format='json')
+
+    def test_patch_doc(self):
+        self.doc.body = [{"text": "One"}, {"text": "Two"}, {"text": "Three"}]
+        self.doc.save()
+
+        response = self.patch_doc([
+            {"op": "replace", "index": 0, "block": {"text": "First"}},
+            {"op": "delete", "index": 1},
+            {"op": "insert", "index": 2, "block": {"text": "Four"}},
+        ], title='Patched Document')
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+        doc = EditorFile.objects.get(pk=self.doc.pk)
+        self.assertEqual(doc.body, [{"text": "First"}, {"text": "Three"}, {"text": "Four"}])
+        self.assertEqual(doc.title, 'Patched Document')
+        self.assertEqual(doc.preview, 'First Three Four')
+        self.assertEqual(doc.block_count, 3)
+        self.assertEqual(response.data['doc']['modified'], doc.modified)
+
+        # The new version is the base for the next edit.
+        response = self.patch_doc([{"op": "delete", "index": 0}], base=doc.modified)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+    def test_patch_doc_stale_base(self):
+        self.doc.body = [{"text": "One"}]
+        self.doc.save()
+        base = self.doc.modified
+
+        # Another save gets in first.
+        self.doc.save()
+
+        response = self.patch_doc([{"op": "delete", "index": 0}], base=base)
+
+        self.assertEqual(response.status_code, status.HTTP_409_CONFLICT)
+        self.assertEqual(response.data['doc']['modified'], self.doc.modified)
+        self.assertEqual(EditorFile.objects.get(pk=self.doc.pk).body, [{"text": "One"}])
+
+    def test_patch_doc_invalid(self):
+        self.doc.body = [{"text": "One"}]
+        self.doc.save()
+
+        for ops in [
+            [{"op": "delete", "index": 1}],
+            [{"op": "insert", "index": 2, "block": {}}],
+            [{"op": "replace", "index": 0}],
+            [{"op": "move", "index": 0}],
+            [{"op": "delete", "index": "0"}],
+            # Applied in order, so the second index is out of range.
+            [{"op": "delete", "index": 0}, {"op": "delete", "index": 0}],
+            "delete",
+        ]:
+            response = self.patch_doc(ops)
+            self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST, ops)
+
+        # Nothing was applied.
+        self.assertEqual(EditorFile.objects.get(pk=self.doc.pk).body, [{"text": "One"}])
+
+        response = self.client.patch(reverse('edit-doc', kwargs={'pk': self.doc.pk}), {'doc': {'ops': []}}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_patch_doc_wrong_user(self):
+        self.client.cookies = self.another_jwt
+
+        response = self.patch_doc([{"op": "insert", "index": 0, "block": {"text": "Hi"}}])
+
+        self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+
+    def test_get_doc_invalid_uid(self):
+        response = self.client.get(reverse('edit-doc', kwargs={'pk': 'not-a-uuid'}))
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+        response = self.client.get(reverse('edit-doc', kwargs={'pk': uuid.uuid4()}))
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_put_doc_invalid_uid(self):
+        url = reverse('edit-doc', kwargs={'pk': 'not-a-uuid'})
+
+        for doc in [{'title': 'New title'}, {'title': 'New title', 'version': 1}]:
+            with self.subTest(doc=doc):
+                response = self.client.put(url, {'doc': doc}, format='json')
+                self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+        self.assertEqual(self.client.patch(url, {'doc': {'version': 1, 'ops': []}}, format='json').status_code, status.HTTP_404_NOT_FOUND)
+        self.assertEqual(self.client.delete(url).status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_docs_deleted_with_author(self):
+        self.user.delete()
+        self.assertFalse(EditorFile.objects.filter(pk=self.doc.pk).exists())
+
+class DocsBatchTest(APITestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='test_user', password='test_password')
+        self.client.cookies = SimpleCookie({'jwt': generate_jwt_token('test_user')})
+        self.url = reverse('batch-docs')
+
+        self.doc = EditorFile.objects.create(author=self.user, title='Doc', body=[{"text": "One"}, {"text": "Two"}])
+        self.other = EditorFile.objects.create(author=self.user, title='Other', body=["Other"])
+
+    def batch(self, ops):
+        response = self.client.post(self.url, {'ops': ops}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return response.data['results']
+
+    def test_batch(self):
+        results = self.batch([
+            {"op": "create", "doc": {"title": "New", "body": [{"text": "New body"}]}},
+            {"op": "update", "uid": str(self.doc.uid), "doc": {"title": "Renamed", "body": [{"text": "One"}, {"text": "Three"}], "version": 1}},
+            {"op": "delete", "uid": str(self.other.uid)},
+            {"op": "create", "doc": {"title": "Empty", "body": []}},
+        ])
+
+        self.assertEqual([result['status'] for result in results], [201, 200, 200, 201])
+        self.assertEqual(results[1]['doc']['version'], 2)
+        self.assertEqual(results[2]['doc'], {"uid": str(self.other.uid)})
+
+        new = EditorFile.objects.get(pk=results[0]['doc']['uid'])
+        self.assertEqual((new.title, new.body, new.version, new.preview, new.block_count), ('New', [{"text": "New body"}], 1, 'New body', 1))
+        self.assertEqual(EditorFileRevision.objects.body_at(new.pk, 1), [{"text": "New body"}])
+
+        self.doc.refresh_from_db()
+        self.assertEqual((self.doc.title, self.doc.body, self.doc.version, self.doc.preview), ('Renamed', [{"text": "One"}, {"text": "Three"}], 2, 'One Three'))
+        self.assertEqual(EditorFileRevision.objects.get(file=self.doc, version=2).delta, [{"op": "replace", "index": 1, "block": {"text": "Three"}}])
+        self.assertEqual(EditorFileRevision.objects.body_at(self.doc.pk, 1), [{"text": "One"}, {"text": "Two"}])
+
+        self.assertFalse(EditorFile.objects.filter(pk=self.other.pk).exists())
+
+        # As a single PUT would.
+        response = self.client.get(reverse('edit-doc', kwargs={'pk': self.doc.pk}))
+        self.assertEqual(response['ETag'], documents.doc_etag(self.doc.uid, 2))
+
+    def test_title_only_updates(self):
+        results = self.batch([
+            {"op": "update", "uid": str(self.doc.uid), "doc": {"title": "First"}},
+            {"op": "update", "uid": str(self.other.uid), "doc": {"title": "Second", "version": 1}},
+        ])
+
+        self.assertEqual([result['doc']['version'] for result in results], [2, 2])
+        self.assertEqual([(doc.title, doc.body) for doc in EditorFile.objects.order_by('title')], [('First', [{"text": "One"}, {"text": "Two"}]), ('Second', ["Other"])])
+        self.assertEqual(EditorFileRevision.objects.count(), 2)
+
+    def test_failed_operations(self):
+        stranger = User.objects.create_user(username='another_user', password='another_password')
+        theirs = EditorFile.objects.create(author=stranger, title='Theirs', body=[])
+
+        results = self.batch([
+            {"op": "move"},
+            {"op": "create", "doc": {"title": "x" * 51, "body": []}},
+            {"op": "update", "uid": str(uuid.uuid4()), "doc": {"title": "Missing"}},
+            {"op": "delete", "uid": "not-a-uid"},
+            {"op": "update", "uid": str(theirs.uid), "doc": {"title": "Mine"}},
+            {"op": "update", "uid": str(self.doc.uid), "doc": {"title": "Stale", "version": 7}},
+            {"op": "delete", "uid": str(self.other.uid), "version": 0},
+            {"op": "update", "uid": str(self.other.uid), "doc": {"title": "Kept"}},
+            {"op": "delete", "uid": str(self.other.uid)},
+            {"op": "create", "doc": {"title": "Made anyway", "body": []}},
+        ])
+
+        self.assertEqual([result['status'] for result in results], [400, 400, 404, 404, 401, 409, 400, 200, 400, 201])
+        self.assertEqual(results[5]['doc']['version'], 1)
+
+        # The rest were made.
+        self.assertEqual(EditorFile.objects.get(pk=self.other.pk).title, 'Kept')
+        self.assertTrue(EditorFile.objects.filter(title='Made anyway').exists())
+        self.assertEqual(EditorFile.objects.get(pk=theirs.pk).title, 'Theirs')
+        self.assertEqual(EditorFile.objects.get(pk=self.doc.pk).title, 'Doc')
+
+    def test_conditional_delete(self):
+        results = self.batch([{"op": "delete", "uid": str(self.doc.uid), "version": 2}, {"op": "delete", "uid": str(self.other.uid), "version": 1}])
+
+        self.assertEqual([result['status'] for result in results], [409, 200])
+        self.assertEqual(list(EditorFile.objects.values_list('pk', flat=True)), [self.doc.pk])
+
+    def test_import_queries(self):
+        docs = [{"op": "create", "doc": {"title": f"Doc {i}", "body": [{"text": f"Paragraph {i}"}]}} for i in range(500)]
+
+        with CaptureQueriesContext(connection) as queries:
+            results = self.batch(docs)
+
+        self.assertEqual({result['status'] for result in results}, {201})
+        self.assertEqual(EditorFile.objects.filter(author=self.user).count(), 502)
+
+        # A few queries (and batches) for all of them, rather than a few for each.
+        self.assertLess(len(queries), 60)
+
+    def test_update_queries(self):
+        docs = EditorFile.objects.create_many(self.user.pk, [{"title": f"Doc {i}", "body": [{"text": "Old"}]} for i in range(200)])
+        ops = [{"op": "update", "uid": str(doc.uid), "doc": {"body": [{"text": "New"}], "version": 1}} for doc in docs]
+        ops += [{"op": "delete", "uid": str(doc.uid)} for doc in [self.doc, self.other]]
+
+        with CaptureQueriesContext(connection) as queries:
+            results = self.batch(ops)
+
+        self.assertEqual({result['status'] for result in results}, {200})
+        self.assertEqual([doc.body for doc in EditorFile.objects.filter(version=2)], [[{"text": "New"}]] * 200)
+        self.assertEqual(EditorFileRevision.objects.filter(version=2).count(), 200)
+        self.assertLess(len(queries), 60)
+
+    @override_settings(DOC_CHUNK_THRESHOLD=100)
+    def test_chunked_docs(self):
+        body = [{"text": f"Paragraph {i}."} for i in range(300)]
+
+        results = self.batch([{"op": "create", "doc": {"title": "Long", "body": body}}])
+        doc = EditorFile.objects.get(pk=results[0]['doc']['uid'])
+        self.assertTrue(doc.chunked)
+        self.assertEqual(doc.body, body)
+        self.assertEqual(doc.block_count, 300)
+
+        # Long bodies, to or from chunks.
+        results = self.batch([
+            {"op": "update", "uid": str(doc.uid), "doc": {"body": body[:10], "version": 1}},
+            {"op": "update", "uid": str(self.doc.uid), "doc": {"body": body, "version": 1}},
+        ])
+        self.assertEqual([result['status'] for result in results], [200, 200])
+        self.assertEqual(EditorFile.objects.get(pk=doc.pk).body, body[:10])
+        self.assertTrue(EditorFile.objects.get(pk=self.doc.pk).chunked)
+        self.assertEqual(EditorFile.objects.get(pk=self.doc.pk).body, body)
+
+        # Deleting a chunked doc releases its blocks; only the other doc's are left.
+        self.batch([{"op": "delete", "uid": str(self.doc.uid)}])
+        self.assertEqual(list(EditorBlock.objects.filter(refs__gt=0).values_list('content', flat=True)), ["Other"])
+
+    def test_bad_batches(self):
+        self.assertEqual(self.client.post(self.url, {'ops': {}}, format='json').status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(self.client.post(self.url, {'ops': []}, format='json').status_code, status.HTTP_400_BAD_REQUEST)
+
+        ops = [{"op": "delete", "uid": str(uuid.uuid4())}] * (documents.MAX_BATCH_SIZE + 1)
+        self.assertEqual(self.client.post(self.url, {'ops': ops}, format='json').status_code, status.HTTP_400_BAD_REQUEST)
+
+        self.client.cookies = SimpleCookie()
+        self.assertEqual(self.client.post(self.url, {'ops': ops[:1]}, format='json').status_code, status.HTTP_401_UNAUTHORIZED)
+
+class DocTransferTest(APITestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='test_user', password='test_password')
+        self.client.cookies = SimpleCookie({'jwt': generate_jwt_token('test_user')})
+
+    def export(self):
+        response = self.client.get(reverse('export-docs'))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response['Content-Type'], 'application/x-ndjson')
+        return [json.loads(line) for line in b"".join(response.streaming_content).splitlines()]
+
+    def import_lines(self, lines):
+        return self.client.post(reverse('import-docs'), "\n".join(lines).encode(), content_type='application/x-ndjson')
+
+    @override_settings(DOC_CHUNK_THRESHOLD=100, DOC_BODY_COMPRESSION_THRESHOLD=100)
+    def test_export(self):
+        bodies = [[{"text": "Short"}], [{"text": "Compressed " * 20}], [{"text": f"Paragraph {i}."} for i in range(150)]]
+        docs = [EditorFile.objects.create(author=self.user, title=f"Doc {i}", body=body) for i, body in enumerate(bodies)]
+        EditorFile.objects.create(author=User.objects.create_user(username='another_user', password='x'), title='Theirs', body=[])
+
+        lines = self.export()
+
+        # Newest first, each with its whole body, however it is stored.
+        self.assertEqual([line['uid'] for line in lines], [str(doc.uid) for doc in reversed(docs)])
+        self.assertEqual([line['body'] for line in lines], list(reversed(bodies)))
+        self.assertEqual(set(lines[0]), {'uid', 'title', 'body', 'created', 'modified', 'version'})
+
+    async def test_export_streamed_asgi(self):
+        await sync_to_async(EditorFile.objects.create_many)(self.user.pk, [{"title": f"Doc {i}", "body": [{"text": f"Paragraph {i}"}]} for i in range(250)])
+        token = await sync_to_async(generate_jwt_token)('test_user')
+
+        # Pages read by the time each chunk was sent.
+        page = documents.page
+        pages_read, pages_read_when_sent = [], []
+
+        with unittest.mock.patch.object(documents, 'page', side_effect=lambda *args: pages_read.append(None) or page(*args)):
+            status_code, chunks = await asgi_request('GET', reverse('export-docs'), cookies={'jwt': token}, on_body=lambda chunk: pages_read_when_sent.append(len(pages_read)))
+
+        self.assertEqual(status_code, status.HTTP_200_OK)
+        self.assertEqual(len(b"".join(chunks).splitlines()), 250)
+
+        # Each page sent before the next is read, not the whole export read first.
+        self.assertEqual(pages_read_when_sent, [1, 2, 3])
+
+    def test_export_pages(self):
+        EditorFile.objects.create_many(self.user.pk, [{"title": f"Doc {i}", "body": [{"text": f"Paragraph {i}"}]} for i in range(250)])
+
+        with CaptureQueriesContext(connection) as queries:
+            lines = self.export()
+
+        self.assertEqual(len(lines), 250)
+        self.assertEqual(len({line['uid'] for line in lines}), 250)
+
+        # A query for each page, rather than one for all of them.
+        pages = [query for query in queries if 'user_accounts_editorfile' in query['sql'] and 'LIMIT' in query['sql']]
+        self.assertEqual(len(pages), 3)
+
+    def test_export_empty(self):
+        self.assertEqual(self.export(), [])
+
+    def test_import(self):
+        lines = [json.dumps({"title": f"Doc {i}", "body": [{"text": f"Paragraph {i}"}]}) for i in range(documents.TRANSFER_BATCH_SIZE + 5)]
+        lines[3] = "not json"
+        lines[4] = json.dumps({"title": "x" * 51, "body": []})
+        lines[5] = json.dumps(["a list"])
+        lines.insert(6, "")
+
+        response = self.import_lines(lines)
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual((response.data['created'], response.data['failed']), (documents.TRANSFER_BATCH_SIZE + 2, 3))
+        self.assertEqual([error['line'] for error in response.data['errors']], [4, 5, 6])
+
+        doc = EditorFile.objects.get(title='Doc 7')
+        self.assertEqual((doc.body, doc.preview, doc.version), ([{"text": "Paragraph 7"}], 'Paragraph 7', 1))
+        self.assertEqual(EditorFileRevision.objects.body_at(doc.pk, 1), [{"text": "Paragraph 7"}])
+
+    def test_import_errors_capped(self):
+        response = self.import_lines(["{"] * (documents.MAX_IMPORT_ERRORS + 10))
+
+        self.assertEqual((response.data['created'], response.data['failed']), (0, documents.MAX_IMPORT_ERRORS + 10))
+        self.assertEqual(len(response.data['errors']), documents.MAX_IMPORT_ERRORS)
+
+    @override_settings(DOC_CHUNK_THRESHOLD=100)
+    def test_export_then_import(self):
+        bodies = {"Short": [{"text": "Short"}], "Long": [{"text": f"Paragraph {i}."} for i in range(150)]}
+
+        for title, body in bodies.items():
+            EditorFile.objects.create(author=self.user, title=title, body=body)
+
+        exported = self.export()
+        response = self.import_lines([json.dumps(line) for line in exported])
+        self.assertEqual(response.data['created'], 2)
+
+        # Copies, with new uids.
+        for title, body in bodies.items():
+            copies = EditorFile.objects.filter(author=self.user, title=title)
+            self.assertEqual(len({doc.uid for doc in copies}), 2)
+            self.assertEqual([doc.body for doc in copies], [body, body])
+
+    def test_unauthorized(self):
+        self.client.cookies = SimpleCookie()
+
+        self.assertEqual(self.client.get(reverse('export-docs')).status_code, status.HTTP_401_UNAUTHORIZED)
+        self.assertEqual(self.import_lines(["{}"]).status_code, status.HTTP_401_UNAUTHORIZED)
+
+# Of bodies stored whole.
+@override_settings(DOC_BODY_COMPRESSION_THRESHOLD=100, DOC_CHUNK_THRESHOLD=None)
+class DocBodyCompressionTest(APITestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='test_user', password='test_password')
+        self.client.cookies = SimpleCookie({'jwt': generate_jwt_token('test_user')})
+
+        self.large_body = [{"type": "paragraph", "text": f"Paragraph {i} of a long document."} for i in range(20)]
+
+    def stored(self, doc):
+        # The raw columns, without decoding.
+        return EditorFile.objects.filter(pk=doc.pk).values_list('body', 'body_zlib').get()
+
+    def test_large_bodies_stored_compressed(self):
+        doc = EditorFile.objects.create(author=self.user, title='Large', body=self.large_body)
+
+        body, body_zlib = self.stored(doc)
+        self.assertIsNone(body)
+        self.assertLess(len(body_zlib), doc.body_size)
+
+        # The instance keeps its body.
+        self.assertEqual(doc.body, self.large_body)
+        self.assertEqual(EditorFile.objects.get(pk=doc.pk).body, self.large_body)
+
+    def test_small_bodies_stored_uncompressed(self):
+        doc = EditorFile.objects.create(author=self.user, title='Small', body=['Lorem Ipsum'])
+
+        self.assertEqual(self.stored(doc), (['Lorem Ipsum'], None))
+
+    @override_settings(DOC_BODY_COMPRESSION_THRESHOLD=None)
+    def test_compression_disabled(self):
+        doc = EditorFile.objects.create(author=self.user, title='Large', body=self.large_body)
+
+        self.assertEqual(self.stored(doc), (self.large_body, None))
+
+    def test_deferred_body_decoded(self):
+        doc = EditorFile.objects.create(author=self.user, title='Large', body=self.large_body)
+
+        self.assertEqual(EditorFile.objects.only('title').get(pk=doc.pk).body, self.large_body)
+
+    def test_body_shrinks_below_threshold(self):
+        doc = EditorFile.objects.create(author=self.user, title='Large', body=self.large_body)
+
+        doc.body = ['Short']
+        doc.save(update_fields=['body'])
+        self.assertEqual(self.stored(doc), (['Short'], None))
+
+        EditorFile.objects.filter(pk=doc.pk).write(body=self.large_body)
+        self.assertIsNone(self.stored(doc)[0])
+        self.assertEqual(EditorFile.objects.get(pk=doc.pk).body, self.large_body)
+
+    def test_views_read_and_write_compressed_bodies(self):
+        doc = EditorFile.objects.create(author=self.user, title='Large', body=self.large_body)
+        url = reverse('edit-doc', kwargs={'pk': doc.pk})
+
+        self.assertEqual(self.client.get(url).data['doc']['body'], self.large_body)
+
+        listing = self.client.get(reverse('create-view-docs'), {'fields': 'title,body'})
+        self.assertEqual(listing.data['docs'][0]['body'], self.large_body)
+
+        ops = [{"op": "delete", "index": 0}]
+        response = self.client.patch(url, {'doc': {'ops': ops, 'version': 1}}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+        self.assertIsNone(self.stored(doc)[0])
+        self.assertEqual(EditorFile.objects.get(pk=doc.pk).body, self.large_body[1:])
+
+    def test_compress_command(self):
+        with override_settings(DOC_BODY_COMPRESSION_THRESHOLD=None):
+            large = EditorFile.objects.create(author=self.user, title='Large', body=self.large_body)
+            small = EditorFile.objects.create(author=self.user, title='Small', body=['Lorem Ipsum'])
+
+        call_command('compress_doc_bodies', batch_size=1, stdout=open(os.devnull, 'w'))
+
+        self.assertIsNone(self.stored(large)[0])
+        self.assertEqual(self.stored(small), (['Lorem Ipsum'], None))
+
+        # Rewriting the storage isn't a new version.
+        large.refresh_from_db()
+        self.assertEqual((large.version, large.body), (1, self.large_body))
+
+        call_command('compress_doc_bodies', decompress=True, stdout=open(os.devnull, 'w'))
+
+        self.assertEqual(self.stored(large), (self.large_body, None))
+
+@override_settings(DOC_CHUNK_THRESHOLD=100)
+class DocChunkTest(APITestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='test_user', password='test_password')
+        self.client.cookies = SimpleCookie({'jwt': generate_jwt_token('test_user')})
+
+        # Four chunks: 64, 64, 64 and 8 blocks.
+        self.body = [{"type": "paragraph", "text": f"Paragraph {i}."} for i in range(200)]
+        self.doc = EditorFile.objects.create(author=self.user, title='Large', body=self.body)
+        self.url = reverse('edit-doc', kwargs={'pk': self.doc.pk})
+
+    def assertStored(self, body):
+        doc = EditorFile.objects.get(pk=self.doc.pk)
+        self.assertEqual(doc.body, body)
+
+        summary = documents.summarize(body)
+        self.assertEqual((doc.preview, doc.body_size, doc.block_count), (summary['preview'], summary['body_size'], summary['block_count']))
+
+    def test_large_bodies_stored_chunked(self):
+        self.assertEqual(EditorFile.objects.filter(pk=self.doc.pk).values_list('chunked', 'body').get(), (True, None))
+        self.assertEqual(list(self.doc.chunks.values_list('block_count', flat=True)), [64, 64, 64, 8])
+
+        self.assertStored(self.body)
+        self.assertEqual(self.client.get(self.url).data['doc']['body'], self.body)
+
+    def test_read_block_range(self):
+        response = self.client.get(self.url, {'blocks': '60-70'})
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['doc']['blocks'], self.body[60:71])
+        self.assertEqual((response.data['doc']['start'], response.data['doc']['block_count']), (60, 200))
+        self.assertNotIn('body', response.data['doc'])
+
+        # Only the two chunks holding them are read.
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(self.doc.read_blocks(60, 71), self.body[60:71])
+
+        # The chunks, then their blocks.
+        self.assertEqual(len(queries), 2)
+
+        self.assertEqual(self.client.get(self.url, {'blocks': '190-300'}).data['doc']['blocks'], self.body[190:])
+        self.assertEqual(self.client.get(self.url, {'blocks': '300-400'}).data['doc']['blocks'], [])
+
+        for blocks in ('70-60', '60', 'a-b', '-1-5'):
+            self.assertEqual(self.client.get(self.url, {'blocks': blocks}).status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_read_block_range_of_unchunked_doc(self):
+        doc = EditorFile.objects.create(author=self.user, title='Small', body=self.body[:10])
+
+        response = self.client.get(reverse('edit-doc', kwargs={'pk': doc.pk}), {'blocks': '2-3'})
+        self.assertEqual(response.data['doc']['blocks'], self.body[2:4])
+
+    def test_patch_rewrites_touched_chunks(self):
+        ops = [{"op": "replace", "index": 70, "block": {"text": "Replaced"}}, {"op": "delete", "index": 71}]
+
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.patch(self.url, {'doc': {'ops': ops, 'version': 1}}, format='json')
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['doc']['version'], 2)
+
+        chunk_writes = [query['sql'] for query in queries if query['sql'].startswith(('UPDATE "user_accounts_editorfilechunk"', 'INSERT INTO "user_accounts_editorfilechunk"'))]
+        self.assertEqual(len(chunk_writes), 1)
+
+        self.assertStored(apply_block_ops(self.body, ops))
+
+    def test_patch_chunked_doc(self):
+        body = self.body
+        version = 1
+
+        # Each batch checked against applying it to the whole body.
+        rng = random.Random(0)
+
+        for batch in range(20):
+            ops = []
+
+            for _ in range(rng.randint(1, 60)):
+                length = len(body) + sum(op['op'] == 'insert' for op in ops) - sum(op['op'] == 'delete' for op in ops)
+                kind = rng.choice(['insert', 'insert', 'replace', 'delete'])
+                index = rng.randint(0, length if kind == 'insert' else length - 1)
+                ops.append({"op": kind, "index": index, "block": {"text": f"Edit {batch}.{len(ops)}"}})
+
+            response = self.client.patch(self.url, {'doc': {'ops': ops, 'version': version}}, format='json')
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+            body = apply_block_ops(body, ops)
+            version += 1
+
+            self.assertStored(body)
+
+        self.assertTrue(EditorFile.objects.get(pk=self.doc.pk).chunked)
+        self.assertTrue(all(0 < size <= 128 for size in self.doc.chunks.values_list('block_count', flat=True)))
+
+    def test_patch_invalid_ops(self):
+        response = self.client.patch(self.url, {'doc': {'ops': [{"op": "delete", "index": 200}], 'version': 1}}, format='json')
+
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertStored(self.body)
+
+    def test_patch_stale_version(self):
+        EditorFile.objects.filter(pk=self.doc.pk).write(title='Renamed')
+
+        response = self.client.patch(self.url, {'doc': {'ops': [{"op": "delete", "index": 0}], 'version': 1}}, format='json')
+
+        self.assertEqual(response.status_code, status.HTTP_409_CONFLICT)
+        self.assertStored(self.body)
+
+    def test_shrinking_body_unchunked(self):
+        ops = [{"op": "delete", "index": 0}] * 160
+
+        response = self.client.patch(self.url, {'doc': {'ops': ops, 'version': 1}}, format='json')
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertFalse(EditorFile.objects.get(pk=self.doc.pk).chunked)
+        self.assertFalse(self.doc.chunks.exists())
+        self.assertStored(self.body[160:])
+
+    def test_put_whole_body(self):
+        response = self.client.put(self.url, {'doc': {'body': ['Short'], 'version': 1}}, format='json')
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertFalse(self.doc.chunks.exists())
+        self.assertStored(['Short'])
+
+        response = self.client.put(self.url, {'doc': {'body': self.body[:150], 'version': 2}}, format='json')
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(self.doc.chunks.count(), 3)
+        self.assertStored(self.body[:150])
+
+        # Stale versions don't touch the chunks.
+        response = self.client.put(self.url, {'doc': {'body': ['Short'], 'version': 2}}, format='json')
+
+        self.assertEqual(response.status_code, status.HTTP_409_CONFLICT)
+        self.assertStored(self.body[:150])
+
+    def test_save_title_leaves_chunks(self):
+        doc = EditorFile.objects.get(pk=self.doc.pk)
+        doc.title = 'Renamed'
+
+        with CaptureQueriesContext(connection) as queries:
+            doc.save()
+
+        # Read to index the new title, but not rewritten.
+        self.assertFalse(any('editorfilechunk' in query['sql'] for query in queries if not query['sql'].startswith('SELECT')))
+        self.assertStored(self.body)
+
+    def test_listing_includes_chunked_bodies(self):
+        EditorFile.objects.create(author=self.user, title='Small', body=['Lorem Ipsum'])
+        EditorFile.objects.create(author=self.user, title='Large', body=self.body[::-1])
+
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse('create-view-docs'))
+
+        bodies = [doc['body'] for doc in response.data['docs']]
+        self.assertEqual(bodies, [self.body[::-1], ['Lorem Ipsum'], self.body])
+
+        # That the user exists, ETag, docs, their chunks and their blocks.
+        self.assertEqual(len(queries), 5)
+
+@override_settings(DOC_CHUNK_THRESHOLD=100)
+class DocBlockStoreTest(APITestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='test_user', password='test_password')
+        self.client.cookies = SimpleCookie({'jwt': generate_jwt_token('test_user')})
+
+        self.body = [{"type": "paragraph", "text": f"Paragraph {i} of a long document."} for i in range(200)]
+        self.doc = EditorFile.objects.create(author=self.user, title='Original', body=self.body)
+
+    def refs(self):
+        return sum(EditorBlock.objects.values_list('refs', flat=True))
+
+    def test_duplicated_corpus(self):
+        # Ten copies of the doc, each with a couple of paragraphs edited.
+        bodies = [self.body]
+
+        for i in range(10):
+            body = list(self.body)
+            body[i] = {"type": "paragraph", "text": f"Edited in copy {i}."}
+            body.insert(100, {"type": "heading", "text": f"Copy {i}"})
+            bodies.append(body)
+
+            self.client.post(reverse('create-view-docs'), {'doc': {'title': f'Copy {i}', 'body': body}}, format='json')
+
+        # Each distinct block is stored once, against 2210 in the bodies.
+        self.assertEqual(EditorBlock.objects.count(), 220)
+        self.assertEqual(self.refs(), sum(map(len, bodies)))
+
+        docs = EditorFile.objects.order_by('created')
+        self.assertEqual([doc.body for doc in docs], bodies)
+
+    # As by default.
+    @override_settings(DOC_CHUNK_THRESHOLD=0)
+    def test_short_copies_deduplicated(self):
+        note = [{"type": "heading", "text": "Meeting notes"}, {"type": "paragraph", "text": "Attendees:"}, {"type": "paragraph", "text": "Actions:"}]
+
+        results = self.client.post(reverse('batch-docs'), {'ops': [
+            {"op": "create", "doc": {"title": f"Notes {i}", "body": [*note, {"type": "paragraph", "text": f"Week {i}."}]}}
+            for i in range(20)
+        ]}, format='json').data['results']
+
+        self.assertEqual({result['status'] for result in results}, {201})
+        self.assertTrue(all(EditorFile.objects.filter(title__startswith='Notes').values_list('chunked', flat=True)))
+
+        # The template's blocks once, and each week's.
+        self.assertEqual(EditorBlock.objects.count(), 200 + 3 + 20)
+        self.assertEqual(EditorFile.objects.get(title='Notes 7').body, [*note, {"type": "paragraph", "text": "Week 7."}])
+
+    def test_unchanged_blocks_not_written(self):
+        url = reverse('edit-doc', kwargs={'pk': self.doc.pk})
+        body = list(self.body)
+        body[150] = {"type": "paragraph", "text": "Edited."}
+
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.put(url, {'doc': {'body': body, 'version': 1}}, format='json')
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+        # One block stored, and one chunk rewritten.
+        inserts = [query['sql'] for query in queries if query['sql'].startswith('INSERT INTO "user_accounts_editorblock"')]
+        self.assertEqual(len(inserts), 1)
+        self.assertEqual(inserts[0].count('Edited.'), 1)
+        self.assertEqual(len([query for query in queries if 'UPDATE "user_accounts_editorfilechunk"' in query['sql']]), 1)
+
+        self.assertEqual(EditorFile.objects.get(pk=self.doc.pk).body, body)
+        self.assertEqual(EditorBlock.objects.filter(refs=0).count(), 1)
+
+    def test_patch_stores_new_blocks(self):
+        url = reverse('edit-doc', kwargs={'pk': self.doc.pk})
+        ops = [{"op": "insert", "index": 0, "block": self.body[199]}, {"op": "replace", "index": 1, "block": {"text": "New"}}]
+
+        response = self.client.patch(url, {'doc': {'ops': ops, 'version': 1}}, format='json')
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(EditorBlock.objects.count(), 201)
+        self.assertEqual(EditorBlock.objects.get(content=self.body[199]).refs, 2)
+        self.assertEqual(EditorBlock.objects.get(content=self.body[0]).refs, 0)
+        self.assertEqual(self.refs(), 201)
+
+        self.assertEqual(EditorFile.objects.get(pk=self.doc.pk).body, apply_block_ops(self.body, ops))
+
+    def test_collect_unreferenced_blocks(self):
+        copy = EditorFile.objects.create(author=self.user, title='Copy', body=self.body[:150])
+
+        self.client.delete(reverse('edit-doc', kwargs={'pk': self.doc.pk}))
+        self.assertEqual(EditorBlock.objects.filter(refs=0).count(), 50)
+
+        call_command('collect_blocks', stdout=open(os.devnull, 'w'))
+
+        self.assertEqual(EditorBlock.objects.count(), 150)
+        self.assertEqual(EditorFile.objects.get(pk=copy.pk).body, self.body[:150])
+
+        # Storing the doc whole again releases the rest.
+        copy.body = ['Short']
+        copy.save()
+        call_command('collect_blocks', stdout=open(os.devnull, 'w'))
+
+        self.assertFalse(EditorBlock.objects.exists())
+
+    def test_bulk_delete_releases_blocks(self):
+        EditorFile.objects.create(author=self.user, title='Copy', body=self.body[:150])
+        EditorFile.objects.create(author=self.user, title='Short', body=self.body[:10])
+
+        EditorFile.objects.filter(author=self.user).exclude(pk=self.doc.pk).delete()
+        self.assertEqual(self.refs(), 200)
+
+        EditorFile.objects.all().delete()
+        self.assertEqual(self.refs(), 0)
+
+    def test_short_docs_stored_whole(self):
+        EditorFile.objects.create(author=self.user, title='Short', body=self.body[:100])
+
+        self.assertEqual(EditorFile.objects.get(title='Short').chunks.count(), 0)
+        self.assertEqual(self.refs(), 200)
+
+    def test_blocks_stored_per_user(self):
+        other = User.objects.create_user(username='another_user', password='another_password')
+        EditorFile.objects.create(author=other, title='Same', body=self.body)
+
+        self.assertEqual(EditorBlock.objects.filter(user=self.user).count(), 200)
+        self.assertEqual(EditorBlock.objects.filter(user=other).count(), 200)
+
+class DocRevisionTest(APITestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='test_user', password='test_password')
+        self.client.cookies = SimpleCookie({'jwt': generate_jwt_token('test_user')})
+
+        self.body = [{"type": "paragraph", "text": f"Paragraph {i}."} for i in range(10)]
+        self.doc = EditorFile.objects.create(author=self.user, title='Original', body=self.body)
+        self.url = reverse('edit-doc', kwargs={'pk': self.doc.pk})
+
+    def save_edits(self, count):
+        """
+        Save count edits to the doc, alternating PUTs and PATCHes.
+        Returns the bodies of all its versions, by version.
+        """
+        bodies = {1: self.body}
+        body = self.body
+
+        for version in range(1, count + 1):
+            if version % 2:
+                body = body[1:] + [{"type": "paragraph", "text": f"Added in {version}."}]
+                response = self.client.put(self.url, {'doc': {'body': body, 'version': version}}, format='json')
+            else:
+                ops = [{"op": "replace", "index": version % len(body), "block": {"text": f"Edited in {version}."}}]
+                body = apply_block_ops(body, ops)
+                response = self.client.patch(self.url, {'doc': {'ops': ops, 'version': version}}, format='json')
+
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            bodies[version + 1] = body
+
+        return bodies
+
+    def test_saves_recorded_as_deltas(self):
+        bodies = self.save_edits(6)
+        revisions = list(self.doc.revisions.all())
+
+        self.assertEqual([revision.version for revision in revisions], list(range(1, 8)))
+        self.assertIsNotNone(revisions[0].snapshot)
+        self.assertTrue(all(revision.snapshot is None for revision in revisions[1:]))
+
+        # PUTs are worked out as a delete and an insert; PATCHes are stored as sent.
+        self.assertEqual([op['op'] for op in revisions[1].delta], ['delete', 'insert'])
+        self.assertEqual(revisions[2].delta, [{"op": "replace", "index": 2, "block": {"text": "Edited in 2."}}])
+
+        for version, body in bodies.items():
+            self.assertEqual(EditorFileRevision.objects.body_at(self.doc.pk, version), body)
+
+    def test_snapshot_interval(self):
+        bodies = self.save_edits(45)
+
+        snapshots = self.doc.revisions.filter(snapshot__isnull=False).values_list('version', flat=True)
+        self.assertEqual(list(snapshots), [1, 1 + revisions.SNAPSHOT_INTERVAL, 1 + 2 * revisions.SNAPSHOT_INTERVAL])
+        self.assertEqual(EditorFile.objects.get(pk=self.doc.pk).revisions_since_snapshot, 5)
+
+        # Reading the latest revision applies only the deltas since the last snapshot.
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(EditorFileRevision.objects.body_at(self.doc.pk, 46), bodies[46])
+
+        self.assertEqual(len(queries), 2)
+
+    def test_rewritten_body_stored_as_snapshot(self):
+        body = [{"text": "Something else entirely."}]
+        self.client.put(self.url, {'doc': {'body': body}}, format='json')
+
+        revision = self.doc.revisions.get(version=2)
+        self.assertIsNotNone(revision.snapshot)
+        self.assertEqual(EditorFileRevision.objects.body_at(self.doc.pk, 2), body)
+
+    def test_title_changes_not_recorded(self):
+        self.client.put(self.url, {'doc': {'title': 'Renamed'}}, format='json')
+        self.client.put(self.url, {'doc': {'body': self.body + ["More"]}}, format='json')
+
+        self.assertEqual(list(self.doc.revisions.values_list('version', 'title')), [(1, 'Original'), (3, 'Renamed')])
+
+    def test_diff(self):
+        rng = random.Random(16)
+
+        for _ in range(200):
+            old = [rng.randrange(8) for _ in range(rng.randrange(30))]
+            new = apply_block_ops(old, [
+                {"op": "insert", "index": 0, "block": rng.randrange(8)} if rng.random() < 0.5 else {"op": "delete", "index": 0}
+            ] if old else [])
+            new = [rng.randrange(8) if rng.random() < 0.2 else block for block in new]
+            ops = revisions.diff(old, new)
+
+            if ops is not None:
+                self.assertEqual(apply_block_ops(old, ops), new)
+                self.assertLessEqual(len(ops), len(new))
+
+        self.assertIsNone(revisions.diff('Text', ['Text']))
+
+    def test_list_revisions(self):
+        self.save_edits(4)
+        url = reverse('doc-revisions', kwargs={'pk': self.doc.pk})
+
+        response = self.client.get(url, {'limit': 3})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual([revision['version'] for revision in response.data['revisions']], [5, 4, 3])
+        self.assertEqual(response.data['revisions'][0]['title'], 'Original')
+
+        response = self.client.get(url, {'limit': 3, 'before': response.data['next']})
+        self.assertEqual([revision['version'] for revision in response.data['revisions']], [2, 1])
+        self.assertIsNone(response.data['next'])
+
+        self.assertEqual(self.client.get(url, {'limit': 'all'}).status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(self.client.get(reverse('doc-revisions', kwargs={'pk': uuid.uuid4()})).status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_get_revision(self):
+        bodies = self.save_edits(3)
+
+        response = self.client.get(reverse('doc-revision', kwargs={'pk': self.doc.pk, 'version': 3}))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['revision']['body'], bodies[3])
+        self.assertEqual(response.data['revision']['version'], 3)
+
+        response = self.client.get(reverse('doc-revision', kwargs={'pk': self.doc.pk, 'version': 9}))
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_restore_revision(self):
+        bodies = self.save_edits(3)
+        url = reverse('restore-doc-revision', kwargs={'pk': self.doc.pk, 'version': 2})
+
+        response = self.client.post(url, {'doc': {'version': 3}}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_409_CONFLICT)
+        self.assertEqual(response.data['doc']['version'], 4)
+
+        response = self.client.post(url, {'doc': {'version': 4}}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['doc']['version'], 5)
+
+        doc = EditorFile.objects.get(pk=self.doc.pk)
+        self.assertEqual(doc.body, bodies[2])
+        self.assertEqual(doc.version, 5)
+
+        # The restore is itself a revision, so can be undone.
+        self.assertEqual(EditorFileRevision.objects.body_at(self.doc.pk, 5), bodies[2])
+        self.assertEqual(EditorFileRevision.objects.body_at(self.doc.pk, 4), bodies[4])
+
+        response = self.client.post(reverse('restore-doc-revision', kwargs={'pk': self.doc.pk, 'version': 9}), format='json')
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_other_users_revisions(self):
+        User.objects.create_user(username='another_user', password='another_password')
+        self.client.cookies = SimpleCookie({'jwt': generate_jwt_token('another_user')})
+
+        self.assertEqual(self.client.get(reverse('doc-revisions', kwargs={'pk': self.doc.pk})).status_code, status.HTTP_401_UNAUTHORIZED)
+        self.assertEqual(self.client.get(reverse('doc-revision', kwargs={'pk': self.doc.pk, 'version': 1})).status_code, status.HTTP_401_UNAUTHORIZED)
+        self.assertEqual(self.client.post(reverse('restore-doc-revision', kwargs={'pk': self.doc.pk, 'version': 1})).status_code, status.HTTP_401_UNAUTHORIZED)
+
+    def test_prune_revisions(self):
+        bodies = self.save_edits(29)
+        start = (timezone.now() - datetime.timedelta(days=60)).replace(hour=12)
+
+        # Versions 1-24 saved four a day, from 60 days ago; the rest today.
+        for version in range(1, 25):
+            created = start + datetime.timedelta(days=(version - 1) // 4, hours=(version - 1) % 4)
+            self.doc.revisions.filter(version=version).update(created=created)
+
+        call_command('prune_revisions', stdout=open(os.devnull, 'w'))
+
+        versions = list(self.doc.revisions.values_list('version', flat=True))
+        self.assertEqual(versions, [4, 8, 12, 16, 20, 24] + list(range(25, 31)))
+
+        for version in versions:
+            self.assertEqual(EditorFileRevision.objects.body_at(self.doc.pk, version), bodies[version])
+
+        # The snapshot, version 1, was removed, so version 4 became one; the
+        # rest are deltas from the revision kept before.
+        depths = list(self.doc.revisions.values_list('depth', flat=True))
+        self.assertEqual(depths, list(range(12)))
+        self.assertEqual(EditorFile.objects.get(pk=self.doc.pk).revisions_since_snapshot, 11)
+
+        # Later saves carry on from the compacted revisions.
+        body = bodies[30] + ["Later"]
+        self.client.put(self.url, {'doc': {'body': body, 'version': 30}}, format='json')
+        self.assertEqual(EditorFileRevision.objects.body_at(self.doc.pk, 31), body)
+
+    @override_settings(DOC_CHUNK_THRESHOLD=100)
+    def test_chunked_doc_revisions(self):
+        body = [{"text": f"Block {i}"} for i in range(300)]
+        doc = EditorFile.objects.create(author=self.user, title='Large', body=body)
+        url = reverse('edit-doc', kwargs={'pk': doc.pk})
+        bodies = {1: body}
+
+        for version in range(1, revisions.SNAPSHOT_INTERVAL + 2):
+            ops = [{"op": "insert", "index": version, "block": {"text": f"Inserted in {version}"}}]
+            body = apply_block_ops(body, ops)
+            bodies[version + 1] = body
+
+            response = self.client.patch(url, {'doc': {'ops': ops, 'version': version}}, format='json')
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+        self.assertTrue(EditorFile.objects.get(pk=doc.pk).chunked)
+        self.assertEqual(doc.revisions.get(version=2).delta, [{"op": "insert", "index": 1, "block": {"text": "Inserted in 1"}}])
+        self.assertIsNotNone(doc.revisions.get(version=1 + revisions.SNAPSHOT_INTERVAL).snapshot)
+
+        for version, body in bodies.items():
+            self.assertEqual(EditorFileRevision.objects.body_at(doc.pk, version), body)
+
+    def test_deleted_with_doc(self):
+        self.save_edits(2)
+        self.client.delete(self.url)
+
+        self.assertFalse(EditorFileRevision.objects.exists())
+
+class DocSearchTest(APITestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='test_user', password='test_password')
+        self.client.cookies = SimpleCookie({'jwt': generate_jwt_token('test_user')})
+
+        self.recipes = EditorFile.objects.create(author=self.user, title='Recipes', body=[
+            {"type": "heading", "text": "Bread"},
+            {"type": "paragraph", "text": "Mix the flour and water, then leave the dough to rise overnight."},
+        ])
+        self.notes = EditorFile.objects.create(author=self.user, title='Garden notes', body=[
+            {"type": "paragraph", "text": "Plant the beans after the last frost. Water daily."},
+        ])
+        self.dough = EditorFile.objects.create(author=self.user, title='Dough', body=[{"text": "Sourdough starter feeding schedule."}])
+
+    def search(self, q, **params):
+        response = self.client.get(reverse('search-docs'), {'q': q, **params})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return response.data['docs']
+
+    def test_search_ranked(self):
+        # Both mention dough; a match in the title ranks higher.
+        docs = self.search('dough')
+        self.assertEqual([doc['uid'] for doc in docs], [str(self.dough.uid), str(self.recipes.uid)])
+        self.assertGreater(docs[0]['rank'], docs[1]['rank'])
+        self.assertEqual(docs[1]['title'], 'Recipes')
+        self.assertEqual(docs[1]['version'], 1)
+
+        # Every word must match, in any case.
+        self.assertEqual({doc['uid'] for doc in self.search('WATER')}, {str(self.recipes.uid), str(self.notes.uid)})
+        self.assertEqual([doc['uid'] for doc in self.search('water beans')], [str(self.notes.uid)])
+        self.assertEqual(self.search('water cake'), [])
+        self.assertEqual(self.search('the'), [])
+
+    def test_snippets(self):
+        snippet = self.search('rise')[0]['snippet']
+
+        self.assertEqual(snippet['text'], 'Bread Mix the flour and water, then leave the dough to rise overnight.')
+        start, end = snippet['highlights'][0]
+        self.assertEqual(snippet['text'][start:end], 'rise')
+
+        text = " ".join(f"word{i}" for i in range(200)) + " needle " + " ".join(f"word{i}" for i in range(200))
+        snippet = search.snippet(text, 'needle')
+        self.assertTrue(snippet['text'].startswith('…word'))
+        self.assertTrue(snippet['text'].endswith('…'))
+        self.assertEqual([snippet['text'][start:end] for start, end in snippet['highlights']], ['needle'])
+
+    def test_index_updated_on_save(self):
+        self.client.put(reverse('edit-doc', kwargs={'pk': self.notes.pk}), {'doc': {'body': [{"text": "Water the tomatoes."}]}}, format='json')
+        self.client.patch(reverse('edit-doc', kwargs={'pk': self.recipes.pk}), {'doc': {'version': 1, 'ops': [{"op": "delete", "index": 1}]}}, format='json')
+
+        self.assertEqual([doc['uid'] for doc in self.search('water')], [str(self.notes.uid)])
+        self.assertEqual([doc['uid'] for doc in self.search('tomatoes')], [str(self.notes.uid)])
+        self.assertEqual(self.search('beans'), [])
+
+        self.client.put(reverse('edit-doc', kwargs={'pk': self.dough.pk}), {'doc': {'title': 'Starter'}}, format='json')
+        self.assertEqual(self.search('dough'), [])
+
+        self.client.delete(reverse('edit-doc', kwargs={'pk': self.notes.pk}))
+        self.assertEqual(self.search('tomatoes'), [])
+        self.assertFalse(EditorFileTerm.objects.filter(file_id=self.notes.pk).exists())
+
+    def test_indexed_on_write(self):
+        with CaptureQueriesContext(connection) as queries:
+            self.client.put(reverse('edit-doc', kwargs={'pk': self.notes.pk}), {'doc': {'body': [{"text": "Plant the beans."}]}}, format='json')
+
+        # Only the changed terms are written.
+        self.assertEqual(len([query for query in queries if query['sql'].startswith('DELETE FROM "user_accounts_editorfileterm"')]), 1)
+        self.assertFalse(any(query['sql'].startswith('INSERT INTO "user_accounts_editorfileterm"') for query in queries))
+        self.assertEqual(EditorFile.objects.filter(indexed_version__lt=F('version')).count(), 0)
+
+        # Searches only read.
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual([doc['uid'] for doc in self.search('beans')], [str(self.notes.uid)])
+
+        self.assertTrue(all(query['sql'].startswith('SELECT') for query in queries))
+
+    def test_import_indexed(self):
+        self.client.post(reverse('batch-docs'), {'ops': [
+            {"op": "create", "doc": {"title": f"Imported {i}", "body": [{"text": "Sourdough"}]}} for i in range(3)
+        ]}, format='json')
+        self.client.post(reverse('batch-docs'), {'ops': [
+            {"op": "update", "uid": str(self.notes.uid), "doc": {"title": "Sourdough notes"}},
+            {"op": "update", "uid": str(self.dough.uid), "doc": {"body": [{"text": "Rye."}]}},
+        ]}, format='json')
+
+        self.assertEqual(len(self.search('sourdough')), 4)
+        self.assertEqual([doc['uid'] for doc in self.search('rye')], [str(self.dough.uid)])
+
+    def test_rare_and_common_terms(self):
+        for i in range(20):
+            EditorFile.objects.create(author=self.user, title=f'Doc {i}', body=["Common words", "Rare" if i == 7 else "Other"])
+
+        # Found by looking up the terms of the one doc with the rare one.
+        docs = self.search('common rare')
+        self.assertEqual([doc['title'] for doc in docs], ['Doc 7'])
+        self.assertEqual(docs[0]['snippet']['text'], 'Common words Rare')
+        self.assertEqual(len(self.search('common words')), 20)
+
+    def test_other_users_docs_not_found(self):
+        other = User.objects.create_user(username='another_user', password='another_password')
+        EditorFile.objects.create(author=other, title='Dough', body=["Dough"])
+
+        self.assertEqual(len(self.search('dough')), 2)
+
+    @override_settings(DOC_CHUNK_THRESHOLD=100)
+    def test_chunked_docs(self):
+        body = [{"text": f"Paragraph {i}."} for i in range(300)] + [{"text": "The hidden treasure."}]
+        doc = EditorFile.objects.create(author=self.user, title='Long', body=body)
+
+        docs = self.search('treasure')
+        self.assertEqual([result['uid'] for result in docs], [str(doc.uid)])
+        self.assertIn('treasure', docs[0]['snippet']['text'])
+
+    def test_limit(self):
+        for i in range(5):
+            EditorFile.objects.create(author=self.user, title=f'Doc {i}', body=["Common"])
+
+        self.assertEqual(len(self.search('common', limit=3)), 3)
+
+        self.assertEqual(self.client.get(reverse('search-docs'), {'q': 'x', 'limit': 51}).status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(self.client.get(reverse('search-docs'), {'q': ' '}).status_code, status.HTTP_400_BAD_REQUEST)
+
+        self.client.cookies = SimpleCookie()
+        self.assertEqual(self.client.get(reverse('search-docs'), {'q': 'x'}).status_code, status.HTTP_401_UNAUTHORIZED)
+
+    def test_index_docs_command(self):
+        # As docs saved before they were indexed on write.
+        EditorFile.objects.update(indexed_version=0)
+        EditorFileTerm.objects.all().delete()
+
+        call_command('index_docs', stdout=open(os.devnull, 'w'))
+
+        self.assertEqual(EditorFile.objects.filter(indexed_version=F('version')).count(), 3)
+        self.assertEqual(EditorFileTerm.objects.get(file=self.notes, term='water').weight, 1)
+        self.assertEqual(EditorFileTerm.objects.get(file=self.dough, term='dough').weight, search.TITLE_WEIGHT)
+
+class RelatedDocsTest(APITestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='test_user', password='test_password')
+        self.client.cookies = SimpleCookie({'jwt': generate_jwt_token('test_user')})
+
+        # Indexes are kept between requests, by user pk, which tests reuse.
+        vectors.indexes.clear()
+
+        self.recipes = EditorFile.objects.create(author=self.user, title='Recipes', body=[
+            {"type": "heading", "text": "Bread"},
+            {"type": "paragraph", "text": "Mix the flour and water, then knead the dough and leave it to rise."},
+        ])
+        self.baking = EditorFile.objects.create(author=self.user, title='Baking bread', body=[
+            {"type": "paragraph", "text": "Knead the dough for ten minutes, then bake the bread."},
+        ])
+        self.garden = EditorFile.objects.create(author=self.user, title='Garden notes', body=[
+            {"type": "paragraph", "text": "Plant the beans after the last frost."},
+        ])
+
+    def related(self, doc, **params):
+        response = self.client.get(reverse('related-docs', kwargs={'pk': doc.pk}), params)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return response.data['docs']
+
+    def test_related_ranked(self):
+        docs = self.related(self.recipes)
+
+        self.assertEqual(docs[0]['uid'], str(self.baking.uid))
+        self.assertEqual(docs[0]['title'], 'Baking bread')
+        self.assertNotIn(str(self.recipes.uid), [doc['uid'] for doc in docs])
+        self.assertTrue(all(0 < doc['score'] <= 1 for doc in docs))
+        self.assertEqual(docs, sorted(docs, key=lambda doc: -doc['score']))
+
+    def test_embeddings(self):
+        self.assertTrue(numpy.allclose(embeddings.embed("Kneading dough"), embeddings.embed("kneading   DOUGH")))
+        self.assertAlmostEqual(float(numpy.linalg.norm(embeddings.embed("Kneading dough"))), 1, places=5)
+        self.assertFalse(embeddings.embed("the ... of").any())
+
+        # Forms of a word share trigrams, unlike unrelated words.
+        kneads = embeddings.embed("kneads")
+        self.assertGreater(embeddings.embed("kneading") @ kneads, embeddings.embed("beans") @ kneads)
+
+        self.assertEqual([text for key, text in embeddings.parts('Title', [{"text": "One"}, {"type": "divider"}, "Two"])], ['Title', 'One', 'divider', 'Two'])
+        self.assertEqual(len(embeddings.parts('', [])), 0)
+
+    def test_only_changed_blocks_embedded(self):
+        stored = EditorBlockVector.objects.count()
+
+        with unittest.mock.patch('user_accounts.embeddings.embed', wraps=embeddings.embed) as embed:
+            self.client.patch(reverse('edit-doc', kwargs={'pk': self.baking.pk}), {'doc': {'version': 1, 'ops': [
+                {"op": "insert", "index": 1, "block": {"text": "Leave the loaf to cool."}},
+            ]}}, format='json')
+
+        self.assertEqual([call.args[0] for call in embed.call_args_list], ['Leave the loaf to cool.'])
+        self.assertEqual(EditorBlockVector.objects.count(), stored + 1)
+        self.assertEqual(EditorFile.objects.filter(embedded_version__lt=F('version')).count(), 0)
+
+    def test_related_only_reads(self):
+        self.related(self.recipes)
+        self.client.put(reverse('edit-doc', kwargs={'pk': self.baking.pk}), {'doc': {'title': 'Baked bread'}}, format='json')
+
+        with CaptureQueriesContext(connection) as queries:
+            docs = self.related(self.recipes)
+
+        self.assertEqual(docs[0]['title'], 'Baked bread')
+        self.assertTrue(all(query['sql'].startswith('SELECT') for query in queries), [query['sql'] for query in queries])
+
+    def test_index_kept_up_to_date(self):
+        self.assertNotIn('Sourdough', [doc['title'] for doc in self.related(self.recipes)])
+
+        sourdough = EditorFile.objects.create(author=self.user, title='Sourdough', body=[{"text": "Knead the dough, then bake the bread."}])
+        self.assertIn('Sourdough', [doc['title'] for doc in self.related(self.recipes)])
+
+        self.client.delete(reverse('edit-doc', kwargs={'pk': sourdough.pk}))
+        self.assertNotIn('Sourdough', [doc['title'] for doc in self.related(self.recipes)])
+
+        # A doc saved with other text moves away.
+        self.client.put(reverse('edit-doc', kwargs={'pk': self.baking.pk}), {'doc': {'title': 'Beans', 'body': [{"text": "Plant the beans."}]}}, format='json')
+        self.assertEqual(self.related(self.garden)[0]['uid'], str(self.baking.uid))
+
+    def test_index_catches_up_by_sequence(self):
+        self.related(self.recipes)
+        sourdough = EditorFile.objects.create(author=self.user, title='Sourdough', body=[{"text": "Knead the dough, then bake the bread."}])
+
+        with unittest.mock.patch.object(vectors.VectorIndex, 'set_row', autospec=True, side_effect=vectors.VectorIndex.set_row) as set_vector:
+            self.related(self.recipes)
+            self.related(self.recipes)
+
+            # Rows older than the index holds, as read by another thread, are left out.
+            index = vectors.indexes.get(self.user.pk)
+            index.catch_up([(self.recipes.pk, numpy.zeros(embeddings.DIMENSIONS), 1)])
+
+        # Only the vector stored since, once.
+        self.assertEqual([call.args[1] for call in set_vector.call_args_list], [sourdough.pk])
+        self.assertEqual(index.sequence, 4)
+
+        # Each store is numbered after the last.
+        self.assertEqual(EditorFileVector.objects.get(file=self.recipes).sequence, 1)
+        self.assertEqual(EditorFileVector.objects.get(file=sourdough).sequence, 4)
+        self.assertEqual(User.objects.get(pk=self.user.pk).vector_sequence, 4)
+
+    def test_index_grows_geometrically(self):
+        rng = numpy.random.default_rng(0)
+        rows = rng.standard_normal((1000, embeddings.DIMENSIONS)).astype(numpy.float32)
+        index = vectors.VectorIndex()
+
+        for key, row in enumerate(rows):
+            index.set(key, row)
+
+        self.assertEqual(len(index), 1000)
+        self.assertEqual(len(index.array), 1024)
+        self.assertEqual(index.nearest(rows[500], 1)[0][0], 500)
+
+    def test_lsh_index(self):
+        rng = numpy.random.default_rng(0)
+        keys = list(range(2000))
+        rows = rng.standard_normal((len(keys), embeddings.DIMENSIONS)).astype(numpy.float32)
+        rows /= numpy.linalg.norm(rows, axis=1, keepdims=True)
+
+        with unittest.mock.patch.object(vectors, 'LSH_THRESHOLD', 1000):
+            index = vectors.VectorIndex(keys, rows)
+            self.assertIsNotNone(index.tables)
+
+            # A vector near one in the index finds it, scoring only some of the others.
+            query = embeddings.normalize(rows[42] + 0.2 * rng.standard_normal(embeddings.DIMENSIONS).astype(numpy.float32))
+            self.assertEqual(index.nearest(query, 1)[0][0], 42)
+            self.assertLess(len(index.candidates(query)), len(keys))
+
+            index.set(42, -rows[42])
+            index.set(2000, rows[42])
+            self.assertEqual(index.nearest(query, 1)[0][0], 2000)
+            self.assertNotEqual(index.nearest(query, 1, exclude=[2000])[0][0], 42)
+
+        small = vectors.VectorIndex(keys[:10], rows[:10])
+        self.assertIsNone(small.tables)
+        self.assertEqual([key for key, score in small.nearest(rows[3], 2)][0], 3)
+
+    def test_collect_block_vectors(self):
+        self.related(self.recipes)
+        self.client.put(reverse('edit-doc', kwargs={'pk': self.garden.pk}), {'doc': {'body': [{"text": "Water daily."}]}}, format='json')
+        self.related(self.recipes)
+
+        call_command('collect_blocks', stdout=open(os.devnull, 'w'))
+
+        texts = {'Recipes', 'Bread', 'Mix the flour and water, then knead the dough and leave it to rise.', 'Baking bread', 'Knead the dough for ten minutes, then bake the bread.', 'Garden notes', 'Water daily.'}
+        self.assertEqual(EditorBlockVector.objects.count(), len(texts))
+
+    def test_other_users_docs(self):
+        other = User.objects.create_user(username='another_user', password='another_password')
+        bread = EditorFile.objects.create(author=other, title='Baking bread', body=["Knead the dough, then bake the bread."])
+
+        self.assertNotIn(str(bread.uid), [doc['uid'] for doc in self.related(self.recipes)])
+        self.assertEqual(self.client.get(reverse('related-docs', kwargs={'pk': bread.pk})).status_code, status.HTTP_401_UNAUTHORIZED)
+        self.assertEqual(self.client.get(reverse('related-docs', kwargs={'pk': 'missing'})).status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_limit(self):
+        for i in range(5):
+            EditorFile.objects.create(author=self.user, title=f'Bread {i}', body=["Dough"])
+
+        self.assertEqual(len(self.related(self.recipes, limit=3)), 3)
+        self.assertEqual(self.client.get(reverse('related-docs', kwargs={'pk': self.recipes.pk}), {'limit': 51}).status_code, status.HTTP_400_BAD_REQUEST)
+
+        self.client.cookies = SimpleCookie()
+        self.assertEqual(self.client.get(reverse('related-docs', kwargs={'pk': self.recipes.pk})).status_code, status.HTTP_401_UNAUTHORIZED)
+
+    def test_embed_docs_command(self):
+        # As docs saved before they were embedded on write.
+        EditorFile.objects.update(embedded_version=0)
+        EditorFileVector.objects.all().delete()
+
+        call_command('embed_docs', stdout=open(os.devnull, 'w'))
+
+        self.assertEqual(EditorFile.objects.filter(embedded_version=F('version')).count(), 3)
+        self.assertEqual(len(blockstore.unpack(EditorFileVector.objects.get(file=self.recipes).digests)), 3)
+
+class PromptViewTests(APITestCase):
+    def setUp(self):
+        self.client = APIClient()
+        self.username = 'test_user'
+        self.user = User.objects.create_user(username=self.username, password='test_password')
+        self.url = reverse('prompts')
+
+        # Include the token in the client's request headers
+        self.client.cookies = SimpleCookie({'jwt': generate_jwt_token(self.username)})        
+
+    def test_get_prompts_empty(self):
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data, [])
+
+    def test_get_prompts_nonempty(self):
+        prompt1 = Prompt.objects.create(user=self.user, name="Test", prompt="Test prompt")
+        prompt2 = Prompt.objects.create(user=self.user, name="Test2", prompt="Test prompt 2")
+
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        expected_data = [
+            {"uid": str(prompt1.uid), "name": "Test", "prompt": "Test prompt"},
+            {"uid": str(prompt2.uid), "name": "Test2", "prompt": "Test prompt 2"}
+        ]
+        self.assertEqual(response.data, expected_data)
+
+    def test_post_single_prompt(self):
+        data = {"name": "Test", "prompt": "Test prompt"}
+        response = self.client.post(self.url, data, format='json')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(self.user.prompts.count(), 1)
+        self.assertEqual(self.user.prompts.first().name, "Test")
+        self.assertEqual(self.user.prompts.first().prompt, "Test prompt")
+
+
+    def test_post_prompts_duplicate_name(self):
+        Prompt.objects.create(user=self.user, name="Test", prompt="Test prompt")
+
+        # Try and create a prompt with a duplicate name
+        data = {"name": "Test", "prompt": "Test prompt 2"}
+        response = self.client.post(self.url, data, format='json')
+
+        # Response should fail.
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_get_prompts_unauthenticated(self):
+        # Log out.
+        self.client.cookies = SimpleCookie({})
+        response = self.client.get(reverse('prompts'))
+        self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+
+    def test_post_prompts_unauthenticated(self):
+        # Log out.
+        self.client.cookies = SimpleCookie({})
+        response = self.client.post(reverse('prompts'), {})
+        self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+
+class PromptDetailViewTests(APITestCase):
+    def setUp(self):
+        self.client = APIClient()
+        self.username = 'test_user'
+        self.user = User.objects.create_user(username=self.username, password='test_password')
+        self.prompt = Prompt.objects.create(user=self.user, name="Test", prompt="Test prompt")
+        self.url_name = 'prompts-detail'
+        self.url = reverse(self.url_name, kwargs={'pk': self.prompt.uid})
+
+        # Include the token in the client's request headers
+        self.client.cookies = SimpleCookie({'jwt': generate_jwt_token(self.username)})
+
+    def test_get_prompt(self):
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        expected_data = {"uid": str(self.prompt.uid), "name": "Test", "prompt": "Test prompt"}
+        self.assertEqual(response.data, expected_data)
+
+    def test_get_nonexistent_prompt(self):
         url = reverse(self.url_name, kwargs={'pk': 'nonexistent_id'})
         response = self.client.get(url)
         self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
@@ -571,26 +2471,92 @@ class PromptDetailViewTests(APITestCase):
         self.assertEqual(self.prompt.name, "Updated Test")
         self.assertEqual(self.prompt.prompt, "Updated prompt")
 
-    def test_update_nonexistent_prompt(self):
-        url = reverse(self.url_name, kwargs={'pk': 'nonexistent_id'})
-        data = {"name": "Updated Test", "prompt": "Updated prompt"}
+    def test_update_nonexistent_prompt(self):
+        url = reverse(self.url_name, kwargs={'pk': 'nonexistent_id'})
+        data = {"name": "Updated Test", "prompt": "Updated prompt"}
+
+        response = self.client.put(url, data, format='json')
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_delete_prompt(self):
+        response = self.client.delete(self.url)
+        self.assertEqual(response.status_code, status.HTTP_204_NO_CONTENT)
+        self.assertFalse(Prompt.objects.filter(uid=self.prompt.uid).exists())
+
+    def test_delete_nonexistent_prompt(self):
+        url = reverse(self.url_name, kwargs={'pk': 'nonexistent_id'})
+        response = self.client.delete(url)
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+
+class EncodingRegistryTest(TestCase):
+    def setUp(self):
+        encodings.clear_encodings()
+
+    def tearDown(self):
+        encodings.clear_encodings()
+
+    @unittest.mock.patch("tiktoken.encoding_for_model")
+    def test_encoding_loaded_once(self, mock_encoding_for_model):
+        mock_encoding_for_model.return_value = byte_encoding()
+
+        first = encodings.get_encoding("gpt-3.5-turbo")
+        second = encodings.get_encoding("gpt-3.5-turbo")
+
+        self.assertIs(first, second)
+        mock_encoding_for_model.assert_called_once_with("gpt-3.5-turbo")
+
+    @unittest.mock.patch("tiktoken.encoding_for_model")
+    def test_encoding_shared_between_requests(self, mock_encoding_for_model):
+        mock_encoding_for_model.return_value = byte_encoding()
+
+        # Each request quotes its prompt with the shared encoding.
+        messages = [{"role": "user", "content": "Hello"}]
+        CostQuote(messages, 100)
+        CostQuote(messages, 100)
+
+        mock_encoding_for_model.assert_called_once()
+
+    def test_warm_up_only_in_servers(self):
+        with unittest.mock.patch('user_accounts.encodings.warm_up') as warm_up:
+            apps.get_app_config('user_accounts').ready()
+            warm_up.assert_not_called()
+
+            for module in ['conduit_backend.asgi', 'conduit_backend.wsgi']:
+                sys.modules.pop(module, None)
+                importlib.import_module(module)
 
-        response = self.client.put(url, data, format='json')
-        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+        self.assertEqual(warm_up.call_count, 2)
 
-    def test_delete_prompt(self):
-        response = self.client.delete(self.url)
-        self.assertEqual(response.status_code, status.HTTP_204_NO_CONTENT)
-        self.assertFalse(Prompt.objects.filter(uid=self.prompt.uid).exists())
+    @unittest.mock.patch("tiktoken.encoding_for_model")
+    def test_warm_up_failure_does_not_raise(self, mock_encoding_for_model):
+        mock_encoding_for_model.side_effect = ConnectionError("No network")
 
-    def test_delete_nonexistent_prompt(self):
-        url = reverse(self.url_name, kwargs={'pk': 'nonexistent_id'})
-        response = self.client.delete(url)
-        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+        with self.assertLogs('defaultlogger', level='WARNING'):
+            encodings.warm_up(["gpt-3.5-turbo"])
+
+        # The next use retries the load.
+        mock_encoding_for_model.side_effect = None
+        mock_encoding_for_model.return_value = byte_encoding()
+        self.assertIsNotNone(encodings.get_encoding("gpt-3.5-turbo"))
+
+    def test_vendored_encodings_dir(self):
+        with self.settings(TIKTOKEN_ENCODINGS_DIR=os.path.dirname(__file__)):
+            with unittest.mock.patch.dict(os.environ, {}, clear=True):
+                encodings.use_vendored_encodings()
+                self.assertEqual(os.environ["TIKTOKEN_CACHE_DIR"], os.path.dirname(__file__))
+
+        # Missing directories are ignored, so Tiktoken falls back to its own cache.
+        with self.settings(TIKTOKEN_ENCODINGS_DIR="/does/not/exist"):
+            with unittest.mock.patch.dict(os.environ, {}, clear=True):
+                encodings.use_vendored_encodings()
+                self.assertNotIn("TIKTOKEN_CACHE_DIR", os.environ)
 
 
 class GenerateTextTest(APITestCase):
     def setUp(self):
+        encodings.register_encoding("gpt-3.5-turbo", byte_encoding())
+
         self.client = APIClient()
         self.username = 'test_user'
         self.user = User.objects.create_user(username=self.username, password='test_password', credits=100)
@@ -674,7 +2640,551 @@ class GenerateTextTest(APITestCase):
         # Check if the response indicates invalid JSON format
         self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
 
-    # TODO: add tests for different credits scenarios.
+    @unittest.mock.patch("user_accounts.views.get_client")
+    def test_generate_text_charges_usage(self, mock_client):
+        create = mock_client.return_value.chat.completions.create
+        create.return_value = fake_completion("The sky is blue because...", 1000, 2000)
+
+        response = self.client.post(reverse('generate-text'), self.request_data, format='json')
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data["prompt"]["messages"][0]["content"], "The sky is blue because...")
+
+        # 1000 prompt tokens at 50 and 2000 completion tokens at 150 cents per million.
+        self.assertAlmostEqual(response.data["cost"], 0.35)
+        self.user.refresh_from_db()
+        self.assertAlmostEqual(self.user.credits, 99.65)
+
+    @unittest.mock.patch("user_accounts.views.get_client")
+    def test_generate_text_insufficient_credits_for_response(self, mock_client):
+        # Enough for the prompt, but not a maximum length response.
+        self.user.credits = 0.5
+        self.user.save()
+
+        response = self.client.post(reverse('generate-text'), self.request_data, format='json')
+
+        self.assertEqual(response.status_code, status.HTTP_402_PAYMENT_REQUIRED)
+        mock_client.return_value.chat.completions.create.assert_not_called()
+
+    @unittest.mock.patch("user_accounts.views.get_client")
+    def test_generate_text_scale_down_output(self, mock_client):
+        create = mock_client.return_value.chat.completions.create
+        create.return_value = fake_completion("Short answer.", 10, 10)
+
+        self.user.credits = 0.5
+        self.user.save()
+
+        self.request_data["scale"] = True
+        response = self.client.post(reverse('generate-text'), self.request_data, format='json')
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+        # The response is limited to what the user can pay for.
+        quote = CostQuote(self.request_data["prompt"]["messages"], 0.5)
+        max_tokens = create.call_args.kwargs["max_tokens"]
+        self.assertEqual(max_tokens, quote.affordable_tokens)
+        self.assertLess(max_tokens, quote.max_response_tokens)
+        self.assertLessEqual(quote.prompt_micro_cost + max_tokens * 150, 0.5 * 1000000)
+
+    @unittest.mock.patch("user_accounts.views.get_client")
+    def test_generate_text_stream(self, mock_client):
+        usage = SimpleNamespace(prompt_tokens=1000, completion_tokens=2000, total_tokens=3000)
+        stream = FakeStream([fake_chunk("The sky "), fake_chunk("is blue."), fake_chunk(usage=usage)])
+        create = mock_client.return_value.chat.completions.create
+        create.return_value = stream
+
+        self.request_data["stream"] = True
+        response = self.client.post(reverse('generate-text'), self.request_data, format='json')
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response["Content-Type"], "text/event-stream")
+        self.assertTrue(create.call_args.kwargs["stream"])
+
+        events = parse_sse(b"".join(response.streaming_content))
+
+        self.assertEqual(events[0], ("token", {"content": "The sky "}))
+        self.assertEqual(events[1], ("token", {"content": "is blue."}))
+
+        event, data = events[-1]
+        self.assertEqual(event, "done")
+        self.assertEqual(data["prompt"]["messages"][0]["content"], "The sky is blue.")
+
+        # Charged from the usage reported at the end of the stream.
+        self.assertAlmostEqual(data["cost"], 0.35)
+        self.user.refresh_from_db()
+        self.assertAlmostEqual(self.user.credits, 99.65)
+
+    @unittest.mock.patch("user_accounts.views.get_client")
+    async def test_generate_text_stream_asgi(self, mock_client):
+        # Sent as it's generated, not once it's done.
+        first_sent = threading.Event()
+        usage = SimpleNamespace(prompt_tokens=10, completion_tokens=10, total_tokens=20)
+
+        class SlowStream(FakeStream):
+            def __iter__(self):
+                yield fake_chunk("The sky ")
+                self.first_sent = first_sent.wait(5)
+                yield fake_chunk("is blue.")
+                yield fake_chunk(usage=usage)
+
+        stream = SlowStream([])
+        mock_client.return_value.chat.completions.create.return_value = stream
+        self.request_data["stream"] = True
+
+        token = await sync_to_async(generate_jwt_token)(self.username)
+        status_code, chunks = await asgi_request('POST', reverse('generate-text'), json.dumps(self.request_data).encode(), {'jwt': token}, on_body=lambda chunk: first_sent.set())
+
+        self.assertEqual(status_code, status.HTTP_200_OK)
+        self.assertTrue(stream.first_sent)
+        self.assertEqual([event for event, data in parse_sse(b"".join(chunks))], ["token", "token", "done"])
+
+    @unittest.mock.patch("user_accounts.views.get_client")
+    def test_generate_text_stream_client_disconnect(self, mock_client):
+        stream = FakeStream([fake_chunk("x" * 100), fake_chunk("y" * 100), fake_chunk("z" * 100)])
+        mock_client.return_value.chat.completions.create.return_value = stream
+
+        self.request_data["stream"] = True
+        response = self.client.post(reverse('generate-text'), self.request_data, format='json')
+
+        # Read the first token, then hang up.
+        content = iter(response.streaming_content)
+        next(content)
+        response.close()
+
+        self.assertTrue(stream.closed)
+
+        # Charged for the prompt and the 100 tokens sent so far.
+        quote = CostQuote(self.request_data["prompt"]["messages"], 100)
+        self.user.refresh_from_db()
+        self.assertAlmostEqual(self.user.credits, 100 - (quote.prompt_micro_cost + 100 * 150) / 1000000)
+
+    @unittest.mock.patch("user_accounts.views.get_client")
+    def test_generate_text_stream_error(self, mock_client):
+        class FailingStream(FakeStream):
+            def __iter__(self):
+                yield fake_chunk("x" * 100)
+                raise upstream_error("Server overloaded")
+
+        mock_client.return_value.chat.completions.create.return_value = FailingStream([])
+
+        self.request_data["stream"] = True
+        response = self.client.post(reverse('generate-text'), self.request_data, format='json')
+        events = parse_sse(b"".join(response.streaming_content))
+
+        # The error ends the stream, with the cost of the 100 tokens sent, rather than "done".
+        quote = CostQuote(self.request_data["prompt"]["messages"], 100)
+        cost = (quote.prompt_micro_cost + 100 * 150) / 1000000
+        self.assertEqual([event for event, data in events], ["token", "error"])
+        self.assertEqual(events[-1][1]["error"], "Server overloaded")
+        self.assertAlmostEqual(events[-1][1]["cost"], cost)
+
+        self.user.refresh_from_db()
+        self.assertAlmostEqual(self.user.credits, 100 - cost)
+
+    @unittest.mock.patch("user_accounts.views.get_client")
+    def test_generate_text_parallel_requests_cannot_overdraw(self, mock_client):
+        # Enough for one maximum length response, but not two.
+        self.user.credits = 1
+        self.user.save()
+
+        responses = []
+
+        def generate(**options):
+            # A second request arrives while the first is generating.
+            self.assertEqual(responses, [])
+            responses.append(self.client.post(reverse('generate-text'), self.request_data, format='json'))
+            return fake_completion("The sky is blue because...", 1000, 2000)
+
+        mock_client.return_value.chat.completions.create.side_effect = generate
+
+        response = self.client.post(reverse('generate-text'), self.request_data, format='json')
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(responses[0].status_code, status.HTTP_402_PAYMENT_REQUIRED)
+
+        # Only the first request was charged, and its hold settled.
+        self.assertAlmostEqual(self.user.credits, 0.65)
+        self.assertFalse(CreditHold.objects.exists())
+        self.assertEqual(ledger.unreconciled_accounts(), [])
+
+    @unittest.mock.patch("user_accounts.views.get_client")
+    def test_generate_text_upstream_error_releases_hold(self, mock_client):
+        mock_client.return_value.chat.completions.create.side_effect = ValueError("upstream")
+
+        with self.assertRaises(ValueError):
+            self.client.post(reverse('generate-text'), self.request_data, format='json')
+
+        self.assertAlmostEqual(self.user.credits, 100)
+        self.assertEqual(ledger.get_available(self.user), 100 * 1000000)
+
+    def test_generate_text_prompt_exceeds_credits(self):
+        self.user.credits = 0.001
+        self.user.save()
+
+        self.request_data["scale"] = True
+        response = self.client.post(reverse('generate-text'), self.request_data, format='json')
+
+        self.assertEqual(response.status_code, status.HTTP_402_PAYMENT_REQUIRED)
+
+class ConcurrentGenerateTextTest(TransactionTestCase):
+    """
+    Generations by one user in parallel, each a request thread with its
+    own database connection, as in a worker.
+    """
+
+    def setUp(self):
+        if connection.vendor == 'sqlite' and connection.is_in_memory_db():
+            # Its connections, shared between threads, fail to write while
+            # another is, rather than waiting.
+            self.skipTest("needs a database file or server")
+
+        encodings.register_encoding("gpt-3.5-turbo", byte_encoding())
+        self.user = User.objects.create_user(username='test_user', password='test_password', credits=100)
+        self.token = generate_jwt_token('test_user')
+        self.messages = [{"role": "user", "content": "The sky is blue."}]
+
+    @unittest.mock.patch("user_accounts.views.get_client")
+    def test_parallel_generations_all_charged(self, mock_client):
+        requests = 8
+        in_flight = threading.Barrier(requests, timeout=10)
+
+        def create(**kwargs):
+            # Every request has reserved its credits before any is charged.
+            in_flight.wait()
+            return fake_completion("Because...", 1000, 2000)
+
+        mock_client.return_value.chat.completions.create.side_effect = create
+
+        def generate(i):
+            client = APIClient()
+            client.cookies = SimpleCookie({'jwt': self.token})
+
+            try:
+                response = client.post(reverse('generate-text'), {"prompt": {"name": f"Prompt {i}", "messages": self.messages}}, format='json')
+                statuses[i] = response.status_code
+            finally:
+                connection.close()
+
+        statuses = [None] * requests
+        threads = [threading.Thread(target=generate, args=(i,)) for i in range(requests)]
+
+        for thread in threads:
+            thread.start()
+
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(statuses, [status.HTTP_200_OK] * requests)
+
+        # 0.35 each, none lost, and nothing left held.
+        self.assertEqual(ledger.get_balance(self.user), 100 * 1000000 - requests * 350000)
+        self.assertEqual(ledger.get_available(self.user), ledger.get_balance(self.user))
+        self.assertEqual(CreditEntry.objects.filter(user=self.user, kind=CreditEntry.GENERATION).count(), requests)
+        self.assertEqual(ledger.unreconciled_accounts(), [])
+
+class AsyncGenerateTextTest(TestCase):
+    def setUp(self):
+        encodings.register_encoding("gpt-3.5-turbo", byte_encoding())
+
+        self.username = 'test_user'
+        self.user = User.objects.create_user(username=self.username, password='test_password', credits=100)
+        self.async_client.cookies = SimpleCookie({'jwt': generate_jwt_token(self.username)})
+
+        self.request_data = {
+            "prompt": {
+                "name": "Test Prompt",
+                "messages": [{"role": "user", "content": "Please add more detail: 'The sky is blue.'"}]
+            }
+        }
+
+    @unittest.mock.patch("user_accounts.views.get_async_client")
+    async def test_generate_text_async(self, mock_client):
+        create = unittest.mock.AsyncMock(return_value=fake_completion("The sky is blue because...", 1000, 2000))
+        mock_client.return_value.chat.completions.create = create
+
+        response = await self.async_client.post(reverse('generate-text-async'), self.request_data, content_type='application/json')
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        data = response.json()
+        self.assertEqual(data["prompt"]["messages"][0]["content"], "The sky is blue because...")
+        self.assertAlmostEqual(data["cost"], 0.35)
+
+        credits = await sync_to_async(lambda: self.user.credits)()
+        self.assertAlmostEqual(credits, 99.65)
+
+    @unittest.mock.patch("user_accounts.views.get_async_client")
+    async def test_generate_text_async_stream_error(self, mock_client):
+        class FailingStream:
+            async def __aiter__(self):
+                yield fake_chunk("The sky ")
+                raise upstream_error("Server overloaded")
+
+            async def close(self):
+                pass
+
+        mock_client.return_value.chat.completions.create = unittest.mock.AsyncMock(return_value=FailingStream())
+
+        self.request_data["stream"] = True
+        response = await self.async_client.post(reverse('generate-text-async'), self.request_data, content_type='application/json')
+        events = parse_sse(b"".join([chunk async for chunk in response.streaming_content]))
+
+        self.assertEqual([event for event, data in events], ["token", "error"])
+        self.assertEqual(events[-1][1]["error"], "Server overloaded")
+        self.assertGreater(events[-1][1]["cost"], 0)
+
+    async def test_generate_text_async_not_logged_in(self):
+        self.async_client.cookies = SimpleCookie({})
+
+        response = await self.async_client.post(reverse('generate-text-async'), self.request_data, content_type='application/json')
+        self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+
+    async def test_generate_text_async_invalid(self):
+        response = await self.async_client.post(reverse('generate-text-async'), "invalid_json", content_type='application/json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+        response = await self.async_client.post(reverse('generate-text-async'), {"prompt": {"messages": [{"role": "user"}]}}, content_type='application/json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    @unittest.mock.patch.dict(os.environ, {"OPENAI_API_KEY": "invalid_key"})
+    @unittest.mock.patch("user_accounts.generation._client", None)
+    def test_clients_shared(self):
+        self.assertIs(generation.get_client(), generation.get_client())
+
+        async def get_twice():
+            return generation.get_async_client(), generation.get_async_client()
+
+        first, second = asyncio.run(get_twice())
+        self.assertIs(first, second)
+
+@override_settings(RATE_LIMITS={'login': (2, 60), 'forgot': (1, 60), 'register': (1, 60), 'generate': (2, 60)}, CONCURRENCY_LIMITS={'generate': 1})
+class RateLimitTest(APITestCase):
+    def setUp(self):
+        ratelimit.get_backend().clear()
+        encodings.register_encoding("gpt-3.5-turbo", byte_encoding())
+
+        self.user = User.objects.create_user(username='test_user', password='test_password', credits=100)
+        self.request_data = {"prompt": {"name": "Test Prompt", "messages": [{"role": "user", "content": "The sky is blue."}]}}
+
+    def backends(self):
+        path = os.path.join(self.enterContext(tempfile.TemporaryDirectory()), 'ratelimit.sqlite3')
+        return [ratelimit.MemoryBackend(), ratelimit.SQLiteBackend(path)]
+
+    def login(self, **extra):
+        return self.client.post(reverse('login'), {'username': 'test_user', 'password': 'wrong_password'}, format='json', **extra)
+
+    def test_bucket(self):
+        for backend in self.backends():
+            with self.subTest(backend=type(backend).__name__):
+                self.assertEqual([backend.take('key', 1, 2, 100) for _ in range(2)], [0, 0])
+                self.assertAlmostEqual(backend.take('key', 1, 2, 100), 1)
+
+                # Refilled at a token a second.
+                self.assertAlmostEqual(backend.take('key', 1, 2, 100.5), 0.5)
+                self.assertEqual(backend.take('key', 1, 2, 101), 0)
+                self.assertEqual(backend.take('other', 1, 2, 101), 0)
+
+                # No more than the burst, however long it waits.
+                self.assertEqual([backend.take('key', 1, 2, 1000) for _ in range(2)], [0, 0])
+                self.assertGreater(backend.take('key', 1, 2, 1000), 0)
+
+    def test_slots(self):
+        for backend in self.backends():
+            with self.subTest(backend=type(backend).__name__):
+                first, second = backend.acquire('key', 2, 60, 100), backend.acquire('key', 2, 60, 100)
+                self.assertNotEqual(first, second)
+                self.assertIsNone(backend.acquire('key', 2, 60, 100))
+
+                backend.release('key', first)
+                backend.release('key', first)
+                self.assertIsNotNone(backend.acquire('key', 2, 60, 100))
+                self.assertIsNone(backend.acquire('key', 2, 60, 100))
+
+                # Not released, as by a worker which died.
+                self.assertIsNotNone(backend.acquire('key', 2, 60, 160))
+
+    def test_sqlite_shared(self):
+        path = os.path.join(self.enterContext(tempfile.TemporaryDirectory()), 'ratelimit.sqlite3')
+        worker, other_worker = ratelimit.SQLiteBackend(path), ratelimit.SQLiteBackend(path)
+
+        self.assertEqual(worker.take('key', 1, 1, 100), 0)
+        self.assertAlmostEqual(other_worker.take('key', 1, 1, 100), 1)
+
+        lease = worker.acquire('key', 1, 60, 100)
+        self.assertIsNone(other_worker.acquire('key', 1, 60, 100))
+        worker.release('key', lease)
+        self.assertIsNotNone(other_worker.acquire('key', 1, 60, 100))
+
+        # Full buckets and expired slots are dropped.
+        other_worker.prune(200)
+        self.assertEqual(worker.connection.execute("SELECT count(*) FROM buckets").fetchone()[0], 0)
+        self.assertEqual(worker.connection.execute("SELECT count(*) FROM leases").fetchone()[0], 0)
+
+    def test_login_limited_per_ip(self):
+        self.assertEqual([self.login().status_code for _ in range(2)], [status.HTTP_401_UNAUTHORIZED] * 2)
+
+        # Refilled at one every 30 seconds (less the time the logins took).
+        response = self.login()
+        self.assertEqual(response.status_code, status.HTTP_429_TOO_MANY_REQUESTS)
+        self.assertIn(int(response['Retry-After']), range(1, 31))
+
+        self.assertEqual(self.login(REMOTE_ADDR='10.0.0.2').status_code, status.HTTP_401_UNAUTHORIZED)
+
+    def test_forwarded_for_not_trusted(self):
+        # As through Heroku's router, which appends the address it saw.
+        statuses = [self.login(HTTP_X_FORWARDED_FOR=f'10.0.1.{i}, 10.0.0.2').status_code for i in range(3)]
+        self.assertEqual(statuses, [status.HTTP_401_UNAUTHORIZED] * 2 + [status.HTTP_429_TOO_MANY_REQUESTS])
+
+        self.assertEqual(self.login(HTTP_X_FORWARDED_FOR='10.0.1.1, 10.0.0.3').status_code, status.HTTP_401_UNAUTHORIZED)
+
+    def test_forwarded_for_ignored_without_proxy(self):
+        with override_settings(REST_FRAMEWORK={**settings.REST_FRAMEWORK, 'NUM_PROXIES': 0}):
+            statuses = [self.login(HTTP_X_FORWARDED_FOR=f'10.0.1.{i}').status_code for i in range(3)]
+
+        self.assertEqual(statuses, [status.HTTP_401_UNAUTHORIZED] * 2 + [status.HTTP_429_TOO_MANY_REQUESTS])
+
+    def test_forgot_and_register_limited(self):
+        for name in ['forgot', 'register-email']:
+            with self.subTest(name=name):
+                self.assertEqual(self.client.post(reverse(name), {'email': 'invalid'}).status_code, status.HTTP_400_BAD_REQUEST)
+
+                response = self.client.post(reverse(name), {'email': 'invalid'})
+                self.assertEqual(response.status_code, status.HTTP_429_TOO_MANY_REQUESTS)
+                self.assertEqual(response['Retry-After'], '60')
+
+    @unittest.mock.patch("user_accounts.views.get_client")
+    def test_generate_limited_per_user(self, mock_client):
+        mock_client.return_value.chat.completions.create.return_value = fake_completion("The sky is blue because...", 10, 10)
+        self.client.cookies = SimpleCookie({'jwt': generate_jwt_token('test_user')})
+
+        responses = [self.client.post(reverse('generate-text'), self.request_data, format='json') for _ in range(3)]
+        self.assertEqual([response.status_code for response in responses], [status.HTTP_200_OK] * 2 + [status.HTTP_429_TOO_MANY_REQUESTS])
+        self.assertEqual(responses[-1]['Retry-After'], '30')
+
+        # Not by anyone else's.
+        User.objects.create_user(username='other_user', password='test_password', credits=100)
+        self.client.cookies = SimpleCookie({'jwt': generate_jwt_token('other_user')})
+        self.assertEqual(self.client.post(reverse('generate-text'), self.request_data, format='json').status_code, status.HTTP_200_OK)
+
+    @override_settings(RATE_LIMITS={})
+    @unittest.mock.patch("user_accounts.views.get_client")
+    def test_generate_concurrency_limited(self, mock_client):
+        usage = SimpleNamespace(prompt_tokens=10, completion_tokens=10, total_tokens=20)
+        mock_client.return_value.chat.completions.create.side_effect = lambda **kwargs: FakeStream([fake_chunk("The sky "), fake_chunk(usage=usage)])
+        self.client.cookies = SimpleCookie({'jwt': generate_jwt_token('test_user')})
+        self.request_data["stream"] = True
+
+        streaming = self.client.post(reverse('generate-text'), self.request_data, format='json')
+        self.assertEqual(streaming.status_code, status.HTTP_200_OK)
+
+        # Until the stream ends.
+        refused = self.client.post(reverse('generate-text'), self.request_data, format='json')
+        self.assertEqual(refused.status_code, status.HTTP_429_TOO_MANY_REQUESTS)
+        self.assertEqual(refused['Retry-After'], str(settings.CONCURRENCY_RETRY_AFTER))
+
+        b"".join(streaming.streaming_content)
+        self.assertEqual(self.client.post(reverse('generate-text'), self.request_data, format='json').status_code, status.HTTP_200_OK)
+
+    @unittest.mock.patch("user_accounts.views.get_client")
+    def test_generate_failure_releases_slot(self, mock_client):
+        mock_client.return_value.chat.completions.create.side_effect = [RuntimeError("Upstream failed."), fake_completion("The sky is blue.", 10, 10)]
+        self.client.cookies = SimpleCookie({'jwt': generate_jwt_token('test_user')})
+
+        with self.assertRaises(RuntimeError):
+            self.client.post(reverse('generate-text'), self.request_data, format='json')
+
+        self.assertEqual(self.client.post(reverse('generate-text'), self.request_data, format='json').status_code, status.HTTP_200_OK)
+
+    @unittest.mock.patch("user_accounts.views.get_async_client")
+    async def test_generate_async_limited(self, mock_client):
+        mock_client.return_value.chat.completions.create = unittest.mock.AsyncMock(return_value=fake_completion("The sky is blue because...", 10, 10))
+        self.async_client.cookies = SimpleCookie({'jwt': await sync_to_async(generate_jwt_token)('test_user')})
+
+        statuses = []
+
+        for _ in range(3):
+            response = await self.async_client.post(reverse('generate-text-async'), self.request_data, content_type='application/json')
+            statuses.append(response.status_code)
+
+        self.assertEqual(statuses, [status.HTTP_200_OK] * 2 + [status.HTTP_429_TOO_MANY_REQUESTS])
+        self.assertEqual(response['Retry-After'], '30')
+
+    async def test_async_off_event_loop(self):
+        # The backend may block, so isn't called on the event loop's thread.
+        threads = []
+        backend = unittest.mock.Mock()
+
+        for method in (backend.take, backend.acquire, backend.release):
+            method.side_effect = lambda *args: threads.append(threading.get_ident()) or 1
+
+        with unittest.mock.patch.object(ratelimit, 'get_backend', return_value=backend):
+            self.assertEqual(await ratelimit.atake('generate', 'user:1'), 1)
+            slot = await ratelimit.aacquire('generate', 'user:1')
+            await slot.arelease()
+
+        self.assertEqual(len(threads), 3)
+        self.assertNotIn(threading.get_ident(), threads)
+
+    @override_settings(RATE_LIMITS={})
+    def test_unlisted_scopes_unlimited(self):
+        self.assertEqual({self.login().status_code for _ in range(5)}, {status.HTTP_401_UNAUTHORIZED})
+
+
+class CostQuoteTest(TestCase):
+    def setUp(self):
+        encodings.register_encoding("gpt-3.5-turbo", byte_encoding())
+
+    def test_prompt_tokens(self):
+        # One token per byte, plus the chat format's boilerplate.
+        messages = [{"role": "user", "content": "Hello"}]
+        self.assertEqual(count_message_tokens(messages, "gpt-3.5-turbo"), 3 + 3 + len("user") + len("Hello"))
+
+    def test_all_messages_counted(self):
+        one = [{"role": "user", "content": "Hello"}]
+        two = one + [{"role": "assistant", "content": "Hi there"}]
+
+        self.assertEqual(
+            count_message_tokens(two, "gpt-3.5-turbo") - count_message_tokens(one, "gpt-3.5-turbo"),
+            3 + len("assistant") + len("Hi there")
+        )
+
+    def test_quote(self):
+        messages = [{"role": "user", "content": "x" * 90}]
+        quote = CostQuote(messages, 100)
+
+        self.assertEqual(quote.prompt_tokens, 100)
+        self.assertEqual(quote.max_response_tokens, 4096 - 100)
+        self.assertEqual(quote.prompt_micro_cost, 100 * 50)
+        self.assertEqual(quote.max_micro_cost, 100 * 50 + (4096 - 100) * 150)
+        self.assertTrue(quote.can_afford_max)
+        self.assertEqual(quote.max_tokens(is_scaling_output=False), 4096 - 100)
+
+        usage = SimpleNamespace(prompt_tokens=100, completion_tokens=200)
+        self.assertAlmostEqual(quote.final_cost(usage), (100 * 50 + 200 * 150) / 1000000)
+
+    def test_quote_affordable_tokens(self):
+        messages = [{"role": "user", "content": "x" * 90}]
+
+        # 0.1 credits pays for the prompt and (100000 - 5000) / 150 response tokens.
+        quote = CostQuote(messages, 0.1)
+        self.assertFalse(quote.can_afford_max)
+        self.assertEqual(quote.max_tokens(is_scaling_output=True), 633)
+
+        # Nothing is affordable once the prompt alone costs too much.
+        quote = CostQuote(messages, 0.001)
+        self.assertFalse(quote.can_afford_prompt)
+        self.assertEqual(quote.affordable_tokens, 0)
+
+    def test_token_counts_cached(self):
+        encoding = byte_encoding()
+        encodings.register_encoding("gpt-3.5-turbo", encoding)
+        messages = [{"role": "user", "content": "A prompt used twice, tokenized once."}]
+
+        with unittest.mock.patch.object(encoding, "encode", wraps=encoding.encode) as encode:
+            CostQuote(messages, 100)
+            calls = encode.call_count
+            CostQuote(messages, 100)
+
+        self.assertEqual(encode.call_count, calls)
 
 class UserCreditsViewTest(APITestCase):
     """
@@ -741,6 +3251,290 @@ class OrderFulfillmentViewTest(APITestCase):
         self.user.refresh_from_db()
         self.assertEqual(self.user.credits, 10)
 
+class CreditLedgerTest(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='test_user', password='test_password', credits=10)
+
+    def test_opening_balance(self):
+        self.assertEqual(self.user.credits, 10)
+        self.assertEqual(ledger.get_balance(self.user), 10 * 1000000)
+
+        entry = CreditEntry.objects.get(user=self.user)
+        self.assertEqual(entry.kind, CreditEntry.ADJUSTMENT)
+        self.assertEqual(entry.amount, 10 * 1000000)
+
+    def test_credit_and_debit(self):
+        ledger.credit(self.user, 5 * 1000000, reference="cs_test")
+        ledger.debit(self.user, 1)
+
+        # Micro-credit amounts are exact.
+        self.assertEqual(ledger.get_balance(self.user), 15 * 1000000 - 1)
+        self.assertEqual(CreditEntry.objects.filter(user=self.user).count(), 3)
+        self.assertEqual(ledger.unreconciled_accounts(), [])
+
+    def test_stale_user_no_lost_update(self):
+        # Two requests holding their own copy of the user, as with
+        # concurrent generations, both charging against it.
+        first = User.objects.get(pk=self.user.pk)
+        second = User.objects.get(pk=self.user.pk)
+
+        ledger.debit(first, 1000000)
+        ledger.debit(second, 2000000)
+
+        self.assertEqual(ledger.get_balance(self.user), 7 * 1000000)
+
+    def test_debit_does_not_write_user(self):
+        with CaptureQueriesContext(connection) as queries:
+            ledger.debit(self.user, 100)
+
+        self.assertFalse(any('"user_accounts_user"' in query['sql'] for query in queries))
+
+    def test_set_credits(self):
+        self.user.credits = 2.5
+        self.user.save()
+
+        self.assertEqual(self.user.credits, 2.5)
+        self.assertEqual(ledger.unreconciled_accounts(), [])
+
+    def test_compact(self):
+        old = timezone.now() - datetime.timedelta(days=100)
+
+        for _ in range(5):
+            ledger.debit(self.user, 1000000)
+        CreditEntry.objects.filter(user=self.user).update(created=old)
+
+        ledger.debit(self.user, 1000000)
+
+        removed = ledger.compact(timezone.now() - datetime.timedelta(days=90))
+
+        # The opening balance and five debits become one entry.
+        self.assertEqual(removed, 5)
+        entries = CreditEntry.objects.filter(user=self.user).order_by('created')
+        self.assertEqual([entry.kind for entry in entries], [CreditEntry.COMPACTION, CreditEntry.GENERATION])
+        self.assertEqual(entries[0].amount, 5 * 1000000)
+
+        self.assertEqual(ledger.get_balance(self.user), 4 * 1000000)
+        self.assertEqual(ledger.unreconciled_accounts(), [])
+
+class CreditHoldTest(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='test_user', password='test_password', credits=10)
+
+    def test_reserve_and_settle(self):
+        hold = ledger.reserve(self.user, 4 * 1000000)
+
+        self.assertEqual(ledger.get_balance(self.user), 10 * 1000000)
+        self.assertEqual(ledger.get_available(self.user), 6 * 1000000)
+
+        ledger.settle(hold, 1000000)
+
+        self.assertEqual(ledger.get_balance(self.user), 9 * 1000000)
+        self.assertEqual(ledger.get_available(self.user), 9 * 1000000)
+        self.assertEqual(ledger.unreconciled_accounts(), [])
+
+    def test_reserve_insufficient(self):
+        ledger.reserve(self.user, 6 * 1000000)
+
+        with self.assertRaises(ledger.InsufficientCredits):
+            ledger.reserve(self.user, 6 * 1000000)
+
+        # Smaller holds still fit.
+        ledger.reserve(self.user, 4 * 1000000)
+        self.assertEqual(ledger.get_available(self.user), 0)
+
+    def test_reserve_without_account(self):
+        user = User.objects.create_user(username='no_credits', password='test_password')
+
+        with self.assertRaises(ledger.InsufficientCredits):
+            ledger.reserve(user, 1)
+
+    def test_expired_hold_released(self):
+        hold = ledger.reserve(self.user, 6 * 1000000, ttl=60)
+        CreditHold.objects.filter(pk=hold.pk).update(expires=timezone.now() - datetime.timedelta(seconds=1))
+
+        # Freed on the next read of the user's available credits.
+        self.assertEqual(ledger.get_available(self.user), 10 * 1000000)
+        self.assertFalse(CreditHold.objects.exists())
+
+        # A late settle still charges, without releasing the hold twice.
+        ledger.settle(hold, 1000000)
+        self.assertEqual(ledger.get_available(self.user), 9 * 1000000)
+        self.assertEqual(ledger.unreconciled_accounts(), [])
+
+    def test_reserve_does_not_read(self):
+        # A conditional update and an insert, with no read (or lock) in between.
+        with CaptureQueriesContext(connection) as queries:
+            ledger.reserve(self.user, 1000000)
+
+        statements = [query['sql'].split()[0] for query in queries if 'SAVEPOINT' not in query['sql']]
+        self.assertEqual(statements, ['UPDATE', 'INSERT'])
+
+class QueryPlanChecks:
+    """
+    Runs each query the endpoints make through the database's EXPLAIN,
+    and fails if any of them scans a whole table, or if the indexes
+    they're meant to use aren't used. Subclasses read the plans.
+    """
+    def setUp(self):
+        encodings.register_encoding("gpt-3.5-turbo", byte_encoding())
+
+        for i in range(5):
+            username = f'user_{i}'
+            user = User.objects.create_user(username=username, email=f'{username}@example.com', password='test_password', credits=10)
+            Prompt.objects.create(user=user, name=f'Prompt {i}', prompt='Summarize this.')
+
+            for j in range(20):
+                EditorFile.objects.create(author=user, title=f'Document {j}', body=[{"text": "Lorem Ipsum"}])
+
+        self.username = 'user_0'
+        self.user = User.objects.get(username=self.username)
+        self.doc = EditorFile.objects.filter(author__username=self.username).first()
+        self.prompt = Prompt.objects.get(user=self.user)
+        self.client.cookies = SimpleCookie({'jwt': generate_jwt_token(self.username)})
+
+    def explain(self, sql):
+        """
+        The tables the query scans whole, the indexes it uses, and its
+        plan, as text.
+        """
+        raise NotImplementedError
+
+    def assertNoTableScans(self, queries, indexes=()):
+        tables = set(connection.introspection.table_names())
+        used = set()
+
+        for query in queries:
+            sql = query['sql']
+
+            if not sql.startswith(('SELECT', 'UPDATE', 'DELETE')):
+                continue
+
+            scanned, query_indexes, plan = self.explain(sql)
+            used |= query_indexes
+
+            # Not scans of subqueries, e.g. of window functions.
+            self.assertEqual(scanned & tables, set(), f"Table scan in:\n{sql}\n{plan}")
+
+        self.assertLessEqual(set(indexes), used)
+
+    def test_docs_queries(self):
+        with CaptureQueriesContext(connection) as queries:
+            self.client.get(reverse('create-view-docs'))
+            response = self.client.get(reverse('create-view-docs'), {'view': 'summary', 'limit': 3})
+            self.client.get(reverse('create-view-docs'), {'view': 'summary', 'limit': 3, 'cursor': response.data['next']})
+            self.client.get(reverse('edit-doc', kwargs={'pk': self.doc.uid}))
+            self.client.put(reverse('edit-doc', kwargs={'pk': self.doc.uid}), {'doc': {'title': 'Renamed'}}, format='json')
+            self.client.delete(reverse('edit-doc', kwargs={'pk': self.doc.uid}))
+
+        self.assertNoTableScans(queries, ['editorfile_author_created_idx'])
+
+    @override_settings(DOC_CHUNK_THRESHOLD=100)
+    def test_chunked_doc_queries(self):
+        doc = EditorFile.objects.create(author=self.user, title='Large', body=[{"text": str(i)} for i in range(300)])
+        url = reverse('edit-doc', kwargs={'pk': doc.uid})
+
+        with CaptureQueriesContext(connection) as queries:
+            self.client.get(reverse('create-view-docs'))
+            self.client.get(url, {'blocks': '100-150'})
+            self.client.patch(url, {'doc': {'ops': [{"op": "insert", "index": 0, "block": {}}] * 100, 'version': 1}}, format='json')
+            self.client.put(url, {'doc': {'body': []}}, format='json')
+
+        self.assertNoTableScans(queries, ['editorfilechunk_file_pos_idx'])
+
+    def test_revision_queries(self):
+        doc = EditorFile.objects.create(author=self.user, title='Revised', body=[{"text": "One"}])
+
+        with CaptureQueriesContext(connection) as queries:
+            self.client.put(reverse('edit-doc', kwargs={'pk': doc.uid}), {'doc': {'body': [{"text": "Two"}]}}, format='json')
+            self.client.get(reverse('doc-revisions', kwargs={'pk': doc.uid}), {'before': 2})
+            self.client.get(reverse('doc-revision', kwargs={'pk': doc.uid, 'version': 2}))
+            self.client.post(reverse('restore-doc-revision', kwargs={'pk': doc.uid, 'version': 1}), format='json')
+
+        self.assertNoTableScans(queries)
+
+    def test_search_queries(self):
+        EditorFile.objects.create(author=self.user, title='Searched', body=[{"text": "Needle in a haystack"}])
+
+        with CaptureQueriesContext(connection) as queries:
+            self.client.get(reverse('search-docs'), {'q': 'needle haystack'})
+
+        self.assertNoTableScans(queries)
+
+    def test_related_queries(self):
+        doc = EditorFile.objects.create(author=self.user, title='Related', body=[{"text": "Needle in a haystack"}])
+
+        with CaptureQueriesContext(connection) as queries:
+            self.client.get(reverse('related-docs', kwargs={'pk': doc.pk}))
+
+        self.assertNoTableScans(queries)
+
+    def test_account_queries(self):
+        with CaptureQueriesContext(connection) as queries:
+            self.client.post(reverse('login'), {'username': self.username, 'password': 'test_password'})
+
+            uid = urlsafe_base64_encode(force_bytes('USER_1@example.com'))
+            response = self.client.post(reverse('register-account', kwargs={'pk': uid}), {'username': 'new_user', 'password': 'test_password'})
+            self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+            self.client.post(reverse('reset', kwargs={'pk': encode_password_reset_uid('user_2@example.com')}), {'password': 'new_password'})
+
+        self.assertNoTableScans(queries, ['user_email_lower_idx'])
+
+    @unittest.mock.patch("user_accounts.views.get_client")
+    def test_generation_queries(self, mock_client):
+        mock_client.return_value.chat.completions.create.return_value = fake_completion("Answer", 10, 10)
+
+        with CaptureQueriesContext(connection) as queries:
+            self.client.get(reverse('prompts'))
+            self.client.get(reverse('prompts-detail', kwargs={'pk': self.prompt.uid}))
+            self.client.get(reverse('credits'))
+
+            response = self.client.post(reverse('generate-text'), {"prompt": {"name": "Test", "messages": [{"role": "user", "content": "Hello"}]}}, format='json')
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+        self.assertNoTableScans(queries)
+
+@unittest.skipUnless(connection.vendor == 'sqlite', "Reads SQLite query plans.")
+class QueryPlanTest(QueryPlanChecks, APITestCase):
+    def explain(self, sql):
+        with connection.cursor() as cursor:
+            cursor.execute('EXPLAIN QUERY PLAN ' + sql)
+            plan = [row[-1] for row in cursor.fetchall()]
+
+        scanned = {step.split()[1] for step in plan if step.startswith('SCAN ')}
+        indexes = {match[1] for step in plan for match in [re.search(r'USING (?:COVERING )?INDEX (\w+)', step)] if match}
+        return scanned, indexes, "\n".join(plan)
+
+@unittest.skipUnless(connection.vendor == 'postgresql', "Reads PostgreSQL query plans.")
+class PostgreSQLQueryPlanTest(QueryPlanChecks, APITestCase):
+    """
+    QueryPlanTest, on PostgreSQL. Sequential scans are turned off, as the
+    planner rightly prefers them on tables this small; one left in a plan
+    means no index could be used.
+    """
+    def explain(self, sql):
+        with connection.cursor() as cursor:
+            cursor.execute('SET LOCAL enable_seqscan = off')
+            cursor.execute('EXPLAIN (FORMAT JSON) ' + sql)
+            plan = cursor.fetchone()[0]
+
+        if isinstance(plan, str):
+            plan = json.loads(plan)
+
+        scanned, indexes, nodes = set(), set(), [plan[0]['Plan']]
+
+        while nodes:
+            node = nodes.pop()
+            nodes.extend(node.get('Plans', []))
+
+            if node['Node Type'] == 'Seq Scan':
+                scanned.add(node['Relation Name'])
+
+            if 'Index Name' in node:
+                indexes.add(node['Index Name'])
+
+        return scanned, indexes, json.dumps(plan, indent=2)
+
 class CreditsSessionIDViewTest(APITestCase):
 
     def setUp(self):
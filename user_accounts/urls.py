@@ -1,5 +1,5 @@
 from django.urls import path
-from .views import RegistrationEmailView, UserRegistrationView, UserLoginView, UserLogoutView, UserForgotView, UserResetPasswordView, DocsCreateRetrieveView, DocRetrieveUpdateDestroyView, PromptView, PromptDetailView, GenerateTextView, UserCreditsView, OrderFulfillmentWebhookView, CreditsSessionIDView
+from .views import RegistrationEmailView, UserRegistrationView, UserLoginView, UserLogoutView, UserRefreshView, UserForgotView, UserResetPasswordView, DocsCreateRetrieveView, DocsBatchView, DocsExportView, DocsImportView, SearchDocsView, DocRetrieveUpdateDestroyView, DocRevisionsView, DocRevisionView, DocRevisionRestoreView, RelatedDocsView, PromptView, PromptDetailView, GenerateTextView, AsyncGenerateTextView, UserCreditsView, OrderFulfillmentWebhookView, CreditsSessionIDView
 
 # Endpoints given in 
 # https://github.com/dan-smith-tech/conduit/blob/main/docs/api.md
@@ -14,6 +14,7 @@ urlpatterns = [
     path('auth/register/<str:pk>', UserRegistrationView.as_view(), name='register-account'),
     path('auth/login', UserLoginView.as_view(), name='login'),
     path('auth/logout', UserLogoutView.as_view(), name='logout'),
+    path('auth/refresh', UserRefreshView.as_view(), name='refresh'),
     path('auth/forgot', UserForgotView.as_view(), name='forgot'),
     path('auth/forgot/<str:pk>', UserResetPasswordView.as_view(), name='reset'),
 
@@ -21,7 +22,15 @@ urlpatterns = [
     # Document controller URLs #
     ############################
     path('store/docs', DocsCreateRetrieveView.as_view(), name='create-view-docs'),
+    path('store/docs/batch', DocsBatchView.as_view(), name='batch-docs'),
+    path('store/docs/export', DocsExportView.as_view(), name='export-docs'),
+    path('store/docs/import', DocsImportView.as_view(), name='import-docs'),
+    path('store/docs/search', SearchDocsView.as_view(), name='search-docs'),
     path('store/docs/<str:pk>', DocRetrieveUpdateDestroyView.as_view(), name='edit-doc'),
+    path('store/docs/<str:pk>/revisions', DocRevisionsView.as_view(), name='doc-revisions'),
+    path('store/docs/<str:pk>/revisions/<int:version>', DocRevisionView.as_view(), name='doc-revision'),
+    path('store/docs/<str:pk>/revisions/<int:version>/restore', DocRevisionRestoreView.as_view(), name='restore-doc-revision'),
+    path('store/docs/<str:pk>/related', RelatedDocsView.as_view(), name='related-docs'),
     
     #################
     # AI controller #
@@ -29,6 +38,7 @@ urlpatterns = [
     path('prompts', PromptView.as_view(), name='prompts'), 
     path('prompts/<str:pk>', PromptDetailView.as_view(), name='prompts-detail'), 
     path('generate/text', GenerateTextView.as_view(), name='generate-text'), 
+    path('generate/text/async', AsyncGenerateTextView.as_view(), name='generate-text-async'), 
 
     ############
     # Payments #
@@ -0,0 +1,227 @@
+"""
+In-memory indexes of a user's document vectors (see embeddings.py).
+
+Each index holds a user's vectors in one float16 array. Small ones are
+searched by brute force: every vector is scored against the query.
+Those of at least LSH_THRESHOLD vectors also keep random-hyperplane LSH
+tables: each vector is hashed, in each table, by which side of some
+random hyperplanes it falls, and only vectors sharing a bucket with the query
+in some table are scored. That is approximate, but scores a few hundred
+vectors rather than every one.
+
+Indexes are kept per process, for the most recently searched users, and
+brought up to date with the vectors stored since they were built. Each
+is shared by the process's threads, so is only read and changed holding
+its lock.
+"""
+
+import math
+import threading
+
+import numpy as np
+
+from . import embeddings
+from .cache import LRUCache
+
+# Vectors from which indexes also keep LSH tables.
+LSH_THRESHOLD = 10000
+
+LSH_TABLES = 16
+
+# Vectors per bucket aimed for, which sets the number of hyperplanes.
+LSH_BUCKET_SIZE = 64
+
+# Users' indexes kept per process.
+CACHED_INDEXES = 32
+
+# Rows scored at a time, to bound the float32 copy of the array.
+SCORE_BATCH = 8192
+
+# The same hyperplanes in every process, so tables can be rebuilt alike.
+HYPERPLANE_SEED = 18
+
+
+def grow(array):
+    """
+    A copy of an array with as many rows again, zeroed, or one if it has none.
+    """
+    grown = np.zeros((max(1, 2 * len(array)), *array.shape[1:]), dtype=array.dtype)
+    grown[:len(array)] = array
+    return grown
+
+
+class VectorIndex:
+    """
+    Vectors for a set of keys, searchable by cosine similarity, with the
+    latest sequence (see EditorFileVector.sequence) of those it holds.
+    """
+
+    def __init__(self, keys=(), vectors=(), sequence=0):
+        self.lock = threading.Lock()
+        self.sequence = sequence
+        self.keys = list(keys)
+        self.rows = {key: row for row, key in enumerate(self.keys)}
+        # Rows past the last key are spare, so adding keys one at a time
+        # copies the array only as often as it doubles.
+        self.array = np.array(vectors, dtype=embeddings.DTYPE).reshape(len(self.keys), embeddings.DIMENSIONS)
+        self.build_tables()
+
+    def __len__(self):
+        return len(self.rows)
+
+    @property
+    def vectors(self):
+        return self.array[:len(self.keys)]
+
+    def catch_up(self, rows):
+        """
+        Add or replace vectors from [(key, vector, sequence)] stored since
+        the index was built, less any it already holds, as another thread
+        may have caught up further meanwhile.
+        """
+        with self.lock:
+            for key, vector, sequence in rows:
+                if sequence > self.sequence:
+                    self.set_row(key, vector)
+
+            self.sequence = max([self.sequence, *(sequence for key, vector, sequence in rows)])
+
+    def set(self, key, vector):
+        """
+        Add or replace the vector for a key.
+        """
+        with self.lock:
+            self.set_row(key, vector)
+
+    def set_row(self, key, vector):
+        row = self.rows.get(key)
+
+        if row is None:
+            row = len(self.keys)
+
+            if row == len(self.array):
+                self.array = grow(self.array)
+
+            self.keys.append(key)
+            self.rows[key] = row
+        elif self.tables is not None:
+            self.unhash(row)
+
+        self.vectors[row] = vector
+
+        if self.tables is None:
+            self.build_tables()
+        else:
+            self.hash(row)
+
+    def remove(self, key):
+        """
+        Remove a key's vector. Its row is zeroed and left unused, rather
+        than the rest moved up.
+        """
+        with self.lock:
+            row = self.rows.pop(key, None)
+
+            if row is None:
+                return
+
+            if self.tables is not None:
+                self.unhash(row)
+
+            self.vectors[row] = 0
+            self.keys[row] = None
+
+    def get(self, key):
+        with self.lock:
+            row = self.rows.get(key)
+            return None if row is None else self.vectors[row].astype(np.float32)
+
+    def nearest(self, vector, limit, exclude=()):
+        """
+        [(key, similarity)] of up to limit keys nearest the vector, best
+        first, less those in exclude. Approximate, if the index keeps LSH tables.
+        """
+        vector = np.asarray(vector, dtype=np.float32)
+
+        with self.lock:
+            if self.tables is None:
+                rows = np.arange(len(self.keys))
+            else:
+                rows = self.candidates(vector)
+
+            excluded = [self.rows[key] for key in exclude if key in self.rows]
+            rows = np.setdiff1d(rows, excluded) if excluded else rows
+
+            if not len(rows) or limit < 1:
+                return []
+
+            scores = np.concatenate([
+                self.vectors[rows[i:i + SCORE_BATCH]].astype(np.float32) @ vector
+                for i in range(0, len(rows), SCORE_BATCH)
+            ])
+
+            best = np.argpartition(-scores, min(limit, len(scores)) - 1)[:limit]
+            best = best[np.argsort(-scores[best], kind="stable")]
+
+            # Less the rows of removed keys.
+            return [(self.keys[rows[i]], float(scores[i])) for i in best if self.keys[rows[i]] is not None]
+
+    def build_tables(self):
+        if len(self.keys) < LSH_THRESHOLD:
+            self.tables = None
+            return
+
+        self.bits = max(1, round(math.log2(len(self.keys) / LSH_BUCKET_SIZE)))
+        rng = np.random.default_rng(HYPERPLANE_SEED)
+        self.hyperplanes = rng.standard_normal((LSH_TABLES * self.bits, embeddings.DIMENSIONS)).astype(np.float32)
+        self.powers = 1 << np.arange(self.bits)
+
+        # Vectors mostly point the same way (documents share common words),
+        # so are hashed relative to their mean, or most fall in few buckets.
+        self.center = self.vectors.mean(axis=0, dtype=np.float32)
+
+        self.hashes = np.concatenate([
+            self.bucket_keys(self.vectors[i:i + SCORE_BATCH])
+            for i in range(0, len(self.keys), SCORE_BATCH)
+        ])
+        self.tables = []
+
+        for column in self.hashes.T:
+            order = np.argsort(column, kind="stable")
+            buckets, starts = np.unique(column[order], return_index=True)
+            self.tables.append({int(bucket): set(rows.tolist()) for bucket, rows in zip(buckets, np.split(order, starts[1:]))})
+
+    def bucket_keys(self, vectors):
+        """
+        The buckets of a vector, or of each of an array of them, in each table.
+        """
+        sides = (np.asarray(vectors, dtype=np.float32) - self.center) @ self.hyperplanes.T > 0
+        return sides.reshape(*sides.shape[:-1], LSH_TABLES, self.bits) @ self.powers
+
+    def hash(self, row):
+        if row == len(self.hashes):
+            self.hashes = grow(self.hashes)
+
+        self.hashes[row] = self.bucket_keys(self.vectors[row])
+
+        for table, bucket in zip(self.tables, self.hashes[row]):
+            table.setdefault(int(bucket), set()).add(row)
+
+    def unhash(self, row):
+        for table, bucket in zip(self.tables, self.hashes[row]):
+            table[int(bucket)].discard(row)
+
+    def candidates(self, vector):
+        """
+        Rows sharing a bucket with the vector in any table.
+        """
+        rows = set()
+
+        for table, bucket in zip(self.tables, self.bucket_keys(vector)):
+            rows.update(table.get(int(bucket), ()))
+
+        return np.fromiter(rows, dtype=np.int64, count=len(rows))
+
+
+# The most recently used users' indexes, by user pk.
+indexes = LRUCache(maxsize=CACHED_INDEXES)
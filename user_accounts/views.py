@@ -1,40 +1,53 @@
-from rest_framework import generics, status
+from rest_framework import generics, serializers, status
 from rest_framework.views import APIView
 from rest_framework.response import Response
 from rest_framework.parsers import MultiPartParser, FormParser, JSONParser
-from rest_framework.permissions import IsAuthenticated
-from rest_framework.exceptions import PermissionDenied, AuthenticationFailed, NotFound
+from rest_framework.exceptions import PermissionDenied, AuthenticationFailed, NotFound, Throttled
 from rest_framework.decorators import api_view
 
+from django.conf import settings
+from django.core.handlers.asgi import ASGIRequest
 from django.core.validators import validate_email
 from django.core.exceptions import ValidationError
+from django.db import transaction
+from django.db.models import Count, Max
+from django.db.models.functions import Lower
 from django.http import JsonResponse
 from django.urls import reverse
+from django.utils import timezone
+from django.utils.cache import get_conditional_response
+from django.utils.dateparse import parse_datetime
 from django.utils.encoding import force_bytes, force_str
-from django.utils.http import urlsafe_base64_encode, urlsafe_base64_decode
+from django.utils.http import http_date, urlsafe_base64_encode, urlsafe_base64_decode
 from django.contrib.auth import authenticate
+from django.utils.decorators import method_decorator
+from django.views import View
+from asgiref.sync import sync_to_async
 
-from .models import User, EditorFile, Prompt
+from .models import User, EditorFile, EditorFileRevision, Prompt
+from .authentication import REFRESH_COOKIE_NAME, IsAuthenticated, IsAuthenticatedWithError, end_all_sessions, end_session, generate_jwt_token, get_user, refresh_session, set_session_cookies, start_session
+from . import chunks, documents, hashing, ledger, ratelimit, search
 
-from .serializers import UserAuthSerializer, FileCreateSerializer, FilePatchSerializer, FileListSerializer, PromptSerializer
+from .serializers import UserAuthSerializer, FileCreateSerializer, FilePatchSerializer, FileListSerializer, FileSummarySerializer, PromptSerializer
+from .patching import PatchError, apply_block_ops
+from .hashing import HasherBusy
+from .ratelimit import TokenBucketThrottle
+from .generation import Generation, GenerationError, StreamTally, get_client, get_async_client, sse_event
 
-from django.http import JsonResponse
+from django.http import JsonResponse, StreamingHttpResponse
 from django.views.decorators.csrf import csrf_exempt
 import json
-import jwt
-from jwt.exceptions import DecodeError
 import datetime
+import math
+import uuid
 
 import os
 import requests
 from dotenv import load_dotenv
 
-from openai import OpenAI
-import tiktoken
+from openai import APIError
 import stripe
 
-from math import floor, ceil
-
 import logging
 # To use:
 # logger = logging.getLogger('defaultlogger')
@@ -74,70 +87,15 @@ def is_valid_email(email):
     except ValidationError:
         return False
     
+# Find the user with an email address, ignoring case.
+def get_user_by_email(email):
+    # Matches the expression of the user_email_lower_idx index, so this is an index lookup.
+    return User.objects.alias(email_lower=Lower('email')).filter(email_lower=email.lower()).first()
+
 # Check if a user with the provided email already exists.
 def is_existing_email(email):
-    return User.objects.filter(email=email).first()
-
-
-# TODO: Set key securely.
-key = "TODO_CHANGEME_KEY"
-
-def generate_jwt_token(username, expiry_length=datetime.timedelta(seconds=3600)):
-
-    return jwt.encode({"username": username, "exp": datetime.datetime.now(tz=datetime.timezone.utc) + expiry_length}, key, algorithm="HS256")
-
-def encode_jwt_token(response, username, expiry_length=datetime.timedelta(seconds=3600)):
+    return get_user_by_email(email)
 
-    # Generate JWT token
-    encoded_jwt = jwt.encode({"username": username, "exp": datetime.datetime.now(tz=datetime.timezone.utc) + expiry_length}, key, algorithm="HS256")
-
-    # Set JWT token as a cookie
-    response.set_cookie(
-        key='jwt', 
-        value=str(encoded_jwt), 
-        httponly=True, 
-        samesite='None', 
-        domain='.conduits.link', 
-        secure=True, 
-        path="/"
-    )
-
-    return response
-
-def decode_jwt_token(request):
-    """
-    Decode the JWT token in the request.
-
-    Args:
-        request: The request object.
-
-    Returns:
-        Username if the token is valid, None otherwise.
-    """
-
-    token = request.COOKIES.get('jwt')
-
-    if token is None:
-        return None
-
-    try:
-        decoded_token = jwt.decode(token, key, algorithms=["HS256"])
-        return decoded_token.get('username')
-    
-    except DecodeError:
-        return None
-    
-def get_user_from_jwt(request):
-    """
-    Returns the User object corresponding to the JWT, if it exists,
-    or None otherwise.
-    """
-    username = decode_jwt_token(request)
-
-    # Get user, or return None if it doesn't exist.
-    return User.objects.filter(username=username).first()
-
-    
 
 def login(request, success_message, success_status):
     """
@@ -149,21 +107,63 @@ def login(request, success_message, success_status):
 
     username = serializer.validated_data['username']
 
-    # Authenticate user
-    user = authenticate(request, username=username,
-                        password=serializer.validated_data['password'])
+    # Authenticate user, hashing in the pool (see hashing.py).
+    try:
+        user = authenticate(request, username=username,
+                            password=serializer.validated_data['password'])
+    except HasherBusy:
+        return hasher_busy()
 
     if user is not None:
 
         response_data = {'detail': success_message}
         response = Response(response_data, status=success_status)
 
-        return encode_jwt_token(response, username)
+        return start_session(response, username, user.pk)
 
     else:
         return Response({"detail": "Invalid credentials."}, status=status.HTTP_401_UNAUTHORIZED)
 
+def hasher_busy():
+    """
+    The response when too many passwords are being hashed to take another.
+    """
+    return Response({"detail": "Too many logins in progress. Please try again shortly."},
+                    status=status.HTTP_503_SERVICE_UNAVAILABLE,
+                    headers={'Retry-After': str(settings.PASSWORD_HASHER_RETRY_AFTER)})
+
+def streaming_content(request, content):
+    """
+    The content of a StreamingHttpResponse, from a sync iterator.
+
+    Under ASGI (see Procfile), Django reads a sync iterator to the end
+    before sending any of it, so there it's read an item at a time in a
+    thread instead, and each sent as it comes.
+    """
+    if isinstance(getattr(request, '_request', request), ASGIRequest):
+        return iterate_in_thread(content)
+
+    return content
+
+async def iterate_in_thread(iterator):
+    """
+    An async iterator over a sync one, each step run by sync_to_async.
+    Closes it (charging for a disconnected stream, say) when closed.
+    """
+    iterator = iter(iterator)
+    end = object()
+
+    try:
+        while (item := await sync_to_async(next)(iterator, end)) is not end:
+            yield item
+    finally:
+        if hasattr(iterator, 'close'):
+            await sync_to_async(iterator.close)()
+
 class RegistrationEmailView(APIView):
+    throttle_classes = [TokenBucketThrottle]
+    throttle_scope = 'register'
+
     def post(self, request):
         email = request.data.get('email')
 
@@ -190,6 +190,9 @@ class RegistrationEmailView(APIView):
         return Response({'error': 'Invalid request method'}, status=status.HTTP_405_METHOD_NOT_ALLOWED)
     
 class UserRegistrationView(APIView):
+    throttle_classes = [TokenBucketThrottle]
+    throttle_scope = 'register'
+
     def post(self, request, pk):
         # Decode the UID to get the email address
         email = force_str(urlsafe_base64_decode(pk))
@@ -204,41 +207,58 @@ class UserRegistrationView(APIView):
         serializer = UserAuthSerializer(data=request.data)
         serializer.is_valid(raise_exception=True)
 
+        try:
+            password = hashing.make_password(serializer.validated_data['password'])
+        except HasherBusy:
+            return hasher_busy()
+
         # Create a new user
-        User.objects.create_user(username=serializer.validated_data['username'],
-                                        email=email,
-                                        password=serializer.validated_data['password'])
-        # Login to the account
-        return login(request, "Account created successfully. You have been logged in.", status.HTTP_201_CREATED)
+        user = User.objects.create_user(username=serializer.validated_data['username'],
+                                        email=email)
+        user.password = password
+        user.save(update_fields=['password'])
+
+        # Login to the account, without hashing the password again.
+        response = Response({'detail': "Account created successfully. You have been logged in."}, status=status.HTTP_201_CREATED)
+        return start_session(response, user.username, user.pk)
     
 
 class UserLoginView(APIView):
+    throttle_classes = [TokenBucketThrottle]
+    throttle_scope = 'login'
+
     def post(self, request):
         return login(request, "Login successful.", status.HTTP_200_OK)
     
 class UserLogoutView(APIView):
+    permission_classes = [IsAuthenticated]
+
     def get(self, request):
+        response = Response({"detail": "You have been logged out."}, status=status.HTTP_200_OK)
+        return end_session(request, response)
 
-        user = decode_jwt_token(request)
 
-        if user is None:
-            # Token authentication failed
-            return Response(status=status.HTTP_401_UNAUTHORIZED)
-        
-        response = Response({"detail": "You have been logged out."}, status=status.HTTP_200_OK)
+class UserRefreshView(APIView):
+    """
+    Handles requests for auth/refresh.
+    POST: Renew the session with the refresh cookie set on logging in.
+    """
+
+    def post(self, request):
+        """
+        Exchange the refresh cookie for a new access token and refresh
+        token, as cookies, without the password. TokenRefreshMiddleware
+        does the same for any request once the access token has expired;
+        this is for clients which would rather renew it up front.
+        """
+        secret = request.COOKIES.get(REFRESH_COOKIE_NAME)
+        session = refresh_session(secret) if secret else None
 
-        # Set JWT token as a cookie
-        response.set_cookie(
-            key='jwt', 
-            value='', 
-            httponly=True, 
-            samesite='None', 
-            domain='.conduits.link', 
-            secure=True, 
-            path="/"
-        )
+        if session is None:
+            return Response(status=status.HTTP_401_UNAUTHORIZED)
 
-        return response
+        response = Response({"detail": "Session refreshed."}, status=status.HTTP_200_OK)
+        return set_session_cookies(response, *session)
 
 
 def encode_password_reset_uid(email):
@@ -255,7 +275,9 @@ def decode_password_reset_uid(uid):
     return force_str(urlsafe_base64_decode(uid)).split('|')
 
 class UserForgotView(APIView):
-    
+    throttle_classes = [TokenBucketThrottle]
+    throttle_scope = 'forgot'
+
     def post(self, request):
         email = request.data.get('email')
 
@@ -278,6 +300,9 @@ class UserForgotView(APIView):
         return Response({"detail": "If email was valid, reset password link has been sent."}, status=status.HTTP_200_OK)
          
 class UserResetPasswordView(APIView):
+    throttle_classes = [TokenBucketThrottle]
+    throttle_scope = 'forgot'
+
     def post(self, request, pk):
 
         email, date = decode_password_reset_uid(pk)
@@ -291,11 +316,18 @@ class UserResetPasswordView(APIView):
         if date < str(datetime.datetime.now() - datetime.timedelta(days=1)):
             return Response({'detail': 'Sorry, this link has expired.'}, status=status.HTTP_410_GONE)
 
-        user = User.objects.get(email=email)
+        user = get_user_by_email(email)
+
+        try:
+            hashing.set_password(user, request.data["password"])
+        except HasherBusy:
+            return hasher_busy()
 
-        user.set_password(request.data["password"])
         user.save()
 
+        # Log them out everywhere.
+        end_all_sessions(user.pk)
+
         return Response(status=status.HTTP_200_OK)
         
 
@@ -305,6 +337,8 @@ class DocsCreateRetrieveView(generics.CreateAPIView, generics.RetrieveAPIView):
     GET: Retrieve all docs for the authenticated user.
     POST: Create a new document for the authenticated user.
     """
+
+    permission_classes = [IsAuthenticatedWithError]
     queryset = EditorFile.objects.all()
     parser_classes = (MultiPartParser, FormParser, JSONParser)
 
@@ -325,45 +359,94 @@ class DocsCreateRetrieveView(generics.CreateAPIView, generics.RetrieveAPIView):
         Retrieve the queryset for the currently authenticated user's documents.
         """
         # Filter documents based on the currently authenticated user
-        return EditorFile.objects.filter(author=self.request.user)
+        return EditorFile.objects.filter(author_id=self.request.user.pk)
 
     def get(self, request, *args, **kwargs):
         """
         Handle GET requests to retrieve documents for the currently authenticated user.
-        """
 
-        user = decode_jwt_token(request)
+        Query parameters (all optional):
+            view=summary: previews and size stats instead of bodies.
+            fields=a,b,...: only these fields of each document.
+            limit=n: return n documents, with a "next" cursor for the rest.
+            cursor=...: continue from a previous page's "next" cursor.
+        """
 
-        if user is None:
-            # Token authentication failed
-            return Response(status=status.HTTP_401_UNAUTHORIZED)
+        user = request.user
         
-        # Retrieve the queryset for the currently authenticated user's documents
-        queryset = EditorFile.objects.filter(author=user)
+        # Bodies are left out of summaries.
+        serializer_class = FileSummarySerializer if request.query_params.get('view') == 'summary' else FileListSerializer
+        available = serializer_class.Meta.fields
+
+        fields = request.query_params.get('fields')
+
+        if fields is None:
+            fields = list(available)
+        else:
+            fields = [field for field in fields.split(',') if field]
+            unknown = set(fields) - set(available)
+
+            if unknown:
+                return Response({"error": f"Unknown fields: {', '.join(sorted(unknown))}."}, status=status.HTTP_400_BAD_REQUEST)
+
+        # Retrieve the queryset for the currently authenticated user's documents,
+        # loading only the requested columns (and those the cursor needs).
+        queryset = EditorFile.objects.filter(author_id=user.pk).only('uid', 'created', *fields)
+
+        # Any change to the user's docs changes the latest modified time or
+        # the count, so an unchanged listing is answered from these alone.
+        # There's no Last-Modified, as deletions don't change the latest time.
+        latest = queryset.aggregate(latest=Max('modified'), count=Count('uid'))
+        etag = documents.listing_etag(user.pk, latest['latest'], latest['count'], request.GET.urlencode())
+
+        response = not_modified(request, etag)
+
+        if response is not None:
+            return response
+
+        if 'limit' not in request.query_params:
+            # Unpaginated, as before.
+            docs = list(queryset.order_by('-created', '-uid'))
+
+            if 'body' in fields:
+                # The bodies of any large docs, together.
+                EditorFile.read_bodies(docs)
+
+            serializer = serializer_class(docs, many=True, fields=fields)
+            return Response({"docs": serializer.data}, headers={'ETag': etag})
+
+        try:
+            limit = int(request.query_params['limit'])
+        except ValueError:
+            limit = 0
 
-        # Serialize the queryset
-        serializer = FileListSerializer(queryset, many=True)
+        if not 1 <= limit <= documents.MAX_PAGE_SIZE:
+            return Response({"error": f"limit must be between 1 and {documents.MAX_PAGE_SIZE}."}, status=status.HTTP_400_BAD_REQUEST)
+
+        try:
+            docs, cursor = documents.page(queryset, limit, request.query_params.get('cursor'))
+        except ValueError as e:
+            return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+
+        if 'body' in fields:
+            EditorFile.read_bodies(docs)
+
+        serializer = serializer_class(docs, many=True, fields=fields)
 
         # Return the serialized data in the desired format
-        return Response({"docs": serializer.data})
+        return Response({"docs": serializer.data, "next": cursor}, headers={'ETag': etag})
 
     def post(self, request, *args, **kwargs):
         """
         Handle POST requests to create a new document for the currently authenticated user.
         """
-        # Decode JWT token
-        username = decode_jwt_token(request)
-        
-        if username is None:
-            # Token authentication failed
-            return Response({"error": "Unauthorized"}, status=status.HTTP_401_UNAUTHORIZED)
+        user = request.user
         
         doc_data = request.data['doc']
 
         now = str(datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S'))
 
         creation_data = {
-                'author': username,
                 'title': doc_data['title'],
                 'body': doc_data['body'],
                 'created': now,
@@ -372,116 +455,721 @@ class DocsCreateRetrieveView(generics.CreateAPIView, generics.RetrieveAPIView):
 
         serializer = self.get_serializer(data=creation_data)
         serializer.is_valid(raise_exception=True)
-        serializer.save()
+        serializer.save(author=user)
 
         # Construct the response in the specified format
         response_data = {
             "doc": {
                 "uid": str(serializer.instance.uid),
                 "created": now,
-                "modified": now
+                "modified": now,
+                "version": serializer.instance.version
             }
         }
         return Response(response_data, status=201)
 
 
+class DocsBatchView(APIView):
+    """
+    Handles requests for store/docs/batch.
+    POST: Create, update and delete many of the authenticated user's docs at once.
+    """
+
+    permission_classes = [IsAuthenticated]
+
+    def post(self, request, *args, **kwargs):
+        """
+        Apply a batch of operations to the user's docs, in one transaction
+        and a few queries for all of them.
+
+        Format:
+
+        "ops": [
+            {"op": "create", "doc": {"title": ..., "body": ...}},
+            {"op": "update", "uid": ..., "doc": {"title": ..., "body": ..., "version": ...}},
+            {"op": "delete", "uid": ..., "version": ...},
+            ...
+        ]
+
+        Versions are optional, and as for PUT: given, the doc is only
+        changed if still at that version. Returns "results", one for each
+        operation, in order, each with the "status" a request for it alone
+        would have had, and its "doc" or "error". Operations which fail
+        don't stop the rest being made.
+        """
+        user = request.user
+
+        ops = request.data.get('ops')
+
+        if not isinstance(ops, list) or not 1 <= len(ops) <= documents.MAX_BATCH_SIZE:
+            return Response({"error": f"ops must be a list of 1 to {documents.MAX_BATCH_SIZE} operations."}, status=status.HTTP_400_BAD_REQUEST)
+
+        results = [None] * len(ops)
+        creates, updates, deletes = {}, {}, {}
+        create_serializer, patch_serializer = FileCreateSerializer(), FilePatchSerializer(partial=True)
+        now = timezone.now()
+
+        def fail(index, status_code, error):
+            results[index] = {"status": status_code, "error": error}
+
+        for index, op in enumerate(ops):
+            kind = op.get('op') if isinstance(op, dict) else None
+
+            if kind not in ('create', 'update', 'delete'):
+                fail(index, status.HTTP_400_BAD_REQUEST, "op must be create, update or delete.")
+                continue
+
+            doc_data = op.get('doc', {})
+
+            if not isinstance(doc_data, dict):
+                fail(index, status.HTTP_400_BAD_REQUEST, "No doc provided.")
+                continue
+
+            version = op.get('version') if kind == 'delete' else doc_data.get('version')
+
+            if kind != 'create' and version is not None and not is_version(version):
+                fail(index, status.HTTP_400_BAD_REQUEST, "version must be a positive integer.")
+                continue
+
+            try:
+                if kind == 'create':
+                    changes = create_serializer.run_validation({'title': doc_data.get('title'), 'body': doc_data.get('body')})
+                elif kind == 'update':
+                    changes = patch_serializer.run_validation({key: value for key, value in doc_data.items() if key != 'version'})
+            except serializers.ValidationError:
+                fail(index, status.HTTP_400_BAD_REQUEST, "The client did not provide the correct data, and the doc was not updated.")
+                continue
+
+            if kind == 'create':
+                creates[index] = changes
+                continue
+
+            try:
+                pk = uuid.UUID(str(op.get('uid')))
+            except ValueError:
+                # Not a UUID, so not a doc.
+                fail(index, status.HTTP_404_NOT_FOUND, "The doc was not found.")
+                continue
+
+            if pk in updates or pk in deletes:
+                fail(index, status.HTTP_400_BAD_REQUEST, "The doc is already changed by another operation in this batch.")
+                continue
+
+            if kind == 'update':
+                updates[pk] = (index, version, {**changes, 'modified': now})
+            else:
+                deletes[pk] = (index, version)
+
+        docs = EditorFile.objects.filter(author_id=user.pk)
+
+        with transaction.atomic():
+            created = docs.create_many(user.pk, creates.values())
+            written = docs.write_many({pk: (version, changes) for pk, (index, version, changes) in updates.items()})
+            deleted = set(docs.delete_many({pk: version for pk, (index, version) in deletes.items()}))
+
+        for index, doc in zip(creates, created):
+            results[index] = {"status": status.HTTP_201_CREATED, "doc": {"uid": str(doc.uid), "created": doc.created, "modified": doc.modified, "version": doc.version}}
+
+        for pk, version in written.items():
+            results[updates[pk][0]] = {"status": status.HTTP_200_OK, "doc": {"uid": str(pk), "modified": now, "version": version}}
+
+        for pk in deleted:
+            results[deletes[pk][0]] = {"status": status.HTTP_200_OK, "doc": {"uid": str(pk)}}
+
+        # Why the rest weren't changed, as write_failed, for all of them at once.
+        failed = {pk: index for pk, (index, *rest) in updates.items() if pk not in written}
+        failed.update((pk, index) for pk, (index, version) in deletes.items() if pk not in deleted)
+        current = {pk: rest for pk, *rest in EditorFile.objects.filter(pk__in=failed).values_list('pk', 'author_id', 'version', 'modified')} if failed else {}
+
+        for pk, index in failed.items():
+            if pk not in current:
+                fail(index, status.HTTP_404_NOT_FOUND, "The doc was not found.")
+            elif current[pk][0] != user.pk:
+                results[index] = {"status": status.HTTP_401_UNAUTHORIZED}
+            else:
+                results[index] = {"status": status.HTTP_409_CONFLICT, "error": "The doc has been changed since this version.", "doc": {"version": current[pk][1], "modified": current[pk][2]}}
+
+        return Response({"results": results}, status=status.HTTP_200_OK)
+
+
+class DocsExportView(APIView):
+    """
+    Handles requests for store/docs/export.
+    GET: Download all of the authenticated user's docs.
+    """
+
+    permission_classes = [IsAuthenticated]
+
+    def get(self, request, *args, **kwargs):
+        """
+        Stream the user's docs, newest first, as NDJSON: a line of JSON
+        for each, with its uid, title, body, created and modified times
+        and version. Docs are read a page at a time as the response is
+        sent, so memory use doesn't grow with the number of docs, under
+        WSGI or ASGI (see streaming_content).
+        """
+        user = request.user
+
+        docs = EditorFile.objects.filter(author_id=user.pk).only('uid', 'title', 'body', 'created', 'modified', 'version')
+
+        response = StreamingHttpResponse(streaming_content(request, self.export_lines(docs)), content_type='application/x-ndjson')
+        response['Content-Disposition'] = 'attachment; filename="docs.ndjson"'
+        response['Cache-Control'] = 'no-cache'
+        return response
+
+    def export_lines(self, docs):
+        """
+        The lines of the export, a page of docs (see documents.page) at a time.
+        """
+        cursor = None
+
+        while True:
+            page, cursor = documents.page(docs, documents.TRANSFER_BATCH_SIZE, cursor)
+            EditorFile.read_bodies(page)
+
+            yield b"".join(documents.export_line(doc) for doc in page)
+
+            if cursor is None:
+                return
+
+
+class DocsImportView(APIView):
+    """
+    Handles requests for store/docs/import.
+    POST: Create docs for the authenticated user from an export.
+    """
+
+    permission_classes = [IsAuthenticated]
+
+    def post(self, request, *args, **kwargs):
+        """
+        Create a doc for each line of an NDJSON request body, as from
+        store/docs/export. Only each line's title and body are used: the
+        docs are new, with their own uids.
+
+        The body is read, and docs created, a batch at a time, so memory
+        use doesn't grow with the size of the import. Lines which aren't
+        valid docs are skipped, and the first of them are listed in
+        "errors" by line number. Returns the number of docs "created",
+        and of lines "failed".
+        """
+        user = request.user
+
+        docs = EditorFile.objects.filter(author_id=user.pk)
+        serializer = FileCreateSerializer()
+        batch, created, failed, errors = [], 0, 0, []
+
+        # The raw body, not request.data, which would read all of it at once.
+        for number, line in enumerate(request.stream or (), start=1):
+            if not line.strip():
+                continue
+
+            try:
+                batch.append(serializer.run_validation(documents.parse_line(line)))
+            except (ValueError, serializers.ValidationError) as error:
+                failed += 1
+
+                if len(errors) < documents.MAX_IMPORT_ERRORS:
+                    detail = error.detail if isinstance(error, serializers.ValidationError) else str(error)
+                    errors.append({"line": number, "error": detail})
+
+                continue
+
+            if len(batch) == documents.TRANSFER_BATCH_SIZE:
+                created += len(docs.create_many(user.pk, batch))
+                batch = []
+
+        if batch:
+            created += len(docs.create_many(user.pk, batch))
+
+        return Response({"created": created, "failed": failed, "errors": errors}, status=status.HTTP_200_OK)
+
+
+class SearchDocsView(APIView):
+    """
+    Handles requests for store/docs/search.
+    GET: Search the authenticated user's docs.
+    """
+
+    permission_classes = [IsAuthenticated]
+
+    def get(self, request, *args, **kwargs):
+        """
+        Search the user's docs' titles and bodies for ?q, returning those
+        containing all its words, best first, with a snippet of each around
+        its first match (and the spans of matched words in it).
+
+        At most ?limit docs are returned (20 by default, up to 50).
+        """
+        user = request.user
+
+        query = request.query_params.get('q', '').strip()
+
+        if not query:
+            return Response({"error": "No search query given."}, status=status.HTTP_400_BAD_REQUEST)
+
+        try:
+            limit = int(request.query_params.get('limit', 20))
+        except ValueError:
+            limit = 0
+
+        if not 1 <= limit <= search.MAX_RESULTS:
+            return Response({"error": f"limit must be between 1 and {search.MAX_RESULTS}."}, status=status.HTTP_400_BAD_REQUEST)
+
+        docs = EditorFile.objects.search(user.pk, query, limit)
+        results = FileSummarySerializer(docs, many=True, fields=('uid', 'title', 'created', 'modified', 'version')).data
+
+        for result, doc in zip(results, docs):
+            result['rank'] = doc.rank
+            result['snippet'] = search.snippet(documents.body_text(doc.body), query)
+
+        return Response({"docs": results}, status=status.HTTP_200_OK)
+
+def not_modified(request, etag, last_modified=None):
+    """
+    A 304 Not Modified response if the request's If-None-Match (or
+    If-Modified-Since) shows the client's copy is current, otherwise None.
+    """
+    response = get_conditional_response(request, etag=etag, last_modified=last_modified and int(last_modified.timestamp()))
+
+    if response is not None:
+        response['ETag'] = etag
+
+    return response
+
+def is_version(version):
+    """
+    Check a doc version from a request is a positive integer.
+    """
+    return isinstance(version, int) and not isinstance(version, bool) and version > 0
+
 class DocRetrieveUpdateDestroyView(generics.RetrieveUpdateDestroyAPIView):
     """
     Handles requests for store/docs/:pk.
     GET: Retrieve the selected doc.
     PUT: Update the selected doc.
+    PATCH: Apply block operations to the selected doc's body.
     DELETE: Delete the selected doc.
     """
+
+    permission_classes = [IsAuthenticated]
     queryset = EditorFile.objects.all()
     serializer_class = FilePatchSerializer
 
+    def get_object(self):
+        try:
+            return super().get_object()
+        except ValidationError:
+            # Not a UUID, so not a doc.
+            raise NotFound()
+
     def get(self, request, *args, **kwargs):
         """
         Retrieve the selected doc.
+
+        With ?blocks=100-150, only those blocks of its body are returned
+        (first to last, inclusive), as "blocks", from index "start".
         """
-        user = decode_jwt_token(request)
-        
-        if user is None:
-            # Token authentication failed
-            return Response(status=status.HTTP_401_UNAUTHORIZED)
+        user = request.user
+
+        blocks = request.query_params.get('blocks')
+
+        if blocks is not None:
+            try:
+                start, stop = chunks.parse_range(blocks)
+            except ValueError as e:
+                return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+
+        if 'If-None-Match' in request.headers or 'If-Modified-Since' in request.headers:
+            # Check the client's copy is out of date before loading the body.
+            try:
+                current = EditorFile.objects.filter(pk=kwargs['pk']).values_list('uid', 'author_id', 'version', 'modified').first()
+            except ValidationError:
+                current = None
+
+            if current is None:
+                return Response({"error": "The doc was not found."}, status=404)
+
+            uid, author_id, version, modified = current
+
+            if author_id != user.pk:
+                return Response(status=status.HTTP_401_UNAUTHORIZED)
+
+            response = not_modified(request, documents.doc_etag(uid, version), modified)
+
+            if response is not None:
+                return response
 
         instance = self.get_object()
 
-        if instance.author != user:
+        if instance.author_id != user.pk:
             return Response(status=status.HTTP_401_UNAUTHORIZED)
 
         if instance is None:
             return Response({"error": "The doc was not found."}, status=404)
 
+        headers = {
+            'ETag': documents.doc_etag(instance.uid, instance.version),
+            'Last-Modified': http_date(instance.modified.timestamp()),
+        }
+
+        if blocks is not None:
+            if not instance.chunked and not isinstance(instance.body, list):
+                return Response({"error": "The doc's body isn't a list of blocks."}, status=status.HTTP_400_BAD_REQUEST)
+
+            doc = FileSummarySerializer(instance, fields=('uid', 'title', 'modified', 'version', 'block_count')).data
+            return Response({"doc": {**doc, "start": start, "blocks": instance.read_blocks(start, stop)}}, status=200, headers=headers)
+
         serializer = self.get_serializer(instance)
-        return Response({"doc": serializer.data}, status=200)
+        return Response({"doc": serializer.data}, status=200, headers=headers)
 
         
     def put(self, request, *args, **kwargs):
         """
         Update the selected doc.
+
+        If the doc data includes the "version" last read, the update is only
+        made if no other save has happened since, and conflicts (409) otherwise.
         """
-        user = decode_jwt_token(request)
-        
-        if user is None:
-            # Token authentication failed
-            return Response(status=status.HTTP_401_UNAUTHORIZED)
+        user = request.user
+
+        doc_data = request.data.get('doc')
+
+        serializer = self.get_serializer(data=doc_data, partial=True)
+
+        if not isinstance(doc_data, dict) or not serializer.is_valid():
+            return Response({"error": "The client did not provide the correct data, and the doc was not updated."}, status=400)
+
+        version = doc_data.get('version')
+
+        if version is not None and not is_version(version):
+            return Response({"error": "version must be a positive integer."}, status=400)
+
+        changes = {**serializer.validated_data, 'modified': timezone.now()}
+
+        # Checks ownership (and the version) as it writes.
+        try:
+            updated = EditorFile.objects.filter(pk=kwargs['pk'], author_id=user.pk).write(version, **changes)
+        except ValidationError:
+            # Not a UUID, so not a doc.
+            return Response({"error": "The doc was not found."}, status=status.HTTP_404_NOT_FOUND)
+
+        if not updated:
+            return self.write_failed(kwargs['pk'], user)
+
+        if version is None:
+            # An unconditional save, so read back the version it made.
+            version = EditorFile.objects.filter(pk=kwargs['pk']).values_list('version', flat=True).first()
+        else:
+            version += 1
+
+        return Response({"doc": {"modified": changes['modified'], "version": version}}, status=200, headers={
+            'ETag': documents.doc_etag(uuid.UUID(kwargs['pk']), version),
+        })
+
+    def patch(self, request, *args, **kwargs):
+        """
+        Apply block operations (see patching.py) to the selected doc's body.
+
+        Format:
+
+        "doc": {
+            "version": <version edited>,
+            "ops": [{"op": "insert", "index": 0, "block": {...}}, ...],
+            "title": "Optional new title"
+        }
+
+        The modified time of the version edited may be given as "base"
+        instead of its version. Conflicts (409) if the doc has been changed
+        since the version edited.
+        """
+        user = request.user
 
         instance = self.get_object()
 
-        if instance.author != user:
+        if instance.author_id != user.pk:
             return Response(status=status.HTTP_401_UNAUTHORIZED)
 
-        serializer = self.get_serializer(instance, data=request.data.get('doc'), partial=True)
+        doc_data = request.data.get('doc')
 
-        if not serializer.is_valid():
-            return Response({"error": "The client did not provide the correct data, and the doc was not updated."}, status=400)
+        if not isinstance(doc_data, dict):
+            return Response({"error": "No doc provided."}, status=status.HTTP_400_BAD_REQUEST)
 
-        instance = self.get_object()
+        if 'version' in doc_data:
+            if not is_version(doc_data['version']):
+                return Response({"error": "version must be a positive integer."}, status=status.HTTP_400_BAD_REQUEST)
 
-        if instance is None:
-            return Response({"error": "The doc was not found."}, status=404)
+            is_stale = doc_data['version'] != instance.version
+
+        else:
+            try:
+                base = parse_datetime(str(doc_data.get('base', '')))
+            except ValueError:
+                base = None
+
+            if base is None:
+                return Response({"error": "Either version or base must identify the version edited."}, status=status.HTTP_400_BAD_REQUEST)
+
+            is_stale = base != instance.modified
+
+        if is_stale:
+            return self.conflict(instance.version, instance.modified)
+
+        changes = {'modified': timezone.now()}
+
+        if 'title' in doc_data:
+            serializer = self.get_serializer(instance, data={'title': doc_data['title']}, partial=True)
+
+            if not serializer.is_valid():
+                return Response({"error": "The client did not provide the correct data, and the doc was not updated."}, status=status.HTTP_400_BAD_REQUEST)
+
+            changes['title'] = serializer.validated_data['title']
+
+        # Only write if no other save has got in since the doc was read.
+        try:
+            if instance.chunked:
+                # Rewrites only the chunks the operations touch.
+                written = instance.write_block_ops(doc_data.get('ops'), **changes)
+            else:
+                body = apply_block_ops(instance.body, doc_data.get('ops'))
+                written = EditorFile.objects.filter(pk=instance.pk).write(instance.version, doc_data['ops'], body=body, **changes)
+        except PatchError as e:
+            return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+
+        if not written:
+            return self.write_failed(instance.pk, user)
+
+        return Response({"doc": {"modified": changes['modified'], "version": instance.version + 1}}, status=status.HTTP_200_OK, headers={
+            'ETag': documents.doc_etag(instance.uid, instance.version + 1),
+        })
+
+    def write_failed(self, pk, user):
+        """
+        Response for a conditional write which updated nothing: the doc
+        doesn't exist, belongs to someone else, or is at another version.
+        """
+        current = EditorFile.objects.filter(pk=pk).values_list('author_id', 'version', 'modified').first()
+
+        if current is None:
+            return Response({"error": "The doc was not found."}, status=status.HTTP_404_NOT_FOUND)
+
+        author_id, version, modified = current
+
+        if author_id != user.pk:
+            return Response(status=status.HTTP_401_UNAUTHORIZED)
 
-        serializer.save()
-        return Response({"doc": {"modified": instance.modified}}, status=200)
+        return self.conflict(version, modified)
 
+    def conflict(self, version, modified):
+        return Response({"error": "The doc has been changed since this version.", "doc": {"version": version, "modified": modified}}, status=status.HTTP_409_CONFLICT)
 
     def delete(self, request, *args, **kwargs):
         """
         Delete the selected doc.
         """
-        user = decode_jwt_token(request)
-        
-        if user is None:
-            # Token authentication failed
-            return Response(status=status.HTTP_401_UNAUTHORIZED)
+        user = request.user
 
         instance = self.get_object()
 
-        if instance.author != user:
+        if instance.author_id != user.pk:
             return Response(status=status.HTTP_401_UNAUTHORIZED)
         
         instance.delete()
         return Response({"detail": "The doc was removed."}, status=200)
 
+def get_user_doc(pk, user, *fields):
+    """
+    The user's doc with the given pk, with only the given fields loaded,
+    or the error response if there isn't one.
+    """
+    try:
+        instance = EditorFile.objects.filter(pk=pk).only('pk', 'author', *fields).first()
+    except ValidationError:
+        # Not a UUID, so not a doc.
+        instance = None
+
+    if instance is None:
+        return Response({"error": "The doc was not found."}, status=status.HTTP_404_NOT_FOUND)
+
+    if instance.author_id != user.pk:
+        return Response(status=status.HTTP_401_UNAUTHORIZED)
+
+    return instance
+
+class DocRevisionsView(APIView):
+    """
+    Handles requests for store/docs/:pk/revisions.
+    GET: List the selected doc's revisions (see revisions.py), newest first.
+    """
+
+    permission_classes = [IsAuthenticated]
+
+    def get(self, request, *args, **kwargs):
+        """
+        List the selected doc's revisions, newest first.
+
+        At most ?limit revisions are returned (up to 100). If there are
+        more, "next" is the ?before to pass for the next page.
+        """
+        user = request.user
+
+        try:
+            limit = min(int(request.query_params.get('limit', documents.MAX_PAGE_SIZE)), documents.MAX_PAGE_SIZE)
+            before = request.query_params.get('before')
+            before = None if before is None else int(before)
+        except ValueError:
+            limit = 0
+
+        if limit < 1:
+            return Response({"error": "limit and before must be positive integers."}, status=status.HTTP_400_BAD_REQUEST)
+
+        instance = get_user_doc(kwargs['pk'], user)
+
+        if isinstance(instance, Response):
+            return instance
+
+        revisions = instance.revisions.order_by('-version')
+
+        if before is not None:
+            revisions = revisions.filter(version__lt=before)
+
+        revisions = list(revisions.values('version', 'created', 'title')[:limit + 1])
+        next_before = revisions[limit - 1]['version'] if len(revisions) > limit else None
+
+        return Response({"revisions": revisions[:limit], "next": next_before}, status=status.HTTP_200_OK)
+
+class DocRevisionView(APIView):
+    """
+    Handles requests for store/docs/:pk/revisions/:version.
+    GET: Retrieve the selected doc as it was at a revision.
+    """
+
+    permission_classes = [IsAuthenticated]
+
+    def get(self, request, *args, **kwargs):
+        """
+        Retrieve the selected doc's title and body as they were at a revision.
+        """
+        user = request.user
+
+        instance = get_user_doc(kwargs['pk'], user)
+
+        if isinstance(instance, Response):
+            return instance
+
+        revision = instance.revisions.filter(version=kwargs['version']).values('version', 'created', 'title').first()
+
+        if revision is None:
+            return Response({"error": "The revision was not found."}, status=status.HTTP_404_NOT_FOUND)
+
+        revision['body'] = EditorFileRevision.objects.body_at(instance.pk, kwargs['version'])
+
+        return Response({"revision": revision}, status=status.HTTP_200_OK)
+
+class DocRevisionRestoreView(APIView):
+    """
+    Handles requests for store/docs/:pk/revisions/:version/restore.
+    POST: Save a revision's title and body as the selected doc's latest.
+    """
+
+    permission_classes = [IsAuthenticated]
+
+    def post(self, request, *args, **kwargs):
+        """
+        Save a revision's title and body as the selected doc's latest,
+        recorded as a new revision, so the restore can itself be undone.
+
+        If the doc data includes the "version" last read, the doc is only
+        restored if no other save has happened since, and conflicts (409)
+        otherwise:
+
+        "doc": {"version": <version last read>}
+        """
+        user = request.user
+
+        doc_data = request.data.get('doc', {})
+        version = doc_data.get('version') if isinstance(doc_data, dict) else None
+
+        if version is not None and not is_version(version):
+            return Response({"error": "version must be a positive integer."}, status=status.HTTP_400_BAD_REQUEST)
+
+        instance = get_user_doc(kwargs['pk'], user)
+
+        if isinstance(instance, Response):
+            return instance
+
+        title = instance.revisions.filter(version=kwargs['version']).values_list('title', flat=True).first()
+
+        if title is None:
+            return Response({"error": "The revision was not found."}, status=status.HTTP_404_NOT_FOUND)
+
+        body = EditorFileRevision.objects.body_at(instance.pk, kwargs['version'])
+        changes = {'title': title, 'body': body, 'modified': timezone.now()}
+
+        if not EditorFile.objects.filter(pk=instance.pk).write(version, **changes):
+            current_version, modified = EditorFile.objects.filter(pk=instance.pk).values_list('version', 'modified').get()
+            return Response({"error": "The doc has been changed since this version.", "doc": {"version": current_version, "modified": modified}}, status=status.HTTP_409_CONFLICT)
+
+        if version is None:
+            # An unconditional save, so read back the version it made.
+            version = EditorFile.objects.filter(pk=instance.pk).values_list('version', flat=True).get()
+        else:
+            version += 1
+
+        return Response({"doc": {"modified": changes['modified'], "version": version, "title": title}}, status=status.HTTP_200_OK, headers={
+            'ETag': documents.doc_etag(instance.uid, version),
+        })
+
+class RelatedDocsView(APIView):
+    """
+    Handles requests for store/docs/:pk/related.
+    GET: Find the authenticated user's docs most like the selected doc.
+    """
+
+    permission_classes = [IsAuthenticated]
+
+    def get(self, request, *args, **kwargs):
+        """
+        Find the user's docs most like the selected doc (see embeddings.py),
+        best first, each with its score, from 0 to 1.
+
+        At most ?limit docs are returned (10 by default, up to 50).
+        """
+        user = request.user
+
+        try:
+            limit = int(request.query_params.get('limit', 10))
+        except ValueError:
+            limit = 0
+
+        if not 1 <= limit <= search.MAX_RESULTS:
+            return Response({"error": f"limit must be between 1 and {search.MAX_RESULTS}."}, status=status.HTTP_400_BAD_REQUEST)
+
+        instance = get_user_doc(kwargs['pk'], user)
+
+        if isinstance(instance, Response):
+            return instance
+
+        docs = EditorFile.objects.related(user.pk, instance.pk, limit)
+        results = FileSummarySerializer(docs, many=True, fields=('uid', 'title', 'created', 'modified', 'version')).data
+
+        for result, doc in zip(results, docs):
+            result['score'] = round(doc.score, 4)
+
+        return Response({"docs": results}, status=status.HTTP_200_OK)
+
 class PromptView(APIView):
+    permission_classes = [IsAuthenticated]
+
     def get(self, request):
-        user = get_user_from_jwt(request)
-        
-        if user is None:
-            # Token authentication failed
-            return Response(status=status.HTTP_401_UNAUTHORIZED)
+        user = request.user
                 
-        prompts = Prompt.objects.filter(user=user)
+        prompts = Prompt.objects.filter(user_id=user.pk)
         serializer = PromptSerializer(prompts, many=True)
         return Response(serializer.data)
 
     def post(self, request):
-        user = get_user_from_jwt(request)
-
-        if user is None:
-            # Token authentication failed
-            return Response(status=status.HTTP_401_UNAUTHORIZED)
+        user = request.user
 
         serializer = PromptSerializer(data=request.data)
         
@@ -492,217 +1180,269 @@ class PromptView(APIView):
         return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
 class PromptDetailView(APIView):
-    def get(self, request, pk):
-        user = get_user_from_jwt(request)
+    permission_classes = [IsAuthenticated]
 
-        if user is None:
-            return Response(status=status.HTTP_401_UNAUTHORIZED)
+    def get(self, request, pk):
+        user = request.user
 
         try:
-            prompt = Prompt.objects.get(pk=pk, user=user)
+            prompt = Prompt.objects.get(pk=pk, user_id=user.pk)
             serializer = PromptSerializer(prompt)
             return Response(serializer.data)
-        except Prompt.DoesNotExist:
+        except (Prompt.DoesNotExist, ValidationError):
             return Response(status=status.HTTP_404_NOT_FOUND)
 
     def put(self, request, pk):
-        user = get_user_from_jwt(request)
-
-        if user is None:
-            return Response(status=status.HTTP_401_UNAUTHORIZED)
+        user = request.user
 
         try:
-            prompt = Prompt.objects.get(pk=pk, user=user)
+            prompt = Prompt.objects.get(pk=pk, user_id=user.pk)
             serializer = PromptSerializer(prompt, data=request.data)
             if serializer.is_valid():
                 serializer.save()
                 return Response(serializer.data)
             return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
-        except Prompt.DoesNotExist:
+        except (Prompt.DoesNotExist, ValidationError):
             return Response(status=status.HTTP_404_NOT_FOUND)
 
     def delete(self, request, pk):
-        user = get_user_from_jwt(request)
-
-        if user is None:
-            return Response(status=status.HTTP_401_UNAUTHORIZED)
+        user = request.user
 
         try:
-            prompt = Prompt.objects.get(pk=pk, user=user)
+            prompt = Prompt.objects.get(pk=pk, user_id=user.pk)
             prompt.delete()
             return Response(status=status.HTTP_204_NO_CONTENT)
-        except Prompt.DoesNotExist:
+        except (Prompt.DoesNotExist, ValidationError):
             return Response(status=status.HTTP_404_NOT_FOUND)
 
 # Performs LLM inference on text provided.
 class GenerateTextView(APIView):
-    def __init__(self):
+    permission_classes = [IsAuthenticated]
+    throttle_classes = [TokenBucketThrottle]
+    throttle_scope = 'generate'
+
+    def post(self, request):
         """
-        ChatGPT 3.5 Turbo pricing details
+        Handles endpoint for /generate/text : POST
+        requests a generative model to generate text, given a prompt.
         """
-        # This number of tokens are permitted
-        # in the combined prompt and response.
-        self.total_tokens = 4096
 
-        # Cents per million tokens.
-        self.input_pricing = 50
-        self.output_pricing = 150 
+        user = request.user
 
-        # Convenience variable for a million.
-        self.million = 1000000
+        # Held until the generation ends, including its stream.
+        slot = ratelimit.acquire('generate', f'user:{user.pk}')
 
-        # Download Tiktoken encoding from web.
-        self.encoding = tiktoken.encoding_for_model("gpt-3.5-turbo")
+        if slot is None:
+            raise Throttled(settings.CONCURRENCY_RETRY_AFTER, "Too many generations in progress.")
 
-    def estimate_tokens(self, prompt):
-        """
-        Use Tiktoken to estimate tokens.
-        """
+        try:
+            response = self.generate(request, user, slot)
+        except BaseException:
+            slot.release()
+            raise
 
-        # Calculation given at URL below. + 7 is for 
-        # boilerplate added to every prompt by ChatGPT API.
-        #
-        # https://cookbook.openai.com/examples/how_to_count_tokens_with_tiktoken
-        # 
-        return len(self.encoding.encode(prompt)) + 7
+        if not response.streaming:
+            slot.release()
 
-    def prompt_cost(self, prompt):
-        """
-         Estimate the cost of the prompt using Tiktoken.
-        """
-        # Pricing is given in cents per million tokens.
-        return self.estimate_tokens(prompt) * self.input_pricing / self.million
+        return response
+
+    def generate(self, request, user, slot):
+        try:
+            # Price against credits not already reserved by other generations,
+            # and reserve the maximum cost of this one.
+            generation = Generation(request.data, ledger.from_micro(ledger.get_available(user)))
+            generation.reserve(user)
+        except GenerationError as e:
+            return Response({"error": e.error}, status=e.status)
 
-    def max_cost(self, prompt):
+        client = get_client()
+
+        try:
+            completion = client.chat.completions.create(**generation.completion_options())
+        except Exception:
+            # Nothing was generated, so nothing to pay for.
+            generation.release()
+            raise
+
+        if generation.is_streaming:
+            response = StreamingHttpResponse(streaming_content(request, self.stream_completion(completion, generation, slot)), content_type='text/event-stream')
+
+            # Stop proxies and the browser from buffering or caching events.
+            response['Cache-Control'] = 'no-cache'
+            response['X-Accel-Buffering'] = 'no'
+
+            return response
+
+        answer = completion.choices[0].message.content
+
+        # Subtract cost of LLM call from user's credits, and release the rest of the hold.
+        cost = generation.quote.final_micro_cost(completion.usage)
+        generation.settle(cost)
+
+        return Response(generation.result(answer, cost), status=status.HTTP_200_OK)
+
+    def stream_completion(self, stream, generation, slot):
         """
-        Given a prompt, estimate the maximum cost of the LLM call.
+        Relay a streamed completion to the client as Server-Sent Events:
+        a "token" event per chunk of text, then a "done" event with the cost,
+        or, if the model fails partway, an "error" event with the cost of
+        what was generated instead.
+
+        The user is charged once the stream ends, or when the client
+        disconnects (which closes this generator), for the tokens generated
+        up to that point, and the slot is released.
         """
+        tally = StreamTally(generation)
+        error = None
 
-        # Estimate the cost of the prompt using Tiktoken.
-        prompt_tokens = self.estimate_tokens(prompt)
-        prompt_cost = self.prompt_cost(prompt)
+        try:
+            for chunk in stream:
+                text = tally.add(chunk)
 
-        # Estimate the cost of the response, assuming it will be of maximum length.
-        max_response_tokens = self.total_tokens - prompt_tokens
+                if text:
+                    yield sse_event("token", {"content": text})
 
-        # Pricing is given in cents per million tokens.
-        max_response_cost = ceil(self.output_pricing * max_response_tokens / self.million)
+        except APIError as e:
+            error = str(e)
 
-        return prompt_cost + max_response_cost
+        finally:
+            # Stop generating (and paying for) tokens nobody will read.
+            stream.close()
 
-    def max_response_length(self, prompt, credits):
-        """
-        Given a prompt and the user's remaining credits, calculate
-        the maximum length the response can be, in tokens.
-        """      
+            cost = tally.cost()
+            generation.settle(cost)
+            slot.release()
 
-        remaining_credits = credits - self.prompt_cost(prompt)
+        if error is None:
+            yield sse_event("done", tally.result(cost))
+        else:
+            yield sse_event("error", {"error": error, "cost": ledger.from_micro(cost)})
 
-        return floor(remaining_credits * (self.million / self.output_pricing))
 
-    def cost(self, usage):
-        """
-        Given the usage field of the ChatGPT Completions
-        response JSON, calculates the cost of the API call. 
-        
-        Format:
+def throttled(wait, detail):
+    """
+    A 429, as DRF's Throttled gives, for views outside DRF.
+    """
+    wait = math.ceil(wait)
+    return JsonResponse({"detail": f"{detail} Expected available in {wait} seconds."},
+                        status=status.HTTP_429_TOO_MANY_REQUESTS,
+                        headers={'Retry-After': str(wait)})
 
-        "usage": {
-            "completion_tokens": 17,
-            "prompt_tokens": 57,
-            "total_tokens": 74
-        }
-        """
-        
-        prompt_cost = usage.prompt_tokens * self.input_pricing
-        completion_cost = usage.completion_tokens * self.output_pricing
 
-        # Pricing is per million tokens.
-        return (prompt_cost + completion_cost) / self.million
+@method_decorator(csrf_exempt, name='dispatch')
+class AsyncGenerateTextView(View):
+    """
+    Handles requests for generate/text/async.
 
-    def post(self, request):
-        """
-        Handles endpoint for /generate/text : POST
-        requests a generative model to generate text, given a prompt.
-        """
+    The same as /generate/text, but the upstream call doesn't hold a thread,
+    so under an ASGI server (see Procfile) one worker can serve many
+    concurrent generations over a shared, pooled connection to OpenAI.
+    """
+
+    async def post(self, request):
+
+        user = await sync_to_async(get_user)(request)
 
-        user = get_user_from_jwt(request)
-        
         if user is None:
             # Token authentication failed
-            return Response(status=status.HTTP_401_UNAUTHORIZED)
-        
-        if user.credits <= 0:
-            return Response({"error": "You have no remaining credits. Please add some to your account."}, status=status.HTTP_402_PAYMENT_REQUIRED)
-        
-        # Extract data from the request
-        data = request.data
-        prompt_name = data.get('prompt', {}).get('name', '')
-        messages = data.get('prompt', {}).get('messages', [])
-        prompt = messages[0].get('content', '')
-        is_scaling_output = True if 'scale' in data else False
-
-        # Validate input.
-        if not messages:
-            return Response({"error": "Messages cannot be empty."}, status=status.HTTP_400_BAD_REQUEST)
-
-        if "role" not in messages[0] or "content" not in messages[0]:
-            return Response({"error": "Messages in wrong format."}, status=status.HTTP_400_BAD_REQUEST)
-
-        if self.prompt_cost(prompt) > user.credits:
-            return Response({"error": "The cost of your prompt exceeds your remaining credits."}, status=status.HTTP_402_PAYMENT_REQUIRED)
-
-        # If the maximum cost of the LLM is too high, and the user has 
-        # not opted to scale down the response output, end the payment.
-        if self.max_cost(prompt) > user.credits and not is_scaling_output:
-            return Response({"error": "Insufficient credits for the response. Please add credits or select 'Scale Down Output'."}, status=status.HTTP_402_PAYMENT_REQUIRED)
-
-        # If scaling down output is selected and necessary, do so.
-        if self.max_cost(prompt) > user.credits and is_scaling_output:
-            max_tokens = self.max_response_length(prompt, user.credits)
-        else:
-            max_tokens = self.total_tokens
-
-        client = OpenAI()
-
-        completion = client.chat.completions.create(
-            model="gpt-3.5-turbo",
-            messages=messages,
-            temperature=0.7,
-            top_p=1,
-            frequency_penalty=0,
-            presence_penalty=0,
-            max_tokens=max_tokens,
-            stream=False, # should use instead of loading icon
-            n=1
-        )
+            return JsonResponse({}, status=status.HTTP_401_UNAUTHORIZED)
+
+        # As TokenBucketThrottle and GenerateTextView.post.
+        client = f'user:{user.pk}'
+        wait = await ratelimit.atake('generate', client)
+
+        if wait:
+            return throttled(wait, "Request was throttled.")
+
+        slot = await ratelimit.aacquire('generate', client)
+
+        if slot is None:
+            return throttled(settings.CONCURRENCY_RETRY_AFTER, "Too many generations in progress.")
+
+        try:
+            response = await self.generate(request, user, slot)
+        except BaseException:
+            await slot.arelease()
+            raise
+
+        if not response.streaming:
+            await slot.arelease()
+
+        return response
+
+    async def generate(self, request, user, slot):
+        try:
+            data = json.loads(request.body)
+        except ValueError:
+            return JsonResponse({"error": "Invalid JSON."}, status=status.HTTP_400_BAD_REQUEST)
+
+        # Reading the balance is a query.
+        credits = ledger.from_micro(await sync_to_async(ledger.get_available)(user))
+
+        try:
+            generation = Generation(data, credits)
+            await sync_to_async(generation.reserve)(user)
+        except GenerationError as e:
+            return JsonResponse({"error": e.error}, status=e.status)
+
+        client = get_async_client()
+
+        try:
+            completion = await client.chat.completions.create(**generation.completion_options())
+        except BaseException:
+            # Including cancellation, if the client disconnected.
+            await sync_to_async(generation.release)()
+            raise
+
+        if generation.is_streaming:
+            response = StreamingHttpResponse(self.stream_completion(completion, generation, slot), content_type='text/event-stream')
+            response['Cache-Control'] = 'no-cache'
+            response['X-Accel-Buffering'] = 'no'
+
+            return response
 
         answer = completion.choices[0].message.content
 
-        # Subtract cost of LLM call from user's credits.
-        cost = self.cost(completion.usage)
-        user.credits -= cost
-        user.save()
+        cost = generation.quote.final_micro_cost(completion.usage)
+        await sync_to_async(generation.settle)(cost)
 
-        response = {
-            "detail": "Text generated successfully",
-            "prompt": {
-                "name": prompt_name,
-                "messages": [
-                    {
-                        "role": "user",
-                        "content": answer
-                    }
-                ]
-            },
-            "cost": cost
-        }
+        return JsonResponse(generation.result(answer, cost), status=status.HTTP_200_OK)
+
+    async def stream_completion(self, stream, generation, slot):
+        """
+        Async version of GenerateTextView.stream_completion. A client
+        disconnect cancels this generator, and it is charged (and the slot
+        released) in the same way.
+        """
+        tally = StreamTally(generation)
+        error = None
+
+        try:
+            async for chunk in stream:
+                text = tally.add(chunk)
+
+                if text:
+                    yield sse_event("token", {"content": text})
+
+        except APIError as e:
+            error = str(e)
+
+        finally:
+            await stream.close()
+
+            cost = tally.cost()
+            await sync_to_async(generation.settle)(cost)
+            await slot.arelease()
+
+        if error is None:
+            yield sse_event("done", tally.result(cost))
+        else:
+            yield sse_event("error", {"error": error, "cost": ledger.from_micro(cost)})
 
-        return Response(response, status=status.HTTP_200_OK)
-    
 stripe.api_key = os.getenv("STRIPE_API_KEY")
 
 class UserCreditsView(APIView):
+    permission_classes = [IsAuthenticatedWithError]
 
     def __init__(self):
         # Key on our Stripe account for user to add their chosen amount of LLM credits.
@@ -713,22 +1453,15 @@ class UserCreditsView(APIView):
     """
     def get(self, request):
 
-        user = get_user_from_jwt(request)
-        
-        if user is None:
-            # Token authentication failed
-            return Response({"error": "Unauthorized"}, status=401)
-        
-        return Response({"credits": user.credits}, status=status.HTTP_200_OK)
+        # From the user's CreditAccount, without loading the user.
+        credits = ledger.from_micro(ledger.get_balance(request.user))
 
+        return Response({"credits": credits}, status=status.HTTP_200_OK)
 
-    def post(self, request):
 
-        user = get_user_from_jwt(request)
+    def post(self, request):
 
-        if user is None:
-            # Token authentication failed
-            return Response({"error": "Unauthorized"}, status=401)
+        user = request.user
         
         final_url = "https://" + site_domain + '/credits?session_id={CHECKOUT_SESSION_ID}'
     
@@ -769,8 +1502,7 @@ class OrderFulfillmentWebhookView(APIView):
 
         credits = purchase["amount_total"]
 
-        user.credits += credits
-        user.save()
+        ledger.credit(user, ledger.to_micro(credits), reference=session.get("id", ""))
         return credits
 
     @csrf_exempt
@@ -807,13 +1539,11 @@ class OrderFulfillmentWebhookView(APIView):
 
 
 class CreditsSessionIDView(APIView):
-    def get(self, request, pk):
+    permission_classes = [IsAuthenticatedWithError]
 
-        user = get_user_from_jwt(request)
+    def get(self, request, pk):
 
-        if user is None:
-            # Token authentication failed - either invalid JWT.
-            return Response({"error": "Unauthorized"}, status=401)
+        user = request.user
 
         try:
             session = stripe.checkout.Session.retrieve(pk)